@@ -1,7 +1,6 @@
 import tkinter as tk
 from tkinter import messagebox, simpledialog
 import socket
-import json
 import threading
 from typing import Dict, Optional
 import winsound
@@ -9,6 +8,14 @@ import time
 from PIL import Image, ImageTk
 import math
 
+from CaroProtocol import CODECS, JSON_CODEC, RECV_SIZE, FrameDecoder, decode_message, encode_message
+
+GAME_LIST_PAGE_SIZE = 8  # Số game mỗi trang trong dialog tham gia
+DEFAULT_BOARD_SIZE = 10
+BOARD_SIZES = (10, 15, 19)  # Cỡ bàn cho phép chọn khi tạo game (giao diện chỉ vẽ được bàn có giới hạn)
+BOT_LEVELS = ('easy', 'medium', 'hard')
+RECONNECT_ATTEMPTS = 5  # Số lần thử kết nối lại khi mất mạng giữa ván (server giữ chỗ 30 giây)
+
 class TicTacToeClient:
     def __init__(self, root):
         self.root = root
@@ -30,8 +37,14 @@ class TicTacToeClient:
         self.game_id: Optional[int] = None
         self.player_symbol: Optional[str] = None
         self.player_name: str = ""
-        self.board = [''] * 100
+        self.board_size = DEFAULT_BOARD_SIZE
+        self.board = [''] * (self.board_size * self.board_size)
+        self.seq = 0  # Số thứ tự cập nhật cuối cùng đã áp dụng
+        self.resync_pending = False
+        self.session_token: Optional[str] = None  # Mã phiên server cấp để quay lại ván (resume)
+        self.codec = JSON_CODEC  # Đổi sang codec server chọn khi nhận welcome
         self.current_turn = 1
+        self.clock: Optional[list] = None  # Thời gian còn lại [X, O] (mili giây) nếu ván có time control
         self.game_active = False
         self.opponent_name: str = ""
         self.player1_name: str = ""
@@ -233,41 +246,11 @@ class TicTacToeClient:
         board_frame.pack(padx=10, pady=10)
         
         # Inner board frame với kích thước cố định
-        inner_board = tk.Frame(board_frame, bg='#e0e0e0')
-        inner_board.pack(padx=10, pady=10)
+        self.inner_board = tk.Frame(board_frame, bg='#e0e0e0')
+        self.inner_board.pack(padx=10, pady=10)
         
         self.buttons = []
-        # Kích thước cố định cho các nút để không bị thay đổi khi click
-        button_font = ("Segoe UI", 10, "bold")
-        button_width = 3
-        button_height = 1
-        
-        for i in range(100):
-            btn = tk.Button(
-                inner_board,
-                text='',
-                font=button_font,
-                width=button_width,
-                height=button_height,
-                bg='#ffffff',
-                fg='#333333',
-                activebackground='#f0f2f5',
-                activeforeground='#000000',
-                relief=tk.RAISED,
-                cursor="hand2",
-                command=lambda pos=i: self.on_button_click(pos),
-                bd=1,
-                highlightthickness=0,
-                padx=2,
-                pady=2
-            )
-            btn.grid(row=i//10, column=i%10, padx=1, pady=1, sticky='nsew')
-            self.buttons.append(btn)
-        
-        # Cấu hình grid để các cột và hàng có kích thước đồng đều - tăng kích thước một chút
-        for i in range(10):
-            inner_board.grid_columnconfigure(i, weight=1, minsize=38)
-            inner_board.grid_rowconfigure(i, weight=1, minsize=38)
+        self.build_board(self.board_size)
         
         control_frame = tk.Frame(main_frame, bg=self.bg_color)
         control_frame.pack(fill=tk.X, pady=15)
@@ -290,6 +273,48 @@ class TicTacToeClient:
         )
         self.create_btn.pack(side=tk.LEFT, padx=5)
         
+        # Cỡ bàn của game sắp tạo
+        self.new_board_size = tk.IntVar(value=DEFAULT_BOARD_SIZE)
+        size_menu = tk.OptionMenu(btn_frame, self.new_board_size, *BOARD_SIZES)
+        size_menu.config(font=("Segoe UI", 10), relief=tk.FLAT, cursor="hand2")
+        size_menu.pack(side=tk.LEFT, padx=5)
+        
+        self.bot_btn = tk.Button(
+            btn_frame,
+            text="🤖 Chơi Với Máy",
+            font=("Segoe UI", 11, "bold"),
+            bg=self.primary_btn,
+            fg='white',
+            padx=20,
+            pady=10,
+            command=lambda: self.create_game(self.bot_level.get()),
+            relief=tk.FLAT,
+            cursor="hand2",
+            activebackground=self.primary_hover
+        )
+        self.bot_btn.pack(side=tk.LEFT, padx=5)
+        
+        # Cấp độ của máy
+        self.bot_level = tk.StringVar(value='medium')
+        level_menu = tk.OptionMenu(btn_frame, self.bot_level, *BOT_LEVELS)
+        level_menu.config(font=("Segoe UI", 10), relief=tk.FLAT, cursor="hand2")
+        level_menu.pack(side=tk.LEFT, padx=5)
+        
+        self.match_btn = tk.Button(
+            btn_frame,
+            text="🎯 Ghép Trận Nhanh",
+            font=("Segoe UI", 11, "bold"),
+            bg=self.secondary_btn,
+            fg='white',
+            padx=20,
+            pady=10,
+            command=self.quick_match,
+            relief=tk.FLAT,
+            cursor="hand2",
+            activebackground=self.secondary_hover
+        )
+        self.match_btn.pack(side=tk.LEFT, padx=5)
+        
         self.join_btn = tk.Button(
             btn_frame,
             text="⚡ Tham Gia Game",
@@ -336,6 +361,63 @@ class TicTacToeClient:
         )
         self.info_label.pack(fill=tk.X)
     
+    def build_board(self, size: int):
+        """Vẽ lưới size x size nút cho bàn cờ"""
+        inner_board = self.inner_board
+        for btn in self.buttons:
+            btn.destroy()
+        self.buttons = []
+        # Kích thước cố định cho các nút để không bị thay đổi khi click
+        button_font = ("Segoe UI", 10, "bold")
+        button_width = 3
+        button_height = 1
+        
+        for i in range(size * size):
+            btn = tk.Button(
+                inner_board,
+                text='',
+                font=button_font,
+                width=button_width,
+                height=button_height,
+                bg='#ffffff',
+                fg='#333333',
+                activebackground='#f0f2f5',
+                activeforeground='#000000',
+                relief=tk.RAISED,
+                cursor="hand2",
+                command=lambda pos=i: self.on_button_click(pos),
+                bd=1,
+                highlightthickness=0,
+                padx=2,
+                pady=2
+            )
+            btn.grid(row=i // size, column=i % size, padx=1, pady=1, sticky='nsew')
+            self.buttons.append(btn)
+        
+        # Cấu hình grid để các cột và hàng có kích thước đồng đều; bàn lớn dùng ô nhỏ hơn
+        # (các cột/hàng thừa của bàn lớn hơn vẽ trước đó thu về 0)
+        cell_size = max(24, 380 // size)
+        for i in range(max(size, *BOARD_SIZES)):
+            inner_board.grid_columnconfigure(i, weight=int(i < size), minsize=cell_size if i < size else 0)
+            inner_board.grid_rowconfigure(i, weight=int(i < size), minsize=cell_size if i < size else 0)
+    
+    def set_board_size(self, size: int):
+        """Đổi cỡ bàn (vẽ lại lưới nút nếu khác cỡ hiện tại) và xóa bàn cờ"""
+        if size != self.board_size:
+            self.board_size = size
+            self.build_board(size)
+        self.board = [''] * (size * size)
+    
+    def board_from_message(self, message: Dict) -> list:
+        """Bàn cờ trong tin nhắn: 'board' đầy đủ, hoặc 'stones' (vị trí quân X/O) với bàn lớn"""
+        if 'board' in message:
+            return message['board']
+        board = [''] * (self.board_size * self.board_size)
+        for symbol, positions in message.get('stones', {}).items():
+            for position in positions:
+                board[position] = symbol
+        return board
+    
     def connect_to_server(self):
         """Kết nối đến server"""
         try:
@@ -347,6 +429,9 @@ class TicTacToeClient:
             
             receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
             receive_thread.start()
+            
+            # Xin chế độ delta (server chỉ gửi nước đi mới) và codec nhị phân
+            self.send_message({'action': 'hello', 'features': ['delta', 'heartbeat'], 'codecs': ['binary', 'json']})
         
         except Exception as e:
             self.status_label.config(text="✗ Lỗi kết nối", fg='#ffcccc')
@@ -377,27 +462,52 @@ class TicTacToeClient:
         btn.config(relief=tk.SUNKEN, bd=1)
         self.root.after(100, lambda: btn.config(relief=tk.RAISED, bd=1))
     
-    def create_game(self):
-        """Tạo game mới"""
+    def create_game(self, bot_level: Optional[str] = None):
+        """Tạo game mới; có bot_level thì chơi ngay với máy"""
         if not self.socket:
             messagebox.showerror("Lỗi", "Chưa kết nối đến server")
             return
         
         try:
             message = {'action': 'create_game', 'player_name': self.player_name}
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            board_size = self.new_board_size.get()
+            if board_size != DEFAULT_BOARD_SIZE:
+                message['board_size'] = board_size
+            if bot_level is not None:
+                message['opponent'] = 'bot'
+                message['level'] = bot_level
+            self.send_message(message)
         except Exception as e:
             messagebox.showerror("Lỗi", f"Lỗi tạo game: {e}")
     
+    def quick_match(self):
+        """Nhờ server ghép với một người chơi có rating gần mình"""
+        if not self.socket:
+            messagebox.showerror("Lỗi", "Chưa kết nối đến server")
+            return
+        
+        try:
+            message = {'action': 'quick_match', 'player_name': self.player_name}
+            board_size = self.new_board_size.get()
+            if board_size != DEFAULT_BOARD_SIZE:
+                message['board_size'] = board_size
+            self.send_message(message)
+        except Exception as e:
+            messagebox.showerror("Lỗi", f"Lỗi ghép trận: {e}")
+    
     def show_join_dialog(self):
         """Hiển thị dialog tham gia game"""
         if not self.socket:
             messagebox.showerror("Lỗi", "Chưa kết nối đến server")
             return
         
+        self.request_game_list(0)
+    
+    def request_game_list(self, offset: int):
+        """Xin một trang danh sách game đang chờ"""
         try:
-            message = {'action': 'list_games'}
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            message = {'action': 'list_games', 'offset': offset, 'limit': GAME_LIST_PAGE_SIZE}
+            self.send_message(message)
         except Exception as e:
             messagebox.showerror("Lỗi", f"Lỗi lấy danh sách game: {e}")
     
@@ -409,7 +519,7 @@ class TicTacToeClient:
         
         try:
             message = {'action': 'join_game', 'game_id': game_id, 'player_name': self.player_name}
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            self.send_message(message)
         except Exception as e:
             messagebox.showerror("Lỗi", f"Lỗi tham gia game: {e}")
     
@@ -431,39 +541,106 @@ class TicTacToeClient:
                 'game_id': self.game_id,
                 'position': position
             }
-            self.socket.send(json.dumps(message).encode('utf-8'))
+            self.send_message(message)
         except Exception as e:
             messagebox.showerror("Lỗi", f"Lỗi gửi nước đi: {e}")
     
     def receive_messages(self):
-        """Nhận tin nhắn từ server"""
+        """Nhận tin nhắn từ server; mất kết nối giữa ván thì kết nối lại và quay về ván cũ"""
+        while True:
+            self.read_until_closed()
+            if self.is_closing or not self.game_active or not self.session_token or not self.reconnect():
+                break
+    
+    def read_until_closed(self):
+        """Đọc và xử lý tin nhắn cho đến khi kết nối hiện tại đóng"""
+        decoder = FrameDecoder()
         while True:
             try:
-                data = self.socket.recv(1024).decode('utf-8')
+                data = self.socket.recv(RECV_SIZE)
                 if not data:
                     break
                 
-                message = json.loads(data)
-                self.handle_message(message)
+                # Xử lý mọi tin nhắn đã đủ khung, phần còn thiếu chờ lần recv sau
+                for frame in decoder.feed(data):
+                    self.handle_message(decode_message(frame))
             
             except Exception as e:
                 print(f"Lỗi nhận tin nhắn: {e}")
                 break
     
+    def reconnect(self) -> bool:
+        """Mở kết nối mới và xin server gắn lại vào ván (resume) từ seq cuối đã áp dụng"""
+        self.update_info("⚠️ Mất kết nối, đang kết nối lại...")
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(min(0.5 * 2 ** attempt, 5))
+            try:
+                sock = socket.create_connection(('localhost', 8888), timeout=5)
+            except OSError:
+                continue
+            sock.settimeout(None)
+            self.socket = sock
+            self.codec = JSON_CODEC
+            self.resync_pending = False
+            try:
+                self.send_message({'action': 'hello', 'features': ['delta', 'heartbeat'], 'codecs': ['binary', 'json']})
+                self.send_message({'action': 'resume', 'game_id': self.game_id, 'token': self.session_token,
+                                   'last_seq': self.seq})
+            except OSError:
+                continue
+            return True
+        
+        self.game_active = False
+        self.status_label.config(text="✗ Mất kết nối", fg='#ffcccc')
+        self.update_info("Không kết nối lại được với server.")
+        return False
+    
+    def send_message(self, message: Dict):
+        """Gửi một tin nhắn đã đóng khung, mã hóa theo codec đã thỏa thuận"""
+        self.socket.sendall(encode_message(message, self.codec))
+    
+    def request_resync(self):
+        """Xin server gửi lại toàn bộ bàn cờ"""
+        if self.resync_pending:
+            return
+        
+        self.resync_pending = True
+        try:
+            self.send_message({'action': 'resync', 'game_id': self.game_id})
+        except Exception as e:
+            print(f"Lỗi gửi resync: {e}")
+    
     def handle_message(self, message: Dict):
         """Xử lý tin nhắn từ server"""
         action = message.get('action')
         
-        if action == 'game_created':
+        if action == 'welcome':
+            self.codec = CODECS.get(message.get('codec'), JSON_CODEC)
+        
+        elif action == 'ping':
+            self.send_message({'action': 'pong'})
+        
+        elif action == 'game_created':
             self.game_id = message.get('game_id')
             self.player_symbol = message.get('player_symbol')
+            self.session_token = message.get('session_token')
+            self.set_board_size(message.get('board_size', DEFAULT_BOARD_SIZE))
+            self.update_board()
             self.update_info(f"Game {self.game_id} được tạo. Bạn là {self.player_symbol}. Chờ người chơi khác...")
         
+        elif action == 'match_queued':
+            self.update_info(f"Đang tìm đối thủ (rating {message.get('rating', 0):.0f}, "
+                             f"{message.get('queue_size', 1)} người đang chờ)...")
+        
         elif action == 'game_started':
             self.game_id = message.get('game_id')
             self.player_symbol = message.get('player_symbol')
-            self.board = message.get('board', [''] * 100)
+            self.set_board_size(message.get('board_size', DEFAULT_BOARD_SIZE))
+            self.board = self.board_from_message(message)
+            self.seq = message.get('seq', 0)
             self.current_turn = message.get('current_turn', 1)
+            self.session_token = message.get('session_token')
+            self.clock = message.get('clock')
             self.game_active = True
             self.player1_name = message.get('player1_name', 'Player 1')
             self.player2_name = message.get('player2_name', 'Player 2')
@@ -473,7 +650,7 @@ class TicTacToeClient:
             
             first_player_symbol = message.get('first_player_symbol', 'X')
             first_player_name = message.get('first_player_name', self.player1_name)
-            turn_text = f"🎮 Tới lượt của {first_player_symbol} ({first_player_name})"
+            turn_text = f"🎮 Tới lượt của {first_player_symbol} ({first_player_name}){self.clock_text()}"
             turn_color = self.x_color if first_player_symbol == 'X' else self.o_color
             self.turn_label.config(text=turn_text, fg=turn_color)
             
@@ -481,14 +658,57 @@ class TicTacToeClient:
             messagebox.showinfo("GAME BẮT ĐẦU", f"Ván caro mới bắt đầu!\n{first_player_name} ({first_player_symbol}) đi trước!")
         
         elif action == 'board_updated':
-            self.board = message.get('board', [''] * 100)
+            if 'board' in message or 'stones' in message:
+                # Server không dùng delta: nhận cả bàn cờ
+                self.board = self.board_from_message(message)
+                self.seq = message.get('seq', self.seq)
+                self.update_board()
+            elif message.get('seq') == self.seq + 1:
+                # Chỉ cập nhật ô vừa đánh
+                position = message.get('last_move')
+                self.board[position] = message.get('last_symbol')
+                self.seq = message['seq']
+                self.update_cell(position)
+            elif message.get('seq', 0) <= self.seq:
+                # Đã có trong ảnh chụp bàn cờ nhận trước đó (server gộp cập nhật khi mạng chậm)
+                return
+            else:
+                # Hụt số thứ tự: xin lại toàn bộ bàn cờ
+                self.request_resync()
+                return
+            
             self.current_turn = message.get('current_turn', 1)
+            self.clock = message.get('clock', self.clock)
+            self.show_turn()
+        
+        elif action == 'resumed':
+            # Quay lại ván sau khi mất kết nối: chỉ nhận các nước đã lỡ (hoặc cả bàn nếu server không có)
+            self.resync_pending = False
+            self.session_token = message.get('session_token', self.session_token)
+            self.player_symbol = message.get('player_symbol')
+            self.player1_name = message.get('player1_name', self.player1_name)
+            self.player2_name = message.get('player2_name', self.player2_name)
+            if 'moves' in message:
+                first_symbol = message.get('first_player_symbol', 'X')
+                second_symbol = 'O' if first_symbol == 'X' else 'X'
+                for index, position in enumerate(message['moves'], message.get('from_seq', 0)):
+                    self.board[position] = first_symbol if index % 2 == 0 else second_symbol
+            else:
+                self.board = self.board_from_message(message)
+            self.seq = message.get('seq', self.seq)
+            self.current_turn = message.get('current_turn', 1)
+            self.clock = message.get('clock', self.clock)
             self.update_board()
-            current_player_symbol = 'X' if self.current_turn == 1 else 'O'
-            current_player_name = self.player1_name if self.current_turn == 1 else self.player2_name
-            turn_text = f"🎮 Tới lượt của {current_player_symbol} ({current_player_name})"
-            turn_color = self.x_color if current_player_symbol == 'X' else self.o_color
-            self.turn_label.config(text=turn_text, fg=turn_color)
+            self.show_turn()
+            self.status_label.config(text=f"✓ Đã kết nối - {self.player_name}", fg='#ffffff')
+            self.update_info("Đã kết nối lại, tiếp tục ván đấu.")
+        
+        elif action == 'player_away':
+            self.update_info(f"⚠️ {message.get('player_name')} mất kết nối, chờ quay lại trong "
+                             f"{message.get('grace', 0):.0f} giây...")
+        
+        elif action == 'player_back':
+            self.update_info(f"✓ {message.get('player_name')} đã quay lại.")
         
         elif action == 'game_over':
             self.game_active = False
@@ -496,8 +716,8 @@ class TicTacToeClient:
             winning_positions = message.get('winning_positions', [])
             
             # Cập nhật board từ message
-            if 'board' in message:
-                self.board = message.get('board', [''] * 100)
+            if 'board' in message or 'stones' in message:
+                self.board = self.board_from_message(message)
             
             # Highlight các nút thắng trước
             if winning_positions:
@@ -505,19 +725,45 @@ class TicTacToeClient:
                 # Đợi một chút để người dùng thấy 5 nút thắng
                 self.root.after(500, lambda: self.show_game_over_message(winner))
             else:
-                # Nếu hòa, hiển thị ngay
+                # Hòa hoặc thắng vì đối thủ hết giờ / bỏ đi: hiển thị ngay
                 self.update_board()
-                self.show_game_over_message(winner)
+                self.show_game_over_message(winner, message.get('reason'))
+        
+        elif action == 'board_snapshot':
+            self.resync_pending = False
+            self.board = self.board_from_message(message)
+            self.seq = message.get('seq', 0)
+            self.current_turn = message.get('current_turn', 1)
+            self.update_board()
         
         elif action == 'game_list':
             games = message.get('games', [])
-            self.show_game_list(games)
+            self.show_game_list(games, message.get('offset', 0), message.get('total', len(games)))
         
         elif action == 'error':
             messagebox.showerror("Lỗi", message.get('message', 'Lỗi không xác định'))
     
-    def show_game_list(self, games: list):
-        """Cải tiến dialog chọn game"""
+    def show_turn(self):
+        """Hiện lượt đi hiện tại"""
+        current_player_symbol = 'X' if self.current_turn == 1 else 'O'
+        current_player_name = self.player1_name if self.current_turn == 1 else self.player2_name
+        turn_text = f"🎮 Tới lượt của {current_player_symbol} ({current_player_name}){self.clock_text()}"
+        turn_color = self.x_color if current_player_symbol == 'X' else self.o_color
+        self.turn_label.config(text=turn_text, fg=turn_color)
+    
+    def clock_text(self) -> str:
+        """Thời gian còn lại của hai bên (lúc nhận cập nhật cuối), rỗng nếu ván không tính giờ"""
+        if not self.clock:
+            return ""
+        x_ms, o_ms = self.clock
+        return f"  ⏱ X {x_ms // 60000}:{x_ms // 1000 % 60:02d} · O {o_ms // 60000}:{o_ms // 1000 % 60:02d}"
+    
+    def show_game_list(self, games: list, offset: int = 0, total: int = 0):
+        """Cải tiến dialog chọn game - mỗi lần một trang"""
+        if not games and offset > 0:
+            # Trang đã trống (game vừa được người khác tham gia): quay về trang đầu
+            self.request_game_list(0)
+            return
         if not games:
             messagebox.showinfo("Danh sách Game", "Không có game nào đang chờ")
             return
@@ -529,7 +775,7 @@ class TicTacToeClient:
         
         title = tk.Label(
             dialog,
-            text="📋 Các game đang chờ:",
+            text=f"📋 Các game đang chờ ({offset + 1}-{offset + len(games)} / {total}):",
             font=("Segoe UI", 13, "bold"),
             bg='#ffffff',
             fg='#1a1a1a'
@@ -538,9 +784,12 @@ class TicTacToeClient:
         
         for game in games:
             player1_name = game.get('player1_name', f"Player {game['player1']}")
+            size = game.get('board_size', DEFAULT_BOARD_SIZE)
             btn = tk.Button(
                 dialog,
-                text=f"Game {game['game_id']} - {player1_name}",
+                text=f"Game {game['game_id']} - {player1_name} ({f'{size}x{size}' if size else 'không giới hạn'})",
+                # Bàn không giới hạn chưa vẽ được bằng lưới nút
+                state=tk.NORMAL if size else tk.DISABLED,
                 font=("Segoe UI", 11),
                 bg=self.primary_btn,
                 fg='white',
@@ -553,52 +802,70 @@ class TicTacToeClient:
                 command=lambda gid=game['game_id']: [self.join_game(gid), dialog.destroy()]
             )
             btn.pack(pady=8, padx=10)
+        
+        nav = tk.Frame(dialog, bg='#ffffff')
+        nav.pack(pady=10)
+        if offset > 0:
+            tk.Button(
+                nav, text="◀ Trang trước", font=("Segoe UI", 10), relief=tk.FLAT, cursor="hand2",
+                command=lambda: [dialog.destroy(), self.request_game_list(max(0, offset - GAME_LIST_PAGE_SIZE))]
+            ).pack(side=tk.LEFT, padx=10)
+        if offset + len(games) < total:
+            tk.Button(
+                nav, text="Trang sau ▶", font=("Segoe UI", 10), relief=tk.FLAT, cursor="hand2",
+                command=lambda: [dialog.destroy(), self.request_game_list(offset + len(games))]
+            ).pack(side=tk.LEFT, padx=10)
     
     def update_board(self):
         """Cập nhật board với animation - giữ kích thước cố định"""
+        for i in range(len(self.buttons)):
+            self.update_cell(i)
+    
+    def update_cell(self, position: int):
+        """Cập nhật một ô theo self.board - giữ kích thước cố định"""
         # Font cố định để không thay đổi kích thước nút
         button_font = ("Segoe UI", 10, "bold")
         
-        for i, btn in enumerate(self.buttons):
-            symbol = self.board[i]
-            if symbol == 'X':
-                btn.config(
-                    text='X',
-                    fg=self.x_color,
-                    bg=self.x_bg,
-                    disabledforeground=self.x_color,
-                    state=tk.DISABLED,
-                    font=button_font,
-                    width=3,
-                    height=1,
-                    relief=tk.RAISED,
-                    bd=1
-                )
-            elif symbol == 'O':
-                btn.config(
-                    text='O',
-                    fg=self.o_color,
-                    bg=self.o_bg,
-                    disabledforeground=self.o_color,
-                    state=tk.DISABLED,
-                    font=button_font,
-                    width=3,
-                    height=1,
-                    relief=tk.RAISED,
-                    bd=1
-                )
-            else:
-                btn.config(
-                    text='',
-                    bg='#ffffff',
-                    fg='#333333',
-                    state=tk.NORMAL,
-                    font=button_font,
-                    width=3,
-                    height=1,
-                    relief=tk.RAISED,
-                    bd=1
-                )
+        btn = self.buttons[position]
+        symbol = self.board[position]
+        if symbol == 'X':
+            btn.config(
+                text='X',
+                fg=self.x_color,
+                bg=self.x_bg,
+                disabledforeground=self.x_color,
+                state=tk.DISABLED,
+                font=button_font,
+                width=3,
+                height=1,
+                relief=tk.RAISED,
+                bd=1
+            )
+        elif symbol == 'O':
+            btn.config(
+                text='O',
+                fg=self.o_color,
+                bg=self.o_bg,
+                disabledforeground=self.o_color,
+                state=tk.DISABLED,
+                font=button_font,
+                width=3,
+                height=1,
+                relief=tk.RAISED,
+                bd=1
+            )
+        else:
+            btn.config(
+                text='',
+                bg='#ffffff',
+                fg='#333333',
+                state=tk.NORMAL,
+                font=button_font,
+                width=3,
+                height=1,
+                relief=tk.RAISED,
+                bd=1
+            )
     
     def update_info(self, text: str):
         """Cập nhật thông tin"""
@@ -619,8 +886,11 @@ class TicTacToeClient:
                 elif symbol == 'O':
                     btn.config(bg='#00ffaa', fg='#ffffff')
     
-    def show_game_over_message(self, winner: str):
+    def show_game_over_message(self, winner: str, reason: Optional[str] = None):
         """Hiển thị thông báo kết thúc game sau khi đã highlight"""
+        if reason == 'timeout':
+            loser = 'O' if winner == 'X' else 'X'
+            messagebox.showinfo("HẾT GIỜ", f"⏰ {loser} đã hết giờ.")
         if winner == 'draw':
             self.turn_label.config(text="🤝 Game kết thúc - Hòa!", fg='#95a5a6')
             self.update_info("Game kết thúc - Hòa! Tạo hoặc tham gia game mới để chơi tiếp.")
@@ -643,7 +913,7 @@ class TicTacToeClient:
     
     def reset_board_after_game(self):
         """Reset board sau khi game kết thúc"""
-        self.board = [''] * 100
+        self.board = [''] * (self.board_size * self.board_size)
         self.update_board()
     
     def exit_game(self):
@@ -668,7 +938,7 @@ class TicTacToeClient:
                         'game_id': self.game_id,
                         'player_name': self.player_name
                     }
-                    self.socket.send(json.dumps(message).encode('utf-8'))
+                    self.send_message(message)
                 except:
                     pass
             
@@ -0,0 +1,435 @@
+"""Đóng khung (framing) và mã hóa tin nhắn giữa client và server Cờ Caro.
+
+Bản sao của Server/CaroProtocol.py để client chạy độc lập - sửa ở đâu thì sửa cả hai.
+
+Mỗi tin nhắn trên dây có dạng: 4 byte độ dài (big-endian, không dấu) + payload.
+FrameDecoder giữ lại phần dữ liệu chưa đủ một khung cho lần recv sau, và tách
+được nhiều khung từ cùng một lần recv.
+
+Payload có hai dạng:
+- JSON UTF-8 (luôn bắt đầu bằng '{'), dùng mặc định và cho client cũ.
+- Nhị phân: 1 byte opcode + các trường đóng gói bằng struct. Chỉ dùng sau khi
+  hai bên thỏa thuận codec 'binary' trong hello/welcome.
+decode_message tự nhận dạng theo byte đầu nên hai dạng có thể xen kẽ nhau.
+"""
+import json
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 1 << 20  # 1 MiB
+RECV_SIZE = 65536  # Đọc lớn để một syscall mang được nhiều tin nhắn
+
+
+class ProtocolError(Exception):
+    """Dữ liệu nhận được không đúng định dạng khung"""
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """Thêm header độ dài vào payload"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f'Khung quá lớn: {len(payload)} byte')
+    return HEADER.pack(len(payload)) + payload
+
+
+# ---------------------------------------------------------------------------
+# Codec nhị phân
+# ---------------------------------------------------------------------------
+
+JSON_START = ord('{')
+
+# Client -> server
+OP_CREATE_GAME = 0x01
+OP_JOIN_GAME = 0x02
+OP_MOVE = 0x03
+OP_LIST_GAMES = 0x04
+OP_RESYNC = 0x05
+# Server -> client
+OP_GAME_CREATED = 0x81
+OP_GAME_STARTED = 0x82
+OP_BOARD_DELTA = 0x83
+OP_BOARD_FULL = 0x84
+OP_GAME_OVER = 0x85
+OP_BOARD_SNAPSHOT = 0x86
+OP_GAME_LIST = 0x87
+OP_ERROR = 0x88
+OP_BOARD_DELTA_CLOCK = 0x89
+OP_BOARD_FULL_CLOCK = 0x8A
+
+SYMBOLS = ('', 'X', 'O')
+SYMBOL_CODES = {symbol: code for code, symbol in enumerate(SYMBOLS)}
+WINNERS = ('draw', 'X', 'O')
+WINNER_CODES = {winner: code for code, winner in enumerate(WINNERS)}
+
+U8 = struct.Struct('!B')
+U16 = struct.Struct('!H')
+GAME_ID = struct.Struct('!BI')                # opcode, game_id
+MOVE = struct.Struct('!BIB')                  # opcode, game_id, position
+GAME_CREATED = struct.Struct('!BIB')          # opcode, game_id, player_symbol (+ session_token nếu có)
+GAME_STARTED = struct.Struct('!BIBBBI')       # opcode, game_id, player_symbol, current_turn, first_player_symbol, seq
+                                              # (+ tên, bàn cờ, session_token nếu có)
+BOARD_DELTA = struct.Struct('!BIBBB')         # opcode, seq, current_turn, last_move, last_symbol
+CLOCK = struct.Struct('!II')                  # thời gian còn lại của X, O (mili giây), sau BOARD_DELTA
+GAME_OVER = struct.Struct('!BIBI')            # opcode, seq, winner, winner_id (0 = không có)
+BOARD_SNAPSHOT = struct.Struct('!BIIB')       # opcode, game_id, seq, current_turn
+LIST_GAMES = struct.Struct('!BIH')            # opcode, offset, limit
+GAME_LIST = struct.Struct('!BIIH')            # opcode, total, offset, count
+GAME_LIST_ENTRY = struct.Struct('!II')        # game_id, player1
+
+
+# CELLS_OF_BYTE[b]: 4 ô được đóng gói trong byte b (ô đầu ở 2 bit thấp)
+CELLS_OF_BYTE = [tuple(SYMBOLS[(b >> shift) & 3] if (b >> shift) & 3 < 3 else '' for shift in (0, 2, 4, 6))
+                 for b in range(256)]
+
+
+# BYTE_OF_CELLS[(a, b, c, d)]: byte đóng gói của 4 ô liên tiếp
+BYTE_OF_CELLS = {}
+for _byte, _cells in enumerate(CELLS_OF_BYTE):
+    BYTE_OF_CELLS.setdefault(_cells, _byte)
+
+
+def pack_board(board: List[str]) -> bytes:
+    """Đóng gói bàn cờ 2 bit mỗi ô (0 trống, 1 X, 2 O), kèm số ô ở đầu"""
+    cells = board + [''] * (-len(board) % 4)
+    groups = iter(cells)
+    return U16.pack(len(board)) + bytes(map(BYTE_OF_CELLS.__getitem__, zip(groups, groups, groups, groups)))
+
+
+def unpack_board(data: bytes, offset: int) -> Tuple[List[str], int]:
+    """Giải nén bàn cờ từ vị trí offset, trả về (board, offset sau bàn cờ)"""
+    (cells,) = U16.unpack_from(data, offset)
+    offset += U16.size
+    size = (cells + 3) // 4
+    packed = data[offset:offset + size]
+    if len(packed) != size:
+        raise ProtocolError('Thiếu dữ liệu bàn cờ')
+    board = [cell for byte in packed for cell in CELLS_OF_BYTE[byte]]
+    del board[cells:]
+    return board, offset + size
+
+
+def pack_str(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return U16.pack(len(data)) + data
+
+
+def unpack_str(data: bytes, offset: int) -> Tuple[str, int]:
+    (size,) = U16.unpack_from(data, offset)
+    offset += U16.size
+    return data[offset:offset + size].decode('utf-8'), offset + size
+
+
+def _fits(message: Dict, required: Tuple[str, ...], optional: Tuple[str, ...] = ()) -> bool:
+    """Tin nhắn chỉ gồm các khóa codec nhị phân biết mã hóa (để không làm mất dữ liệu)"""
+    keys = message.keys()
+    return all(k in keys for k in required) and len(keys) <= len(required) + len(optional) \
+        and all(k in required or k in optional for k in keys)
+
+
+def _is_token(value) -> bool:
+    """session_token (không bắt buộc) mã hóa được bằng pack_str"""
+    return value is None or (isinstance(value, str) and len(value) < 0x100)
+
+
+def _pack_token(message: Dict) -> bytes:
+    """session_token ở cuối payload; không có thì không thêm gì"""
+    token = message.get('session_token')
+    return pack_str(token) if token is not None else b''
+
+
+def _unpack_token(payload: bytes, offset: int, message: Dict):
+    if offset < len(payload):
+        message['session_token'], _ = unpack_str(payload, offset)
+
+
+def _is_u8(value) -> bool:
+    return isinstance(value, int) and 0 <= value < 0x100
+
+
+def _is_u16(value) -> bool:
+    return isinstance(value, int) and 0 <= value < 0x10000
+
+
+def _is_u32(value) -> bool:
+    return isinstance(value, int) and 0 <= value < 0x100000000
+
+
+def _encode_binary(message: Dict) -> Optional[bytes]:
+    """Mã hóa nhị phân, hoặc None nếu tin nhắn không có dạng nhị phân tương ứng"""
+    action = message.get('action')
+
+    if action == 'move':
+        if _fits(message, ('action', 'game_id', 'position')) and _is_u32(message['game_id']) \
+                and _is_u8(message['position']):
+            return MOVE.pack(OP_MOVE, message['game_id'], message['position'])
+
+    elif action == 'board_updated':
+        clock = message.get('clock')
+        if _fits(message, ('action', 'seq', 'current_turn', 'last_move', 'last_symbol'), ('board', 'clock')) \
+                and _is_u32(message['seq']) and _is_u8(message['last_move']) \
+                and (clock is None or (len(clock) == 2 and all(_is_u32(ms) for ms in clock))):
+            if clock is None:
+                opcode = OP_BOARD_FULL if 'board' in message else OP_BOARD_DELTA
+            else:
+                opcode = OP_BOARD_FULL_CLOCK if 'board' in message else OP_BOARD_DELTA_CLOCK
+            data = BOARD_DELTA.pack(opcode, message['seq'], message['current_turn'],
+                                    message['last_move'], SYMBOL_CODES[message['last_symbol']])
+            if clock is not None:
+                data += CLOCK.pack(*clock)
+            return data + pack_board(message['board']) if 'board' in message else data
+
+    elif action == 'game_over':
+        if _fits(message, ('action', 'seq', 'winner', 'winning_positions'), ('winner_id', 'board')) \
+                and _is_u32(message.get('winner_id', 0)) and all(_is_u8(p) for p in message['winning_positions']):
+            positions = message['winning_positions']
+            data = GAME_OVER.pack(OP_GAME_OVER, message['seq'], WINNER_CODES[message['winner']],
+                                  message.get('winner_id', 0))
+            data += U8.pack(len(positions)) + bytes(positions)
+            if 'board' in message:
+                return data + U8.pack(1) + pack_board(message['board'])
+            return data + U8.pack(0)
+
+    elif action == 'create_game':
+        if _fits(message, ('action', 'player_name')):
+            return U8.pack(OP_CREATE_GAME) + pack_str(message['player_name'])
+
+    elif action == 'join_game':
+        if _fits(message, ('action', 'game_id', 'player_name')) and _is_u32(message['game_id']):
+            return GAME_ID.pack(OP_JOIN_GAME, message['game_id']) + pack_str(message['player_name'])
+
+    elif action == 'list_games':
+        if _fits(message, ('action',)):
+            return U8.pack(OP_LIST_GAMES)
+        if _fits(message, ('action', 'offset', 'limit')) and _is_u32(message['offset']) \
+                and _is_u16(message['limit']):
+            return LIST_GAMES.pack(OP_LIST_GAMES, message['offset'], message['limit'])
+
+    elif action == 'resync':
+        if _fits(message, ('action', 'game_id')) and _is_u32(message['game_id']):
+            return GAME_ID.pack(OP_RESYNC, message['game_id'])
+
+    elif action == 'game_created':
+        if _fits(message, ('action', 'game_id', 'player_symbol'), ('session_token',)) \
+                and _is_u32(message['game_id']) and _is_token(message.get('session_token')):
+            return GAME_CREATED.pack(OP_GAME_CREATED, message['game_id'], SYMBOL_CODES[message['player_symbol']]) \
+                + _pack_token(message)
+
+    elif action == 'game_started':
+        if _fits(message, ('action', 'game_id', 'player_symbol', 'player1_name', 'player2_name', 'board', 'seq',
+                           'current_turn', 'first_player_symbol', 'first_player_name'), ('session_token',)) \
+                and _is_u32(message['game_id']) and _is_u32(message['seq']) \
+                and _is_token(message.get('session_token')):
+            return GAME_STARTED.pack(
+                OP_GAME_STARTED, message['game_id'], SYMBOL_CODES[message['player_symbol']],
+                message['current_turn'], SYMBOL_CODES[message['first_player_symbol']], message['seq']
+            ) + pack_str(message['player1_name']) + pack_str(message['player2_name']) \
+                + pack_str(message['first_player_name']) + pack_board(message['board']) + _pack_token(message)
+
+    elif action == 'board_snapshot':
+        if _fits(message, ('action', 'game_id', 'board', 'seq', 'current_turn')) \
+                and _is_u32(message['game_id']) and _is_u32(message['seq']):
+            return BOARD_SNAPSHOT.pack(OP_BOARD_SNAPSHOT, message['game_id'], message['seq'],
+                                       message['current_turn']) + pack_board(message['board'])
+
+    elif action == 'game_list':
+        games = message.get('games')
+        if _fits(message, ('action', 'games', 'offset', 'total')) and len(games) < 0x10000 \
+                and _is_u32(message['offset']) and _is_u32(message['total']) and all(
+                _fits(g, ('game_id', 'player1', 'player1_name')) and _is_u32(g['game_id']) and _is_u32(g['player1'])
+                for g in games):
+            parts = [GAME_LIST.pack(OP_GAME_LIST, message['total'], message['offset'], len(games))]
+            for g in games:
+                parts.append(GAME_LIST_ENTRY.pack(g['game_id'], g['player1']))
+                parts.append(pack_str(g['player1_name']))
+            return b''.join(parts)
+
+    elif action == 'error':
+        if _fits(message, ('action', 'message')):
+            return U8.pack(OP_ERROR) + pack_str(message['message'])
+
+    return None
+
+
+def _decode_binary(payload: bytes) -> Dict:
+    """Giải mã payload nhị phân thành tin nhắn dạng dict giống JSON"""
+    opcode = payload[0]
+
+    if opcode == OP_MOVE:
+        _, game_id, position = MOVE.unpack_from(payload)
+        return {'action': 'move', 'game_id': game_id, 'position': position}
+
+    if opcode in (OP_BOARD_DELTA, OP_BOARD_FULL, OP_BOARD_DELTA_CLOCK, OP_BOARD_FULL_CLOCK):
+        _, seq, current_turn, last_move, last_symbol = BOARD_DELTA.unpack_from(payload)
+        message = {'action': 'board_updated', 'seq': seq, 'current_turn': current_turn,
+                   'last_move': last_move, 'last_symbol': SYMBOLS[last_symbol]}
+        offset = BOARD_DELTA.size
+        if opcode in (OP_BOARD_DELTA_CLOCK, OP_BOARD_FULL_CLOCK):
+            message['clock'] = list(CLOCK.unpack_from(payload, offset))
+            offset += CLOCK.size
+        if opcode in (OP_BOARD_FULL, OP_BOARD_FULL_CLOCK):
+            message['board'], _ = unpack_board(payload, offset)
+        return message
+
+    if opcode == OP_GAME_OVER:
+        _, seq, winner, winner_id = GAME_OVER.unpack_from(payload)
+        offset = GAME_OVER.size
+        count = payload[offset]
+        positions = list(payload[offset + 1:offset + 1 + count])
+        offset += 1 + count
+        message = {'action': 'game_over', 'seq': seq, 'winner': WINNERS[winner], 'winning_positions': positions}
+        if winner_id:
+            message['winner_id'] = winner_id
+        if payload[offset]:
+            message['board'], _ = unpack_board(payload, offset + 1)
+        return message
+
+    if opcode == OP_CREATE_GAME:
+        player_name, _ = unpack_str(payload, 1)
+        return {'action': 'create_game', 'player_name': player_name}
+
+    if opcode == OP_JOIN_GAME:
+        _, game_id = GAME_ID.unpack_from(payload)
+        player_name, _ = unpack_str(payload, GAME_ID.size)
+        return {'action': 'join_game', 'game_id': game_id, 'player_name': player_name}
+
+    if opcode == OP_LIST_GAMES:
+        if len(payload) == 1:
+            return {'action': 'list_games'}
+        _, offset, limit = LIST_GAMES.unpack_from(payload)
+        return {'action': 'list_games', 'offset': offset, 'limit': limit}
+
+    if opcode == OP_RESYNC:
+        _, game_id = GAME_ID.unpack_from(payload)
+        return {'action': 'resync', 'game_id': game_id}
+
+    if opcode == OP_GAME_CREATED:
+        _, game_id, symbol = GAME_CREATED.unpack_from(payload)
+        message = {'action': 'game_created', 'game_id': game_id, 'player_symbol': SYMBOLS[symbol]}
+        _unpack_token(payload, GAME_CREATED.size, message)
+        return message
+
+    if opcode == OP_GAME_STARTED:
+        _, game_id, symbol, current_turn, first_symbol, seq = GAME_STARTED.unpack_from(payload)
+        player1_name, offset = unpack_str(payload, GAME_STARTED.size)
+        player2_name, offset = unpack_str(payload, offset)
+        first_player_name, offset = unpack_str(payload, offset)
+        board, offset = unpack_board(payload, offset)
+        message = {
+            'action': 'game_started',
+            'game_id': game_id,
+            'player_symbol': SYMBOLS[symbol],
+            'player1_name': player1_name,
+            'player2_name': player2_name,
+            'board': board,
+            'seq': seq,
+            'current_turn': current_turn,
+            'first_player_symbol': SYMBOLS[first_symbol],
+            'first_player_name': first_player_name
+        }
+        _unpack_token(payload, offset, message)
+        return message
+
+    if opcode == OP_BOARD_SNAPSHOT:
+        _, game_id, seq, current_turn = BOARD_SNAPSHOT.unpack_from(payload)
+        board, _ = unpack_board(payload, BOARD_SNAPSHOT.size)
+        return {'action': 'board_snapshot', 'game_id': game_id, 'board': board, 'seq': seq,
+                'current_turn': current_turn}
+
+    if opcode == OP_GAME_LIST:
+        _, total, first, count = GAME_LIST.unpack_from(payload)
+        offset = GAME_LIST.size
+        games = []
+        for _ in range(count):
+            game_id, player1 = GAME_LIST_ENTRY.unpack_from(payload, offset)
+            player1_name, offset = unpack_str(payload, offset + GAME_LIST_ENTRY.size)
+            games.append({'game_id': game_id, 'player1': player1, 'player1_name': player1_name})
+        return {'action': 'game_list', 'games': games, 'offset': first, 'total': total}
+
+    if opcode == OP_ERROR:
+        text, _ = unpack_str(payload, 1)
+        return {'action': 'error', 'message': text}
+
+    raise ProtocolError(f'Opcode không hợp lệ: {opcode:#x}')
+
+
+class Codec:
+    """Cách mã hóa payload cho một kết nối"""
+
+    def __init__(self, name: str, encode: Callable[[Dict], bytes]):
+        self.name = name
+        self.encode = encode
+
+
+def _encode_json(message: Dict) -> bytes:
+    return json.dumps(message).encode('utf-8')
+
+
+def _encode_binary_or_json(message: Dict) -> bytes:
+    # Tin nhắn chưa có opcode riêng (hoặc có trường lạ) vẫn đi dưới dạng JSON
+    data = _encode_binary(message)
+    return data if data is not None else _encode_json(message)
+
+
+JSON_CODEC = Codec('json', _encode_json)
+BINARY_CODEC = Codec('binary', _encode_binary_or_json)
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+
+
+def choose_codec(offered: List[str]) -> Codec:
+    """Chọn codec đầu tiên trong danh sách client đề nghị mà bên này hỗ trợ"""
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+def encode_message(message: Dict, codec: Codec = JSON_CODEC) -> bytes:
+    """Mã hóa một tin nhắn thành khung hoàn chỉnh"""
+    return encode_frame(codec.encode(message))
+
+
+def decode_message(payload: bytes) -> Dict:
+    """Giải mã payload của một khung, tự nhận dạng JSON hay nhị phân"""
+    if not payload:
+        raise ProtocolError('Khung rỗng')
+    if payload[0] == JSON_START:
+        return json.loads(payload.decode('utf-8'))
+    try:
+        return _decode_binary(payload)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ProtocolError(f'Tin nhắn nhị phân hỏng: {e}')
+
+
+class FrameDecoder:
+    """Bộ giải mã khung tăng dần: feed() từng mẩu dữ liệu, nhận về các khung đã đủ"""
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Thêm dữ liệu vừa nhận và trả về mọi khung hoàn chỉnh"""
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        offset = 0
+        available = len(buffer)
+
+        while available - offset >= HEADER.size:
+            (size,) = HEADER.unpack_from(buffer, offset)
+            if size > self.max_frame_size:
+                raise ProtocolError(f'Khung quá lớn: {size} byte')
+            end = offset + HEADER.size + size
+            if end > available:
+                break
+            frames.append(bytes(buffer[offset + HEADER.size:end]))
+            offset = end
+
+        # Xóa một lần phần đã đọc thay vì cắt sau mỗi khung
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def pending(self) -> int:
+        """Số byte đang chờ đủ khung"""
+        return len(self.buffer)
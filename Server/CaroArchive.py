@@ -0,0 +1,420 @@
+"""Kho lưu các ván đã kết thúc: lịch sử người chơi, thắng / thua và phát lại.
+
+Mỗi ngày (UTC, theo lúc kết thúc) là một thư mục, mỗi shard ghi một tệp dữ liệu
+<ngày>/games-s<shard>.dat chỉ nối thêm. Một bản ghi:
+
+    [độ dài u32] GAME (id, lúc bắt đầu / kết thúc theo mili giây, cỡ bàn, độ dài thắng, người đi trước,
+    kết quả, số byte mỗi nước) + tên hai người chơi + số nước u32 + history của ván
+    (một byte mỗi nước trên bàn tới 16x16, xem CaroGame.move_width)
+
+Khi sang ngày mới, tệp của ngày cũ được "niêm phong" bằng hai chỉ mục sắp xếp sẵn:
+    .ids      (game_id, offset) theo game_id
+    .players  (hash tên, lúc kết thúc, game_id, offset, kết quả với người đó) theo
+              (hash, lúc kết thúc, game_id)
+Chỉ mục được mmap và tìm nhị phân, nên truy vấn chỉ chạm vài trang của mỗi ngày thay
+vì đọc cả lịch sử. Tệp của ngày đang ghi (chưa niêm phong) được đọc tiếp từ offset đã
+đọc lần trước vào một chỉ mục trong bộ nhớ - chỉ gồm các ván trong ngày.
+
+append() chỉ nối bản ghi vào hàng chờ trong bộ nhớ (được gọi khi đang giữ game.lock, có thể
+trên event loop); một thread ghi mỗi FLUSH_INTERVAL giây ghi cả hàng chờ bằng một lần write
+cho mỗi ngày, như WAL và tệp rating. Ván vừa kết thúc có thể chưa hiện trong truy vấn trong
+khoảng thời gian đó.
+"""
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from CaroGame import history_positions, move_width
+
+LENGTH = struct.Struct('<I')
+GAME = struct.Struct('<qQQHHBBB')  # game_id, started_at / ended_at (ms), board_size, win_length, first_player, kết quả, move_width
+MOVE_COUNT = struct.Struct('<I')
+INDEX_HEADER = struct.Struct('<8sQ')  # magic, số mục
+ID_ENTRY = struct.Struct('<qQ')  # game_id, offset
+PLAYER_ENTRY = struct.Struct('<QQqQB')  # hash tên, ended_at (ms), game_id, offset, kết quả với người đó
+IDS_MAGIC = b'CAROIDS1'
+PLAYERS_MAGIC = b'CAROPLY1'
+MAX_NAME_BYTES = 255
+
+# Kết quả ván (GAME) và kết quả với một người chơi (PLAYER_ENTRY)
+RESULT_DRAW, RESULT_X, RESULT_O, RESULT_ABANDONED = 0, 1, 2, 3
+WIN, LOSS, DRAW, ABANDONED = 0, 1, 2, 3
+OUTCOMES = ('wins', 'losses', 'draws', 'abandoned')
+RESULT_NAMES = {RESULT_DRAW: 'draw', RESULT_X: 'X', RESULT_O: 'O', RESULT_ABANDONED: 'abandoned'}
+LIST_INTERVAL = 1.0  # Giây giữa hai lần liệt kê lại thư mục ngày
+FLUSH_INTERVAL = 0.5  # Giây giữa hai lần ghi hàng chờ ra tệp
+
+
+def name_hash(name: str) -> int:
+    """Hash 64 bit ổn định giữa các tiến trình (hash() của Python thay đổi mỗi lần chạy)"""
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def day_of(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def pack_name(name: Optional[str]) -> bytes:
+    data = (name or '').encode('utf-8')[:MAX_NAME_BYTES]
+    return bytes((len(data),)) + data
+
+
+def encode_game(game_id: int, game, result: int, ended_at: float) -> bytes:
+    """Bản ghi của một ván (CaroGame.Game) đã kết thúc; ended_at là time.time()"""
+    body = (GAME.pack(game_id, int(game.created_at * 1000), int(ended_at * 1000), game.board_size,
+                      game.win_length, game.first_player or 1, result, move_width(game.board_size))
+            + pack_name(game.player1_name) + pack_name(game.player2_name)
+            + MOVE_COUNT.pack(game.moves) + game.history)
+    return LENGTH.pack(len(body)) + body
+
+
+def decode_game(data: bytes) -> Dict:
+    """Bản ghi (không gồm tiền tố độ dài) -> dict; started_at / ended_at là mili giây từ epoch"""
+    game_id, started_at, ended_at, board_size, win_length, first_player, result, _ = GAME.unpack_from(data)
+    offset = GAME.size
+    names = []
+    for _ in range(2):
+        size = data[offset]
+        names.append(data[offset + 1:offset + 1 + size].decode('utf-8', 'replace'))
+        offset += 1 + size
+    (moves,) = MOVE_COUNT.unpack_from(data, offset)
+    offset += MOVE_COUNT.size
+    return {
+        'game_id': game_id, 'started_at': started_at, 'ended_at': ended_at,
+        'board_size': board_size, 'win_length': win_length,
+        'player1_name': names[0], 'player2_name': names[1],
+        'first_player_symbol': 'X' if first_player == 1 else 'O',
+        'result': RESULT_NAMES[result], 'move_count': moves,
+        'history': data[offset:],
+    }
+
+
+def outcome_for(result: int, symbol: str) -> int:
+    """Kết quả ván nhìn từ người cầm quân symbol"""
+    if result == RESULT_ABANDONED:
+        return ABANDONED
+    if result == RESULT_DRAW:
+        return DRAW
+    return WIN if (result == RESULT_X) == (symbol == 'X') else LOSS
+
+
+def scan_records(data: bytes, offset: int = 0):
+    """(offset, bản ghi) của các bản ghi trọn vẹn từ offset; dừng ở bản ghi ghi dở"""
+    while offset + LENGTH.size <= len(data):
+        (size,) = LENGTH.unpack_from(data, offset)
+        end = offset + LENGTH.size + size
+        if end > len(data):
+            return
+        yield offset, data[offset + LENGTH.size:end]
+        offset = end
+
+
+def index_entries(offset: int, record: bytes) -> Tuple[Tuple[int, int], List[Tuple[int, int, int, int, int]]]:
+    """Mục chỉ mục id và hai mục chỉ mục người chơi của một bản ghi"""
+    game_id, _, ended_at, _, _, _, result, _ = GAME.unpack_from(record)
+    position = GAME.size
+    players = []
+    for symbol in 'XO':
+        size = record[position]
+        name = record[position + 1:position + 1 + size].decode('utf-8', 'replace')
+        players.append((name_hash(name), ended_at, game_id, offset, outcome_for(result, symbol)))
+        position += 1 + size
+    return (game_id, offset), players
+
+
+def lower_bound(mm, entry: struct.Struct, count: int, key: int) -> int:
+    """Chỉ số mục đầu tiên có trường đầu >= key trong chỉ mục đã sắp xếp"""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if entry.unpack_from(mm, INDEX_HEADER.size + mid * entry.size)[0] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def write_index(path: str, magic: bytes, entry: struct.Struct, entries: List[Tuple]):
+    data = bytearray(INDEX_HEADER.pack(magic, len(entries)))
+    for values in entries:
+        data += entry.pack(*values)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+def seal(data_path: str):
+    """Ghi hai chỉ mục cho một tệp dữ liệu đã ngừng ghi"""
+    with open(data_path, 'rb') as f:
+        data = f.read()
+    ids, players = [], []
+    for offset, record in scan_records(data):
+        id_entry, player_entries = index_entries(offset, record)
+        ids.append(id_entry)
+        players.extend(player_entries)
+    base = data_path[:-len('.dat')]
+    # .players ghi sau cùng: có nó nghĩa là tệp đã niêm phong xong
+    write_index(base + '.ids', IDS_MAGIC, ID_ENTRY, sorted(ids))
+    write_index(base + '.players', PLAYERS_MAGIC, PLAYER_ENTRY, sorted(players))
+
+
+def map_file(path: str) -> Optional[mmap.mmap]:
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Segment:
+    """Tệp dữ liệu của một ngày / một shard cùng chỉ mục (mmap nếu đã niêm phong)"""
+
+    def __init__(self, data_path: str):
+        self.data_path = data_path
+        self.base = data_path[:-len('.dat')]
+        self.day = os.path.basename(os.path.dirname(data_path))
+        self.sealed = False
+        self.data = self.ids = self.players = None
+        self.id_count = self.player_count = 0
+        # Chỉ mục trong bộ nhớ khi chưa niêm phong
+        self.scanned = 0
+        self.id_index: Dict[int, int] = {}
+        self.player_index: Dict[int, List[Tuple[int, int, int, int]]] = {}
+
+    def refresh(self):
+        """Dùng chỉ mục nếu đã niêm phong, nếu không thì đọc tiếp các bản ghi mới"""
+        if self.sealed:
+            return
+        if os.path.exists(self.base + '.players'):
+            self.data = map_file(self.data_path)
+            self.ids = map_file(self.base + '.ids')
+            self.players = map_file(self.base + '.players')
+            self.id_count = INDEX_HEADER.unpack_from(self.ids, 0)[1]
+            self.player_count = INDEX_HEADER.unpack_from(self.players, 0)[1]
+            self.id_index, self.player_index = {}, {}
+            self.sealed = True
+            return
+        with open(self.data_path, 'rb') as f:
+            f.seek(self.scanned)
+            data = f.read()
+        consumed = 0
+        for offset, record in scan_records(data):
+            (game_id, position), players = index_entries(self.scanned + offset, record)
+            self.id_index[game_id] = position
+            for key, ended_at, _, _, outcome in players:
+                self.player_index.setdefault(key, []).append((ended_at, game_id, position, outcome))
+            consumed = offset + LENGTH.size + len(record)
+        self.scanned += consumed
+
+    def read(self, offset: int) -> bytes:
+        if self.sealed:
+            (size,) = LENGTH.unpack_from(self.data, offset)
+            return self.data[offset + LENGTH.size:offset + LENGTH.size + size]
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            (size,) = LENGTH.unpack(f.read(LENGTH.size))
+            return f.read(size)
+
+    def find(self, game_id: int) -> Optional[int]:
+        """offset của ván game_id trong tệp này"""
+        if not self.sealed:
+            return self.id_index.get(game_id)
+        if self.ids is None:
+            return None
+        index = lower_bound(self.ids, ID_ENTRY, self.id_count, game_id)
+        if index < self.id_count:
+            found, offset = ID_ENTRY.unpack_from(self.ids, INDEX_HEADER.size + index * ID_ENTRY.size)
+            if found == game_id:
+                return offset
+        return None
+
+    def player_games(self, key: int) -> List[Tuple[int, int, int, int]]:
+        """(ended_at, game_id, offset, kết quả) các ván của người có hash key, cũ trước"""
+        if not self.sealed:
+            return self.player_index.get(key, [])
+        if self.players is None:
+            return []
+        entries = []
+        index = lower_bound(self.players, PLAYER_ENTRY, self.player_count, key)
+        while index < self.player_count:
+            found, ended_at, game_id, offset, outcome = PLAYER_ENTRY.unpack_from(
+                self.players, INDEX_HEADER.size + index * PLAYER_ENTRY.size)
+            if found != key:
+                break
+            entries.append((ended_at, game_id, offset, outcome))
+            index += 1
+        return entries
+
+
+class ArchiveReader:
+    """Truy vấn kho lưu của mọi shard dưới một thư mục gốc"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.segments: Dict[str, Segment] = {}
+        self.ordered: List[Segment] = []  # Mới trước
+        self.listed_at = 0.0
+        self.lock = threading.Lock()  # Lock lá
+
+    def newest_first(self) -> List[Segment]:
+        """Các segment, ngày mới trước (các segment cùng ngày đứng liền nhau); liệt kê lại thư
+        mục tối đa mỗi LIST_INTERVAL giây"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.listed_at >= LIST_INTERVAL:
+                self.listed_at = now
+                for day in sorted(os.listdir(self.root), reverse=True):
+                    directory = os.path.join(self.root, day)
+                    if not os.path.isdir(directory):
+                        continue
+                    for name in os.listdir(directory):
+                        path = os.path.join(directory, name)
+                        if name.endswith('.dat') and path not in self.segments:
+                            self.segments[path] = Segment(path)
+                self.ordered = sorted(self.segments.values(), key=lambda segment: segment.day, reverse=True)
+            segments = self.ordered
+            for segment in segments:
+                if not segment.sealed:
+                    segment.refresh()
+            return segments
+
+    def recent_games(self, player_name: str, limit: int) -> List[Dict]:
+        """limit ván gần nhất của người chơi, mới trước (không gồm history)"""
+        key = name_hash(player_name)
+        games = []
+        for day_segments in self.by_day():
+            # Trộn các ván của mọi shard trong ngày theo (lúc kết thúc, game_id), chỉ giải mã các
+            # ván cần lấy. Cùng mili giây thì game_id quyết định, nên thứ tự không phụ thuộc shard.
+            found = heapq.merge(*(
+                [entry + (segment,) for entry in sorted(segment.player_games(key), reverse=True)]
+                for segment in day_segments),
+                key=lambda entry: entry[:2], reverse=True)
+            for _, _, offset, outcome, segment in found:
+                game = decode_game(segment.read(offset))
+                if player_name not in (game['player1_name'], game['player2_name']):
+                    continue  # Trùng hash
+                del game['history']
+                game['outcome'] = OUTCOMES[outcome]
+                games.append(game)
+                if len(games) >= limit:
+                    return games
+        return games
+
+    def by_day(self) -> List[List[Segment]]:
+        """Các segment gom theo ngày, ngày mới trước"""
+        days: List[List[Segment]] = []
+        for segment in self.newest_first():
+            if days and days[-1][0].day == segment.day:
+                days[-1].append(segment)
+            else:
+                days.append([segment])
+        return days
+
+    def player_totals(self, player_name: str) -> Dict[str, int]:
+        """Số ván thắng / thua / hòa / bỏ dở của người chơi, chỉ đọc chỉ mục"""
+        key = name_hash(player_name)
+        totals = dict.fromkeys(OUTCOMES, 0)
+        for segment in self.newest_first():
+            for _, _, _, outcome in segment.player_games(key):
+                totals[OUTCOMES[outcome]] += 1
+        totals['games'] = sum(totals.values())
+        return totals
+
+    def game(self, game_id: int) -> Optional[Dict]:
+        """Ván game_id kèm danh sách nước đi theo thứ tự"""
+        for segment in self.newest_first():
+            offset = segment.find(game_id)
+            if offset is not None:
+                game = decode_game(segment.read(offset))
+                game['moves'] = history_positions(game.pop('history'), game['board_size'])
+                return game
+        return None
+
+
+class GameArchive(ArchiveReader):
+    """Kho lưu của một shard: ghi ván đã kết thúc vào tệp của ngày hiện tại"""
+
+    def __init__(self, root: str, shard_index: int = 0, flush_interval: float = FLUSH_INTERVAL):
+        super().__init__(root)
+        os.makedirs(root, exist_ok=True)
+        self.shard_index = shard_index
+        self.file_name = f'games-s{shard_index}.dat'
+        self.flush_interval = flush_interval
+        self.pending: List[Tuple[bytes, float]] = []
+        self.pending_lock = threading.Lock()  # Lock lá: append() được gọi khi đang giữ game.lock
+        self.write_lock = threading.Lock()  # Ghi tệp không chạy song song; append() không phải chờ
+        self.day: Optional[str] = None
+        self.fd: Optional[int] = None
+        self.games_archived = 0
+        self.stop_event = threading.Event()
+        today = day_of(time.time())
+        for day in os.listdir(root):
+            path = os.path.join(root, day, self.file_name)
+            if day != today and os.path.exists(path) and not os.path.exists(path[:-len('.dat')] + '.players'):
+                seal(path)  # Lần chạy trước dừng trước khi kịp niêm phong
+        self.flusher = threading.Thread(target=self.flush_loop, name='caro-archive-flush', daemon=True)
+        self.flusher.start()
+
+    def append(self, record: bytes, ended_at: float):
+        """Đưa một bản ghi (encode_game) vào hàng chờ ghi (không syscall)"""
+        with self.pending_lock:
+            self.pending.append((record, ended_at))
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Ghi hàng chờ: một lần write cho mỗi ngày, sang ngày mới thì niêm phong ngày cũ"""
+        with self.write_lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, []
+            chunk = bytearray()
+            for record, ended_at in pending:
+                day = day_of(ended_at)
+                if day != self.day:
+                    if chunk:
+                        os.write(self.fd, chunk)
+                        chunk = bytearray()
+                    self.open_day(day)
+                chunk += record
+            if chunk:
+                os.write(self.fd, chunk)
+            self.games_archived += len(pending)
+
+    def open_day(self, day: str):
+        previous = os.path.join(self.root, self.day, self.file_name) if self.day else None
+        if self.fd is not None:
+            os.close(self.fd)
+        directory = os.path.join(self.root, day)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self.file_name)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+        if os.fstat(self.fd).st_size:
+            # Bỏ bản ghi ghi dở nếu lần chạy trước dừng giữa chừng
+            with open(path, 'rb') as f:
+                data = f.read()
+            valid = 0
+            for offset, record in scan_records(data):
+                valid = offset + LENGTH.size + len(record)
+            os.truncate(path, valid)
+        self.day = day
+        if previous is not None:
+            # Niêm phong ngoài đường xử lý nước đi
+            threading.Thread(target=seal, args=(previous,), name='caro-archive-seal', daemon=True).start()
+
+    def close(self):
+        self.stop_event.set()
+        self.flusher.join()
+        self.flush()
+        with self.write_lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
@@ -0,0 +1,218 @@
+import asyncio
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+from CaroOutbox import DEFAULT_HIGH_WATER, Outbox
+from CaroProtocol import JSON_CODEC, RECV_SIZE, FrameDecoder, decode_message, encode_frame
+from CaroServer import TicTacToeServer, enable_keepalive
+from CaroShards import decode_pending, encode_pending
+
+
+class AsyncConnection:
+    """Bọc StreamWriter để các handler của TicTacToeServer dùng như ClientConnection.
+
+    Khung được đưa vào Outbox; một task flush trên event loop ghi ra transport và
+    chờ drain(), nên buffer của transport không phình ra khi client đọc chậm.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, high_water: int = DEFAULT_HIGH_WATER):
+        self.writer = writer
+        self.codec = JSON_CODEC
+        self.outbox = Outbox(high_water)
+        self.handoff = None
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.commit_wait: Optional[Callable[[], None]] = None
+        self.last_seen = time.monotonic()
+        self.heartbeat = False
+        self.flushing = False
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def sendall(self, data: bytes, collapse_key: Optional[int] = None):
+        if not self.outbox.put(data, collapse_key):
+            if self.outbox.evicted:
+                # Client quá chậm: cắt kết nối, reader sẽ nhận EOF và dọn dẹp
+                self.writer.transport.abort()
+            return
+        if not self.flushing:
+            self.flushing = True
+            self.flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Ghi các khung đang chờ cho đến khi Outbox rỗng"""
+        try:
+            while len(self.outbox):
+                frames, is_open = self.outbox.take(timeout=0)
+                if frames:
+                    if self.commit_wait is not None:
+                        # Nhật ký mức sync: chờ fsync ngoài event loop
+                        await asyncio.get_running_loop().run_in_executor(None, self.commit_wait)
+                    self.writer.write(b''.join(frames))
+                    await self.writer.drain()
+                if not is_open:
+                    break
+        except (ConnectionError, OSError):
+            self.outbox.close()
+            self.writer.transport.abort()
+        finally:
+            self.flushing = False
+
+    async def drain(self):
+        """Chờ ghi hết các khung đang chờ và buffer của transport (trước khi chuyển shard)"""
+        while self.flushing:
+            await self.flush_task
+        if len(self.outbox):
+            self.flushing = True
+            await self.flush()
+        self.writer.transport.set_write_buffer_limits(high=0)
+        await self.writer.drain()
+
+    def abort(self):
+        """Cắt kết nối chết (gọi trên event loop): reader nhận EOF và dọn dẹp"""
+        self.writer.transport.abort()
+
+    def close(self):
+        self.outbox.close()
+        self.writer.close()
+
+
+class AsyncCaroServer(TicTacToeServer):
+    """Server Cờ Caro chạy trên một event loop asyncio thay vì một thread cho mỗi client.
+
+    Dùng chung toàn bộ logic game (create_game, join_game, make_move, list_games)
+    với TicTacToeServer, chỉ thay phần vào/ra mạng.
+    """
+
+    def __init__(self, host='localhost', port=8888, backlog=4096, **options):
+        super().__init__(host, port, backlog, **options)
+        self.loop: asyncio.AbstractEventLoop = None
+
+    def start(self):
+        """Khởi động server"""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("\n🛑 Server dừng")
+        self.shutdown()
+
+    async def serve(self):
+        """Mở cổng và phục vụ cho đến khi bị dừng"""
+        self.loop = asyncio.get_running_loop()
+        self.start_metrics_http()
+        self.open_wal()
+        self.start_heartbeats()
+        if self.router is not None:
+            # Worker: router nhận kết nối từ tiến trình chính trên một thread riêng
+            self.print_startup('async')
+            await self.loop.run_in_executor(None, self.router.serve, self)
+            return
+
+        try:
+            server = await asyncio.start_server(
+                self.handle_connection,
+                self.host,
+                self.port,
+                backlog=self.backlog,
+                reuse_address=True
+            )
+        except OSError as e:
+            self.print_bind_error(e)
+            return
+
+        self.print_startup('async')
+        async with server:
+            await server.serve_forever()
+
+    def adopt_connection(self, sock: socket.socket, address, handoff: Optional[Dict] = None):
+        """Nhận kết nối do router chuyển tới (gọi từ thread router)"""
+        asyncio.run_coroutine_threadsafe(self.adopt(sock, handoff), self.loop)
+
+    async def adopt(self, sock: socket.socket, handoff: Optional[Dict]):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.handle_connection(reader, writer, handoff)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                handoff: Optional[Dict] = None):
+        """Xử lý kết nối từ client"""
+        client_id = self.next_client_id()
+        enable_keepalive(writer.get_extra_info('socket'), self.idle_timeout)
+        connection = AsyncConnection(writer, self.send_queue_limit)
+        self.register_client(client_id, connection)
+
+        print(f"✅ Client {client_id} kết nối từ {writer.get_extra_info('peername')}")
+        print(f"   Số client hiện tại: {len(self.clients)}")
+
+        handed_off = False
+        try:
+            decoder = FrameDecoder()
+            data = self.resume_handoff(client_id, connection, handoff) if handoff else None
+            while True:
+                if data is None:
+                    data = await reader.read(RECV_SIZE)
+
+                if not data:
+                    break
+
+                connection.last_seen = time.monotonic()
+                frames = decoder.feed(data)
+                connection.received_bytes += len(data)
+                connection.received_frames += len(frames)
+                data = None
+                for index, frame in enumerate(frames):
+                    self.process_message(client_id, decode_message(frame), connection)
+                    if connection.handoff is not None:
+                        pending = b''.join(map(encode_frame, frames[index + 1:])) + bytes(decoder.buffer)
+                        await self.hand_off(client_id, connection, reader, pending)
+                        handed_off = True
+                        return
+
+        except Exception as e:
+            print(f"❌ Lỗi client {client_id}: {e}")
+        finally:
+            if not handed_off:
+                self.disconnect_client(client_id, connection)
+
+    async def hand_off(self, client_id: int, connection: AsyncConnection, reader: asyncio.StreamReader,
+                       pending: bytes):
+        """Chuyển kết nối sang shard sở hữu game mà client muốn tham gia"""
+        transport = connection.writer.transport
+        transport.pause_reading()
+        state = self.detach_client(client_id, connection, pending)
+        await connection.drain()
+
+        # Từ đây không nhường event loop nữa: sau feed_eof, read() trả về ngay phần dữ liệu
+        # StreamReader đã nhận mà không chờ; chuyển socket và đóng transport trong cùng một
+        # bước của event loop. Phần chưa đọc vẫn nằm trong buffer của kernel và đi cùng socket.
+        reader.feed_eof()
+        buffered = await reader.read()
+        if buffered:
+            state['pending'] = encode_pending(decode_pending(state['pending']) + buffered)
+        self.router.hand_off(state, connection.writer.get_extra_info('socket').fileno())
+        transport.abort()
+
+    def query_archive(self, connection: AsyncConnection, action: str, message: Dict):
+        """Truy vấn kho lưu đọc đĩa: chạy trong executor, gửi trả lời trên event loop khi xong"""
+        future = self.loop.run_in_executor(None, self.archive_response, action, message)
+        future.add_done_callback(lambda f: self.send_archive_response(connection, action, f))
+    
+    def send_archive_response(self, connection: AsyncConnection, action: str, future: asyncio.Future):
+        try:
+            response = future.result()
+        except Exception as e:
+            print(f"❌ Lỗi truy vấn kho lưu ({action}): {e}")
+            response = {'action': 'error', 'message': 'Lỗi đọc lịch sử ván'}
+        self.send_message(connection, response)
+    
+    def call_later(self, delay: float, callback, *args):
+        """Hẹn giờ bằng chính event loop thay vì thread scheduler"""
+        return self.loop.call_later(delay, callback, *args)
+    
+    def call_soon_threadsafe(self, callback, *args):
+        """Chuyển callback từ thread khác (pool của CaroBot) về event loop"""
+        return self.loop.call_soon_threadsafe(callback, *args)
+
+
+if __name__ == '__main__':
+    server = AsyncCaroServer('localhost', 8888)
+    server.start()
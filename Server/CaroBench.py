@@ -0,0 +1,1184 @@
+import argparse
+import asyncio
+import contextlib
+import gc
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from CaroArchive import ArchiveReader, GameArchive, decode_game, encode_game, scan_records
+from CaroBook import OpeningBook
+from CaroBot import LEVELS, choose_move
+from CaroClock import ClockQueue, GameClock, parse_time_control
+from CaroGame import Game
+from CaroMatchmaker import SWEEP_INTERVAL, Matchmaker, MatchQueue, Ticket
+from CaroOutbox import Outbox
+from CaroRatings import RatingBook
+from CaroScheduler import TimerHandle
+from CaroServer import TicTacToeServer
+from CaroTimingWheel import TimingWheel
+from CaroWal import DURABILITY_LEVELS
+from CaroProtocol import BINARY_CODEC, HEADER, JSON_CODEC, decode_message, encode_message
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    """Lấy một cổng TCP còn trống trên localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    """Nâng giới hạn file descriptor để mở được nhiều kết nối"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def read_proc_stats(pid: int) -> Dict[str, float]:
+    """Đọc RSS, số thread và thời gian CPU của một tiến trình (chỉ Linux)"""
+    stats = {'rss_kb': 0.0, 'threads': 0.0, 'cpu_s': 0.0}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss_kb'] = float(line.split()[1])
+                elif line.startswith('Threads:'):
+                    stats['threads'] = float(line.split()[1])
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+            ticks = os.sysconf('SC_CLK_TCK')
+            stats['cpu_s'] = (int(fields[11]) + int(fields[12])) / ticks
+    except OSError:
+        pass
+    return stats
+
+
+def child_pids(pid: int) -> List[int]:
+    """Các tiến trình con trực tiếp của pid (chỉ Linux)"""
+    children = []
+    for task in os.listdir(f'/proc/{pid}/task') if os.path.isdir(f'/proc/{pid}/task') else ():
+        try:
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return children
+
+
+def read_tree_stats(pid: int) -> Dict[str, float]:
+    """read_proc_stats cộng dồn cho tiến trình và các tiến trình con (server nhiều shard)"""
+    total = read_proc_stats(pid)
+    for child in child_pids(pid):
+        for key, value in read_tree_stats(child).items():
+            total[key] += value
+    return total
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Phân vị p (0-100) của danh sách giá trị"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def start_server(engine: str, port: int, backlog: int, workers: int = 1,
+                 extra_args: Sequence[str] = ()) -> subprocess.Popen:
+    """Chạy server ở tiến trình con và chờ cổng mở"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SERVER_DIR, 'CaroServer.py'),
+         '--engine', engine, '--port', str(port), '--backlog', str(backlog), '--workers', str(workers),
+         *extra_args],
+        cwd=SERVER_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            probe = socket.create_connection(('localhost', port), timeout=0.2)
+            # Cổng lấy từ dải ephemeral nên có thể tự kết nối vào chính mình trước khi server mở
+            self_connected = probe.getsockname() == probe.getpeername()
+            probe.close()
+            if not self_connected:
+                return process
+        except OSError:
+            pass
+        time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f'Server {engine} không khởi động được')
+
+
+async def send_message(writer: asyncio.StreamWriter, message: Dict):
+    writer.write(encode_message(message))
+    await writer.drain()
+
+
+async def read_message(reader: asyncio.StreamReader) -> Dict:
+    header = await reader.readexactly(HEADER.size)
+    (size,) = HEADER.unpack(header)
+    return decode_message(await reader.readexactly(size))
+
+
+async def wait_for(reader: asyncio.StreamReader, action: str) -> Dict:
+    """Đọc cho đến khi nhận được tin nhắn có action mong muốn"""
+    while True:
+        message = await read_message(reader)
+        if message.get('action') == action:
+            return message
+
+
+async def open_idle_connections(port: int, count: int) -> List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+    """Mở count kết nối không làm gì, theo từng đợt để không tràn backlog"""
+    connections = []
+    batch = 500
+    for start in range(0, count, batch):
+        results = await asyncio.gather(
+            *[asyncio.open_connection('localhost', port) for _ in range(min(batch, count - start))],
+            return_exceptions=True
+        )
+        connections.extend(r for r in results if not isinstance(r, BaseException))
+    return connections
+
+
+# Các nước đi không thể tạo thành 5 quân liên tiếp nên game không kết thúc giữa chừng
+SAFE_MOVES = [0, 99, 2, 97, 4, 95, 6, 93]
+
+
+async def play_game(port: int, latencies: List[float]):
+    """Một cặp người chơi tạo game, tham gia và đánh các nước trong SAFE_MOVES"""
+    r1, w1 = await asyncio.open_connection('localhost', port)
+    r2, w2 = await asyncio.open_connection('localhost', port)
+    try:
+        await send_message(w1, {'action': 'create_game', 'player_name': 'bench1'})
+        created = await wait_for(r1, 'game_created')
+        game_id = created['game_id']
+
+        await send_message(w2, {'action': 'join_game', 'game_id': game_id, 'player_name': 'bench2'})
+        started = await wait_for(r1, 'game_started')
+        await wait_for(r2, 'game_started')
+
+        players = {1: (r1, w1), 2: (r2, w2)}
+        turn = started['current_turn']
+        for position in SAFE_MOVES:
+            reader, writer = players[turn]
+            other_reader, _ = players[3 - turn]
+            t0 = time.perf_counter()
+            await send_message(writer, {'action': 'move', 'game_id': game_id, 'position': position})
+            await wait_for(reader, 'board_updated')
+            latencies.append((time.perf_counter() - t0) * 1000)
+            await wait_for(other_reader, 'board_updated')
+            turn = 3 - turn
+    finally:
+        w1.close()
+        w2.close()
+
+
+async def bench_engine(engine: str, connections: int, games: int, backlog: int,
+                       workers: int = 1) -> Dict[str, float]:
+    port = free_port()
+    process = start_server(engine, port, backlog, workers)
+    try:
+        base = read_tree_stats(process.pid)
+        t0 = time.perf_counter()
+        idle = await open_idle_connections(port, connections)
+        await asyncio.sleep(1.0)
+        connect_time = time.perf_counter() - t0
+        loaded = read_tree_stats(process.pid)
+
+        latencies: List[float] = []
+        await asyncio.gather(*[play_game(port, latencies) for _ in range(games)], return_exceptions=True)
+
+        for _, writer in idle:
+            writer.close()
+
+        cpu = max(loaded['cpu_s'] - base['cpu_s'], 1e-6)
+        return {
+            'connections': len(idle),
+            'connect_s': connect_time,
+            'rss_mb': loaded['rss_kb'] / 1024,
+            'kb_per_conn': (loaded['rss_kb'] - base['rss_kb']) / max(len(idle), 1),
+            'threads': loaded['threads'],
+            'conn_per_cpu_s': len(idle) / cpu,
+            'moves': len(latencies),
+            'move_p50_ms': percentile(latencies, 50),
+            'move_p99_ms': percentile(latencies, 99),
+            'move_mean_ms': statistics.mean(latencies) if latencies else 0.0,
+        }
+    finally:
+        process.kill()
+        process.wait()
+
+
+def cmd_engines(args):
+    """So sánh engine threaded và async: số kết nối giữ được, bộ nhớ, độ trễ nước đi"""
+    raise_fd_limit()
+    results = {}
+    for engine in args.engine:
+        print(f"⏱  Đang đo engine {engine} với {args.connections} kết nối...")
+        results[engine] = asyncio.run(bench_engine(engine, args.connections, args.games, args.backlog,
+                                                     args.workers))
+
+    columns = ['connections', 'connect_s', 'rss_mb', 'kb_per_conn', 'threads',
+               'conn_per_cpu_s', 'moves', 'move_p50_ms', 'move_p99_ms', 'move_mean_ms']
+    print(f"{'metric':<16}" + ''.join(f"{engine:>14}" for engine in results))
+    for column in columns:
+        print(f"{column:<16}" + ''.join(f"{results[engine][column]:>14.2f}" for engine in results))
+
+
+def legacy_game(client_id: int, player_name: str, sock) -> Dict:
+    """Ván cờ dạng dict như trước khi có CaroGame.Game, dùng để so sánh bộ nhớ"""
+    return {
+        'player1': client_id,
+        'player2': None,
+        'player1_name': player_name,
+        'player2_name': None,
+        'board': ['' for _ in range(100)],
+        'current_turn': 1,
+        'status': 'waiting',
+        'sockets': {client_id: sock},
+        'first_player': None,
+        'created_at': datetime.now()
+    }
+
+
+def measure_games(factory, count: int) -> float:
+    """Số byte cấp phát trung bình cho một ván tạo bởi factory(i)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    games = {i: factory(i) for i in range(count)}
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del games
+    # Không tính phần dict self.games chứa các ván
+    return (after - before - sys.getsizeof({i: None for i in range(count)})) / count
+
+
+def cmd_memory(args):
+    """Đo số byte mỗi ván (dict cũ so với Game dùng bitboard) và số ván chứa được trong 1 GB"""
+    moves = list(range(0, 100, 3))[:args.moves]
+
+    def make_legacy(i):
+        game = legacy_game(i, f'Player {i}', None)
+        game['player2'], game['player2_name'], game['status'] = i + 1, f'Player {i + 1}', 'playing'
+        for k, position in enumerate(moves):
+            game['board'][position] = 'X' if k % 2 == 0 else 'O'
+        return game
+
+    def make_bitboard(i):
+        game = Game(i, f'Player {i}', {i: None})
+        game.player2, game.player2_name, game.status = i + 1, f'Player {i + 1}', 'playing'
+        for k, position in enumerate(moves):
+            game.play(position, 'X' if k % 2 == 0 else 'O')
+        return game
+
+    print(f"⏱  {args.games} ván, mỗi ván {len(moves)} nước")
+    print(f"{'kiểu':<12}{'byte/ván':>12}{'ván/GB':>14}")
+    for name, factory in (('dict', make_legacy), ('bitboard', make_bitboard)):
+        per_game = measure_games(factory, args.games)
+        print(f"{name:<12}{per_game:>12.0f}{int(2 ** 30 / per_game):>14,}")
+
+
+def time_per_call(fn, repeat: int) -> float:
+    """Thời gian trung bình (µs) của một lần gọi fn"""
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e6
+
+
+def cmd_delta(args):
+    """So sánh board_updated gửi cả bàn cờ với bản delta (chỉ nước vừa đánh + seq)"""
+    game = Game(1, 'A', {})
+    for k, position in enumerate(range(0, 100, 3)[:args.moves]):
+        game.play(position, 'X' if k % 2 == 0 else 'O')
+
+    delta = {
+        'action': 'board_updated',
+        'seq': game.seq,
+        'current_turn': 1,
+        'last_move': 42,
+        'last_symbol': 'X'
+    }
+
+    def encode_full():
+        return encode_message(dict(delta, board=game.to_board()))
+
+    def encode_delta():
+        return encode_message(delta)
+
+    full_bytes = encode_full()
+    delta_bytes = encode_delta()
+    rows = [
+        ('full', len(full_bytes), time_per_call(encode_full, args.repeat),
+         time_per_call(lambda: decode_message(full_bytes[HEADER.size:]), args.repeat)),
+        ('delta', len(delta_bytes), time_per_call(encode_delta, args.repeat),
+         time_per_call(lambda: decode_message(delta_bytes[HEADER.size:]), args.repeat)),
+    ]
+    print(f"{'kiểu':<8}{'byte':>8}{'encode µs':>12}{'decode µs':>12}")
+    for name, size, encode_us, decode_us in rows:
+        print(f"{name:<8}{size:>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+    print(f"Tiết kiệm: {rows[0][1] / rows[1][1]:.1f}x byte, {rows[0][2] / rows[1][2]:.1f}x thời gian encode")
+
+
+def sample_messages() -> Dict[str, Dict]:
+    """Các tin nhắn điển hình giữa một ván đang chơi"""
+    game = Game(1, 'Player 1', {})
+    for k, position in enumerate(range(0, 100, 3)[:30]):
+        game.play(position, 'X' if k % 2 == 0 else 'O')
+    board = game.to_board()
+    delta = {'action': 'board_updated', 'seq': game.seq, 'current_turn': 1, 'last_move': 42, 'last_symbol': 'X'}
+    return {
+        'move': {'action': 'move', 'game_id': 1234, 'position': 42},
+        'board_delta': delta,
+        'board_full': dict(delta, board=board),
+        'game_started': {
+            'action': 'game_started', 'game_id': 1234, 'player_symbol': 'X',
+            'player1_name': 'Player 1', 'player2_name': 'Player 2', 'board': board, 'seq': 0,
+            'current_turn': 1, 'first_player_symbol': 'X', 'first_player_name': 'Player 1'
+        },
+        'game_over': {'action': 'game_over', 'seq': game.seq, 'winner': 'X',
+                      'winning_positions': [0, 1, 2, 3, 4], 'winner_id': 7},
+    }
+
+
+def cmd_codec(args):
+    """So sánh kích thước và chi phí encode/decode của codec JSON và nhị phân"""
+    print(f"{'tin nhắn':<14}{'codec':<8}{'byte':>6}{'encode µs':>12}{'decode µs':>12}")
+    for name, message in sample_messages().items():
+        for codec in (JSON_CODEC, BINARY_CODEC):
+            frame = encode_message(message, codec)
+            payload = frame[HEADER.size:]
+            encode_us = time_per_call(lambda: encode_message(message, codec), args.repeat)
+            decode_us = time_per_call(lambda: decode_message(payload), args.repeat)
+            print(f"{name:<14}{codec.name:<8}{len(frame):>6}{encode_us:>12.2f}{decode_us:>12.2f}")
+
+
+class FakeConnection:
+    """Kết nối giả cho benchmark trong tiến trình: sendall ngủ latency giây như một syscall chậm.
+
+    latency = 0 tương ứng server hiện tại, nơi handler chỉ đưa khung vào Outbox còn
+    syscall chạy trên writer của kết nối.
+    """
+
+    def __init__(self, latency: float):
+        self.codec = JSON_CODEC
+        self.latency = latency
+        self.first_frame: Optional[bytes] = None
+        self.outbox = Outbox()  # Chỉ để disconnect_client đọc thống kê
+
+    def sendall(self, data: bytes, collapse_key: Optional[int] = None):
+        if self.first_frame is None:
+            self.first_frame = data
+        if self.latency:
+            time.sleep(self.latency)
+
+    def close(self):
+        pass
+
+
+def run_contention(games: int, duration: float, latency: float, shared_lock: bool) -> float:
+    """Chạy games ván song song (mỗi ván một thread), trả về số nước đi/giây"""
+    server = TicTacToeServer()
+    global_lock = threading.Lock()
+    # Server cũ gửi ngay trong lock chung; server hiện tại chỉ xếp hàng nên handler không chờ socket
+    send_latency = latency if shared_lock else 0.0
+    stop = threading.Event()
+    counts = [0] * games
+
+    def player_loop(index: int):
+        client1, client2 = 2 * index + 1, 2 * index + 2
+        while not stop.is_set():
+            conn1, conn2 = FakeConnection(send_latency), FakeConnection(send_latency)
+            server.create_game(client1, conn1, f'P{client1}')
+            game_id = decode_message(conn1.first_frame[HEADER.size:])['game_id']
+            game = server.games[game_id]
+            if shared_lock:
+                # Mô phỏng server cũ: một lock chung cho mọi ván
+                game.lock = global_lock
+            server.join_game(client2, game_id, conn2, f'P{client2}')
+            players = {1: client1, 2: client2}
+            for position in SAFE_MOVES:
+                server.make_move(players[game.current_turn], game_id, position)
+                counts[index] += 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        threads = [threading.Thread(target=player_loop, args=(i,), daemon=True) for i in range(games)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return sum(counts) / duration
+
+
+def cmd_contention(args):
+    """Thông lượng nước đi khi nhiều ván chạy song song: lock chung + gửi trong lock so với
+    lock theo ván + hàng đợi gửi"""
+    print(f"⏱  sendall giả lập {args.latency * 1000:.1f} ms, mỗi mức đo {args.duration:.1f}s")
+    print(f"{'số ván':>8}{'lock chung':>14}{'lock theo ván + outbox':>25}")
+    for games in args.games:
+        shared = run_contention(games, args.duration, args.latency, True)
+        per_game = run_contention(games, args.duration, args.latency, False)
+        print(f"{games:>8}{shared:>14.0f}{per_game:>25.0f}")
+
+
+class QueueConnection:
+    """Kết nối chỉ có Outbox (không writer): đo chi phí phát tin mà không tính syscall"""
+
+    def __init__(self, codec=JSON_CODEC, high_water: int = 1 << 20):
+        self.codec = codec
+        self.outbox = Outbox(high_water)
+        self.handoff = None
+        self.received_frames = 0
+        self.received_bytes = 0
+
+    def sendall(self, data: bytes, collapse_key: Optional[int] = None):
+        self.outbox.put(data, collapse_key)
+
+    def close(self):
+        pass
+
+
+def run_fan_out(watchers: int, events: int, encode_once: bool) -> float:
+    """µs để phát một board_updated tới hai người chơi và watchers người xem (delta, codec nhị phân)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = TicTacToeServer()
+        players = [QueueConnection(BINARY_CODEC), QueueConnection(BINARY_CODEC)]
+        server.create_game(1, players[0], 'P1')
+        server.join_game(2, 1, players[1], 'P2')
+        for client_id in range(3, watchers + 3):
+            server.spectate(client_id, 1, QueueConnection(BINARY_CODEC))
+        server.delta_clients.update(range(1, watchers + 3))
+    game = server.games[1]
+    message = {'action': 'board_updated', 'seq': 1, 'current_turn': 2, 'last_move': 0, 'last_symbol': 'X'}
+    recipients = list(game.sockets.values()) + list((game.spectators or {}).values())
+
+    def send_each():
+        # Cách cũ: mã hóa lại cho từng người nhận
+        for sock in recipients:
+            server.send_message(sock, message, collapse_key=1)
+
+    fan_out = (lambda: server.broadcast(game, message, collapse_key=1)) if encode_once else send_each
+    return time_per_call(fan_out, events)
+
+
+def cmd_spectators(args):
+    """Chi phí phát một nước đi theo số người xem: mã hóa mỗi người nhận so với mã hóa một lần"""
+    print(f"⏱  {args.events} sự kiện mỗi mức, hai người chơi + người xem (delta, codec nhị phân)")
+    print(f"{'người xem':>10}{'mỗi người µs':>15}{'một lần µs':>13}{'µs/người nhận':>16}")
+    for watchers in args.watchers:
+        each = run_fan_out(watchers, args.events, False)
+        once = run_fan_out(watchers, args.events, True)
+        print(f"{watchers:>10}{each:>15.1f}{once:>13.1f}{once / (watchers + 2):>16.2f}")
+
+
+def lobby_herd(players: int, waiting: int, page: int) -> Dict[str, int]:
+    """players người cùng đọc một trang sảnh rồi join_game một game trong trang, so với quick_match"""
+    rng = random.Random(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = TicTacToeServer()
+        for creator in range(1, waiting + 1):
+            conn = QueueConnection()
+            server.register_client(creator, conn)
+            server.create_game(creator, conn, f'P{creator}')
+        listed = [entry['game_id'] for entry in server.lobby.page(0, page)['games']]
+        joiners = [QueueConnection() for _ in range(players)]
+        for index, conn in enumerate(joiners):
+            client_id = waiting + 1 + index
+            server.register_client(client_id, conn)
+            server.join_game(client_id, rng.choice(listed), conn, f'P{client_id}')
+
+        matchers = [QueueConnection() for _ in range(players)]
+        for index, conn in enumerate(matchers):
+            client_id = waiting + players + 1 + index
+            server.register_client(client_id, conn)
+            server.quick_match(client_id, conn, f'P{client_id}')
+
+    def count(conns, action):
+        frames = [frame for conn in conns for frame in conn.outbox.take(timeout=0)[0]]
+        return sum(decode_message(frame[HEADER.size:])['action'] == action for frame in frames)
+
+    return {'join_errors': count(joiners, 'error'), 'match_started': count(matchers, 'game_started')}
+
+
+def simulate_matchmaking(rate: float, duration: float, spread: float) -> Dict[str, float]:
+    """Người chơi đến theo Poisson (rate người/giây, rating ~ N(1500, spread)), đồng hồ giả lập"""
+    rng = random.Random(0)
+    matchmaker = Matchmaker()
+    waits, gaps = [], []
+    now, next_sweep, client_id = 0.0, SWEEP_INTERVAL, 0
+
+    def record(pairs, at):
+        for first, second in pairs:
+            waits.extend((at - first.enqueued_at, at - second.enqueued_at))
+            gaps.append(abs(first.rating - second.rating))
+
+    while now < duration:
+        now += rng.expovariate(rate)
+        while next_sweep <= now:
+            record(matchmaker.sweep(next_sweep), next_sweep)
+            next_sweep += SWEEP_INTERVAL
+        client_id += 1
+        pair = matchmaker.enqueue(Ticket(client_id, '', rng.gauss(1500, spread), (10, 5), None, now), now)
+        if pair is not None:
+            record([pair], now)
+    return {'players': client_id, 'matched': len(waits), 'waiting': len(matchmaker),
+            'p50': percentile(waits, 50), 'p99': percentile(waits, 99), 'max': max(waits, default=0),
+            'gap': statistics.mean(gaps) if gaps else 0.0}
+
+
+def cmd_matchmaking(args):
+    """quick_match: lỗi 'Game đã đầy' của sảnh, chi phí tìm đối thủ theo cỡ hàng đợi, thời gian chờ"""
+    herd = lobby_herd(args.players, args.waiting, 20)
+    print(f"🐘 {args.players} người cùng vào sảnh có {args.waiting} game chờ: "
+          f"{herd['join_errors']} lần 'Game đã đầy'; quick_match: {herd['match_started']} người vào game, 0 lỗi")
+
+    print(f"{'hàng đợi':>10}{'µs/tìm':>10}")
+    rng = random.Random(1)
+    for size in args.queue_sizes:
+        queue = MatchQueue(50)
+        tickets = [Ticket(i, '', rng.gauss(1500, 300), (10, 5), None, 0.0) for i in range(size)]
+        for ticket in tickets:
+            queue.add(ticket)
+        probe = lambda: queue.find(rng.choice(tickets), 100, 100, lambda t: 100)
+        print(f"{size:>10}{time_per_call(probe, args.repeat):>10.2f}")
+
+    print(f"{'người/giây':>10}{'đã ghép':>10}{'p50 s':>8}{'p99 s':>8}{'max s':>8}{'chênh rating':>14}")
+    for rate in args.rates:
+        result = simulate_matchmaking(rate, args.duration, args.spread)
+        print(f"{rate:>10g}{result['matched']:>10}{result['p50']:>8.2f}{result['p99']:>8.2f}"
+              f"{result['max']:>8.2f}{result['gap']:>14.1f}")
+
+
+def fill_ratings(players: int, rng: random.Random, path: Optional[str] = None) -> Tuple[RatingBook, List[str]]:
+    """RatingBook có players người, mỗi người đã chơi vài ván với đối thủ ngẫu nhiên"""
+    book = RatingBook(path, flush_interval=3600)
+    names = [f'P{i}' for i in range(players)]
+    for index in range(players * 2):
+        first, second = names[index % players], rng.choice(names)
+        if first != second:
+            book.record_game(first, second, rng.choice((0.0, 0.5, 1.0)))
+    return book, names
+
+
+def cmd_ratings(args):
+    """Rating Elo: µs mỗi lần cập nhật / tra hạng / trang leaderboard so với sắp xếp lại cả danh sách"""
+    rng = random.Random(1)
+    print(f"{'người chơi':>10}{'µs/ván':>9}{'µs/hạng':>9}{'µs/hạng sort':>14}"
+          f"{'µs/trang':>10}{'µs/trang cache':>16}{'µs/trang sort':>15}")
+    for size in args.players:
+        book, names = fill_ratings(size, rng)
+        play = lambda: book.record_game(rng.choice(names), rng.choice(names), rng.choice((0.0, 1.0)))
+        rank = lambda: book.rank_of(rng.choice(names))
+
+        def rank_sorted():
+            name = rng.choice(names)
+            ordered = sorted(book.players, key=lambda n: (-book.players[n].rating, n))
+            return ordered.index(name) + 1
+
+        def page_uncached():
+            book.pages.clear()
+            return book.page_frame(args.limit, JSON_CODEC)
+
+        page_cached = lambda: book.page_frame(args.limit, JSON_CODEC)
+        page_sorted = lambda: encode_message({'action': 'leaderboard', 'players': [
+            {'player_name': n, 'rating': book.players[n].rating}
+            for n in sorted(book.players, key=lambda n: -book.players[n].rating)[:args.limit]]}, JSON_CODEC)
+        sort_repeat = max(1, args.repeat // size)
+        print(f"{size:>10}{time_per_call(play, args.repeat):>9.2f}{time_per_call(rank, args.repeat):>9.2f}"
+              f"{time_per_call(rank_sorted, sort_repeat):>14.0f}{time_per_call(page_uncached, args.repeat):>10.2f}"
+              f"{time_per_call(page_cached, args.repeat):>16.2f}{time_per_call(page_sorted, sort_repeat):>15.0f}")
+
+    directory = tempfile.mkdtemp(prefix='caro-ratings-')
+    try:
+        book, names = fill_ratings(args.flush_players, rng, os.path.join(directory, 'ratings.jsonl'))
+        book.flush()
+        for _ in range(args.flush_games):
+            book.record_game(rng.choice(names), rng.choice(names), 1.0)
+        t0 = time.perf_counter()
+        book.flush()
+        batched = time.perf_counter() - t0
+        book.close()
+        print(f"💾 Ghi {args.flush_games} ván theo lô: {batched * 1e3:.2f} ms (một lần write + fsync)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def simulate_heartbeats(connections: int, duration: float, message_interval: float, ping_interval: float,
+                        timer_wheel: bool) -> Dict[str, float]:
+    """Chi phí hẹn giờ nhàn rỗi của connections kết nối, mỗi kết nối gửi một tin mỗi message_interval giây.
+
+    heap: mỗi tin hủy hẹn giờ cũ và đẩy hẹn giờ mới vào heap (cách làm thường gặp).
+    wheel: mỗi tin chỉ ghi last_seen; hẹn giờ trên bánh xe tự hẹn lại khi kết nối còn hoạt động.
+    Đồng hồ giả lập, chỉ đo thời gian của phần hẹn giờ.
+    """
+    wheel = TimingWheel()
+    tick = wheel.tick
+    heap: List[Tuple[float, int, TimerHandle]] = []
+    handles: List[Optional[TimerHandle]] = [None] * connections
+    last_seen = [0.0] * connections
+    counter = 0
+    peak = fired = 0
+    elapsed = 0.0
+
+    def check(client_id: int, now: float):
+        idle = now - last_seen[client_id]
+        wheel.call_at(wheel.origin + now + max(tick, ping_interval - idle), check, client_id)
+
+    t0 = time.perf_counter()
+    for client_id in range(connections):
+        if timer_wheel:
+            wheel.call_at(wheel.origin + ping_interval, check, client_id)
+        else:
+            handles[client_id] = TimerHandle(ping_interval, None, (client_id,))
+            heap.append((ping_interval, client_id, handles[client_id]))
+    heapq.heapify(heap)
+    counter = connections
+    elapsed += time.perf_counter() - t0
+
+    per_tick = max(1, round(message_interval / tick))
+    for step in range(1, int(duration / tick) + 1):
+        now = step * tick
+        # Mỗi nhịp một phần kết nối gửi tin, rải đều để mỗi kết nối gửi một tin mỗi message_interval
+        senders = range(step % per_tick, connections, per_tick)
+        t0 = time.perf_counter()
+        if timer_wheel:
+            for client_id in senders:
+                last_seen[client_id] = now
+            for timer in wheel.advance(wheel.origin + now):
+                timer.callback(*timer.args, now)
+                fired += 1
+            peak = max(peak, len(wheel))
+        else:
+            for client_id in senders:
+                handles[client_id].cancel()
+                handle = handles[client_id] = TimerHandle(now + ping_interval, None, (client_id,))
+                heapq.heappush(heap, (now + ping_interval, counter, handle))
+                counter += 1
+            peak = max(peak, len(heap))
+            while heap and heap[0][0] <= now:
+                _, _, handle = heapq.heappop(heap)
+                if not handle.cancelled:
+                    fired += 1
+        elapsed += time.perf_counter() - t0
+    messages = connections * duration / message_interval
+    return {'us_per_message': elapsed / messages * 1e6, 'cpu_ms': elapsed * 1e3, 'peak': peak, 'fired': fired}
+
+
+def cmd_heartbeats(args):
+    """Hẹn giờ ping / thu hồi kết nối: heap hẹn lại mỗi tin so với bánh xe hẹn giờ"""
+    print(f"⏱  {args.duration:.0f} giây giả lập, mỗi kết nối một tin / {args.message_interval:g} giây, "
+          f"ping {args.ping_interval:g} giây")
+    print(f"{'kết nối':>9}{'cách':>7}{'µs/tin':>9}{'ms CPU':>10}{'hẹn giờ tối đa':>16}{'lần chạy':>10}")
+    for connections in args.connections:
+        for timer_wheel in (False, True):
+            result = simulate_heartbeats(connections, args.duration, args.message_interval,
+                                         args.ping_interval, timer_wheel)
+            print(f"{connections:>9}{'wheel' if timer_wheel else 'heap':>7}{result['us_per_message']:>9.3f}"
+                  f"{result['cpu_ms']:>10.1f}{result['peak']:>16}{result['fired']:>10}")
+
+
+def simulate_clocks(games: int, duration: float, move_interval: float, time_control: Dict,
+                    shared_queue: bool) -> Dict[str, float]:
+    """Chi phí giữ mốc hết giờ của games ván có đồng hồ, mỗi ván một nước mỗi move_interval giây.
+
+    timers: mỗi nước hủy hẹn giờ của ván và đẩy hẹn giờ mới vào heap scheduler (mỗi đồng hồ một hẹn giờ).
+    queue: ClockQueue dùng chung, bấm đồng hồ chỉ đẩy vào heap khi mốc mới sớm hơn mốc đang có.
+    Đồng hồ giả lập, chỉ đo thời gian của phần hẹn giờ; thread hẹn giờ thức mỗi tick giây.
+    """
+    control, _ = parse_time_control(time_control)
+    tick = 0.1
+    clocks = [GameClock(control) for _ in range(games)]
+    queue = ClockQueue()
+    heap: List[Tuple[float, int, TimerHandle]] = []
+    handles: List[Optional[TimerHandle]] = [None] * games
+    counter = itertools.count()
+    wakes = []  # Hẹn giờ đánh thức của ClockQueue (mốc)
+    peak = flags = 0
+    elapsed = 0.0
+
+    def arm(game_id: int):
+        if shared_queue:
+            wake = queue.schedule(game_id, clocks[game_id])
+            if wake is not None:
+                heapq.heappush(wakes, wake)
+        else:
+            if handles[game_id] is not None:
+                handles[game_id].cancel()
+            deadline = clocks[game_id].deadline()
+            handle = handles[game_id] = TimerHandle(deadline, None, (game_id,))
+            heapq.heappush(heap, (deadline, next(counter), handle))
+
+    t0 = time.perf_counter()
+    for game_id, clock in enumerate(clocks):
+        clock.start(1, 0.0)
+        arm(game_id)
+    elapsed += time.perf_counter() - t0
+
+    per_tick = max(1, round(move_interval / tick))
+    for step in range(1, int(duration / tick) + 1):
+        now = step * tick
+        # Mỗi nhịp một phần các ván có nước đi, rải đều để mỗi ván đi một nước mỗi move_interval
+        movers = range(step % per_tick, games, per_tick)
+        t0 = time.perf_counter()
+        for game_id in movers:
+            clocks[game_id].press(now)
+            arm(game_id)
+        if shared_queue:
+            while wakes and wakes[0] <= now:
+                due, wake = queue.pop_due(now, heapq.heappop(wakes))
+                if wake is not None:
+                    heapq.heappush(wakes, wake)
+                for game_id, clock, deadline in due:
+                    if clock.queued != deadline:
+                        continue
+                    clock.queued = None
+                    if clock.deadline() <= now:
+                        flags += 1
+                    else:
+                        arm(game_id)
+            peak = max(peak, len(queue))
+        else:
+            while heap and heap[0][0] <= now:
+                _, _, handle = heapq.heappop(heap)
+                if not handle.cancelled:
+                    flags += 1
+            peak = max(peak, len(heap))
+        elapsed += time.perf_counter() - t0
+    moves = games * duration / move_interval
+    return {'us_per_move': elapsed / moves * 1e6, 'cpu_ms': elapsed * 1e3, 'peak': peak, 'flags': flags}
+
+
+def cmd_clocks(args):
+    """Đồng hồ ván cờ: mỗi đồng hồ một hẹn giờ so với hàng đợi mốc dùng chung (ClockQueue)"""
+    controls = {'base': {'base': args.base, 'increment': args.increment}, 'per_move': {'per_move': args.per_move}}
+    print(f"⏱  {args.duration:.0f} giây giả lập, mỗi ván một nước / {args.move_interval:g} giây")
+    print(f"{'ván':>8}{'time control':>14}{'cách':>8}{'µs/nước':>10}{'ms CPU':>10}{'mục heap tối đa':>17}")
+    for games in args.games:
+        for name, control in controls.items():
+            for shared_queue in (False, True):
+                result = simulate_clocks(games, args.duration, args.move_interval, control, shared_queue)
+                print(f"{games:>8}{name:>14}{'queue' if shared_queue else 'timers':>8}"
+                      f"{result['us_per_move']:>10.3f}{result['cpu_ms']:>10.1f}{result['peak']:>17}")
+
+
+def run_durability(level: str, games: int, duration: float, fsync_interval: float) -> Dict[str, float]:
+    """Thông lượng và độ trễ make_move với nhật ký ghi trước ở mức level ('off': không ghi)"""
+    directory = tempfile.mkdtemp(prefix='caro-wal-')
+    with contextlib.redirect_stdout(io.StringIO()):
+        if level == 'off':
+            server = TicTacToeServer()
+        else:
+            server = TicTacToeServer(wal_dir=directory, durability=level, fsync_interval=fsync_interval)
+            server.open_wal()
+    stop = threading.Event()
+    latencies: List[List[float]] = [[] for _ in range(games)]
+
+    def player_loop(index: int):
+        client1, client2 = 2 * index + 1, 2 * index + 2
+        while not stop.is_set():
+            conn1, conn2 = FakeConnection(0), FakeConnection(0)
+            server.create_game(client1, conn1, f'P{client1}')
+            game_id = decode_message(conn1.first_frame[HEADER.size:])['game_id']
+            game = server.games[game_id]
+            server.join_game(client2, game_id, conn2, f'P{client2}')
+            players = {1: client1, 2: client2}
+            for position in SAFE_MOVES:
+                t0 = time.perf_counter()
+                server.make_move(players[game.current_turn], game_id, position)
+                if level == 'sync':
+                    server.wal.wait_committed()  # Như writer của kết nối trước khi gửi board_updated
+                latencies[index].append(time.perf_counter() - t0)
+
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            threads = [threading.Thread(target=player_loop, args=(i,), daemon=True) for i in range(games)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            wal = server.wal
+            server.shutdown()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    moves = [latency for per_game in latencies for latency in per_game]
+    return {
+        'moves_per_s': len(moves) / duration,
+        'p50_us': percentile(moves, 50) * 1e6,
+        'p99_us': percentile(moves, 99) * 1e6,
+        'records': wal.records if wal else 0,
+        'fsyncs': wal.fsyncs if wal else 0,
+    }
+
+
+def cmd_durability(args):
+    """Chi phí của từng mức bền vững: không ghi, write, group commit, fsync mỗi bản ghi"""
+    print(f"⏱  {args.games} ván song song, mỗi mức {args.duration:.1f}s, chu kỳ group {args.fsync_interval * 1000:.0f} ms")
+    print(f"{'mức':<8}{'nước/giây':>12}{'p50 µs':>10}{'p99 µs':>10}{'bản ghi':>10}{'fsync':>8}{'so với off':>12}")
+    baseline = None
+    for level in args.levels:
+        result = run_durability(level, args.games, args.duration, args.fsync_interval)
+        baseline = baseline or result['moves_per_s']
+        print(f"{level:<8}{result['moves_per_s']:>12.0f}{result['p50_us']:>10.1f}{result['p99_us']:>10.1f}"
+              f"{result['records']:>10}{result['fsyncs']:>8}{result['moves_per_s'] / baseline:>11.0%}")
+
+
+def fill_archive(root: str, days: int, games_per_day: int, players: int, moves: int) -> List[str]:
+    """Ghi games_per_day ván ngẫu nhiên cho mỗi ngày trong days ngày gần nhất; trả về tên người chơi"""
+    rng = random.Random(0)
+    names = [f'Player {i}' for i in range(players)]
+    archive = GameArchive(root)
+    now = time.time()
+    game_id = 0
+    for day in range(days - 1, -1, -1):
+        for index in range(games_per_day):
+            game_id += 1
+            game = Game(0, '', {})
+            game.player1_name, game.player2_name = rng.sample(names, 2)
+            game.first_player = rng.choice((1, 2))
+            symbol = 'X' if game.first_player == 1 else 'O'
+            for position in rng.sample(range(100), rng.randint(9, moves)):
+                game.play(position, symbol)
+                symbol = 'O' if symbol == 'X' else 'X'
+            ended_at = now - day * 86400 - (games_per_day - index)
+            archive.append(encode_game(game_id, game, rng.randint(0, 3), ended_at), ended_at)
+    archive.close()
+    return names
+
+
+def scan_recent_games(root: str, player_name: str, limit: int) -> List[Dict]:
+    """Cách làm ngây thơ: đọc và giải mã mọi bản ghi của mọi ngày"""
+    games = []
+    for day in sorted(os.listdir(root), reverse=True):
+        for file_name in os.listdir(os.path.join(root, day)):
+            if file_name.endswith('.dat'):
+                with open(os.path.join(root, day, file_name), 'rb') as f:
+                    data = f.read()
+                for _, record in scan_records(data):
+                    game = decode_game(record)
+                    if player_name in (game['player1_name'], game['player2_name']):
+                        games.append(game)
+    games.sort(key=lambda game: (game['ended_at'], game['game_id']), reverse=True)
+    return games[:limit]
+
+
+def cmd_archive(args):
+    """Kích thước trên đĩa và thời gian truy vấn kho lưu ván: chỉ mục mmap so với quét toàn bộ"""
+    root = tempfile.mkdtemp(prefix='caro-archive-')
+    try:
+        t0 = time.perf_counter()
+        names = fill_archive(root, args.days, args.games_per_day, args.players, args.moves)
+        games = args.days * args.games_per_day
+        write_us = (time.perf_counter() - t0) / games * 1e6
+        time.sleep(0.5)  # Chờ các thread niêm phong
+        data_bytes = index_bytes = 0
+        for day in os.listdir(root):
+            for file_name in os.listdir(os.path.join(root, day)):
+                size = os.path.getsize(os.path.join(root, day, file_name))
+                if file_name.endswith('.dat'):
+                    data_bytes += size
+                else:
+                    index_bytes += size
+        print(f"💾 {games} ván trong {args.days} ngày, {args.players} người chơi: "
+              f"{data_bytes / games:.1f} byte/ván + chỉ mục {index_bytes / games:.1f} byte/ván, "
+              f"tạo + ghi {write_us:.1f} µs/ván")
+
+        reader = ArchiveReader(root)
+        rng = random.Random(1)
+        last_id = games
+        queries = {
+            f'game_history {args.limit}': lambda: reader.recent_games(rng.choice(names), args.limit),
+            'player_stats': lambda: reader.player_totals(rng.choice(names)),
+            'replay': lambda: reader.game(rng.randint(1, last_id)),
+            f'quét toàn bộ {args.limit}': lambda: scan_recent_games(root, rng.choice(names), args.limit),
+        }
+        print(f"{'truy vấn':<20}{'µs/lần':>12}")
+        for label, query in queries.items():
+            repeat = args.scan_repeat if label.startswith('quét') else args.repeat
+            print(f"{label:<20}{time_per_call(query, repeat):>12.1f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def legacy_game_list(server: TicTacToeServer) -> bytes:
+    """list_games kiểu cũ: quét mọi game dưới lock registry rồi mã hóa toàn bộ danh sách"""
+    with server.lock:
+        waiting_games = [
+            {'game_id': gid, 'player1': g.player1, 'player1_name': g.player1_name}
+            for gid, g in server.games.items()
+            if g.status == 'waiting'
+        ]
+    return encode_message({'action': 'game_list', 'games': waiting_games})
+
+
+def cmd_lobby(args):
+    """Chi phí một lần list_games: quét toàn bộ so với trang lấy từ chỉ mục + cache"""
+    print(f"{'số game':>10}{'quét µs':>12}{'trang µs':>12}{'trang (cache miss) µs':>24}")
+    for total in args.games:
+        server = TicTacToeServer()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for client_id in range(1, total + 1):
+                server.create_game(client_id, FakeConnection(0), f'Player {client_id}')
+            # Một nửa số game đã có người chơi thứ hai
+            for game_id in range(1, total + 1, 2):
+                server.join_game(total + game_id, game_id, FakeConnection(0), 'B')
+        conn = FakeConnection(0)
+        repeat = max(10, args.repeat // max(1, total // 1000))
+        scan_us = time_per_call(lambda: legacy_game_list(server), repeat)
+        page_us = time_per_call(lambda: server.send_game_list(0, conn, 0, args.limit), args.repeat)
+
+        def miss():
+            server.lobby.pages.clear()
+            server.send_game_list(0, conn, 0, args.limit)
+        miss_us = time_per_call(miss, args.repeat)
+        print(f"{total:>10}{scan_us:>12.1f}{page_us:>12.2f}{miss_us:>24.1f}")
+
+
+def cmd_boards(args):
+    """Bộ nhớ, thời gian một nước (kèm kiểm tra thắng) và cỡ ảnh chụp JSON theo cỡ bàn"""
+    print(f"⏱  {args.games} ván, mỗi ván {args.moves} nước")
+    print(f"{'cỡ bàn':<14}{'lưu':>10}{'byte/ván':>12}{'µs/nước':>10}{'ảnh chụp B':>12}{'board đầy đủ B':>16}")
+    for size in args.sizes:
+        width = size or 19
+        # Nước rải đều theo hàng, xen kẽ X/O; bàn không giới hạn dùng tọa độ quanh gốc
+        cells = [divmod(p, width) for p in range(0, width * width, 3)][:args.moves]
+
+        def make(i):
+            game = Game(i, f'Player {i}', {i: None}, size)
+            for k, (row, col) in enumerate(cells):
+                game.play(game.position_of(row - width // 2, col) if not size else row * size + col,
+                          'X' if k % 2 == 0 else 'O')
+            return game
+
+        per_game = measure_games(make, args.games)
+        play_us = time_per_call(lambda: make(0), max(1, args.repeat // max(1, len(cells)))) / max(1, len(cells))
+        game = make(0)
+        snapshot = len(encode_message(game.board_fields()))
+        full = len(encode_message({'board': [game.symbol_at(p) for p in range(size * size)]})) if size else 0
+        name = f'{size}x{size}' if size else 'không giới hạn'
+        kind = 'thưa' if game.cells is not None else 'bitboard'
+        print(f"{name:<14}{kind:>10}{per_game:>12.0f}{play_us:>10.2f}{snapshot:>12}{full or '-':>16}")
+
+
+def bot_self_play(level: str, board_size: int, win_length: int, games: int, moves: int):
+    """Cho máy tự đấu; trả về các thế cờ đã tìm [(stones, symbol)] và kết quả choose_move tương ứng"""
+    positions, results = [], []
+    budget = LEVELS[level]['time_budget']
+    for index in range(games):
+        rng = random.Random(index)
+        game = Game(0, 'A', {}, board_size, win_length)
+        # Hai nước mở đầu ngẫu nhiên gần giữa bàn để các ván khác nhau
+        center = board_size // 2 if board_size else 0
+        for symbol in 'XO':
+            while True:
+                position = game.position_of(center + rng.randint(-2, 2), center + rng.randint(-2, 2))
+                if game.is_empty(position):
+                    game.play(position, symbol)
+                    break
+        symbol = 'X'
+        while game.moves < moves:
+            stones = game.stone_list()
+            result = choose_move(stones, symbol, board_size, win_length, time.monotonic() + budget, level)
+            positions.append((stones, symbol))
+            results.append(result)
+            if result['row'] is None:
+                break
+            winner, _ = game.play(game.position_of(result['row'], result['col']), symbol)
+            if winner or game.is_full():
+                break
+            symbol = 'O' if symbol == 'X' else 'X'
+    return positions, results
+
+
+def cmd_bot(args):
+    """Nút/giây, độ sâu và độ trễ mỗi nước của CaroBot theo cấp độ, tính trong tiến trình và qua pool"""
+    print(f"⏱  bàn {args.board_size or 'không giới hạn'}, {args.games} ván tự đấu mỗi cấp, tối đa {args.moves} nước")
+    print(f"{'cấp':<8}{'nước':>6}{'nút/giây':>10}{'độ sâu':>8}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'pool p50':>10}{'pool p99':>10}")
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pool.submit(choose_move, [], 'X', args.board_size, args.win_length, time.monotonic() + 1).result()
+        for level in args.levels:
+            positions, results = bot_self_play(level, args.board_size, args.win_length, args.games, args.moves)
+            elapsed = [r['elapsed'] for r in results]
+            nodes_per_s = sum(r['nodes'] for r in results) / max(sum(elapsed), 1e-9)
+            depth = statistics.mean(r['depth'] for r in results)
+
+            # Độ trễ server thấy: giao việc cho pool đến khi có kết quả (gồm pickle và IPC)
+            budget = LEVELS[level]['time_budget']
+            round_trips = []
+            for stones, symbol in positions[:args.pool_moves]:
+                t0 = time.perf_counter()
+                pool.submit(choose_move, stones, symbol, args.board_size, args.win_length,
+                            time.monotonic() + budget, level).result()
+                round_trips.append(time.perf_counter() - t0)
+
+            print(f"{level:<8}{len(results):>6}{nodes_per_s:>10.0f}{depth:>8.1f}"
+                  f"{percentile(elapsed, 50) * 1000:>9.1f}{percentile(elapsed, 99) * 1000:>9.1f}"
+                  f"{max(elapsed) * 1000:>9.1f}{percentile(round_trips, 50) * 1000:>10.1f}"
+                  f"{percentile(round_trips, 99) * 1000:>10.1f}")
+
+    if args.book:
+        # Tra sách khai cuộc cho các thế đầu ván (ít quân hơn max_stones) của lần tự đấu cuối
+        book = OpeningBook(args.book)
+        if (book.board_size, book.win_length) != (args.board_size, args.win_length):
+            print(f"⚠️  sách dành cho bàn {book.board_size}/{book.win_length}, bỏ qua")
+            return
+        openings = [(stones, symbol) for stones, symbol in positions if len(stones) <= book.max_stones]
+        hits, lookups = 0, []
+        for stones, symbol in openings * 100:
+            t0 = time.perf_counter()
+            hits += book.lookup(stones, symbol) is not None
+            lookups.append(time.perf_counter() - t0)
+        print(f"📖 sách {len(book)} thế: {len(openings)} thế đầu ván, trúng {hits // 100}, "
+              f"tra p50 {percentile(lookups, 50) * 1e6:.1f} µs, p99 {percentile(lookups, 99) * 1e6:.1f} µs")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Benchmark server Cờ Caro')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    engines = subparsers.add_parser('engines', help='So sánh engine threaded và async')
+    engines.add_argument('--engine', action='append', choices=['threaded', 'async'],
+                         help='Engine cần đo (mặc định: cả hai)')
+    engines.add_argument('--connections', type=int, default=10000)
+    engines.add_argument('--games', type=int, default=50)
+    engines.add_argument('--backlog', type=int, default=4096)
+    engines.add_argument('--workers', type=int, default=1, help='Số tiến trình server (shard)')
+    engines.set_defaults(func=cmd_engines)
+
+    memory = subparsers.add_parser('memory', help='Bộ nhớ mỗi ván: dict so với bitboard')
+    memory.add_argument('--games', type=int, default=100000)
+    memory.add_argument('--moves', type=int, default=30, help='Số nước đã đánh trong mỗi ván')
+    memory.set_defaults(func=cmd_memory)
+
+    delta = subparsers.add_parser('delta', help='Kích thước và chi phí board_updated: cả bàn cờ so với delta')
+    delta.add_argument('--moves', type=int, default=30)
+    delta.add_argument('--repeat', type=int, default=20000)
+    delta.set_defaults(func=cmd_delta)
+
+    codec = subparsers.add_parser('codec', help='Codec JSON so với nhị phân: byte và µs mỗi tin nhắn')
+    codec.add_argument('--repeat', type=int, default=20000)
+    codec.set_defaults(func=cmd_codec)
+
+    contention = subparsers.add_parser('contention', help='Thông lượng nước đi theo số ván chạy song song')
+    contention.add_argument('--games', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    contention.add_argument('--duration', type=float, default=2.0)
+    contention.add_argument('--latency', type=float, default=0.001, help='Thời gian giả lập mỗi lần sendall (giây)')
+    contention.set_defaults(func=cmd_contention)
+
+    lobby = subparsers.add_parser('lobby', help='Chi phí list_games: quét toàn bộ so với trang có cache')
+    lobby.add_argument('--games', type=int, nargs='+', default=[100, 1000, 10000])
+    lobby.add_argument('--limit', type=int, default=20)
+    lobby.add_argument('--repeat', type=int, default=2000)
+    lobby.set_defaults(func=cmd_lobby)
+
+    boards = subparsers.add_parser('boards', help='Chi phí theo cỡ bàn: bitboard so với lưu thưa')
+    boards.add_argument('--sizes', type=int, nargs='+', default=[10, 15, 19, 0], help='Cỡ bàn (0: không giới hạn)')
+    boards.add_argument('--games', type=int, default=20000)
+    boards.add_argument('--moves', type=int, default=30)
+    boards.add_argument('--repeat', type=int, default=20000)
+    boards.set_defaults(func=cmd_boards)
+
+    durability = subparsers.add_parser('durability', help='Thông lượng nước đi theo mức bền vững của nhật ký')
+    durability.add_argument('--levels', nargs='+', choices=('off',) + DURABILITY_LEVELS,
+                            default=['off', *DURABILITY_LEVELS])
+    durability.add_argument('--games', type=int, default=8)
+    durability.add_argument('--duration', type=float, default=2.0)
+    durability.add_argument('--fsync-interval', type=float, default=0.01)
+    durability.set_defaults(func=cmd_durability)
+
+    spectators = subparsers.add_parser('spectators', help='Chi phí phát một nước đi theo số người xem')
+    spectators.add_argument('--watchers', type=int, nargs='+', default=[0, 10, 100, 500])
+    spectators.add_argument('--events', type=int, default=500)
+    spectators.set_defaults(func=cmd_spectators)
+
+    matchmaking = subparsers.add_parser('matchmaking', help='quick_match: lỗi sảnh, µs tìm đối thủ, thời gian chờ')
+    matchmaking.add_argument('--players', type=int, default=1000)
+    matchmaking.add_argument('--waiting', type=int, default=200, help='Số game chờ trong sảnh')
+    matchmaking.add_argument('--queue-sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    matchmaking.add_argument('--repeat', type=int, default=20000)
+    matchmaking.add_argument('--rates', type=float, nargs='+', default=[0.5, 5, 50],
+                             help='Số người vào hàng đợi mỗi giây (đồng hồ giả lập)')
+    matchmaking.add_argument('--duration', type=float, default=3600, help='Số giây giả lập')
+    matchmaking.add_argument('--spread', type=float, default=300, help='Độ lệch chuẩn rating')
+    matchmaking.set_defaults(func=cmd_matchmaking)
+
+    ratings = subparsers.add_parser('ratings', help='Rating Elo: µs cập nhật, tra hạng và trang leaderboard')
+    ratings.add_argument('--players', type=int, nargs='+', default=[1000, 10000, 100000])
+    ratings.add_argument('--limit', type=int, default=10, help='Số người mỗi trang leaderboard')
+    ratings.add_argument('--repeat', type=int, default=20000)
+    ratings.add_argument('--flush-players', type=int, default=10000)
+    ratings.add_argument('--flush-games', type=int, default=1000, help='Số ván gom trong một lần ghi')
+    ratings.set_defaults(func=cmd_ratings)
+
+    heartbeats = subparsers.add_parser('heartbeats', help='Hẹn giờ nhàn rỗi theo kết nối: heap so với bánh xe')
+    heartbeats.add_argument('--connections', type=int, nargs='+', default=[1000, 10000, 100000])
+    heartbeats.add_argument('--duration', type=float, default=120, help='Số giây giả lập')
+    heartbeats.add_argument('--message-interval', type=float, default=2.0, help='Giây giữa hai tin của một kết nối')
+    heartbeats.add_argument('--ping-interval', type=float, default=15.0)
+    heartbeats.set_defaults(func=cmd_heartbeats)
+
+    clocks = subparsers.add_parser('clocks', help='Đồng hồ ván cờ: hẹn giờ mỗi ván so với hàng đợi mốc chung')
+    clocks.add_argument('--games', type=int, nargs='+', default=[1000, 10000, 50000])
+    clocks.add_argument('--duration', type=float, default=120, help='Số giây giả lập')
+    clocks.add_argument('--move-interval', type=float, default=3.0, help='Giây giữa hai nước của một ván')
+    clocks.add_argument('--base', type=float, default=300)
+    clocks.add_argument('--increment', type=float, default=2)
+    clocks.add_argument('--per-move', type=float, default=30)
+    clocks.set_defaults(func=cmd_clocks)
+
+    archive = subparsers.add_parser('archive', help='Kho lưu ván: byte trên đĩa và µs mỗi truy vấn lịch sử')
+    archive.add_argument('--days', type=int, default=7)
+    archive.add_argument('--games-per-day', type=int, default=20000)
+    archive.add_argument('--players', type=int, default=2000)
+    archive.add_argument('--moves', type=int, default=40, help='Số nước tối đa mỗi ván')
+    archive.add_argument('--limit', type=int, default=10)
+    archive.add_argument('--repeat', type=int, default=2000)
+    archive.add_argument('--scan-repeat', type=int, default=2)
+    archive.set_defaults(func=cmd_archive)
+
+    bot = subparsers.add_parser('bot', help='CaroBot: nút/giây và độ trễ mỗi nước theo cấp độ')
+    bot.add_argument('--levels', nargs='+', choices=list(LEVELS), default=list(LEVELS))
+    bot.add_argument('--board-size', type=int, default=15)
+    bot.add_argument('--win-length', type=int, default=5)
+    bot.add_argument('--games', type=int, default=3)
+    bot.add_argument('--moves', type=int, default=40, help='Số nước tối đa mỗi ván tự đấu')
+    bot.add_argument('--pool-moves', type=int, default=20, help='Số thế cờ đo lại qua pool tiến trình')
+    bot.add_argument('--book', help='Tệp sách khai cuộc (CaroBook.py) để đo thời gian tra')
+    bot.set_defaults(func=cmd_bot)
+
+    args = parser.parse_args(argv)
+    if args.command == 'engines' and not args.engine:
+        args.engine = ['threaded', 'async']
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
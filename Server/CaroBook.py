@@ -0,0 +1,237 @@
+"""Sách khai cuộc cho CaroBot: thế cờ đầu ván -> nước trả lời đã tính sẵn.
+
+Một thế cờ được nhìn theo bên sắp đi (quân mình / quân đối thủ thay vì X / O) và
+gộp tám phép đối xứng của bàn vuông (xoay 0/90/180/270 độ, có lật hoặc không):
+khóa là Zobrist hash nhỏ nhất trong tám ảnh, nước trả lời được lưu trong đúng ảnh đó.
+Khi tra cứu, nước trong sách được biến đổi ngược về hướng của bàn thật.
+
+Định dạng tệp (little-endian):
+    HEADER  magic 'CAROBOOK', version, board_size, win_length, max_stones, số bản ghi
+    RECORD  khóa (u64), ô trả lời row * board_size + col (u16), độ sâu đã tìm (u16)
+Các bản ghi sắp theo khóa nên server mmap tệp rồi tìm nhị phân trực tiếp trên đó:
+không phải nạp hay parse gì, và mọi tiến trình (shard) mở cùng tệp dùng chung các
+trang trong page cache của hệ điều hành.
+
+Tạo sách (ngoại tuyến, dùng CaroBot để tìm nước):
+    python CaroBook.py --board-size 10 --plies 6 --width 4 --level hard --output book10.bin
+"""
+import argparse
+import mmap
+import multiprocessing
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from CaroBot import LEVELS, Searcher, choose_move, zobrist
+from CaroGame import KEY_SPAN, UNBOUNDED
+
+MAGIC = b'CAROBOOK'
+VERSION = 1
+HEADER = struct.Struct('<8sHHHHQ')
+RECORD = struct.Struct('<QHH')
+
+Stones = Sequence[Tuple[int, int, str]]
+
+
+@lru_cache(maxsize=None)
+def symmetries(board_size: int) -> Tuple[Tuple[Tuple[int, ...], ...], Tuple[Tuple[int, ...], ...]]:
+    """(perms, inverses): perms[t][cell] là ảnh của ô cell qua phép đối xứng t"""
+    last = board_size - 1
+    maps = (
+        lambda r, c: (r, c),
+        lambda r, c: (c, last - r),
+        lambda r, c: (last - r, last - c),
+        lambda r, c: (last - c, r),
+        lambda r, c: (r, last - c),
+        lambda r, c: (c, r),
+        lambda r, c: (last - r, c),
+        lambda r, c: (last - c, last - r),
+    )
+    perms, inverses = [], []
+    for transform in maps:
+        perm = [0] * (board_size * board_size)
+        inverse = [0] * (board_size * board_size)
+        for row in range(board_size):
+            for col in range(board_size):
+                r, c = transform(row, col)
+                perm[row * board_size + col] = r * board_size + c
+                inverse[r * board_size + c] = row * board_size + col
+        perms.append(tuple(perm))
+        inverses.append(tuple(inverse))
+    return tuple(perms), tuple(inverses)
+
+
+@lru_cache(maxsize=None)
+def hash_tables(board_size: int) -> Tuple[Tuple[Tuple[int, int], ...], ...]:
+    """tables[t][cell] = (hash quân mình, hash quân đối thủ) tại ảnh của cell qua phép t"""
+    perms, _ = symmetries(board_size)
+    return tuple(
+        tuple((zobrist(target, 1), zobrist(target, 2)) for target in perm)
+        for perm in perms
+    )
+
+
+def canonical_key(stones: Stones, symbol: str, board_size: int) -> Tuple[int, int]:
+    """(khóa, phép đối xứng) của thế cờ stones với bên symbol sắp đi"""
+    cells = [(row * board_size + col, 0 if stone == symbol else 1) for row, col, stone in stones]
+    best_key, best_transform = None, 0
+    for transform, table in enumerate(hash_tables(board_size)):
+        key = 0
+        for cell, owner in cells:
+            key ^= table[cell][owner]
+        if best_key is None or key < best_key:
+            best_key, best_transform = key, transform
+    return best_key, best_transform
+
+
+class OpeningBook:
+    """Sách khai cuộc đọc qua mmap (chỉ đọc, an toàn giữa các thread)"""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size:
+            raise ValueError(f'{path}: không phải sách khai cuộc')
+        magic, version, self.board_size, self.win_length, self.max_stones, self.count = \
+            HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path}: không phải sách khai cuộc phiên bản {VERSION}')
+        if len(self.mm) != HEADER.size + self.count * RECORD.size:
+            raise ValueError(f'{path}: tệp bị cắt cụt')
+        self.path = path
+
+    def __len__(self) -> int:
+        return self.count
+
+    def find(self, key: int) -> Optional[Tuple[int, int]]:
+        """(ô trả lời theo hướng chuẩn, độ sâu) của khóa, hoặc None"""
+        mm, lo, hi = self.mm, 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record_key, move, depth = RECORD.unpack_from(mm, HEADER.size + mid * RECORD.size)
+            if record_key < key:
+                lo = mid + 1
+            elif record_key > key:
+                hi = mid
+            else:
+                return move, depth
+        return None
+
+    def lookup(self, stones: Stones, symbol: str) -> Optional[Tuple[int, int]]:
+        """Nước (row, col) trong sách cho bên symbol, hoặc None nếu thế cờ không có trong sách"""
+        if len(stones) > self.max_stones:
+            return None
+        key, transform = canonical_key(stones, symbol, self.board_size)
+        entry = self.find(key)
+        if entry is None:
+            return None
+        _, inverses = symmetries(self.board_size)
+        return divmod(inverses[transform][entry[0]], self.board_size)
+
+    def close(self):
+        self.mm.close()
+
+
+def load_books(paths: Sequence[str]) -> Dict[Tuple[int, int], OpeningBook]:
+    """Mở các tệp sách, khóa theo (board_size, win_length)"""
+    books = {}
+    for path in paths or ():
+        book = OpeningBook(path)
+        books[(book.board_size, book.win_length)] = book
+    return books
+
+
+def analyse(stones: Stones, symbol: str, board_size: int, win_length: int, level: str,
+            width: int) -> Tuple[Optional[Tuple[int, int]], int, List[Tuple[int, int]]]:
+    """Nước tốt nhất, độ sâu và width ứng viên hàng đầu của thế cờ (chạy trong pool)"""
+    budget = LEVELS[level]['time_budget']
+    result = choose_move(stones, symbol, board_size, win_length, time.monotonic() + budget, level)
+    if result['row'] is None:
+        return None, 0, []
+    best = (result['row'], result['col'])
+
+    if not stones:
+        # Bàn trống chưa có ứng viên: mở rộng ô giữa và tám ô kề (đối xứng sẽ gộp bớt)
+        row, col = best
+        return best, result['depth'], [(row + d_row, col + d_col) for d_row in (-1, 0, 1) for d_col in (-1, 0, 1)]
+
+    searcher = Searcher(board_size, win_length, time.monotonic() + budget, width)
+    for row, col, stone in stones:
+        searcher.place(row * KEY_SPAN + col, 1 if stone == 'X' else 2)
+    replies = [best]
+    for key, wins in searcher.candidates(1 if symbol == 'X' else 2):
+        if wins:
+            return best, result['depth'], [best]  # Thế đã thắng: không cần mở rộng
+        move = divmod(key, KEY_SPAN)
+        if move not in replies:
+            replies.append(move)
+    return best, result['depth'], replies[:width]
+
+
+def build_book(board_size: int, win_length: int, plies: int, width: int, level: str,
+               workers: int) -> Tuple[Dict[int, Tuple[int, int]], int]:
+    """Duyệt cây khai cuộc theo từng nước tới plies quân; trả về ({khóa: (ô, độ sâu)}, max_stones)"""
+    entries: Dict[int, Tuple[int, int]] = {}
+    frontier: List[Tuple[Stones, str]] = [((), 'X')]
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        for ply in range(plies):
+            t0 = time.monotonic()
+            futures = [pool.submit(analyse, stones, symbol, board_size, win_length, level, width)
+                       for stones, symbol in frontier]
+            next_frontier: Dict[int, Tuple[Stones, str]] = {}
+            for (stones, symbol), future in zip(frontier, futures):
+                best, depth, replies = future.result()
+                if best is None:
+                    continue
+                key, transform = canonical_key(stones, symbol, board_size)
+                perms, _ = symmetries(board_size)
+                entries[key] = (perms[transform][best[0] * board_size + best[1]], depth)
+                other = 'O' if symbol == 'X' else 'X'
+                for row, col in replies:
+                    child = tuple(stones) + ((row, col, symbol),)
+                    child_key, _ = canonical_key(child, other, board_size)
+                    if child_key not in entries:
+                        next_frontier.setdefault(child_key, (child, other))
+            print(f"📖 {ply} quân: {len(frontier)} thế cờ ({time.monotonic() - t0:.1f}s), "
+                  f"sách có {len(entries)} thế")
+            frontier = list(next_frontier.values())
+    return entries, plies - 1
+
+
+def write_book(path: str, entries: Dict[int, Tuple[int, int]], board_size: int, win_length: int,
+               max_stones: int):
+    """Ghi sách đã sắp theo khóa"""
+    data = bytearray(HEADER.pack(MAGIC, VERSION, board_size, win_length, max_stones, len(entries)))
+    for key in sorted(entries):
+        move, depth = entries[key]
+        data += RECORD.pack(key, move, depth)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Tạo sách khai cuộc cho CaroBot')
+    parser.add_argument('--board-size', type=int, default=10)
+    parser.add_argument('--win-length', type=int, default=5)
+    parser.add_argument('--plies', type=int, default=6, help='Số quân tối đa của thế cờ trong sách')
+    parser.add_argument('--width', type=int, default=4, help='Số nước được mở rộng ở mỗi thế cờ')
+    parser.add_argument('--level', choices=list(LEVELS), default='hard')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--output', default='book.bin')
+    args = parser.parse_args(argv)
+    if args.board_size == UNBOUNDED or args.board_size * args.board_size > 1 << 16:
+        parser.error('sách khai cuộc chỉ dùng cho bàn có giới hạn tới 256x256')
+
+    t0 = time.monotonic()
+    entries, max_stones = build_book(args.board_size, args.win_length, args.plies, args.width,
+                                     args.level, args.workers)
+    write_book(args.output, entries, args.board_size, args.win_length, max_stones)
+    size = HEADER.size + len(entries) * RECORD.size
+    print(f"✅ {args.output}: {len(entries)} thế cờ, {size} byte, {time.monotonic() - t0:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
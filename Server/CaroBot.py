@@ -0,0 +1,306 @@
+"""Máy chơi Cờ Caro: tìm nước đi bằng alpha-beta có giới hạn thời gian.
+
+- Ứng viên theo đe dọa: chỉ xét ô trống cách quân đã đánh tối đa 2 ô; nếu một bên
+  có nước thắng ngay thì chỉ còn nước đó (hoặc nước chặn), còn lại xếp theo điểm
+  tấn công + phòng thủ và giữ tối đa `width` ô.
+- Đánh giá tăng dần theo cửa sổ: mỗi đoạn win_length ô liên tiếp chỉ chứa quân
+  của một bên được cộng weights[số quân]. Điểm tăng thêm khi đặt quân vào một ô
+  trống được cache theo từng hướng; đặt / gỡ một quân chỉ làm mất cache của các ô
+  trên bốn đường qua ô đó.
+- Negamax alpha-beta, đào sâu dần và bảng chuyển vị khóa theo Zobrist hash. Hash
+  của từng (ô, quân) được sinh bằng splitmix64 thay vì bảng ngẫu nhiên nên dùng
+  được cho cả bàn không giới hạn.
+- Thời hạn là một mốc time.monotonic() tuyệt đối do server đặt lúc giao việc; hết
+  hạn giữa chừng thì trả nước tốt nhất của lần đào sâu đã xong gần nhất.
+
+choose_move() là hàm thuần (chỉ nhận dữ liệu pickle được) để chạy trong
+ProcessPoolExecutor của server, không chặn đường vào/ra mạng.
+"""
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from CaroGame import KEY_SPAN, LINE_DIRECTIONS, MAX_COORDINATE, UNBOUNDED
+
+# Cấp độ: thời gian mỗi nước (giây), độ sâu tối đa, số ứng viên mỗi nút
+LEVELS = {
+    'easy': {'time_budget': 0.1, 'max_depth': 2, 'width': 6},
+    'medium': {'time_budget': 0.5, 'max_depth': 4, 'width': 10},
+    'hard': {'time_budget': 1.5, 'max_depth': 12, 'width': 14},
+}
+DEFAULT_LEVEL = 'medium'
+
+WIN_SCORE = 10 ** 9
+CANDIDATE_RADIUS = 2
+MAX_TT_ENTRIES = 1 << 18
+CHECK_EVERY = 16  # Số nút giữa hai lần xem đồng hồ
+WALL = 3  # Ô ngoài bàn có giới hạn
+MASK64 = (1 << 64) - 1
+
+# TT_EXACT / TT_LOWER / TT_UPPER: điểm lưu là chính xác / cận dưới / cận trên
+TT_EXACT, TT_LOWER, TT_UPPER = 0, 1, 2
+
+# Các ô quanh một quân được coi là ứng viên
+NEIGHBOR_STEPS = tuple(
+    d_row * KEY_SPAN + d_col
+    for d_row in range(-CANDIDATE_RADIUS, CANDIDATE_RADIUS + 1)
+    for d_col in range(-CANDIDATE_RADIUS, CANDIDATE_RADIUS + 1)
+    if d_row or d_col
+)
+
+
+class SearchTimeout(Exception):
+    """Hết thời gian tìm kiếm"""
+
+
+def zobrist(key: int, color: int) -> int:
+    """Hash 64 bit của quân color (1 X, 2 O) tại ô key (splitmix64)"""
+    z = (key * 2 + color + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def window_weights(win_length: int) -> List[int]:
+    """Điểm của một cửa sổ theo số quân: tăng gấp 10 lần mỗi quân, đủ win_length là thắng"""
+    return [0] + [10 ** (n - 1) for n in range(1, win_length)] + [WIN_SCORE]
+
+
+class Searcher:
+    """Trạng thái một lần tìm nước: bàn cờ thưa, điểm tăng dần, bảng chuyển vị"""
+
+    def __init__(self, board_size: int, win_length: int, deadline: float, width: int):
+        self.board_size = board_size
+        self.win_length = win_length
+        self.deadline = deadline
+        self.width = width
+        self.weights = window_weights(win_length)
+        self.steps = tuple(d_row * KEY_SPAN + d_col for d_row, d_col in LINE_DIRECTIONS)
+        self.offsets = tuple(range(-(win_length - 1), win_length))
+        self.cells: Dict[int, int] = {}  # khóa ô (row * KEY_SPAN + col) -> 1 (X) / 2 (O) / WALL
+        self.near: Dict[int, int] = {}  # khóa ô -> số quân trong bán kính CANDIDATE_RADIUS
+        # Điểm của một ô trống theo từng hướng, khóa ô * 4 + hướng; chỉ các ô nằm trên
+        # đường qua nước vừa đánh bị xóa khỏi cache (và được trả lại khi gỡ quân)
+        self.line_cache: Dict[int, Tuple[int, int, bool, bool]] = {}
+        self.undo: List[List[Tuple[int, object]]] = []
+        self.score = 0  # Điểm theo góc nhìn của X
+        self.hash = 0
+        self.tt: Dict[int, Tuple[int, int, int, Optional[int]]] = {}
+        self.nodes = 0
+        if board_size != UNBOUNDED:
+            self.build_walls()
+
+    def build_walls(self):
+        """Vành win_length - 1 ô quanh bàn có giới hạn coi như đã có quân WALL"""
+        margin = self.win_length - 1
+        size = self.board_size
+        for row in range(-margin, size + margin):
+            for col in range(-margin, size + margin):
+                if not (0 <= row < size and 0 <= col < size):
+                    self.cells[row * KEY_SPAN + col] = WALL
+
+    def line_eval(self, key: int, direction: int) -> Tuple[int, int, bool, bool]:
+        """Điểm X / O tăng thêm khi đặt quân tại ô trống key, chỉ theo một hướng, và nước đó có thắng không"""
+        cells = self.cells
+        step = self.steps[direction]
+        weights = self.weights
+        win_length = self.win_length
+        line = [cells.get(key + k * step, 0) for k in self.offsets]
+        x_gain = o_gain = 0
+        x_wins = o_wins = False
+        for start in range(win_length):
+            window = line[start:start + win_length]
+            if WALL in window:
+                continue
+            x = window.count(1)
+            o = window.count(2)
+            if not o:
+                x_gain += weights[x + 1] - weights[x]
+                x_wins = x_wins or x + 1 == win_length
+            if not x:
+                o_gain += weights[o + 1] - weights[o]
+                o_wins = o_wins or o + 1 == win_length
+        return x_gain, o_gain, x_wins, o_wins
+
+    def cell_eval(self, key: int) -> Tuple[int, int, bool, bool]:
+        """Tổng line_eval bốn hướng của ô trống key (lấy từ cache khi còn)"""
+        cache = self.line_cache
+        x_gain = o_gain = 0
+        x_wins = o_wins = False
+        for direction in range(4):
+            entry = cache.get(key * 4 + direction)
+            if entry is None:
+                entry = cache[key * 4 + direction] = self.line_eval(key, direction)
+            x_gain += entry[0]
+            o_gain += entry[1]
+            x_wins = x_wins or entry[2]
+            o_wins = o_wins or entry[3]
+        return x_gain, o_gain, x_wins, o_wins
+
+    def place(self, key: int, color: int):
+        x_gain, o_gain, _, _ = self.cell_eval(key)
+        self.score += x_gain if color == 1 else -o_gain
+        self.cells[key] = color
+        self.hash ^= zobrist(key, color)
+        near = self.near
+        for step in NEIGHBOR_STEPS:
+            near[key + step] = near.get(key + step, 0) + 1
+        # Điểm các ô cùng đường với quân mới không còn đúng
+        cache = self.line_cache
+        saved = []
+        for direction, step in enumerate(self.steps):
+            for k in self.offsets:
+                if k:
+                    cache_key = (key + k * step) * 4 + direction
+                    saved.append((cache_key, cache.pop(cache_key, None)))
+        self.undo.append(saved)
+        return x_gain if color == 1 else -o_gain
+
+    def remove(self, key: int, color: int, delta: int):
+        self.score -= delta
+        del self.cells[key]
+        self.hash ^= zobrist(key, color)
+        near = self.near
+        for step in NEIGHBOR_STEPS:
+            count = near[key + step] - 1
+            if count:
+                near[key + step] = count
+            else:
+                del near[key + step]
+        cache = self.line_cache
+        for cache_key, entry in self.undo.pop():
+            if entry is None:
+                cache.pop(cache_key, None)
+            else:
+                cache[cache_key] = entry
+
+    def candidates(self, color: int) -> List[Tuple[int, bool]]:
+        """Ứng viên theo đe dọa cho bên color: [(khóa ô, có thắng ngay)]"""
+        cells = self.cells
+        scored = []
+        blocks = []
+        for key in self.near:
+            if key in cells:
+                continue
+            x_gain, o_gain, x_wins, o_wins = self.cell_eval(key)
+            attack, defense = (x_gain, o_gain) if color == 1 else (o_gain, x_gain)
+            if (x_wins if color == 1 else o_wins):
+                return [(key, True)]
+            if (o_wins if color == 1 else x_wins):
+                blocks.append((key, False))
+            scored.append((attack + defense * 0.9, key))
+        if blocks:
+            # Đối thủ sắp thắng: chỉ còn cách chặn
+            return blocks
+        scored.sort(reverse=True)
+        return [(key, False) for _, key in scored[:self.width]]
+
+    def negamax(self, depth: int, alpha: int, beta: int, color: int, ply: int) -> int:
+        self.nodes += 1
+        if self.nodes % CHECK_EVERY == 0 and time.monotonic() >= self.deadline:
+            raise SearchTimeout()
+
+        alpha_orig = alpha
+        entry = self.tt.get(self.hash)
+        tt_move = None
+        if entry is not None:
+            tt_depth, tt_score, tt_flag, tt_move = entry
+            if tt_depth >= depth:
+                if tt_flag == TT_EXACT:
+                    return tt_score
+                if tt_flag == TT_LOWER:
+                    alpha = max(alpha, tt_score)
+                elif tt_flag == TT_UPPER:
+                    beta = min(beta, tt_score)
+                if alpha >= beta:
+                    return tt_score
+
+        if depth == 0:
+            return self.score if color == 1 else -self.score
+
+        moves = self.candidates(color)
+        if not moves:
+            return 0  # Hết ô: hòa
+        if tt_move is not None:
+            moves.sort(key=lambda move: move[0] != tt_move)
+
+        best = -WIN_SCORE * 2
+        best_move = None
+        for key, wins in moves:
+            if wins:
+                score = WIN_SCORE - ply  # Thắng càng sớm càng tốt
+            else:
+                delta = self.place(key, color)
+                try:
+                    score = -self.negamax(depth - 1, -beta, -alpha, 3 - color, ply + 1)
+                finally:
+                    self.remove(key, color, delta)
+            if score > best:
+                best, best_move = score, key
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if len(self.tt) >= MAX_TT_ENTRIES:
+            self.tt.clear()
+        flag = TT_UPPER if best <= alpha_orig else (TT_LOWER if best >= beta else TT_EXACT)
+        self.tt[self.hash] = (depth, best, flag, best_move)
+        return best
+
+    def search(self, color: int, max_depth: int) -> Tuple[Optional[int], int]:
+        """Đào sâu dần tới max_depth hoặc hết giờ; trả về (khóa ô, độ sâu đã xong)"""
+        moves = self.candidates(color)
+        if not moves:
+            return None, 0
+        best_move = moves[0][0]  # Dự phòng: ứng viên tốt nhất theo heuristic
+        if moves[0][1] or len(moves) == 1:
+            return best_move, 1
+        completed = 0
+        for depth in range(1, max_depth + 1):
+            try:
+                alpha = -WIN_SCORE * 2
+                depth_best = None
+                ordered = sorted(moves, key=lambda move: move[0] != best_move)
+                for key, _ in ordered:
+                    delta = self.place(key, color)
+                    try:
+                        score = -self.negamax(depth - 1, -WIN_SCORE * 2, -alpha, 3 - color, 1)
+                    finally:
+                        self.remove(key, color, delta)
+                    if score > alpha:
+                        alpha, depth_best = score, key
+            except SearchTimeout:
+                break
+            best_move, completed = depth_best, depth
+            if alpha >= WIN_SCORE - max_depth or alpha <= -(WIN_SCORE - max_depth):
+                break  # Đã thấy thắng / thua chắc chắn, đào sâu thêm không đổi kết quả
+        return best_move, completed
+
+
+def choose_move(stones: Sequence[Tuple[int, int, str]], symbol: str, board_size: int, win_length: int,
+                deadline: float, level: str = DEFAULT_LEVEL) -> Dict:
+    """Chọn nước cho quân symbol trên bàn có các quân stones [(row, col, 'X'/'O')].
+
+    Trả về {'row', 'col', 'nodes', 'depth', 'elapsed'}; row/col là None nếu hết ô.
+    """
+    t0 = time.monotonic()
+    settings = LEVELS.get(level, LEVELS[DEFAULT_LEVEL])
+    # Thời hạn chặt: mốc của server, nhưng không quá time_budget kể từ lúc bắt đầu tìm
+    deadline = min(deadline, t0 + settings['time_budget'])
+    searcher = Searcher(board_size, win_length, deadline, settings['width'])
+    for row, col, stone in stones:
+        searcher.place(row * KEY_SPAN + col, 1 if stone == 'X' else 2)
+    searcher.undo.clear()  # Các quân có sẵn không bao giờ bị gỡ
+
+    if not stones:
+        # Bàn trống: đánh giữa bàn
+        center = board_size // 2 if board_size != UNBOUNDED else 0
+        key, depth = center * KEY_SPAN + center, 0
+    else:
+        key, depth = searcher.search(1 if symbol == 'X' else 2, settings['max_depth'])
+
+    result = {'row': None, 'col': None, 'nodes': searcher.nodes, 'depth': depth,
+              'elapsed': time.monotonic() - t0}
+    if key is not None:
+        row, col = divmod(key + MAX_COORDINATE, KEY_SPAN)
+        result['row'], result['col'] = row, col - MAX_COORDINATE
+    return result
@@ -0,0 +1,164 @@
+"""Đồng hồ ván cờ (time control) và hàng đợi mốc hết giờ dùng chung cho mọi ván.
+
+Ván có đồng hồ khi create_game kèm một trong hai dạng (đơn vị giây):
+    'time_control': {'base': 300, 'increment': 2}   thời gian cả ván, cộng thêm sau mỗi nước
+    'time_control': {'per_move': 30}                 thời gian cố định cho mỗi nước
+Đồng hồ của người tới lượt chạy từ lúc ván bắt đầu / đối thủ vừa đi; đi xong thì cộng
+increment (hoặc đặt lại per_move) và bấm sang đối thủ.
+
+Mọi đồng hồ của server nằm chung một ClockQueue: một heap (mốc hết giờ, đồng hồ) và đúng
+một hẹn giờ đánh thức cho mốc sớm nhất, nên số đồng hồ không làm tăng số hẹn giờ. Bấm đồng
+hồ không chạm vào heap khi mốc mới muộn hơn mốc đồng hồ đang có trong heap (thường gặp:
+người chơi còn nhiều thời gian hơn một nước); tới mốc cũ mà chưa hết giờ thì đồng hồ được
+đẩy lại với mốc thật. Mỗi đồng hồ vì vậy chỉ có một mục còn hiệu lực, và chi phí theo thời
+gian ván chứ không theo số nước.
+"""
+import heapq
+import itertools
+import threading
+from typing import Dict, List, Optional, Tuple
+
+MAX_CLOCK_SECONDS = 4 * 3600  # Giới hạn base / per_move / increment
+
+
+class TimeControl:
+    """Luật thời gian của một ván: base + increment, hoặc per_move"""
+
+    __slots__ = ('base', 'increment', 'per_move')
+
+    def __init__(self, base: float = 0, increment: float = 0, per_move: float = 0):
+        self.base = base
+        self.increment = increment
+        self.per_move = per_move
+
+    def initial(self) -> float:
+        """Thời gian mỗi người có khi ván bắt đầu"""
+        return self.per_move or self.base
+
+    def to_dict(self) -> Dict[str, float]:
+        if self.per_move:
+            return {'per_move': self.per_move}
+        return {'base': self.base, 'increment': self.increment}
+
+
+def parse_time_control(value) -> Tuple[Optional[TimeControl], Optional[str]]:
+    """Trường time_control của create_game -> (TimeControl, None); (None, None) nếu ván không
+    tính giờ; (None, thông báo lỗi) nếu không hợp lệ"""
+    if value is None:
+        return None, None
+    error = 'time_control phải là {"base": giây, "increment": giây} hoặc {"per_move": giây}'
+    if not isinstance(value, dict) or not value or set(value) - {'base', 'increment', 'per_move'} \
+            or ('per_move' in value and len(value) > 1) or ('increment' in value and 'base' not in value):
+        return None, error
+    for key, low in (('base', 1), ('per_move', 1), ('increment', 0)):
+        seconds = value.get(key, low)
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) \
+                or not low <= seconds <= MAX_CLOCK_SECONDS:
+            return None, f'{key} phải từ {low} đến {MAX_CLOCK_SECONDS} giây'
+    if 'per_move' in value:
+        return TimeControl(per_move=value['per_move']), None
+    return TimeControl(value['base'], value.get('increment', 0)), None
+
+
+class GameClock:
+    """Thời gian còn lại của hai người chơi (gọi khi đang giữ game.lock).
+
+    remaining[i] là thời gian của người chơi i + 1 tính tới lúc lượt hiện tại bắt đầu;
+    đồng hồ của người tới lượt (running) đang chạy từ started (time.monotonic()).
+    """
+
+    __slots__ = ('control', 'remaining', 'running', 'started', 'queued')
+
+    def __init__(self, control: TimeControl, remaining: Optional[List[float]] = None):
+        self.control = control
+        self.remaining = list(remaining) if remaining else [control.initial(), control.initial()]
+        self.running: Optional[int] = None  # 1 / 2, None khi ván chưa bắt đầu / đã kết thúc
+        self.started = 0.0
+        self.queued: Optional[float] = None  # Mốc của mục còn hiệu lực trong ClockQueue
+
+    def start(self, player: int, now: float):
+        self.running = player
+        self.started = now
+
+    def deadline(self) -> Optional[float]:
+        """Lúc người tới lượt hết giờ (time.monotonic())"""
+        if self.running is None:
+            return None
+        return self.started + self.remaining[self.running - 1]
+
+    def left(self, now: float) -> List[float]:
+        """Thời gian còn lại của hai người tại now"""
+        remaining = list(self.remaining)
+        if self.running is not None:
+            index = self.running - 1
+            remaining[index] = max(0.0, remaining[index] - (now - self.started))
+        return remaining
+
+    def press(self, now: float) -> bool:
+        """Người tới lượt vừa đi: trừ thời gian đã dùng, cộng increment (hoặc đặt lại per_move) rồi
+        chuyển đồng hồ sang đối thủ. False nếu người đó đã hết giờ (nước đi không được tính)."""
+        player = self.running
+        left = self.remaining[player - 1] - (now - self.started)
+        if left <= 0:
+            return False
+        self.remaining[player - 1] = self.control.per_move or left + self.control.increment
+        self.start(3 - player, now)
+        return True
+
+    def stop(self, now: float):
+        self.remaining = self.left(now)
+        self.running = None
+
+    def millis(self, now: Optional[float] = None) -> List[int]:
+        """Thời gian còn lại (mili giây) của [X, O] tại now; None: tính tới đầu lượt hiện tại"""
+        remaining = self.remaining if now is None else self.left(now)
+        return [int(seconds * 1000) for seconds in remaining]
+
+
+class ClockQueue:
+    """Heap mốc hết giờ của mọi đồng hồ, phục vụ bởi một hẹn giờ đánh thức duy nhất (lock lá).
+
+    Server hẹn giờ đánh thức ở mốc schedule() / pop_due() trả về; các mục cũ (đồng hồ đã
+    được bấm, ván đã kết thúc) bị bỏ qua khi tới lượt.
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, int, GameClock]] = []
+        self.counter = itertools.count()  # Phá hòa khi cùng mốc
+        self.armed: Optional[float] = None  # Mốc của hẹn giờ đánh thức đang chờ
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def schedule(self, game_id: int, clock: GameClock) -> Optional[float]:
+        """Đưa mốc hết giờ của clock vào heap nếu sớm hơn mục nó đang có (gọi khi đang giữ game.lock).
+
+        Trả về mốc cần hẹn đánh thức, hoặc None nếu hẹn giờ đang chờ đã đủ sớm.
+        """
+        deadline = clock.deadline()
+        if deadline is None or (clock.queued is not None and clock.queued <= deadline):
+            return None
+        clock.queued = deadline
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, next(self.counter), game_id, clock))
+            if self.armed is None or deadline < self.armed:
+                self.armed = deadline
+                return deadline
+        return None
+
+    def pop_due(self, now: float, wake: float) -> Tuple[List[Tuple[int, GameClock, float]], Optional[float]]:
+        """Lấy các mục (game_id, đồng hồ, mốc) đã tới mốc khi hẹn giờ đánh thức ở mốc wake chạy.
+
+        Trả về kèm mốc đánh thức kế tiếp cần hẹn (None nếu không cần: heap rỗng, hoặc đây là
+        một hẹn giờ cũ và hẹn giờ sớm hơn vẫn đang chờ).
+        """
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, game_id, clock = heapq.heappop(self.heap)
+                due.append((game_id, clock, deadline))
+            if wake != self.armed:
+                return due, None
+            self.armed = self.heap[0][0] if self.heap else None
+            return due, self.armed
@@ -0,0 +1,366 @@
+"""Trạng thái một ván Cờ Caro.
+
+Cỡ bàn và độ dài thắng được chọn khi tạo ván (mặc định 10x10, thắng 5). Có hai
+cách lưu bàn cờ:
+
+- Bitboard cho bàn nhỏ (cạnh < SPARSE_MIN_SIZE): mỗi người chơi có một số nguyên,
+  bit (row * stride + col) bật khi ô đó có quân. stride = cạnh + 1 chừa một cột đệm
+  luôn trống ở cuối mỗi hàng nên phép dịch bit theo hàng ngang và đường chéo không
+  tràn sang hàng kế. Bảng tra của mỗi (cạnh, độ dài thắng) dùng chung giữa các ván.
+- Thưa cho bàn lớn (15x15, 19x19...) và bàn không giới hạn (board_size = 0): dict
+  khóa ô -> quân chỉ chứa các ô đã đánh, nên bộ nhớ và chi phí kiểm tra thắng tỉ lệ
+  với số nước đã đi chứ không với diện tích bàn. Khóa ô là row * KEY_SPAN + col (một
+  số nguyên thay vì tuple), ô kề theo một hướng chỉ cách một hằng số.
+
+Vị trí ô trong tin nhắn là row * board_size + col trên bàn có giới hạn và cặp
+[row, col] (có thể âm) trên bàn không giới hạn. Danh sách 'board' gồm 'X'/'O'/''
+chỉ được dựng khi gửi tin nhắn cho client, và chỉ cho bàn bitboard; bàn thưa gửi
+'stones' (vị trí các quân X và O).
+
+history giữ thứ tự các nước đi (cho kho lưu ván và phát lại): một byte mỗi nước trên
+bàn tới 16x16, hai byte tới 256x256, và (row, col) 8 byte trên bàn không giới hạn.
+Quân của mỗi nước suy ra từ người đi trước vì hai bên luôn đi luân phiên.
+"""
+import struct
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+BOARD_SIZE = 10
+WIN_LENGTH = 5
+UNBOUNDED = 0  # board_size của bàn không giới hạn
+MIN_WIN_LENGTH = 3
+MAX_WIN_LENGTH = 10
+MAX_BOARD_SIZE = 100
+SPARSE_MIN_SIZE = 15  # Bàn từ cỡ này trở lên lưu thưa
+MAX_COORDINATE = 1 << 20  # Tọa độ trên bàn không giới hạn nằm trong (-MAX_COORDINATE, MAX_COORDINATE)
+KEY_SPAN = 2 * MAX_COORDINATE + 1
+
+STRIDE = BOARD_SIZE + 1
+CELL_COUNT = BOARD_SIZE * BOARD_SIZE
+
+# Hướng (d_row, d_col) theo thứ tự: ngang, dọc, chéo trái-phải, chéo phải-trái
+LINE_DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+# Vị trí ô: số nguyên trên bàn có giới hạn, [row, col] trên bàn không giới hạn
+Position = Union[int, List[int]]
+
+UNBOUNDED_MOVE = struct.Struct('<ii')
+
+
+def check_settings(board_size: int, win_length: int) -> Optional[str]:
+    """Thông báo lỗi nếu cỡ bàn / độ dài thắng không hợp lệ, None nếu hợp lệ"""
+    if not isinstance(board_size, int) or not isinstance(win_length, int):
+        return 'board_size/win_length phải là số nguyên'
+    if not MIN_WIN_LENGTH <= win_length <= MAX_WIN_LENGTH:
+        return f'win_length phải từ {MIN_WIN_LENGTH} đến {MAX_WIN_LENGTH}'
+    if board_size != UNBOUNDED and not win_length <= board_size <= MAX_BOARD_SIZE:
+        return f'board_size phải là 0 (không giới hạn) hoặc từ win_length đến {MAX_BOARD_SIZE}'
+    return None
+
+
+class Geometry:
+    """Bảng tra bitboard cho một cỡ bàn và độ dài thắng"""
+
+    __slots__ = ('size', 'win_length', 'stride', 'cell_count', 'shifts', 'line_masks')
+
+    def __init__(self, size: int, win_length: int):
+        self.size = size
+        self.win_length = win_length
+        self.stride = size + 1
+        self.cell_count = size * size
+        # Bước dịch bit ứng với LINE_DIRECTIONS
+        self.shifts = tuple(d_row * self.stride + d_col for d_row, d_col in LINE_DIRECTIONS)
+        # line_masks[position][i]: đoạn thẳng qua position theo hướng LINE_DIRECTIONS[i]
+        self.line_masks = [
+            tuple(self._line_mask(p, d_row, d_col) for d_row, d_col in LINE_DIRECTIONS)
+            for p in range(self.cell_count)
+        ]
+
+    def _line_mask(self, position: int, d_row: int, d_col: int) -> int:
+        """Mặt nạ các ô cách position tối đa win_length - 1 bước theo một hướng (cả hai phía)"""
+        row, col = divmod(position, self.size)
+        mask = 0
+        for k in range(-(self.win_length - 1), self.win_length):
+            r, c = row + k * d_row, col + k * d_col
+            if 0 <= r < self.size and 0 <= c < self.size:
+                mask |= 1 << (r * self.stride + c)
+        return mask
+
+    def position_to_bit(self, position: int) -> int:
+        """Chỉ số ô trên bàn -> chỉ số bit trong bitboard có cột đệm"""
+        row, col = divmod(position, self.size)
+        return row * self.stride + col
+
+    def bit_to_position(self, bit: int) -> int:
+        """Chỉ số bit trong bitboard -> chỉ số ô trên bàn"""
+        row, col = divmod(bit, self.stride)
+        return row * self.size + col
+
+
+def move_width(board_size: int) -> int:
+    """Số byte mỗi nước trong history"""
+    if board_size == UNBOUNDED:
+        return UNBOUNDED_MOVE.size
+    return 1 if board_size * board_size <= 256 else 2
+
+
+def history_positions(history: bytes, board_size: int) -> List[Position]:
+    """history -> danh sách vị trí theo thứ tự đã đánh"""
+    width = move_width(board_size)
+    if width == 1:
+        return list(history)
+    if width == 2:
+        return [int.from_bytes(history[i:i + 2], 'little') for i in range(0, len(history), 2)]
+    return [list(move) for move in UNBOUNDED_MOVE.iter_unpack(history)]
+
+
+@lru_cache(maxsize=None)
+def geometry(size: int, win_length: int) -> Geometry:
+    """Bảng tra dùng chung cho mọi ván cùng cỡ bàn và độ dài thắng"""
+    return Geometry(size, win_length)
+
+
+def find_run(bits: int, shift: int, win_length: int = WIN_LENGTH) -> int:
+    """Trả về mặt nạ các bit bắt đầu một dãy win_length quân liên tiếp theo bước shift.
+
+    Dùng dịch-và-AND kiểu nhân đôi: sau mỗi bước, bit p còn bật nghĩa là
+    p, p + shift, ..., p + (length - 1) * shift đều có quân.
+    """
+    run = bits
+    length = 1
+    while length * 2 <= win_length:
+        run &= run >> (length * shift)
+        length *= 2
+    if length < win_length:
+        run &= run >> ((win_length - length) * shift)
+    return run
+
+
+class Game:
+    """Một ván cờ: bàn cờ (bitboard hoặc thưa) cùng thông tin người chơi"""
+
+    __slots__ = (
+        'player1', 'player2', 'player1_name', 'player2_name',
+        'board_size', 'win_length', 'geometry', 'x_bits', 'o_bits', 'cells',
+        'moves', 'seq', 'last_move', 'history', 'current_turn', 'status',
+        'first_player', 'bot_level', 'sockets', 'spectators', 'tokens', 'away', 'clock', 'created_at', 'ended_at',
+        'lock'
+    )
+
+    def __init__(self, player1: int, player1_name: str, sockets: Dict,
+                 board_size: int = BOARD_SIZE, win_length: int = WIN_LENGTH):
+        self.player1 = player1
+        self.player2: Optional[int] = None
+        self.player1_name = player1_name
+        self.player2_name: Optional[str] = None
+        self.board_size = board_size
+        self.win_length = win_length
+        if board_size != UNBOUNDED and board_size < SPARSE_MIN_SIZE:
+            self.geometry: Optional[Geometry] = geometry(board_size, win_length)
+            self.cells: Optional[Dict[int, str]] = None
+        else:
+            self.geometry = None
+            self.cells = {}
+        self.x_bits = 0
+        self.o_bits = 0
+        self.moves = 0
+        self.seq = 0  # Số thứ tự cập nhật, tăng sau mỗi nước đi
+        self.last_move: Optional[Position] = None
+        self.history = bytearray()  # Các nước theo thứ tự (xem move_width)
+        self.current_turn = 1
+        self.status = 'waiting'
+        self.first_player: Optional[int] = None
+        self.bot_level: Optional[str] = None  # Cấp độ máy khi player2 là bot (CaroBot)
+        self.sockets = sockets
+        # Người xem {client_id: kết nối}; chỉ tạo dict khi có người xem đầu tiên để ván thường nhẹ hơn
+        self.spectators: Optional[Dict] = None
+        # Mã phiên [player1, player2] để kết nối lại (resume), server gán khi tạo ván; None với máy
+        self.tokens: Optional[List[Optional[str]]] = None
+        # Người chơi đang mất kết nối {1 / 2: hạn quay lại (time.monotonic())}; chỉ tạo khi cần
+        self.away: Optional[Dict[int, float]] = None
+        self.clock = None  # CaroClock.GameClock khi ván có time control, None: không tính giờ
+        self.created_at = time.time()
+        self.ended_at: Optional[float] = None  # time.monotonic() lúc kết thúc / bị bỏ dở
+        self.lock = threading.Lock()  # Bảo vệ trạng thái ván cờ
+
+    def settings(self) -> Dict:
+        """Cỡ bàn, độ dài thắng và time control; rỗng với ván mặc định để tin nhắn giữ nguyên như trước"""
+        settings = {}
+        if self.board_size != BOARD_SIZE or self.win_length != WIN_LENGTH:
+            settings = {'board_size': self.board_size, 'win_length': self.win_length}
+        if self.clock is not None:
+            settings['time_control'] = self.clock.control.to_dict()
+        return settings
+
+    def coordinates(self, position) -> Optional[Tuple[int, int]]:
+        """Vị trí trong tin nhắn -> (row, col), hoặc None nếu nằm ngoài bàn / sai kiểu"""
+        if self.board_size == UNBOUNDED:
+            if not isinstance(position, (list, tuple)) or len(position) != 2:
+                return None
+            row, col = position
+            if not isinstance(row, int) or not isinstance(col, int) \
+                    or not (-MAX_COORDINATE < row < MAX_COORDINATE and -MAX_COORDINATE < col < MAX_COORDINATE):
+                return None
+            return row, col
+        if not isinstance(position, int) or not 0 <= position < self.board_size * self.board_size:
+            return None
+        return divmod(position, self.board_size)
+
+    def on_board(self, row: int, col: int) -> bool:
+        if self.board_size == UNBOUNDED:
+            return -MAX_COORDINATE < row < MAX_COORDINATE and -MAX_COORDINATE < col < MAX_COORDINATE
+        return 0 <= row < self.board_size and 0 <= col < self.board_size
+
+    def position_of(self, row: int, col: int) -> Position:
+        """(row, col) -> vị trí dùng trong tin nhắn"""
+        if self.board_size == UNBOUNDED:
+            return [row, col]
+        return row * self.board_size + col
+
+    def is_empty(self, position: Position) -> bool:
+        """Ô position nằm trong bàn và còn trống hay không"""
+        cell = self.coordinates(position)
+        if cell is None:
+            return False
+        if self.cells is not None:
+            return cell[0] * KEY_SPAN + cell[1] not in self.cells
+        bit = 1 << self.geometry.position_to_bit(position)
+        return not ((self.x_bits | self.o_bits) & bit)
+
+    def symbol_at(self, position: Position) -> str:
+        """Quân tại ô position: 'X', 'O' hoặc ''"""
+        if self.cells is not None:
+            row, col = self.coordinates(position)
+            return self.cells.get(row * KEY_SPAN + col, '')
+        bit = 1 << self.geometry.position_to_bit(position)
+        return 'X' if self.x_bits & bit else ('O' if self.o_bits & bit else '')
+
+    def free_position(self) -> Optional[Position]:
+        """Một ô trống cạnh nước vừa đi (hoặc cạnh quân bất kỳ, giữa bàn nếu bàn trống); None
+        nếu hết ô. Dùng khi máy không đưa ra được nước hợp lệ."""
+        if self.is_full():
+            return None
+        stones = [(row, col) for row, col, _ in self.stone_list()]
+        if not stones:
+            center = self.board_size // 2
+            return self.position_of(center, center)
+        if self.last_move is not None:
+            stones.insert(0, self.coordinates(self.last_move))
+        for row, col in stones:
+            for d_row in (-1, 0, 1):
+                for d_col in (-1, 0, 1):
+                    if self.on_board(row + d_row, col + d_col):
+                        position = self.position_of(row + d_row, col + d_col)
+                        if self.is_empty(position):
+                            return position
+        return None
+
+    def is_full(self) -> bool:
+        return self.board_size != UNBOUNDED and self.moves == self.board_size * self.board_size
+
+    def play(self, position: Position, symbol: str) -> Tuple[int, List[Position]]:
+        """Đặt quân symbol tại position (ô phải trống) và kiểm tra thắng.
+
+        Trả về (1 cho X, 2 cho O, 0 nếu chưa, danh sách vị trí thắng).
+        """
+        self.moves += 1
+        self.seq += 1
+        self.last_move = position
+        if self.cells is not None:
+            cell = self.coordinates(position)
+            if self.board_size == UNBOUNDED:
+                self.history += UNBOUNDED_MOVE.pack(*cell)
+            else:
+                self.history += position.to_bytes(move_width(self.board_size), 'little')
+            found = self._play_sparse(cell, symbol)
+        else:
+            self.history.append(position)  # Bàn bitboard luôn nhỏ hơn 16x16
+            found = self._play_bits(position, symbol)
+        return (1 if symbol == 'X' else 2, found) if found else (0, [])
+
+    def _play_bits(self, position: int, symbol: str) -> List[int]:
+        geo = self.geometry
+        bit = 1 << geo.position_to_bit(position)
+        if symbol == 'X':
+            self.x_bits |= bit
+            bits = self.x_bits
+        else:
+            self.o_bits |= bit
+            bits = self.o_bits
+
+        # Chỉ xét các đường đi qua nước vừa đánh, theo thứ tự ngang, dọc, chéo
+        for shift, mask in zip(geo.shifts, geo.line_masks[position]):
+            run = find_run(bits & mask, shift, geo.win_length)
+            if run:
+                # Bit thấp nhất là đầu dãy có chỉ số nhỏ nhất
+                start = (run & -run).bit_length() - 1
+                return [geo.bit_to_position(start + i * shift) for i in range(geo.win_length)]
+        return []
+
+    def _play_sparse(self, cell: Tuple[int, int], symbol: str) -> List[Position]:
+        cells = self.cells
+        row, col = cell
+        key = row * KEY_SPAN + col
+        cells[key] = symbol
+        win_length = self.win_length
+
+        # Đếm quân liên tiếp về hai phía của nước vừa đánh: tối đa win_length - 1 ô mỗi phía
+        for d_row, d_col in LINE_DIRECTIONS:
+            step = d_row * KEY_SPAN + d_col
+            back = 0
+            while back < win_length - 1 and cells.get(key - (back + 1) * step) == symbol:
+                back += 1
+            forward = 0
+            while back + forward < win_length - 1 and cells.get(key + (forward + 1) * step) == symbol:
+                forward += 1
+            if back + forward + 1 >= win_length:
+                start_row, start_col = row - back * d_row, col - back * d_col
+                return [self.position_of(start_row + i * d_row, start_col + i * d_col) for i in range(win_length)]
+        return []
+
+    def to_board(self) -> List[str]:
+        """Dựng danh sách 'board' board_size * board_size ô (chỉ bàn bitboard)"""
+        x_bits = self.x_bits
+        o_bits = self.o_bits
+        stride = self.geometry.stride
+        board = []
+        for row in range(self.board_size):
+            base = row * stride
+            for col in range(self.board_size):
+                bit = 1 << (base + col)
+                board.append('X' if x_bits & bit else ('O' if o_bits & bit else ''))
+        return board
+
+    def stone_list(self) -> List[Tuple[int, int, str]]:
+        """Các quân đã đánh dạng (row, col, 'X'/'O') - gọn và pickle được, để gửi cho CaroBot"""
+        if self.cells is not None:
+            stones = []
+            for key, symbol in self.cells.items():
+                row, col = divmod(key + MAX_COORDINATE, KEY_SPAN)
+                stones.append((row, col - MAX_COORDINATE, symbol))
+            return stones
+        stride = self.geometry.stride
+        stones = []
+        for symbol, bits in (('X', self.x_bits), ('O', self.o_bits)):
+            while bits:
+                low = bits & -bits
+                row, col = divmod(low.bit_length() - 1, stride)
+                stones.append((row, col, symbol))
+                bits ^= low
+        return stones
+
+    def stones(self) -> Dict[str, List[Position]]:
+        """Vị trí các quân đã đánh của mỗi bên (bàn thưa)"""
+        stones: Dict[str, List[Position]] = {'X': [], 'O': []}
+        for key, symbol in sorted(self.cells.items()):
+            row, col = divmod(key + MAX_COORDINATE, KEY_SPAN)
+            stones[symbol].append(self.position_of(row, col - MAX_COORDINATE))
+        return stones
+
+    def board_fields(self) -> Dict:
+        """Phần bàn cờ của tin nhắn: 'board' đầy đủ với bàn bitboard, 'stones' với bàn thưa"""
+        if self.cells is not None:
+            return {'stones': self.stones()}
+        return {'board': self.to_board()}
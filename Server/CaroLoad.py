@@ -0,0 +1,394 @@
+"""Máy tạo tải không giao diện cho server Cờ Caro.
+
+Mô phỏng hàng nghìn người chơi theo từng cặp: một người tạo game, người kia xem
+sảnh (list_games) rồi tham gia; hai bên đánh các nước ngẫu nhiên hợp lệ với nhịp
+cấu hình được, và thỉnh thoảng một người ngắt kết nối giữa ván. Đo độ trễ
+create→game_created, list_games→game_list, join→game_started, move→board_updated
+(p50/p99/p999) cùng CPU/RSS của server, và ghi kết quả ra file JSON để so sánh
+giữa các lần chạy.
+
+    python CaroLoad.py --engine async --players 2000 --duration 30 --output baseline.json
+    python CaroLoad.py --engine async --players 2000 --duration 30 --baseline baseline.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from CaroBench import free_port, percentile, raise_fd_limit, read_tree_stats, start_server
+from CaroGame import CELL_COUNT, Game
+from CaroProtocol import CODECS, HEADER, JSON_CODEC, decode_message, encode_message
+
+BASELINE_VERSION = 1
+OPERATIONS = ('create', 'list_games', 'join', 'move')
+
+
+class LoadError(Exception):
+    """Server trả lời sai hoặc không trả lời kịp"""
+    pass
+
+
+class Player:
+    """Một kết nối người chơi giả lập"""
+
+    def __init__(self, port: int, codec: str, timeout: float, stats: 'LoadStats'):
+        self.port = port
+        self.codec_name = codec
+        self.timeout = timeout
+        self.stats = stats
+        self.codec = JSON_CODEC
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('localhost', self.port)
+        self.stats.counters['connections'] += 1
+        await self.send({'action': 'hello', 'features': ['delta'], 'codecs': [self.codec_name, 'json']})
+        welcome = await self.wait_for('welcome')
+        self.codec = CODECS[welcome['codec']]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def send(self, message: Dict):
+        frame = encode_message(message, self.codec)
+        self.stats.counters['messages_out'] += 1
+        self.stats.counters['bytes_out'] += len(frame)
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def read(self) -> Dict:
+        header = await asyncio.wait_for(self.reader.readexactly(HEADER.size), self.timeout)
+        (size,) = HEADER.unpack(header)
+        payload = await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+        self.stats.counters['messages_in'] += 1
+        self.stats.counters['bytes_in'] += HEADER.size + size
+        return decode_message(payload)
+
+    async def wait_for(self, *actions: str) -> Dict:
+        """Đọc cho đến khi nhận được một trong các action; 'error' là lỗi"""
+        while True:
+            message = await self.read()
+            action = message.get('action')
+            if action in actions:
+                return message
+            if action == 'error':
+                raise LoadError(message.get('message', 'error'))
+
+    async def request(self, operation: str, message: Dict, *actions: str) -> Dict:
+        """Gửi message và đo thời gian đến khi nhận được phản hồi"""
+        t0 = time.perf_counter()
+        await self.send(message)
+        reply = await self.wait_for(*actions)
+        self.stats.record(operation, time.perf_counter() - t0)
+        return reply
+
+
+class LoadStats:
+    """Mẫu độ trễ (giây) theo thao tác và các bộ đếm"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {operation: [] for operation in OPERATIONS}
+        self.counters: Counter = Counter()
+
+    def record(self, operation: str, seconds: float):
+        self.latencies[operation].append(seconds)
+
+    def merge(self, other: Dict):
+        for operation, samples in other['latencies'].items():
+            self.latencies[operation].extend(samples)
+        self.counters.update(other['counters'])
+
+    def to_dict(self) -> Dict:
+        return {'latencies': self.latencies, 'counters': dict(self.counters)}
+
+
+async def play_game(creator: Player, joiner: Player, config: Dict, stats: LoadStats) -> Optional[Player]:
+    """Chơi một ván giữa hai người; trả về người vừa ngắt kết nối (nếu có) để mở lại"""
+    created = await creator.request('create', {'action': 'create_game', 'player_name': 'load'},
+                                    'game_created')
+    game_id = created['game_id']
+
+    await joiner.request('list_games', {'action': 'list_games', 'offset': 0, 'limit': 20}, 'game_list')
+    started = await joiner.request('join', {'action': 'join_game', 'game_id': game_id, 'player_name': 'load'},
+                                   'game_started')
+    await creator.wait_for('game_started')
+
+    players = {1: creator, 2: joiner}
+    turn = started['current_turn']
+    # Bàn cờ cục bộ để chọn ô trống và biết khi nào ván kết thúc
+    board = Game(0, '', {})
+    free: Set[int] = set(range(CELL_COUNT))
+    # Ván này có kết thúc bằng việc một người bỏ đi không, và ở nước thứ mấy
+    quit_at = random.randrange(CELL_COUNT) if random.random() < config['disconnect_rate'] else None
+
+    for move_index in range(CELL_COUNT):
+        mover, other = players[turn], players[3 - turn]
+        if move_index == quit_at:
+            mover.close()
+            stats.counters['disconnects'] += 1
+            return mover
+
+        interval = config['move_interval']
+        if interval:
+            await asyncio.sleep(random.uniform(0.5 * interval, 1.5 * interval))
+
+        position = random.choice(tuple(free))
+        free.discard(position)
+        await mover.request('move', {'action': 'move', 'game_id': game_id, 'position': position},
+                            'board_updated', 'board_snapshot')
+        await other.wait_for('board_updated', 'board_snapshot')
+        stats.counters['moves'] += 1
+
+        winner, _ = board.play(position, 'X' if turn == 1 else 'O')
+        if winner or board.is_full():
+            # Server gửi game_over sau game_over_delay
+            await mover.wait_for('game_over')
+            await other.wait_for('game_over')
+            stats.counters['games'] += 1
+            return None
+        turn = 3 - turn
+
+    raise LoadError(f'Game {game_id} không kết thúc sau {CELL_COUNT} nước')
+
+
+async def run_pair(port: int, config: Dict, stats: LoadStats, deadline: float):
+    """Một cặp người chơi chơi liên tục cho đến deadline"""
+    await asyncio.sleep(random.uniform(0, config['ramp']))
+    players = [Player(port, config['codec'], config['timeout'], stats) for _ in range(2)]
+    try:
+        for player in players:
+            await player.connect()
+        while time.monotonic() < deadline:
+            random.shuffle(players)
+            try:
+                quitter = await play_game(players[0], players[1], config, stats)
+            except (LoadError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                stats.counters['errors'] += 1
+                stats.counters[f'error:{type(e).__name__}'] += 1
+                # Không biết trạng thái phía server: mở lại cả hai kết nối
+                for player in players:
+                    player.close()
+                    await player.connect()
+                continue
+            if quitter is not None:
+                await quitter.connect()
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        stats.counters['connect_errors'] += 1
+    finally:
+        for player in players:
+            player.close()
+
+
+async def run_players(port: int, pairs: int, config: Dict) -> LoadStats:
+    stats = LoadStats()
+    deadline = time.monotonic() + config['ramp'] + config['duration']
+    await asyncio.gather(*[run_pair(port, config, stats, deadline) for _ in range(pairs)])
+    return stats
+
+
+def worker(port: int, pairs: int, config: Dict, seed: int) -> Dict:
+    """Điểm vào của một tiến trình tạo tải"""
+    raise_fd_limit()
+    random.seed(seed)
+    return asyncio.run(run_players(port, pairs, config)).to_dict()
+
+
+class ServerSampler:
+    """Lấy mẫu RSS của tiến trình server (và các shard) trong lúc chạy tải"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_rss_kb = max(self.peak_rss_kb, read_tree_stats(self.pid)['rss_kb'])
+
+    def __enter__(self):
+        self.start = read_tree_stats(self.pid)
+        self.t0 = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        end = read_tree_stats(self.pid)
+        self.elapsed = time.perf_counter() - self.t0
+        self.cpu_s = end['cpu_s'] - self.start['cpu_s']
+        self.peak_rss_kb = max(self.peak_rss_kb, end['rss_kb'])
+
+
+def summarize(stats: LoadStats, elapsed: float) -> Dict:
+    """Tổng hợp phân vị độ trễ (ms) và thông lượng"""
+    results = {}
+    for operation, samples in stats.latencies.items():
+        ms = [s * 1000 for s in samples]
+        results[operation] = {
+            'count': len(ms),
+            'p50_ms': percentile(ms, 50),
+            'p99_ms': percentile(ms, 99),
+            'p999_ms': percentile(ms, 99.9),
+            'max_ms': max(ms, default=0.0),
+        }
+    counters = dict(stats.counters)
+    return {
+        'latency': results,
+        'counters': counters,
+        'moves_per_s': counters.get('moves', 0) / elapsed if elapsed else 0.0,
+    }
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Các chỉ số tệ hơn baseline quá tolerance (tỉ lệ)"""
+    regressions = []
+    for operation, now in current['latency'].items():
+        before = baseline.get('latency', {}).get(operation)
+        if not before or not before['count'] or not now['count']:
+            continue
+        for key in ('p50_ms', 'p99_ms', 'p999_ms'):
+            if now[key] > before[key] * (1 + tolerance):
+                regressions.append(f"{operation} {key}: {before[key]:.2f} -> {now[key]:.2f}")
+    if current['moves_per_s'] < baseline.get('moves_per_s', 0) * (1 - tolerance):
+        regressions.append(f"moves_per_s: {baseline['moves_per_s']:.0f} -> {current['moves_per_s']:.0f}")
+    return regressions
+
+
+def print_report(report: Dict):
+    print(f"{'thao tác':<12}{'số mẫu':>9}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+    for operation, row in report['latency'].items():
+        print(f"{operation:<12}{row['count']:>9}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+              f"{row['p999_ms']:>10.2f}{row['max_ms']:>10.2f}")
+    counters = report['counters']
+    print(f"🎮 {counters.get('games', 0)} ván xong, {counters.get('moves', 0)} nước "
+          f"({report['moves_per_s']:.0f} nước/giây), {counters.get('disconnects', 0)} lần bỏ ván, "
+          f"{counters.get('errors', 0)} lỗi")
+    server = report.get('server')
+    if server:
+        print(f"🖥  Server: CPU {server['cpu_s']:.1f}s ({server['cpu_percent']:.0f}%), "
+              f"RSS đỉnh {server['peak_rss_mb']:.1f} MB")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Tạo tải cho server Cờ Caro')
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='async',
+                        help='Engine server chạy kèm (bỏ qua nếu dùng --port)')
+    parser.add_argument('--workers', type=int, default=1, help='Số shard của server chạy kèm')
+    parser.add_argument('--port', type=int, help='Đánh vào server đang chạy thay vì tự khởi động')
+    parser.add_argument('--server-pid', type=int, help='PID server đang chạy để đo CPU/RSS (cùng --port)')
+    parser.add_argument('--players', type=int, default=1000, help='Số người chơi giả lập (làm tròn xuống số chẵn)')
+    parser.add_argument('--processes', type=int, default=1, help='Số tiến trình tạo tải')
+    parser.add_argument('--duration', type=float, default=20.0, help='Số giây chạy sau giai đoạn khởi động')
+    parser.add_argument('--ramp', type=float, default=5.0, help='Số giây rải đều các cặp khi bắt đầu')
+    parser.add_argument('--move-interval', type=float, default=0.2, help='Thời gian nghĩ trung bình mỗi nước (giây)')
+    parser.add_argument('--disconnect-rate', type=float, default=0.1,
+                        help='Xác suất một ván kết thúc vì một người ngắt kết nối')
+    parser.add_argument('--codec', choices=sorted(CODECS), default='json')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Giây chờ tối đa mỗi phản hồi')
+    parser.add_argument('--game-over-delay', type=float, default=0.0, help='--game-over-delay của server chạy kèm')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Ghi kết quả ra file JSON (baseline)')
+    parser.add_argument('--baseline', help='So sánh với file baseline; mã thoát 1 nếu tệ hơn')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Mức tệ hơn cho phép khi so baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    raise_fd_limit()
+    config = {
+        'duration': args.duration,
+        'ramp': args.ramp,
+        'move_interval': args.move_interval,
+        'disconnect_rate': args.disconnect_rate,
+        'codec': args.codec,
+        'timeout': args.timeout,
+    }
+    pairs = args.players // 2
+    processes = max(1, min(args.processes, pairs))
+
+    process = None
+    port = args.port
+    server_pid = args.server_pid
+    if port is None:
+        port = free_port()
+        process = start_server(args.engine, port, 4096, args.workers,
+                               extra_args=['--game-over-delay', str(args.game_over_delay)])
+        server_pid = process.pid
+
+    print(f"⏱  {pairs * 2} người chơi, {processes} tiến trình tạo tải, "
+          f"{args.ramp:.0f}s khởi động + {args.duration:.0f}s đo")
+    stats = LoadStats()
+    t0 = time.perf_counter()
+    try:
+        sampler = ServerSampler(server_pid) if server_pid else None
+        with sampler if sampler else contextlib.nullcontext():
+            shares = [pairs // processes + (1 if i < pairs % processes else 0) for i in range(processes)]
+            if processes == 1:
+                stats.merge(worker(port, shares[0], config, args.seed))
+            else:
+                with multiprocessing.Pool(processes) as pool:
+                    for result in pool.starmap(worker, [(port, share, config, args.seed + i)
+                                                        for i, share in enumerate(shares)]):
+                        stats.merge(result)
+        elapsed = time.perf_counter() - t0
+    finally:
+        if process is not None:
+            process.kill()
+            process.wait()
+
+    # Ván đang dở lúc hết giờ vẫn được chơi nốt nên đo thời gian thực
+    report = summarize(stats, elapsed)
+    report.update({
+        'version': BASELINE_VERSION,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'config': dict(config, players=pairs * 2, processes=processes,
+                       engine=None if args.port else args.engine, workers=args.workers),
+    })
+    if sampler:
+        report['server'] = {
+            'cpu_s': sampler.cpu_s,
+            'cpu_percent': sampler.cpu_s / sampler.elapsed * 100,
+            'peak_rss_mb': sampler.peak_rss_kb / 1024,
+        }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Đã ghi {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != report['config']:
+            print("⚠️  Cấu hình khác baseline, so sánh có thể không công bằng")
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ Tệ hơn baseline quá {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print(f"✅ Không tệ hơn baseline quá {args.tolerance:.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
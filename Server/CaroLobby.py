@@ -0,0 +1,81 @@
+"""Sảnh chờ: chỉ mục các game đang chờ người chơi thứ hai.
+
+Server cập nhật chỉ mục khi game được tạo, có người tham gia hoặc bị xóa, nên
+list_games không phải duyệt toàn bộ self.games. Mỗi trang (offset, limit, codec)
+được mã hóa sẵn thành khung và giữ trong cache cho đến lần sảnh thay đổi kế tiếp:
+nhiều lần làm mới sảnh liên tiếp chỉ tốn một lần tra dict.
+"""
+import bisect
+import threading
+from typing import Dict, List, Tuple
+
+from CaroProtocol import Codec, encode_message
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_CACHED_PAGES = 256
+
+
+class Lobby:
+    """Các game đang chờ, sắp theo game_id, kèm cache trang đã mã hóa"""
+
+    def __init__(self):
+        self.game_ids: List[int] = []  # Sắp tăng dần để cắt trang theo offset
+        self.entries: Dict[int, Dict] = {}
+        self.version = 0  # Tăng mỗi khi sảnh thay đổi
+        self.pages: Dict[Tuple[int, int, str], bytes] = {}
+        # Lock lá: có thể lấy khi đang giữ lock registry hoặc game.lock
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.game_ids)
+
+    def add(self, game_id: int, player1: int, player1_name: str, **settings):
+        """Thêm một game vừa tạo vào sảnh; settings là cỡ bàn / độ dài thắng nếu khác mặc định"""
+        with self.lock:
+            if game_id in self.entries:
+                return
+            self.entries[game_id] = {'game_id': game_id, 'player1': player1, 'player1_name': player1_name,
+                                     **settings}
+            bisect.insort(self.game_ids, game_id)
+            self._changed()
+
+    def remove(self, game_id: int):
+        """Bỏ game khỏi sảnh (đã có người tham gia hoặc bị xóa)"""
+        with self.lock:
+            if self.entries.pop(game_id, None) is None:
+                return
+            index = bisect.bisect_left(self.game_ids, game_id)
+            del self.game_ids[index]
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self.pages.clear()
+
+    def page(self, offset: int, limit: int) -> Dict:
+        """Tin nhắn game_list cho một trang; offset/limit đã được chuẩn hóa"""
+        with self.lock:
+            games = [self.entries[gid] for gid in self.game_ids[offset:offset + limit]]
+            total = len(self.game_ids)
+        return {'action': 'game_list', 'games': games, 'offset': offset, 'total': total}
+
+    def page_frame(self, offset: int, limit: int, codec: Codec) -> bytes:
+        """Khung game_list đã mã hóa cho một trang, lấy từ cache nếu sảnh chưa đổi"""
+        offset = max(0, offset)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        key = (offset, limit, codec.name)
+        with self.lock:
+            frame = self.pages.get(key)
+            if frame is not None:
+                return frame
+            version = self.version
+
+        frame = encode_message(self.page(offset, limit), codec)
+        with self.lock:
+            # Bỏ qua nếu sảnh đã đổi trong lúc mã hóa, tránh cache trang cũ
+            if self.version == version:
+                if len(self.pages) >= MAX_CACHED_PAGES:
+                    self.pages.clear()
+                self.pages[key] = frame
+        return frame
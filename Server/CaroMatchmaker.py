@@ -0,0 +1,177 @@
+"""Hàng đợi ghép trận nhanh (quick_match) theo khoảng rating.
+
+Người chơi đang chờ được chia vào các ô rating rộng bucket_width điểm. Danh sách
+chỉ số các ô đang có người được giữ sắp xếp, nên tìm đối thủ chỉ là một lần bisect
+rồi xét người chờ lâu nhất của vài ô lân cận (số ô bị chặn bởi cửa sổ tối đa), thay
+vì quét cả hàng đợi hay để mọi người cùng join_game vào một game trong sảnh.
+
+Cửa sổ rating chấp nhận được nới rộng dần theo thời gian chờ; server gọi sweep()
+định kỳ để ghép lại những người đã chờ đủ lâu. Mỗi (cỡ bàn, độ dài thắng) có một
+hàng đợi riêng.
+"""
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+BUCKET_WIDTH = 50
+BASE_WINDOW = 100  # Chênh lệch rating chấp nhận ngay khi vào hàng đợi
+WINDOW_GROWTH = 50  # Số điểm nới thêm mỗi giây chờ
+MAX_WINDOW = 1000
+SWEEP_INTERVAL = 0.5  # Giây giữa hai lượt ghép lại những người đang chờ
+# Mốc histogram thời gian chờ ghép trận (giây)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Ticket:
+    """Một người chơi đang chờ ghép trận"""
+
+    __slots__ = ('client_id', 'player_name', 'rating', 'settings', 'connection', 'enqueued_at')
+
+    def __init__(self, client_id: int, player_name: str, rating: float, settings: Tuple[int, int],
+                 connection, enqueued_at: float):
+        self.client_id = client_id
+        self.player_name = player_name
+        self.rating = rating
+        self.settings = settings  # (board_size, win_length)
+        self.connection = connection
+        self.enqueued_at = enqueued_at  # time.monotonic()
+
+
+class MatchQueue:
+    """Người chờ của một (cỡ bàn, độ dài thắng), chia theo ô rating"""
+
+    def __init__(self, bucket_width: int):
+        self.bucket_width = bucket_width
+        # Ô -> {client_id: Ticket}; dict giữ thứ tự vào hàng nên phần tử đầu là người chờ lâu nhất
+        self.buckets: Dict[int, Dict[int, Ticket]] = {}
+        self.keys: List[int] = []  # Chỉ số các ô đang có người, sắp tăng dần
+
+    def bucket_of(self, rating: float) -> int:
+        return int(rating // self.bucket_width)
+
+    def add(self, ticket: Ticket):
+        key = self.bucket_of(ticket.rating)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {}
+            bisect.insort(self.keys, key)
+        bucket[ticket.client_id] = ticket
+
+    def remove(self, ticket: Ticket):
+        key = self.bucket_of(ticket.rating)
+        bucket = self.buckets[key]
+        del bucket[ticket.client_id]
+        if not bucket:
+            del self.buckets[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def find(self, ticket: Ticket, window: float, reach: float, window_of) -> Optional[Ticket]:
+        """Đối thủ gần rating nhất (hòa thì chờ lâu hơn) mà một trong hai bên chấp nhận được.
+
+        reach: cửa sổ rộng nhất trong hàng đợi, giới hạn số ô phải xét.
+        """
+        best, best_gap = None, None
+        reach = max(window, reach)
+        low = self.bucket_of(ticket.rating - reach)
+        high = self.bucket_of(ticket.rating + reach)
+        index = bisect.bisect_left(self.keys, low)
+        while index < len(self.keys) and self.keys[index] <= high:
+            for other in self.buckets[self.keys[index]].values():
+                if other is ticket:
+                    continue
+                # Người chờ lâu nhất của ô (khác chính mình) đại diện cho ô đó
+                gap = abs(other.rating - ticket.rating)
+                if gap <= max(window, window_of(other)) and (
+                        best is None or (gap, other.enqueued_at) < (best_gap, best.enqueued_at)):
+                    best, best_gap = other, gap
+                break
+            index += 1
+        return best
+
+
+class Matchmaker:
+    """Các hàng đợi ghép trận (an toàn giữa các thread; lock lá)"""
+
+    def __init__(self, bucket_width: int = BUCKET_WIDTH, base_window: float = BASE_WINDOW,
+                 window_growth: float = WINDOW_GROWTH, max_window: float = MAX_WINDOW):
+        self.bucket_width = bucket_width
+        self.base_window = base_window
+        self.window_growth = window_growth
+        self.max_window = max_window
+        self.queues: Dict[Tuple[int, int], MatchQueue] = {}
+        self.tickets: Dict[int, Ticket] = {}  # client_id -> Ticket, theo thứ tự vào hàng
+        self.sweep_pending = False
+        self.matches = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tickets)
+
+    def __contains__(self, client_id: int) -> bool:
+        return client_id in self.tickets
+
+    def window(self, ticket: Ticket, now: float) -> float:
+        """Chênh lệch rating người này chấp nhận sau khi đã chờ tới now"""
+        return min(self.base_window + self.window_growth * (now - ticket.enqueued_at), self.max_window)
+
+    def reach(self, window: float, now: float) -> float:
+        """Cửa sổ rộng nhất có thể gặp: của chính mình hoặc của người chờ lâu nhất"""
+        for oldest in self.tickets.values():
+            return max(window, self.window(oldest, now))
+        return window
+
+    def enqueue(self, ticket: Ticket, now: float) -> Optional[Tuple[Ticket, Ticket]]:
+        """Ghép ngay nếu có đối thủ phù hợp (trả về cặp, người chờ trước đứng đầu), không thì xếp hàng"""
+        with self.lock:
+            if ticket.client_id in self.tickets:
+                return None
+            queue = self.queues.get(ticket.settings)
+            if queue is None:
+                queue = self.queues[ticket.settings] = MatchQueue(self.bucket_width)
+            window = self.window(ticket, now)
+            other = queue.find(ticket, window, self.reach(window, now), lambda t: self.window(t, now))
+            if other is not None:
+                queue.remove(other)
+                del self.tickets[other.client_id]
+                self.matches += 1
+                return other, ticket
+            queue.add(ticket)
+            self.tickets[ticket.client_id] = ticket
+            return None
+
+    def cancel(self, client_id: int) -> Optional[Ticket]:
+        """Bỏ người chơi khỏi hàng đợi (hủy tìm trận hoặc ngắt kết nối)"""
+        with self.lock:
+            ticket = self.tickets.pop(client_id, None)
+            if ticket is not None:
+                self.queues[ticket.settings].remove(ticket)
+            return ticket
+
+    def claim_sweep(self) -> bool:
+        """True nếu người gọi cần hẹn một lượt sweep (có người chờ và chưa có lượt nào được hẹn)"""
+        with self.lock:
+            if self.sweep_pending or not self.tickets:
+                return False
+            self.sweep_pending = True
+            return True
+
+    def sweep(self, now: float) -> List[Tuple[Ticket, Ticket]]:
+        """Ghép lại những người đang chờ theo cửa sổ đã nới, người chờ lâu nhất được xét trước"""
+        pairs = []
+        with self.lock:
+            self.sweep_pending = False
+            window_of = lambda t: self.window(t, now)
+            reach = self.reach(0, now)
+            for ticket in list(self.tickets.values()):
+                if ticket.client_id not in self.tickets:
+                    continue  # Vừa được ghép trong lượt này
+                queue = self.queues[ticket.settings]
+                other = queue.find(ticket, self.window(ticket, now), reach, window_of)
+                if other is None:
+                    continue
+                for matched in (ticket, other):
+                    queue.remove(matched)
+                    del self.tickets[matched.client_id]
+                pairs.append((ticket, other))
+            self.matches += len(pairs)
+        return pairs
@@ -0,0 +1,214 @@
+"""Số liệu vận hành của server Cờ Caro ở định dạng văn bản Prometheus.
+
+Bộ đếm và histogram được cập nhật ngay trên đường xử lý nên chỉ làm vài phép
+cộng dưới một lock riêng của từng metric. Các gauge (số kết nối, số game theo
+trạng thái, độ sâu hàng đợi gửi...) do collector tính lúc được đọc, nên không tốn
+gì khi không ai đọc.
+
+Đọc qua action 'stats' của giao thức hoặc HTTP (GET /metrics) khi bật --metrics-port.
+"""
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Mốc histogram độ trễ (giây): 50 µs đến 1 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Collector trả về các dòng (tên, kiểu, mô tả, [(nhãn, giá trị)])
+Sample = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+class Counter:
+    """Bộ đếm tăng dần"""
+
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    """Histogram với các mốc cố định (đếm theo mốc, tổng và số lần)"""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # Ô cuối: lớn hơn mọi mốc (+Inf)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Family:
+    """Một metric kèm các nhãn; mỗi bộ giá trị nhãn là một Counter/Histogram riêng"""
+
+    def __init__(self, name: str, kind: str, help_text: str, label_names: Sequence[str], factory: Callable):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children: Dict[Tuple[str, ...], object] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values: str):
+        """Metric con theo giá trị nhãn; nên giữ lại kết quả thay vì gọi mỗi lần cập nhật"""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self, lines: List[str]):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        for values, child in sorted(self.children.items()):
+            labels = dict(zip(self.label_names, values))
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{format_labels(labels)} {child.value}')
+                continue
+            with child.lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket in zip(child.bounds + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{format_labels(dict(labels, le=le))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Sổ đăng ký metric của một server"""
+
+    def __init__(self, const_labels: Dict[str, str] = None):
+        self.families: List[Family] = []
+        self.collectors: List[Callable[[], Iterable[Sample]]] = []
+        self.const_labels = const_labels or {}
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Family:
+        family = Family(name, 'counter', help_text, label_names, Counter)
+        self.families.append(family)
+        return family
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Family:
+        family = Family(name, 'histogram', help_text, label_names, lambda: Histogram(buckets))
+        self.families.append(family)
+        return family
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        """Đăng ký hàm tính các gauge lúc được đọc"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """Văn bản định dạng Prometheus (text exposition 0.0.4)"""
+        lines: List[str] = []
+        for family in self.families:
+            family.render(lines)
+        for collector in self.collectors:
+            for name, kind, help_text, samples in collector():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        if self.const_labels:
+            # Nhãn chung (ví dụ shard) gắn vào mọi dòng số liệu
+            extra = ','.join(f'{k}="{v}"' for k, v in self.const_labels.items())
+            lines = [line if line.startswith('#') else add_labels(line, extra) for line in lines]
+        return '\n'.join(lines) + '\n'
+
+
+def add_labels(line: str, extra: str) -> str:
+    name, value = line.rsplit(' ', 1)
+    if name.endswith('}'):
+        return f'{name[:-1]},{extra}}} {value}'
+    return f'{name}{{{extra}}} {value}'
+
+
+class TimedLock:
+    """threading.Lock đo thời gian chờ lấy lock và thời gian giữ lock"""
+
+    __slots__ = ('lock', 'wait', 'hold', 'acquired_at')
+
+    def __init__(self, wait: Histogram, hold: Histogram):
+        self.lock = threading.Lock()
+        self.wait = wait
+        self.hold = hold
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        t0 = perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = now = perf_counter()
+            self.wait.observe(now - t0)
+        return acquired
+
+    def release(self):
+        held = perf_counter() - self.acquired_at
+        self.lock.release()
+        self.hold.observe(held)
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def __enter__(self):
+        # Như acquire() nhưng không qua tham số mặc định: đây là đường nóng của mọi nước đi
+        t0 = perf_counter()
+        self.lock.acquire()
+        self.acquired_at = now = perf_counter()
+        self.wait.observe(now - t0)
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def start_http_server(metrics: Metrics, host: str, port: int) -> ThreadingHTTPServer:
+    """Phục vụ GET /metrics trên một thread daemon"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Không in mỗi lần Prometheus đọc
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='caro-metrics-http', daemon=True).start()
+    return httpd
@@ -0,0 +1,107 @@
+"""Hàng đợi gửi có giới hạn cho mỗi kết nối.
+
+Handler chỉ đưa khung đã mã hóa vào Outbox rồi đi tiếp; việc ghi ra socket do
+writer của kết nối làm (thread riêng với engine threaded, task trên event loop
+với engine async). Một client mạng chậm vì vậy không giữ chân handler hay lock nào.
+
+Khi số tin nhắn chờ vượt high_water:
+- các cập nhật bàn cờ cùng một game (có collapse_key) được gộp thành một ảnh chụp
+  duy nhất, dựng lúc writer thực sự gửi (nên luôn là trạng thái mới nhất);
+- nếu vẫn vượt, kết nối bị coi là slow consumer và bị đóng.
+"""
+import threading
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+
+DEFAULT_HIGH_WATER = 256
+
+
+class Outbox:
+    """Hàng đợi khung chờ gửi của một kết nối (an toàn khi gọi từ nhiều thread)"""
+
+    def __init__(self, high_water: int = DEFAULT_HIGH_WATER):
+        self.high_water = high_water
+        # Mỗi phần tử: (khung, collapse_key). Khung None nghĩa là "ảnh chụp game collapse_key"
+        self.items: deque = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.evicted = False
+        self.max_depth = 0
+        self.collapsed = 0
+        # Tổng số khung / byte đã nhận vào hàng đợi (đếm dưới cond sẵn có, không thêm lock)
+        self.queued_frames = 0
+        self.queued_bytes = 0
+        # Dựng khung ảnh chụp bàn cờ cho một game; server gán khi tạo kết nối
+        self.snapshot_provider: Optional[Callable[[int], Optional[bytes]]] = None
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def put(self, data: bytes, collapse_key: Optional[int] = None) -> bool:
+        """Đưa một khung vào hàng đợi. Trả về False nếu kết nối đã đóng hoặc vừa bị loại vì quá chậm"""
+        with self.cond:
+            if self.closed:
+                return False
+            self.items.append((data, collapse_key))
+            self.queued_frames += 1
+            self.queued_bytes += len(data)
+            if len(self.items) > self.high_water and not self._collapse():
+                self.closed = True
+                self.evicted = True
+                self.items.clear()
+                self.cond.notify_all()
+                return False
+            if len(self.items) > self.max_depth:
+                self.max_depth = len(self.items)
+            self.cond.notify()
+            return True
+
+    def _collapse(self) -> bool:
+        """Gộp các cập nhật bàn cờ đang chờ thành ảnh chụp; True nếu hàng đợi về dưới high_water"""
+        if self.snapshot_provider is None:
+            return False
+
+        last_index = {}
+        for index, (_, key) in enumerate(self.items):
+            if key is not None:
+                last_index[key] = index
+        if not last_index:
+            return False
+
+        # Giữ thứ tự: ảnh chụp nằm ở vị trí cập nhật cuối cùng của game đó
+        collapsed = deque()
+        for index, (data, key) in enumerate(self.items):
+            if key is None:
+                collapsed.append((data, key))
+            elif last_index[key] == index:
+                collapsed.append((None, key))
+        self.collapsed += len(self.items) - len(collapsed)
+        self.items = collapsed
+        return len(self.items) <= self.high_water
+
+    def take(self, timeout: Optional[float] = None) -> Tuple[List[bytes], bool]:
+        """Lấy mọi khung đang chờ (chờ tối đa timeout nếu rỗng). Trả về (các khung, còn mở)"""
+        with self.cond:
+            if not self.items and not self.closed:
+                self.cond.wait(timeout)
+            pending = list(self.items)
+            self.items.clear()
+            is_open = not self.closed
+
+        frames = []
+        for data, key in pending:
+            if data is None:
+                # Dựng ảnh chụp ngoài lock của Outbox (provider lấy game.lock)
+                data = self.snapshot_provider(key)
+                if data is None:
+                    continue
+            frames.append(data)
+        return frames, is_open
+
+    def close(self, discard: bool = True):
+        """Đóng hàng đợi; discard=False để writer vẫn gửi nốt các khung đang chờ"""
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.items.clear()
+            self.cond.notify_all()
@@ -0,0 +1,352 @@
+"""Rating Elo của người chơi và bảng xếp hạng.
+
+Rating được cập nhật ngay khi một ván có kết quả (Elo, hệ số K cố định). Bảng xếp
+hạng là một skip list có độ rộng cạnh, sắp theo (-rating, tên): chèn / xóa, hạng
+của một người và phần tử thứ k đều O(log n) kỳ vọng, nên rank_of() và một trang
+top N không phải sắp xếp lại cả danh sách. Trang top N được mã hóa sẵn thành khung
+và giữ trong cache cho đến khi một thay đổi chạm tới MAX_LEADERBOARD hạng đầu.
+
+Tệp rating (JSON lines, mỗi dòng là trạng thái mới nhất của một người) được ghi theo
+lô: thay đổi gom trong bộ nhớ và một thread nối chúng vào tệp mỗi flush_interval giây
+bằng một lần write + fsync. Khi đọc lại, dòng sau đè dòng trước; tệp được viết gọn
+lại khi số dòng vượt quá hai lần số người chơi.
+
+Chạy nhiều shard (CaroShards), chỉ một RatingBook là chủ (writable): nó tính Elo cho
+mọi ván và là nơi duy nhất ghi tệp. Các shard khác giữ bản sao chỉ đọc (đọc tệp lúc khởi
+động rồi nhận trạng thái mới của người chơi qua apply()), nên rating không phụ thuộc ván
+được chơi ở shard nào và mọi shard trả về cùng một bảng xếp hạng.
+"""
+import json
+import os
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from CaroProtocol import Codec, encode_message
+
+DEFAULT_RATING = 1200  # Rating của người chơi chưa có ván nào
+K_FACTOR = 32
+DEFAULT_LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD = 100
+DEFAULT_FLUSH_INTERVAL = 1.0
+MAX_LEVEL = 32
+
+Key = Tuple[float, str]  # (-rating, tên): người rating cao đứng trước, hòa thì theo tên
+
+
+def expected_score(rating: float, opponent: float) -> float:
+    return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / 400.0))
+
+
+def elo_update(rating1: float, rating2: float, score1: float, k: float = K_FACTOR) -> Tuple[float, float]:
+    """Rating mới của hai người sau một ván; score1 = 1 / 0.5 / 0 (thắng / hòa / thua) của người thứ nhất"""
+    change = k * (score1 - expected_score(rating1, rating2))
+    return rating1 + change, rating2 - change
+
+
+class SkipNode:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key: Optional[Key], level: int):
+        self.key = key
+        self.next: List[Optional['SkipNode']] = [None] * level
+        # width[i]: số vị trí từ nút này tới next[i] (tới cuối danh sách nếu next[i] là None)
+        self.width = [1] * level
+
+
+class RankedSkipList:
+    """Skip list có độ rộng cạnh (order-statistics): hạng và phần tử thứ k trong O(log n)"""
+
+    def __init__(self):
+        self.head = SkipNode(None, MAX_LEVEL)
+        self.level = 1  # Số tầng đang dùng; các tầng trên chỉ được khởi tạo khi một nút đầu tiên cần tới
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _predecessors(self, key: Key) -> Tuple[List[SkipNode], List[int]]:
+        """Nút cuối cùng có khóa < key ở mỗi tầng đang dùng và vị trí của nó (head ở vị trí 0)"""
+        update, positions = [self.head] * MAX_LEVEL, [0] * MAX_LEVEL
+        node, position = self.head, 0
+        for level in range(self.level - 1, -1, -1):
+            following = node.next[level]
+            while following is not None and following.key < key:
+                position += node.width[level]
+                node, following = following, following.next[level]
+            update[level], positions[level] = node, position
+        return update, positions
+
+    def insert(self, key: Key) -> int:
+        """Chèn key, trả về hạng của nó"""
+        update, positions = self._predecessors(key)
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        for i in range(self.level, level):
+            self.head.next[i] = None
+            self.head.width[i] = self.size + 1
+        self.level = max(self.level, level)
+        node = SkipNode(key, level)
+        position = positions[0] + 1
+        for i in range(level):
+            previous = update[i]
+            node.next[i] = previous.next[i]
+            previous.next[i] = node
+            node.width[i] = previous.width[i] - (position - positions[i]) + 1
+            previous.width[i] = position - positions[i]
+        for i in range(level, self.level):
+            update[i].width[i] += 1
+        self.size += 1
+        return position
+
+    def remove(self, key: Key) -> Optional[int]:
+        """Xóa key, trả về hạng nó vừa giữ (None nếu không có)"""
+        update, positions = self._predecessors(key)
+        target = update[0].next[0]
+        if target is None or target.key != key:
+            return None
+        for i in range(self.level):
+            if update[i].next[i] is target:
+                update[i].width[i] += target.width[i] - 1
+                update[i].next[i] = target.next[i]
+            else:
+                update[i].width[i] -= 1
+        self.size -= 1
+        return positions[0] + 1
+
+    def rank(self, key: Key) -> Optional[int]:
+        """Hạng (bắt đầu từ 1) của key, hoặc None nếu không có"""
+        update, positions = self._predecessors(key)
+        following = update[0].next[0]
+        if following is None or following.key != key:
+            return None
+        return positions[0] + 1
+
+    def slice(self, start: int, count: int) -> List[Key]:
+        """count khóa bắt đầu từ hạng start + 1"""
+        node, position = self.head, 0
+        for level in range(self.level - 1, -1, -1):
+            while node.next[level] is not None and position + node.width[level] <= start + 1:
+                position += node.width[level]
+                node = node.next[level]
+        keys = []
+        if position != start + 1:
+            return keys
+        while node is not None and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class PlayerRating:
+    __slots__ = ('rating', 'games', 'wins', 'losses', 'draws')
+
+    def __init__(self, rating: float = DEFAULT_RATING, games: int = 0, wins: int = 0, losses: int = 0,
+                 draws: int = 0):
+        self.rating = rating
+        self.games = games
+        self.wins = wins
+        self.losses = losses
+        self.draws = draws
+
+    def to_dict(self, name: str) -> Dict:
+        return {'name': name, 'rating': self.rating, 'games': self.games, 'wins': self.wins,
+                'losses': self.losses, 'draws': self.draws}
+
+
+class RatingBook:
+    """Rating của mọi người chơi, bảng xếp hạng và tệp lưu (an toàn giữa các thread; lock lá)"""
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 writable: bool = True):
+        self.path = path
+        self.writable = writable  # False: bản sao chỉ đọc của RatingBook chủ (không ghi tệp)
+        self.flush_interval = flush_interval
+        self.players: Dict[str, PlayerRating] = {}
+        self.ranking = RankedSkipList()
+        self.pages: Dict[Tuple[int, str], bytes] = {}  # (limit, codec) -> khung leaderboard đã mã hóa
+        self.version = 0  # Tăng mỗi khi top MAX_LEADERBOARD thay đổi
+        self.dirty: Dict[str, PlayerRating] = {}
+        self.lines = 0  # Số dòng trong tệp (để biết khi nào cần viết gọn)
+        self.games_rated = 0
+        self.lock = threading.Lock()  # Lock lá: record_game() được gọi khi đang giữ game.lock
+        self.write_lock = threading.Lock()  # Ghi tệp không chạy song song; record_game() không phải chờ
+        self.stop_event = threading.Event()
+        self.flusher: Optional[threading.Thread] = None
+        if path is not None:
+            self.load()
+        if path is not None and writable:
+            self.flusher = threading.Thread(target=self.flush_loop, name='caro-ratings-flush', daemon=True)
+            self.flusher.start()
+
+    def __len__(self) -> int:
+        return len(self.players)
+
+    def load(self):
+        """Đọc tệp rating (bỏ qua dòng ghi dở ở cuối) rồi viết gọn lại (chỉ RatingBook chủ)"""
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Dòng ghi dở khi tiến trình dừng giữa chừng
+                    name = entry.pop('name')
+                    self.players[name] = PlayerRating(**entry)
+        for name, player in self.players.items():
+            self.ranking.insert((-player.rating, name))
+        if self.writable:
+            self.compact()
+
+    def rating(self, name: str) -> float:
+        with self.lock:
+            player = self.players.get(name)
+            return player.rating if player is not None else DEFAULT_RATING
+
+    def record_game(self, name1: str, name2: str, score1: float) -> Tuple[float, float]:
+        """Cập nhật rating sau một ván giữa name1 và name2; trả về rating mới của hai người.
+        
+        Ván tự đấu (cùng tên) không làm đổi rating.
+        """
+        with self.lock:
+            if name1 == name2:
+                rating = self.players[name1].rating if name1 in self.players else DEFAULT_RATING
+                return rating, rating
+            players = [self.players.get(name1), self.players.get(name2)]
+            old_keys = [None, None]
+            for index, name in enumerate((name1, name2)):
+                if players[index] is None:
+                    players[index] = self.players[name] = PlayerRating()
+                else:
+                    old_keys[index] = (-players[index].rating, name)
+            first, second = players
+            first.rating, second.rating = elo_update(first.rating, second.rating, score1)
+            for player, score in ((first, score1), (second, 1.0 - score1)):
+                player.games += 1
+                if score == 1.0:
+                    player.wins += 1
+                elif score == 0.0:
+                    player.losses += 1
+                else:
+                    player.draws += 1
+
+            touches_top = False
+            for old_key, player, name in zip(old_keys, players, (name1, name2)):
+                touches_top |= self._rerank(name, player, old_key)
+            self.games_rated += 1
+            if touches_top:
+                self.version += 1
+                self.pages.clear()
+            return first.rating, second.rating
+
+    def _rerank(self, name: str, player: PlayerRating, old_key: Optional[Key]) -> bool:
+        """Đưa người chơi về đúng chỗ trong bảng xếp hạng (gọi khi đang giữ self.lock);
+        True nếu chạm tới top MAX_LEADERBOARD"""
+        touches_top = False
+        if old_key is not None:
+            touches_top = self.ranking.remove(old_key) <= MAX_LEADERBOARD
+        touches_top |= self.ranking.insert((-player.rating, name)) <= MAX_LEADERBOARD
+        if self.writable:
+            self.dirty[name] = player
+        return touches_top
+
+    def entries(self, names: Tuple[str, ...]) -> List[Dict]:
+        """Trạng thái hiện tại của các người chơi (để gửi cho bản sao)"""
+        with self.lock:
+            return [self.players[name].to_dict(name) for name in names if name in self.players]
+
+    def apply(self, entries: List[Dict]):
+        """Bản sao: nhận trạng thái mới của các người chơi trong một ván do RatingBook chủ tính"""
+        with self.lock:
+            touches_top = False
+            for entry in entries:
+                entry = dict(entry)
+                name = entry.pop('name')
+                player = self.players.get(name)
+                if player is not None and player.games >= entry['games']:
+                    continue  # Trạng thái cũ hơn bản đang có (hai lần phát đến lệch thứ tự)
+                old_key = None if player is None else (-player.rating, name)
+                player = self.players[name] = PlayerRating(**entry)
+                touches_top |= self._rerank(name, player, old_key)
+            self.games_rated += 1
+            if touches_top:
+                self.version += 1
+                self.pages.clear()
+
+    def rank_of(self, name: str) -> Dict:
+        """Hạng (None nếu chưa có ván nào), rating và thành tích của một người"""
+        with self.lock:
+            player = self.players.get(name)
+            if player is None:
+                return {'player_name': name, 'rank': None, 'rating': DEFAULT_RATING, 'games': 0,
+                        'total': len(self.players)}
+            return {'player_name': name, 'rank': self.ranking.rank((-player.rating, name)),
+                    'rating': round(player.rating, 1), 'games': player.games, 'wins': player.wins,
+                    'losses': player.losses, 'draws': player.draws, 'total': len(self.players)}
+
+    def top(self, limit: int) -> List[Dict]:
+        with self.lock:
+            return [{'rank': index + 1, 'player_name': name, 'rating': round(-negative, 1),
+                     'games': self.players[name].games}
+                    for index, (negative, name) in enumerate(self.ranking.slice(0, limit))]
+
+    def page_frame(self, limit: int, codec: Codec) -> bytes:
+        """Khung leaderboard top limit, lấy từ cache nếu top chưa đổi"""
+        limit = max(1, min(limit, MAX_LEADERBOARD))
+        key = (limit, codec.name)
+        with self.lock:
+            frame = self.pages.get(key)
+            if frame is not None:
+                return frame
+            version = self.version
+
+        frame = encode_message({'action': 'leaderboard', 'players': self.top(limit)}, codec)
+        with self.lock:
+            # Bỏ qua nếu top đã đổi trong lúc mã hóa, tránh cache trang cũ
+            if self.version == version:
+                self.pages[key] = frame
+        return frame
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Nối trạng thái mới của những người vừa đổi rating vào tệp bằng một lần write + fsync"""
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                dirty, self.dirty = self.dirty, {}
+                lines = ''.join(json.dumps(player.to_dict(name), ensure_ascii=False) + '\n'
+                                for name, player in dirty.items())
+                compact = self.lines + len(dirty) > 2 * len(self.players)
+            if compact:
+                self.compact()
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.lines += len(dirty)
+
+    def compact(self):
+        """Viết lại tệp chỉ gồm trạng thái hiện tại của mỗi người (tệp tạm + fsync + đổi tên)"""
+        with self.lock:
+            entries = [player.to_dict(name) for name, player in self.players.items()]
+            self.dirty.clear()
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self.lines = len(entries)
+
+    def close(self):
+        self.stop_event.set()
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flush()
@@ -0,0 +1,94 @@
+"""Hẹn giờ cho server Cờ Caro: một heap các mốc thời gian do một thread duy nhất phục vụ.
+
+Dùng thay cho time.sleep trong handler: việc cần làm sau một khoảng trễ được đưa
+vào heap, thread scheduler ngủ đến mốc gần nhất rồi gọi callback. Không giữ lock
+nào của server trong lúc chờ.
+"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+
+class TimerHandle:
+    """Một lần hẹn giờ; cancel() để bỏ (heap bỏ qua khi tới lượt)"""
+
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline: float, callback: Callable, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """Heap các TimerHandle theo deadline (time.monotonic), phục vụ bởi một thread daemon"""
+
+    def __init__(self, name: str = 'caro-scheduler'):
+        self.name = name
+        self._heap: List[Tuple[float, int, TimerHandle]] = []
+        self._counter = itertools.count()  # Phá hòa khi cùng deadline, giữ thứ tự hẹn
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def call_later(self, delay: float, callback: Callable, *args) -> TimerHandle:
+        """Gọi callback(*args) sau delay giây trên thread scheduler"""
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline: float, callback: Callable, *args) -> TimerHandle:
+        """Gọi callback(*args) khi time.monotonic() đạt deadline"""
+        handle = TimerHandle(deadline, callback, args)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, (deadline, next(self._counter), handle))
+            # Chỉ cần đánh thức khi mốc mới sớm hơn mốc thread đang chờ
+            if self._heap[0][2] is handle:
+                self._cond.notify()
+        return handle
+
+    def stop(self):
+        """Dừng thread scheduler, bỏ các hẹn giờ còn lại"""
+        with self._cond:
+            self._stopped = True
+            self._heap.clear()
+            self._cond.notify()
+
+    def pending(self) -> int:
+        """Số hẹn giờ đang chờ (kể cả đã cancel nhưng chưa tới lượt)"""
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+
+                # Lấy mọi hẹn giờ đã tới hạn, gọi callback ngoài lock
+                now = time.monotonic()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+
+            for handle in due:
+                if handle.cancelled:
+                    continue
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:
+                    print(f"❌ Lỗi hẹn giờ {getattr(handle.callback, '__name__', handle.callback)}: {e}")
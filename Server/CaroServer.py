@@ -1,311 +1,1741 @@
+import argparse
+import multiprocessing
+import os
 import socket
 import threading
-import json
 import random
+import secrets
+import signal
 import time
-from typing import Dict, List, Tuple
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Set
 from datetime import datetime
 
+from CaroArchive import RESULT_ABANDONED, GameArchive, encode_game
+from CaroBook import load_books
+from CaroBot import DEFAULT_LEVEL, LEVELS, choose_move
+from CaroClock import ClockQueue, GameClock, parse_time_control
+from CaroGame import BOARD_SIZE, WIN_LENGTH, Game, check_settings, history_positions, move_width
+from CaroLobby import DEFAULT_PAGE_SIZE, Lobby
+from CaroMatchmaker import SWEEP_INTERVAL, WAIT_BUCKETS, Matchmaker, Ticket
+from CaroMetrics import Metrics, TimedLock, start_http_server
+from CaroOutbox import DEFAULT_HIGH_WATER, Outbox
+from CaroScheduler import Scheduler
+from CaroRatings import DEFAULT_LEADERBOARD_SIZE, MAX_LEADERBOARD, RatingBook
+from CaroProtocol import (CODECS, JSON_CODEC, RECV_SIZE, FrameDecoder, choose_codec, decode_message,
+                          encode_frame, encode_message)
+from CaroShards import decode_pending, encode_pending
+from CaroTimingWheel import TimingWheel
+from CaroWal import (DEFAULT_FSYNC_INTERVAL, DURABILITY_LEVELS, LIVE_STATUSES, WriteAheadLog, encode_create,
+                     encode_drop, encode_end, encode_move, encode_start, game_state, list_segments, recover)
+
+# Các tính năng client có thể bật bằng tin nhắn hello
+SUPPORTED_FEATURES = ('delta', 'heartbeat')
+
+# player2 của ván chơi với máy (id client thật luôn >= 1)
+BOT_PLAYER_ID = 0
+
+# Shard giữ hàng đợi quick_match khi chạy nhiều shard: kết nối ghép trận được chuyển sang đó
+MATCH_SHARD = 0
+
+# Shard giữ bảng rating chung khi chạy nhiều shard: tính Elo cho mọi ván và ghi ratings_file
+RATINGS_SHARD = 0
+
+def bot_to_move(game: Game) -> bool:
+    """Ván với máy đang chờ máy đi (gọi khi đang giữ game.lock)"""
+    return game.status == 'playing' and game.bot_level is not None and game.current_turn == 2
+
+# Action được đếm riêng trong số liệu; action lạ gộp vào 'unknown' để số nhãn không tăng vô hạn
+ACTIONS = ('hello', 'ping', 'pong', 'create_game', 'join_game', 'quick_match', 'cancel_match', 'spectate', 'move', 'list_games',
+           'resync', 'resume', 'stats', 'game_history', 'player_stats', 'replay', 'leaderboard', 'rank')
+
+# Heartbeat: ping client 'heartbeat' đã im lặng PING_INTERVAL giây, ngắt nếu im lặng IDLE_TIMEOUT giây
+DEFAULT_PING_INTERVAL = 15.0
+DEFAULT_IDLE_TIMEOUT = 45.0
+
+# Số giây giữ chỗ cho người chơi mất kết nối giữa ván trước khi xử thua
+DEFAULT_SESSION_GRACE = 30.0
+
+# Số ván mặc định / tối đa trong một lần game_history
+DEFAULT_HISTORY_LIMIT = 10
+MAX_HISTORY_LIMIT = 100
+
+def enable_keepalive(sock: socket.socket, idle_timeout: float):
+    """Bật TCP keepalive để kernel phát hiện peer chết của client không dùng heartbeat
+    trong khoảng idle_timeout giây (các tùy chọn TCP_KEEP* chỉ có trên một số hệ điều hành)"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        interval = max(1, int(idle_timeout / 6))
+        for option, value in (('TCP_KEEPIDLE', max(1, int(idle_timeout / 2))), ('TCP_KEEPINTVL', interval),
+                              ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError:
+        pass
+
+class ClientConnection:
+    """Socket của một client, codec đã thỏa thuận trong hello và hàng đợi gửi riêng.
+    
+    sendall() chỉ đưa khung vào Outbox; thread writer của kết nối gom các khung đang chờ
+    và ghi bằng một lần sock.sendall.
+    """
+    
+    def __init__(self, sock: socket.socket, high_water: int = DEFAULT_HIGH_WATER):
+        self.sock = sock
+        self.codec = JSON_CODEC
+        self.outbox = Outbox(high_water)
+        # (shard, tin nhắn join_game) khi kết nối cần chuyển sang shard sở hữu game
+        self.handoff = None
+        # Chỉ thread đọc của kết nối cập nhật nên không cần lock
+        self.received_frames = 0
+        self.received_bytes = 0
+        # Nhật ký mức sync: chờ các bản ghi đã append được fsync trước khi gửi (server gán)
+        self.commit_wait: Optional[Callable[[], None]] = None
+        self.last_seen = time.monotonic()  # Lần cuối nhận được dữ liệu (heartbeat)
+        self.heartbeat = False  # Client đã bật 'heartbeat' qua hello: trả lời ping
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+    
+    def sendall(self, data: bytes, collapse_key: Optional[int] = None):
+        if not self.outbox.put(data, collapse_key) and self.outbox.evicted:
+            # Client quá chậm: đóng socket để thread đọc thoát ra và dọn dẹp
+            self.shutdown()
+    
+    def write_loop(self):
+        """Ghi các khung đang chờ ra socket cho đến khi kết nối đóng"""
+        while True:
+            frames, is_open = self.outbox.take()
+            if frames:
+                if self.commit_wait is not None:
+                    self.commit_wait()
+                try:
+                    self.sock.sendall(b''.join(frames))
+                except OSError:
+                    self.outbox.close()
+                    self.shutdown()
+                    return
+            if not is_open:
+                return
+    
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def abort(self):
+        """Cắt kết nối chết: recv và sendall đang chặn đều trả về, thread đọc dọn dẹp như khi client thoát"""
+        self.shutdown()
+    
+    def detach(self):
+        """Gửi nốt các khung đang chờ rồi dừng writer, giữ socket mở để chuyển sang shard khác"""
+        self.outbox.close(discard=False)
+        self.writer.join()
+    
+    def close(self):
+        self.outbox.close()
+        self.sock.close()
+
 class TicTacToeServer:
-    def __init__(self, host='localhost', port=8888):
+    def __init__(self, host='localhost', port=8888, backlog=5, game_over_delay=0.3,
+                 send_queue_limit=DEFAULT_HIGH_WATER, game_ttl=300.0, shard_index=0, shard_count=1,
+                 metrics_port=None, bot_workers=1, opening_books=(), wal_dir=None, durability='group',
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, snapshot_interval=60.0, archive_dir=None,
+                 ratings_file=None, session_grace=DEFAULT_SESSION_GRACE, ping_interval=DEFAULT_PING_INTERVAL,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients: Dict[int, socket.socket] = {}
-        self.games: Dict[int, Dict] = {}
+        self.backlog = backlog
+        # Số tin nhắn tối đa chờ gửi cho một client trước khi gộp cập nhật / ngắt kết nối
+        self.send_queue_limit = send_queue_limit
+        self.slow_consumers_evicted = 0
+        self.collapsed_updates = 0
+        # Lưu lượng của các kết nối đã đóng; kết nối đang mở được cộng thêm lúc đọc số liệu
+        self.traffic = {'received_frames': 0, 'received_bytes': 0, 'sent_frames': 0, 'sent_bytes': 0}
+        # Độ trễ giữa board_updated cuối và game_over để client kịp vẽ nước thắng
+        self.game_over_delay = game_over_delay
+        # Số giây giữ lại game đã kết thúc / bị bỏ dở trước khi thu hồi
+        self.game_ttl = game_ttl
+        self.games_evicted = 0
+        # Số giây người chơi mất kết nối giữa ván được quay lại bằng resume (0: xử thua ngay)
+        self.session_grace = session_grace
+        self.sessions_resumed = 0
+        self.scheduler = Scheduler()
+        # Hẹn giờ ping / thu hồi kết nối chết: một bánh xe cho mọi kết nối, quay bằng một hẹn giờ
+        # (ping_interval = 0: tắt heartbeat)
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = TimingWheel()
+        self.idle_reaped = 0
+        # Mốc hết giờ của mọi ván có time control: một heap, một hẹn giờ đánh thức
+        self.clocks = ClockQueue()
+        self.flags_fallen = 0
+        self.server_socket: Optional[socket.socket] = None
+        self.clients: Dict[int, ClientConnection] = {}
+        self.games: Dict[int, Game] = {}
+        self.next_game_id = 1  # Tăng đơn điệu, không tái sử dụng id của game đã xóa
+        # Chỉ mục ngược client -> các game client đang tham gia
+        self.client_games: Dict[int, Set[int]] = {}
+        # Chỉ mục ngược client -> các game client đang xem (spectate)
+        self.client_spectating: Dict[int, Set[int]] = {}
+        # Chỉ mục các game đang chờ cho list_games
+        self.lobby = Lobby()
+        # Hàng đợi quick_match theo ô rating; nhiều shard: chỉ hàng đợi của MATCH_SHARD được dùng
+        self.matchmaker = Matchmaker()
+        # Client đã bật chế độ 'delta' qua hello: chỉ nhận nước đi mới thay vì cả bàn cờ
+        self.delta_clients: Set[int] = set()
         self.client_counter = 0
+        # Chạy nhiều tiến trình (CaroShards): id game / client mang chỉ số shard (id % shard_count)
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.router = None  # CaroShards.ShardRouter khi là worker
+        # Cổng HTTP cho GET /metrics (None: chỉ đọc qua action 'stats'); mỗi shard dùng cổng + chỉ số shard
+        self.metrics_port = metrics_port
+        # Pool tiến trình chạy CaroBot, tạo khi có ván chơi với máy đầu tiên
+        self.bot_workers = bot_workers
+        self.bot_pool: Optional[ProcessPoolExecutor] = None
+        self.bot_pool_lock = threading.Lock()  # Lock lá: có thể lấy khi đang giữ game.lock
+        # Sách khai cuộc (CaroBook) mmap chỉ đọc, theo (board_size, win_length)
+        self.books = load_books(opening_books)
+        # Nhật ký ghi trước (CaroWal), mở trong open_wal() khi có wal_dir; None: không lưu xuống đĩa
+        self.wal_dir = wal_dir
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.wal: Optional[WriteAheadLog] = None
+        # Kho lưu ván đã kết thúc (CaroArchive); các shard ghi tệp riêng trong cùng thư mục
+        self.archive = GameArchive(archive_dir, shard_index) if archive_dir else None
+        # Rating Elo và bảng xếp hạng (CaroRatings); ratings_file: lưu xuống đĩa. Nhiều shard:
+        # RATINGS_SHARD là chủ, các shard khác giữ bản sao chỉ đọc cập nhật qua router
+        self.ratings = RatingBook(ratings_file, writable=shard_index == RATINGS_SHARD)
+        self.setup_metrics()
+        # Lock registry: chỉ bảo vệ self.clients, self.games, self.client_games, self.client_spectating,
+        # self.delta_clients.
+        # Trạng thái từng ván được bảo vệ bởi game.lock riêng (luôn lấy sau self.lock).
         self.lock = threading.Lock()
         
     def start(self):
         """Khởi động server"""
+        self.start_metrics_http()
+        self.open_wal()
+        self.start_heartbeats()
+        if self.router is not None:
+            # Worker: kết nối do tiến trình chính accept rồi chuyển sang
+            self.print_startup('threaded')
+            try:
+                self.router.serve(self)
+            except KeyboardInterrupt:
+                pass
+            self.shutdown()
+            return
+        
         try:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            print(f"🎮 Server khởi động tại {self.host}:{self.port}")
-            print(f"⏰ Thời gian: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            self.server_socket.listen(self.backlog)
+            self.print_startup('threaded')
         except OSError as e:
-            if e.errno == 10048 or e.errno == 98:  # Port already in use
-                print(f"❌ Lỗi: Cổng {self.port} đang được sử dụng!")
-                print(f"💡 Hãy đóng ứng dụng khác đang dùng cổng này hoặc đổi cổng khác.")
-            else:
-                print(f"❌ Lỗi khởi động server: {e}")
+            self.print_bind_error(e)
             return
         
         try:
             while True:
-                client_socket, address = self.server_socket.accept()
-                self.client_counter += 1
-                client_id = self.client_counter
-                
-                with self.lock:
-                    self.clients[client_id] = client_socket
-                
-                print(f"✅ Client {client_id} kết nối từ {address}")
-                print(f"   Số client hiện tại: {len(self.clients)}")
-                
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_id, client_socket)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+                sock, address = self.server_socket.accept()
+                self.adopt_connection(sock, address)
                 
         except KeyboardInterrupt:
             print("\n🛑 Server dừng")
             self.shutdown()
     
-    def handle_client(self, client_id: int, client_socket: socket.socket):
+    def adopt_connection(self, sock: socket.socket, address, handoff: Optional[Dict] = None):
+        """Nhận một kết nối mới (hoặc được shard khác chuyển sang) và chạy thread xử lý"""
+        enable_keepalive(sock, self.idle_timeout)
+        client_socket = ClientConnection(sock, self.send_queue_limit)
+        client_id = self.next_client_id()
+        self.register_client(client_id, client_socket)
+        
+        print(f"✅ Client {client_id} kết nối từ {address}")
+        print(f"   Số client hiện tại: {len(self.clients)}")
+        
+        client_thread = threading.Thread(
+            target=self.handle_client,
+            args=(client_id, client_socket, handoff)
+        )
+        client_thread.daemon = True
+        client_thread.start()
+    
+    def next_client_id(self) -> int:
+        with self.lock:
+            self.client_counter += 1
+            return self.client_counter * self.shard_count + self.shard_index
+    
+    def shard_of(self, game_id: int) -> int:
+        return game_id % self.shard_count
+    
+    def setup_metrics(self):
+        """Khai báo các metric (CaroMetrics) và giữ sẵn metric con cho đường xử lý nóng"""
+        self.metrics = Metrics({'shard': str(self.shard_index)} if self.shard_count > 1 else None)
+        durations = self.metrics.histogram('caro_request_duration_seconds',
+                                           'Thời gian xử lý một tin nhắn client theo action', ('action',))
+        # Số lần gọi mỗi action chính là _count của histogram nên không cần bộ đếm riêng
+        self.action_durations = {action: durations.labels(action) for action in ACTIONS + ('unknown',)}
+        self.lock_wait = self.metrics.histogram('caro_game_lock_wait_seconds', 'Thời gian chờ lấy game.lock').labels()
+        self.lock_hold = self.metrics.histogram('caro_game_lock_hold_seconds', 'Thời gian giữ game.lock').labels()
+        self.connections_total = self.metrics.counter('caro_connections_total', 'Số kết nối đã nhận').labels()
+        self.bot_search = self.metrics.histogram('caro_bot_search_seconds', 'Thời gian CaroBot tìm một nước',
+                                                 ('level',))
+        self.bot_nodes = self.metrics.counter('caro_bot_nodes_total', 'Số nút CaroBot đã duyệt', ('level',))
+        self.wal_fsync = self.metrics.histogram('caro_wal_fsync_seconds', 'Thời gian một lần fsync nhật ký').labels()
+        self.bot_book_moves = self.metrics.counter('caro_bot_book_moves_total',
+                                                   'Số nước CaroBot lấy từ sách khai cuộc', ('level',))
+        self.match_wait = self.metrics.histogram('caro_match_wait_seconds', 'Thời gian chờ từ quick_match tới khi có trận',
+                                                 buckets=WAIT_BUCKETS).labels()
+        self.metrics.add_collector(self.collect_gauges)
+    
+    def collect_gauges(self):
+        """Các gauge tính lúc đọc số liệu"""
+        with self.lock:
+            connections = len(self.clients)
+            statuses = Counter(game.status for game in self.games.values())
+            away = sum(len(game.away) for game in self.games.values() if game.away)
+            spectators = sum(len(game_ids) for game_ids in self.client_spectating.values())
+        yield ('caro_requests_total', 'counter', 'Số tin nhắn client đã xử lý theo action',
+               [({'action': action}, hist.count) for action, hist in self.action_durations.items()])
+        yield ('caro_connections', 'gauge', 'Số kết nối đang mở', [({}, connections)])
+        yield ('caro_spectators', 'gauge', 'Số lượt xem game đang mở', [({}, spectators)])
+        traffic = self.traffic_stats()
+        yield ('caro_messages_received_total', 'counter', 'Số tin nhắn đã nhận', [({}, traffic['received_frames'])])
+        yield ('caro_bytes_received_total', 'counter', 'Số byte đã nhận', [({}, traffic['received_bytes'])])
+        yield ('caro_messages_sent_total', 'counter', 'Số tin nhắn đã đưa vào hàng đợi gửi',
+               [({}, traffic['sent_frames'])])
+        yield ('caro_bytes_sent_total', 'counter', 'Số byte đã đưa vào hàng đợi gửi', [({}, traffic['sent_bytes'])])
+        yield ('caro_games', 'gauge', 'Số game theo trạng thái',
+               [({'status': status}, count) for status, count in sorted(statuses.items())])
+        yield ('caro_lobby_games', 'gauge', 'Số game đang chờ trong sảnh (gồm cả shard khác)', [({}, len(self.lobby))])
+        yield ('caro_matchmaking_queue', 'gauge', 'Số người chơi đang chờ ghép trận', [({}, len(self.matchmaker))])
+        yield ('caro_matches_total', 'counter', 'Số cặp quick_match đã ghép', [({}, self.matchmaker.matches)])
+        yield ('caro_rated_players', 'gauge', 'Số người chơi có rating', [({}, len(self.ratings))])
+        yield ('caro_games_rated_total', 'counter', 'Số ván đã tính rating', [({}, self.ratings.games_rated)])
+        yield ('caro_scheduled_timers', 'gauge', 'Số hẹn giờ đang chờ', [({}, self.scheduler.pending())])
+        yield ('caro_wheel_timers', 'gauge', 'Số hẹn giờ kết nối trên bánh xe', [({}, len(self.wheel))])
+        yield ('caro_idle_reaped_total', 'counter', 'Số kết nối bị ngắt vì im lặng quá idle_timeout',
+               [({}, self.idle_reaped)])
+        yield ('caro_clock_deadlines', 'gauge', 'Số mốc hết giờ trong hàng đợi đồng hồ', [({}, len(self.clocks))])
+        yield ('caro_flags_fallen_total', 'counter', 'Số ván thua vì hết giờ', [({}, self.flags_fallen)])
+        yield ('caro_players_away', 'gauge', 'Số người chơi mất kết nối đang được giữ chỗ', [({}, away)])
+        yield ('caro_sessions_resumed_total', 'counter', 'Số lần người chơi quay lại ván bằng resume',
+               [({}, self.sessions_resumed)])
+        yield ('caro_games_evicted_total', 'counter', 'Số game đã kết thúc bị xóa sau game_ttl',
+               [({}, self.games_evicted)])
+        if self.archive is not None:
+            yield ('caro_games_archived_total', 'counter', 'Số ván đã ghi vào kho lưu',
+                   [({}, self.archive.games_archived)])
+        if self.wal is not None:
+            yield ('caro_wal_records_total', 'counter', 'Số bản ghi nhật ký đã ghi', [({}, self.wal.records)])
+            yield ('caro_wal_bytes_total', 'counter', 'Số byte nhật ký đã ghi', [({}, self.wal.bytes)])
+        for name, value in self.outbound_stats().items():
+            kind = 'counter' if name in ('collapsed_updates', 'slow_consumers_evicted') else 'gauge'
+            suffix = '_total' if kind == 'counter' else ''
+            yield (f'caro_outbound_{name}{suffix}', kind, f'Hàng đợi gửi: {name}', [({}, value)])
+    
+    def register_client(self, client_id: int, client_socket: ClientConnection):
+        """Ghi nhận kết nối mới"""
+        client_socket.outbox.snapshot_provider = (
+            lambda game_id: self.snapshot_frame(client_id, client_socket, game_id)
+        )
+        if self.wal is not None and self.durability == 'sync':
+            client_socket.commit_wait = self.wal.wait_committed
+        with self.lock:
+            self.clients[client_id] = client_socket
+        self.connections_total.inc()
+        if self.ping_interval > 0:
+            self.wheel.call_later(self.ping_interval, self.check_connection, client_id, client_socket)
+    
+    def start_heartbeats(self):
+        """Quay bánh xe hẹn giờ mỗi nhịp bằng một hẹn giờ duy nhất (gọi khi call_later đã dùng được)"""
+        if self.ping_interval > 0:
+            self.call_later(self.wheel.tick, self.turn_wheel)
+    
+    def turn_wheel(self):
+        for timer in self.wheel.advance():
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"❌ Lỗi hẹn giờ kết nối: {e}")
+        self.call_later(self.wheel.tick, self.turn_wheel)
+    
+    def check_connection(self, client_id: int, client_socket: ClientConnection):
+        """Hẹn giờ của một kết nối: ping khi client im lặng ping_interval giây, ngắt khi quá idle_timeout.
+        
+        Đường nhận dữ liệu chỉ ghi last_seen; hẹn giờ tự đặt lại theo last_seen khi tới lượt,
+        nên mỗi kết nối luôn chỉ có một mục trên bánh xe.
+        """
+        with self.lock:
+            if self.clients.get(client_id) is not client_socket:
+                return  # Đã ngắt kết nối hoặc chuyển shard
+        idle = time.monotonic() - client_socket.last_seen
+        if not client_socket.heartbeat:
+            # Client cũ không trả lời ping: để TCP keepalive phát hiện peer chết
+            delay = self.ping_interval
+        elif idle >= self.idle_timeout:
+            self.idle_reaped += 1
+            print(f"💤 Client {client_id} im lặng {idle:.0f}s, ngắt kết nối")
+            client_socket.abort()
+            return
+        elif idle >= self.ping_interval:
+            self.send_message(client_socket, {'action': 'ping'})
+            delay = min(self.ping_interval, self.idle_timeout - idle)
+        else:
+            delay = self.ping_interval - idle
+        self.wheel.call_later(delay, self.check_connection, client_id, client_socket)
+    
+    def start_metrics_http(self):
+        """Mở GET /metrics nếu có --metrics-port"""
+        if self.metrics_port is None:
+            return
+        port = self.metrics_port + self.shard_index
+        try:
+            start_http_server(self.metrics, self.host, port)
+            print(f"📊 Số liệu tại http://{self.host}:{port}/metrics")
+        except OSError as e:
+            print(f"❌ Không mở được cổng số liệu {port}: {e}")
+    
+    def print_startup(self, engine: str):
+        """In thông tin khởi động server"""
+        print(f"🎮 Server khởi động tại {self.host}:{self.port}")
+        if self.shard_count > 1:
+            print(f"⚙️  Engine: {engine} (shard {self.shard_index + 1}/{self.shard_count}, pid {os.getpid()})")
+        else:
+            print(f"⚙️  Engine: {engine} (backlog={self.backlog})")
+        print(f"⏰ Thời gian: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    def print_bind_error(self, e: OSError):
+        """In lỗi khi không mở được cổng"""
+        if e.errno == 10048 or e.errno == 98:  # Port already in use
+            print(f"❌ Lỗi: Cổng {self.port} đang được sử dụng!")
+            print(f"💡 Hãy đóng ứng dụng khác đang dùng cổng này hoặc đổi cổng khác.")
+        else:
+            print(f"❌ Lỗi khởi động server: {e}")
+    
+    def handle_client(self, client_id: int, client_socket: ClientConnection, handoff: Optional[Dict] = None):
         """Xử lý kết nối từ client"""
+        handed_off = False
         try:
+            decoder = FrameDecoder()
+            # Kết nối chuyển từ shard khác: xử lý trước các byte shard đó đã nhận
+            data = self.resume_handoff(client_id, client_socket, handoff) if handoff else None
             while True:
-                data = client_socket.recv(1024).decode('utf-8')
+                if data is None:
+                    data = client_socket.sock.recv(RECV_SIZE)
                 
                 if not data:
                     break
                 
-                message = json.loads(data)
-                self.process_message(client_id, message, client_socket)
+                client_socket.last_seen = time.monotonic()
+                # Một lần recv có thể chứa nhiều tin nhắn hoặc chỉ một phần tin nhắn
+                frames = decoder.feed(data)
+                client_socket.received_bytes += len(data)
+                client_socket.received_frames += len(frames)
+                data = None
+                for index, frame in enumerate(frames):
+                    self.process_message(client_id, decode_message(frame), client_socket)
+                    if client_socket.handoff is not None:
+                        pending = b''.join(map(encode_frame, frames[index + 1:])) + bytes(decoder.buffer)
+                        state = self.detach_client(client_id, client_socket, pending)
+                        client_socket.detach()
+                        self.router.hand_off(state, client_socket.sock.fileno())
+                        client_socket.sock.close()
+                        handed_off = True
+                        return
                 
         except Exception as e:
             print(f"❌ Lỗi client {client_id}: {e}")
         finally:
-            self.disconnect_client(client_id, client_socket)
+            if not handed_off:
+                self.disconnect_client(client_id, client_socket)
     
-    def process_message(self, client_id: int, message: Dict, client_socket: socket.socket):
-        """Xử lý tin nhắn từ client"""
+    def send_message(self, sock: ClientConnection, message: Dict, collapse_key: Optional[int] = None):
+        """Đưa một tin nhắn đã đóng khung (mã hóa theo codec của kết nối) vào hàng đợi gửi.
+        
+        collapse_key (game_id) đánh dấu cập nhật bàn cờ có thể gộp khi client bị tụt lại.
+        """
+        sock.sendall(encode_message(message, sock.codec), collapse_key)
+    
+    def broadcast(self, game: Game, message: Dict, collapse_key: Optional[int] = None, players: bool = True,
+                  board: bool = True, exclude: Optional[int] = None):
+        """Gửi một sự kiện của game cho người chơi và người xem (gọi khi đang giữ game.lock).
+        
+        Tin nhắn chỉ được mã hóa một lần cho mỗi biến thể (codec, delta hay cả bàn cờ); mọi
+        người nhận cùng biến thể dùng chung một khung bytes, nên chi phí thêm cho mỗi người
+        xem chỉ là một lần đưa vào hàng đợi gửi. players=False: chỉ gửi cho người xem;
+        board=False: thông báo không kèm bàn cờ kể cả cho client cũ; exclude: bỏ qua client đó.
+        """
+        frames = {}
+        full = None
+        for recipients in ((game.sockets, game.spectators) if players else (game.spectators,)):
+            if not recipients:
+                continue
+            for pid, sock in recipients.items():
+                if pid == exclude:
+                    continue
+                delta = not board or pid in self.delta_clients
+                variant = (sock.codec, delta)
+                frame = frames.get(variant)
+                if frame is None:
+                    if delta:
+                        frame = encode_message(message, sock.codec)
+                    else:
+                        # Client cũ vẫn nhận cả bàn cờ; chỉ dựng board khi thật sự cần
+                        if full is None:
+                            full = dict(message, **game.board_fields())
+                        frame = encode_message(full, sock.codec)
+                    frames[variant] = frame
+                sock.sendall(frame, collapse_key)
+    
+    def process_message(self, client_id: int, message: Dict, client_socket: ClientConnection):
+        """Xử lý tin nhắn từ client, đếm và đo thời gian theo action"""
         action = message.get('action')
+        t0 = time.perf_counter()
+        try:
+            self.dispatch_message(client_id, action, message, client_socket)
+        finally:
+            duration = self.action_durations.get(action) or self.action_durations['unknown']
+            duration.observe(time.perf_counter() - t0)
+    
+    def dispatch_message(self, client_id: int, action: str, message: Dict, client_socket: ClientConnection):
+        """Gọi handler ứng với action"""
+        if action == 'hello':
+            self.hello(client_id, client_socket, message.get('features', []), message.get('codecs', ['json']))
+        
+        elif action == 'ping':
+            self.send_message(client_socket, {'action': 'pong'})
         
-        if action == 'create_game':
+        elif action == 'pong':
+            pass  # Chỉ cần last_seen đã được cập nhật khi nhận
+        
+        elif action == 'create_game':
             player_name = message.get('player_name', f'Player {client_id}')
-            self.create_game(client_id, client_socket, player_name)
+            board_size = message.get('board_size', BOARD_SIZE)
+            win_length = message.get('win_length', WIN_LENGTH)
+            # opponent = 'bot': chơi ngay với máy (player2) thay vì chờ trong sảnh
+            bot_level = message.get('level', DEFAULT_LEVEL) if message.get('opponent') == 'bot' else None
+            self.create_game(client_id, client_socket, player_name, board_size, win_length, bot_level,
+                             message.get('time_control'))
         
         elif action == 'join_game':
             game_id = message.get('game_id')
             player_name = message.get('player_name', f'Player {client_id}')
             self.join_game(client_id, game_id, client_socket, player_name)
         
+        elif action in ('quick_match', 'cancel_match') and self.router is not None \
+                and self.shard_index != MATCH_SHARD:
+            # Một hàng đợi chung cho mọi shard: chuyển kết nối sang MATCH_SHARD, shard đó xử lý lại tin nhắn
+            client_socket.handoff = (MATCH_SHARD, message)
+        
+        elif action == 'quick_match':
+            player_name = message.get('player_name', f'Player {client_id}')
+            board_size = message.get('board_size', BOARD_SIZE)
+            win_length = message.get('win_length', WIN_LENGTH)
+            self.quick_match(client_id, client_socket, player_name, board_size, win_length)
+        
+        elif action == 'cancel_match':
+            self.cancel_match(client_id, client_socket)
+        
+        elif action == 'spectate':
+            self.spectate(client_id, message.get('game_id'), client_socket)
+        
         elif action == 'move':
             game_id = message.get('game_id')
             position = message.get('position')
             self.make_move(client_id, game_id, position)
         
         elif action == 'list_games':
-            self.send_game_list(client_id, client_socket)
+            offset = message.get('offset', 0)
+            limit = message.get('limit', DEFAULT_PAGE_SIZE)
+            self.send_game_list(client_id, client_socket, offset, limit)
+        
+        elif action == 'resync':
+            self.send_snapshot(client_id, message.get('game_id'), client_socket)
+        
+        elif action == 'resume':
+            self.resume(client_id, client_socket, message.get('game_id'), message.get('token'),
+                        message.get('last_seq'))
+        
+        elif action == 'stats':
+            self.send_message(client_socket, {'action': 'stats', 'format': 'prometheus', 'text': self.metrics.render()})
+        
+        elif action in ('game_history', 'player_stats', 'replay'):
+            self.query_archive(client_socket, action, message)
+        
+        elif action == 'leaderboard':
+            self.send_leaderboard(client_socket, message.get('limit', DEFAULT_LEADERBOARD_SIZE))
+        
+        elif action == 'rank':
+            self.send_rank(client_socket, message.get('player_name'))
     
-    def create_game(self, client_id: int, client_socket: socket.socket, player_name: str):
-        """Tạo game mới"""
+    def hello(self, client_id: int, client_socket: ClientConnection, features: List[str], codecs: List[str]):
+        """Thỏa thuận tính năng và codec giao thức với client"""
+        accepted = [f for f in features if f in SUPPORTED_FEATURES]
         with self.lock:
-            game_id = len(self.games) + 1
-            self.games[game_id] = {
-                'player1': client_id,
-                'player2': None,
-                'player1_name': player_name,
-                'player2_name': None,
-                'board': ['' for _ in range(100)],
-                'current_turn': 1,
-                'status': 'waiting',
-                'sockets': {client_id: client_socket},
-                'first_player': None,
-                'created_at': datetime.now()
-            }
+            if 'delta' in accepted:
+                self.delta_clients.add(client_id)
+            else:
+                self.delta_clients.discard(client_id)
+        client_socket.heartbeat = 'heartbeat' in accepted
+        
+        codec = choose_codec(codecs)
+        # welcome luôn gửi bằng JSON, các tin nhắn sau mới dùng codec đã chọn
+        client_socket.codec = JSON_CODEC
+        welcome = {'action': 'welcome', 'features': accepted, 'codec': codec.name}
+        if client_socket.heartbeat:
+            welcome['ping_interval'] = self.ping_interval
+        self.send_message(client_socket, welcome)
+        client_socket.codec = codec
+    
+    def create_game(self, client_id: int, client_socket: ClientConnection, player_name: str,
+                    board_size: int = BOARD_SIZE, win_length: int = WIN_LENGTH, bot_level: Optional[str] = None,
+                    time_control: Optional[Dict] = None):
+        """Tạo game mới với cỡ bàn và độ dài thắng client chọn (0 = bàn không giới hạn).
+        
+        Có bot_level thì máy vào làm player2 ngay, game không qua sảnh chờ. Có time_control
+        (CaroClock) thì mỗi người có đồng hồ riêng, hết giờ là thua.
+        """
+        error = check_settings(board_size, win_length)
+        if bot_level is not None and bot_level not in LEVELS:
+            error = f"level phải là một trong {', '.join(LEVELS)}"
+        control, clock_error = parse_time_control(time_control)
+        error = error or clock_error
+        if error:
+            self.send_message(client_socket, {'action': 'error', 'message': error})
+            return
+        
+        game = Game(client_id, player_name, {client_id: client_socket}, board_size, win_length)
+        game.lock = TimedLock(self.lock_wait, self.lock_hold)
+        game.tokens = [secrets.token_urlsafe(16), None]
+        if control is not None:
+            game.clock = GameClock(control)
+        if bot_level is not None:
+            # Gán máy làm player2 trước khi game vào registry để không ai join_game chen vào
+            game.player2 = BOT_PLAYER_ID
+            game.player2_name = f'Máy ({bot_level})'
+            game.bot_level = bot_level
+        self.matchmaker.cancel(client_id)
+        with self.lock:
+            game_id = self.register_game(game)
+            if self.wal is not None:
+                self.wal.append(encode_create(game_id, client_id, player_name, board_size, win_length, bot_level,
+                                              game.tokens[0], control.to_dict() if control is not None else None))
+            if bot_level is None:
+                self.add_to_lobby(game_id, client_id, player_name, game.settings())
         
         response = {
             'action': 'game_created',
             'game_id': game_id,
-            'player_symbol': 'X'
+            'player_symbol': 'X',
+            **game.settings(),
+            'session_token': game.tokens[0]
         }
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        self.send_message(client_socket, response)
         print(f"🎮 Game {game_id} được tạo bởi {player_name}")
+        
+        if bot_level is not None:
+            with game.lock:
+                self.start_game(game_id, game)
+                if game.current_turn == 2:
+                    self.request_bot_move(game_id, game)
+            print(f"🤖 Game {game_id}: {player_name} chơi với máy ({bot_level})")
+    
+    def register_game(self, game: Game) -> int:
+        """Cấp game_id và đưa game vào registry cùng chỉ mục ngược của người chơi (gọi khi đang giữ self.lock)"""
+        game_id = self.next_game_id * self.shard_count + self.shard_index
+        self.next_game_id += 1
+        self.games[game_id] = game
+        for client_id in game.sockets:
+            self.client_games.setdefault(client_id, set()).add(game_id)
+        return game_id
     
-    def join_game(self, client_id: int, game_id: int, client_socket: socket.socket, player_name: str):
+    def rating_of(self, player_name: str) -> float:
+        """Rating dùng để ghép trận (người chưa có ván nào ở mức khởi điểm)"""
+        return self.ratings.rating(player_name)
+    
+    def quick_match(self, client_id: int, client_socket: ClientConnection, player_name: str,
+                    board_size: int = BOARD_SIZE, win_length: int = WIN_LENGTH):
+        """Xếp người chơi vào hàng đợi ghép trận; có đối thủ rating gần thì vào game ngay"""
+        error = check_settings(board_size, win_length)
+        if error is None and client_id in self.matchmaker:
+            error = 'Bạn đang chờ ghép trận'
+        if error:
+            self.send_message(client_socket, {'action': 'error', 'message': error})
+            return
+        ticket = Ticket(client_id, player_name, self.rating_of(player_name), (board_size, win_length),
+                        client_socket, time.monotonic())
+        self.enqueue_match(ticket)
+    
+    def enqueue_match(self, ticket: Ticket):
+        pair = self.matchmaker.enqueue(ticket, time.monotonic())
+        if pair is not None:
+            self.start_match(*pair)
+            return
+        self.send_message(ticket.connection, {'action': 'match_queued', 'rating': ticket.rating,
+                                              'queue_size': len(self.matchmaker)})
+        if self.matchmaker.claim_sweep():
+            self.call_later(SWEEP_INTERVAL, self.sweep_matches)
+    
+    def sweep_matches(self):
+        """Lượt ghép định kỳ cho những người đang chờ (cửa sổ rating đã nới theo thời gian chờ)"""
+        for pair in self.matchmaker.sweep(time.monotonic()):
+            self.start_match(*pair)
+        if self.matchmaker.claim_sweep():
+            self.call_later(SWEEP_INTERVAL, self.sweep_matches)
+    
+    def cancel_match(self, client_id: int, client_socket: ClientConnection):
+        if self.matchmaker.cancel(client_id) is None:
+            self.send_message(client_socket, {'action': 'error', 'message': 'Bạn không ở trong hàng đợi ghép trận'})
+            return
+        self.send_message(client_socket, {'action': 'match_cancelled'})
+    
+    def start_match(self, first: Ticket, second: Ticket):
+        """Tạo game cho hai người vừa được ghép.
+        
+        Cả hai vào game trong cùng một lần giữ lock registry và game không qua sảnh chờ,
+        nên không ai khác chen vào được. Người còn lại được xếp hàng lại nếu đối thủ vừa thoát.
+        """
+        board_size, win_length = first.settings
+        game = Game(first.client_id, first.player_name,
+                    {first.client_id: first.connection, second.client_id: second.connection}, board_size, win_length)
+        game.lock = TimedLock(self.lock_wait, self.lock_hold)
+        game.tokens = [secrets.token_urlsafe(16), None]
+        game.player2 = second.client_id
+        game.player2_name = second.player_name
+        with self.lock:
+            present = [ticket for ticket in (first, second) if ticket.client_id in self.clients]
+            if len(present) == 2:
+                game_id = self.register_game(game)
+                if self.wal is not None:
+                    self.wal.append(encode_create(game_id, first.client_id, first.player_name, board_size,
+                                                  win_length, None, game.tokens[0]))
+        if len(present) < 2:
+            for ticket in present:
+                self.enqueue_match(ticket)
+            return
+        
+        now = time.monotonic()
+        for ticket in (first, second):
+            self.match_wait.observe(now - ticket.enqueued_at)
+        with game.lock:
+            self.start_game(game_id, game)
+        print(f"🎯 Game {game_id}: ghép {first.player_name} ({first.rating:.0f}) với "
+              f"{second.player_name} ({second.rating:.0f}) sau {now - first.enqueued_at:.1f}s")
+    
+    def add_to_lobby(self, game_id: int, player1: int, player1_name: str, settings: Dict[str, int]):
+        """Thêm game vào sảnh chờ (và sảnh của các shard khác)"""
+        self.lobby.add(game_id, player1, player1_name, **settings)
+        if self.router is not None:
+            self.router.publish_lobby_add({'game_id': game_id, 'player1': player1, 'player1_name': player1_name,
+                                           **settings})
+    
+    def remove_from_lobby(self, game_id: int):
+        self.lobby.remove(game_id)
+        if self.router is not None:
+            self.router.publish_lobby_remove(game_id)
+    
+    def get_game(self, game_id: int) -> Optional[Game]:
+        """Tìm game trong registry (chỉ giữ lock registry trong lúc tra cứu)"""
+        with self.lock:
+            return self.games.get(game_id)
+    
+    def join_game(self, client_id: int, game_id: int, client_socket: ClientConnection, player_name: str):
         """Tham gia game"""
+        if self.router is not None and isinstance(game_id, int) and self.shard_of(game_id) != self.shard_index:
+            # Game thuộc shard khác: chuyển kết nối sang đó, shard đích xử lý lại join_game
+            message = {'action': 'join_game', 'game_id': game_id, 'player_name': player_name}
+            client_socket.handoff = (self.shard_of(game_id), message)
+            return
+        
+        game = self.get_game(game_id)
+        if game is None:
+            response = {'action': 'error', 'message': 'Game không tồn tại'}
+            self.send_message(client_socket, response)
+            return
+        
+        with game.lock:
+            if game.player2 is not None or game.status != 'waiting':
+                full = True
+            else:
+                full = False
+                game.player2 = client_id
+                game.player2_name = player_name
+                game.sockets[client_id] = client_socket
+                if game.spectators:
+                    # Người xem vào chơi: chỉ nhận cập nhật một lần, với tư cách người chơi
+                    game.spectators.pop(client_id, None)
+                self.remove_from_lobby(game_id)
+                self.start_game(game_id, game)
+        
+        if full:
+            response = {'action': 'error', 'message': 'Game đã đầy'}
+            self.send_message(client_socket, response)
+            return
+        
+        self.matchmaker.cancel(client_id)
         with self.lock:
-            if game_id not in self.games:
-                response = {'action': 'error', 'message': 'Game không tồn tại'}
-                client_socket.send(json.dumps(response).encode('utf-8'))
-                return
-            
-            game = self.games[game_id]
-            
-            if game['player2'] is not None:
-                response = {'action': 'error', 'message': 'Game đã đầy'}
-                client_socket.send(json.dumps(response).encode('utf-8'))
-                return
-            
-            game['player2'] = client_id
-            game['player2_name'] = player_name
-            game['status'] = 'playing'
-            game['sockets'][client_id] = client_socket
-            
-            game['first_player'] = random.choice([1, 2])
-            game['current_turn'] = game['first_player']
-        
-        for pid, sock in game['sockets'].items():
-            symbol = 'X' if pid == game['player1'] else 'O'
-            player1_name = game['player1_name']
-            player2_name = game['player2_name']
-            first_player_symbol = 'X' if game['first_player'] == 1 else 'O'
-            first_player_name = player1_name if game['first_player'] == 1 else player2_name
-            
+            self.client_games.setdefault(client_id, set()).add(game_id)
+            self.client_spectating.get(client_id, set()).discard(game_id)
+        
+        print(f"✅ {player_name} tham gia Game {game_id}")
+        print(f"   Người chơi 1: {game.player1_name} (X)")
+        print(f"   Người chơi 2: {game.player2_name} (O)")
+        first_player_name = game.player1_name if game.first_player == 1 else game.player2_name
+        print(f"   Người đi trước: {first_player_name} ({'X' if game.first_player == 1 else 'O'})")
+    
+    def spectate(self, client_id: int, game_id: int, client_socket: ClientConnection):
+        """Xem một game đang chờ / đang diễn ra: nhận ảnh chụp hiện tại rồi mọi cập nhật sau đó"""
+        if self.router is not None and isinstance(game_id, int) and self.shard_of(game_id) != self.shard_index:
+            # Game thuộc shard khác: chuyển kết nối sang đó như join_game
+            client_socket.handoff = (self.shard_of(game_id), {'action': 'spectate', 'game_id': game_id})
+            return
+        
+        game = self.get_game(game_id)
+        if game is None:
+            self.send_message(client_socket, {'action': 'error', 'message': 'Game không tồn tại'})
+            return
+        
+        with game.lock:
+            if client_id in game.sockets:
+                error = 'Bạn đang chơi game này'
+            elif game.status not in ('waiting', 'playing'):
+                error = 'Game đã kết thúc'
+            else:
+                error = None
+                if game.spectators is None:
+                    game.spectators = {}
+                game.spectators[client_id] = client_socket
+                # Ảnh chụp gửi dưới game.lock nên không lỡ hay lặp cập nhật nào
+                snapshot = {
+                    'action': 'spectating',
+                    'game_id': game_id,
+                    'status': game.status,
+                    'player1_name': game.player1_name,
+                    'player2_name': game.player2_name,
+                    **game.board_fields(),
+                    **game.settings(),
+                    'seq': game.seq,
+                    'current_turn': game.current_turn,
+                    'spectators': len(game.spectators)
+                }
+                if game.clock is not None:
+                    snapshot['clock'] = game.clock.millis(time.monotonic())
+                self.send_message(client_socket, snapshot)
+        
+        if error:
+            self.send_message(client_socket, {'action': 'error', 'message': error})
+            return
+        
+        with self.lock:
+            self.client_spectating.setdefault(client_id, set()).add(game_id)
+    
+    def start_game(self, game_id: int, game: Game):
+        """Bắt đầu ván khi đã đủ hai người chơi và báo cho họ (gọi khi đang giữ game.lock)"""
+        game.status = 'playing'
+        game.first_player = random.choice([1, 2])
+        game.current_turn = game.first_player
+        if game.bot_level is None:
+            game.tokens[1] = secrets.token_urlsafe(16)
+        if self.wal is not None:
+            self.wal.append(encode_start(game_id, game.player2, game.player2_name, game.first_player,
+                                         game.tokens[1]))
+        if game.clock is not None:
+            # Đồng hồ của người đi trước chạy ngay từ lúc ván bắt đầu
+            game.clock.start(game.current_turn, time.monotonic())
+            self.schedule_clock(game_id, game)
+        
+        # Đưa vào hàng đợi ngay dưới game.lock: không chặn, và giữ đúng thứ tự
+        board = game.board_fields()
+        if game.clock is not None:
+            board['clock'] = game.clock.millis()
+        first_player_symbol = 'X' if game.first_player == 1 else 'O'
+        first_player_name = game.player1_name if game.first_player == 1 else game.player2_name
+        for pid, sock in game.sockets.items():
             response = {
                 'action': 'game_started',
                 'game_id': game_id,
-                'player_symbol': symbol,
-                'player1_name': player1_name,
-                'player2_name': player2_name,
-                'board': game['board'],
-                'current_turn': game['current_turn'],
+                'player_symbol': 'X' if pid == game.player1 else 'O',
+                'player1_name': game.player1_name,
+                'player2_name': game.player2_name,
+                **board,
+                **game.settings(),
+                'seq': game.seq,
+                'current_turn': game.current_turn,
                 'first_player_symbol': first_player_symbol,
-                'first_player_name': first_player_name
+                'first_player_name': first_player_name,
+                'session_token': game.tokens[0 if pid == game.player1 else 1]
             }
-            sock.send(json.dumps(response).encode('utf-8'))
+            self.send_message(sock, response)
         
-        print(f"✅ {player_name} tham gia Game {game_id}")
-        print(f"   Người chơi 1: {game['player1_name']} (X)")
-        print(f"   Người chơi 2: {game['player2_name']} (O)")
-        print(f"   Người đi trước: {first_player_name} ({first_player_symbol})")
+        if game.spectators:
+            # Người xem nhận cùng tin nhắn nhưng không có player_symbol
+            self.broadcast(game, {
+                'action': 'game_started',
+                'game_id': game_id,
+                'player1_name': game.player1_name,
+                'player2_name': game.player2_name,
+                **board,
+                **game.settings(),
+                'seq': game.seq,
+                'current_turn': game.current_turn,
+                'first_player_symbol': first_player_symbol,
+                'first_player_name': first_player_name
+            }, players=False)
+    
+    def request_bot_move(self, game_id: int, game: Game, use_book: bool = True):
+        """Giao việc tìm nước cho máy sang pool tiến trình (gọi khi đang giữ game.lock, không chặn)"""
+        level = game.bot_level
+        book = self.books.get((game.board_size, game.win_length)) if use_book else None
+        if book is not None and game.moves <= book.max_stones:
+            move = book.lookup(game.stone_list(), 'O')
+            if move is not None:
+                # Có sẵn trong sách: không cần tìm, đánh ngay sau khi handler hiện tại nhả game.lock
+                self.bot_book_moves.labels(level).inc()
+                self.call_soon_threadsafe(self.play_bot_move, game_id, *move, True)
+                return
+        deadline = time.monotonic() + LEVELS[level]['time_budget']
+        future = self.bot_executor().submit(choose_move, game.stone_list(), 'O', game.board_size, game.win_length,
+                                            deadline, level)
+        future.add_done_callback(lambda f: self.call_soon_threadsafe(self.bot_move_ready, game_id, level, f))
+    
+    def bot_executor(self) -> ProcessPoolExecutor:
+        with self.bot_pool_lock:
+            if self.bot_pool is None:
+                # spawn: tiến trình con không thừa hưởng thread và lock của server
+                self.bot_pool = ProcessPoolExecutor(self.bot_workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.bot_pool
+    
+    def reset_bot_pool(self, pool: ProcessPoolExecutor):
+        """Bỏ pool đã hỏng (tiến trình con chết); lần tìm sau tạo pool mới"""
+        with self.bot_pool_lock:
+            if self.bot_pool is pool:
+                self.bot_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    def bot_move_ready(self, game_id: int, level: str, future: Future):
+        """Đánh nước máy đã chọn (bỏ qua nếu ván đã xong hoặc bị xóa trong lúc tìm).
+        
+        Tìm lỗi hoặc không ra nước thì máy đánh một ô trống để người chơi không phải chờ mãi.
+        """
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"❌ Lỗi máy tìm nước cho Game {game_id}: {e}")
+            if isinstance(e, BrokenProcessPool) and self.bot_pool is not None:
+                self.reset_bot_pool(self.bot_pool)
+            self.play_fallback_move(game_id)
+            return
+        self.bot_search.labels(level).observe(result['elapsed'])
+        self.bot_nodes.labels(level).inc(result['nodes'])
+        if result['row'] is None:
+            self.play_fallback_move(game_id)
+        else:
+            self.play_bot_move(game_id, result['row'], result['col'])
+    
+    def play_bot_move(self, game_id: int, row: int, col: int, from_book: bool = False):
+        """Đánh nước của máy. Nước bị từ chối (ô đã có quân, ngoài bàn): nước từ sách thì tìm
+        lại không dùng sách, nước tìm được thì đánh một ô trống"""
+        game = self.get_game(game_id)
+        if game is None:
+            return
+        with game.lock:
+            seq = game.seq
+        if game.on_board(row, col):
+            self.make_move(BOT_PLAYER_ID, game_id, game.position_of(row, col))
+        with game.lock:
+            if not bot_to_move(game) or game.seq != seq:
+                return
+            print(f"⚠️ Game {game_id}: nước của máy ({row}, {col}) không hợp lệ")
+            if from_book:
+                self.request_bot_move(game_id, game, use_book=False)
+                return
+        self.play_fallback_move(game_id)
+    
+    def play_fallback_move(self, game_id: int):
+        """Máy đánh một ô trống cạnh nước vừa đi; không còn ô nào thì máy bỏ cuộc"""
+        game = self.get_game(game_id)
+        if game is None:
+            return
+        with game.lock:
+            if not bot_to_move(game):
+                return
+            position = game.free_position()
+            if position is None:
+                self.end_game(game_id, game, 'finished', 1)
+        if position is None:
+            self.schedule_game_over(game_id, 1, [])
+            return
+        self.make_move(BOT_PLAYER_ID, game_id, position)
     
-    def make_move(self, client_id: int, game_id: int, position: int):
+    def make_move(self, client_id: int, game_id: int, position):
         """Thực hiện nước đi"""
-        with self.lock:
-            if game_id not in self.games:
+        game = self.get_game(game_id)
+        if game is None:
+            return
+        
+        with game.lock:
+            # Chỉ nhận nước đi khi game đang diễn ra
+            if game.status != 'playing':
                 return
             
-            game = self.games[game_id]
-            
             # Kiểm tra lượt chơi
-            if game['current_turn'] == 1 and client_id != game['player1']:
+            if game.current_turn == 1 and client_id != game.player1:
                 return
-            if game['current_turn'] == 2 and client_id != game['player2']:
+            if game.current_turn == 2 and client_id != game.player2:
                 return
             
-            # Kiểm tra ô hợp lệ
-            if game['board'][position] != '':
+            # Kiểm tra ô hợp lệ (trong bàn, đúng kiểu vị trí và còn trống)
+            if not game.is_empty(position):
                 return
             
-            # Cập nhật bảng
-            symbol = 'X' if client_id == game['player1'] else 'O'
-            game['board'][position] = symbol
+            if game.clock is not None:
+                if not game.clock.press(time.monotonic()):
+                    # Hết giờ trước khi nước đi tới (hẹn giờ chưa kịp chạy): thua vì hết giờ
+                    self.flag_fall(game_id, game)
+                    return
             
-            winner, winning_positions = self.check_winner(game['board'])
-            is_draw = all(cell != '' for cell in game['board'])
+            # Cập nhật bảng
+            symbol = 'X' if client_id == game.player1 else 'O'
+            winner, winning_positions = game.play(position, symbol)
+            is_draw = not winner and game.is_full()
+            if self.wal is not None:
+                clock = game.clock.millis()[game.current_turn - 1] if game.clock is not None else None
+                self.wal.append(encode_move(game_id, game.seq, *game.coordinates(position), symbol, clock))
             
-            # Gửi cập nhật board trước cho cả 2 người chơi
-            for pid, sock in game['sockets'].items():
-                response = {
-                    'action': 'board_updated',
-                    'board': game['board'],
-                    'current_turn': 3 - game['current_turn'],
-                    'last_move': position,
-                    'last_symbol': symbol
-                }
-                sock.send(json.dumps(response).encode('utf-8'))
+            # Gửi cập nhật board trước cho người chơi và người xem. Chỉ đưa vào hàng đợi gửi
+            # (không chặn) nên làm ngay dưới game.lock để giữ đúng thứ tự các nước đi.
+            update = {
+                'action': 'board_updated',
+                'seq': game.seq,
+                'current_turn': 3 - game.current_turn,
+                'last_move': position,
+                'last_symbol': symbol
+            }
+            if game.clock is not None:
+                update['clock'] = game.clock.millis()
+            self.broadcast(game, update, collapse_key=game_id)
             
-            # Nếu có người thắng, gửi thông báo game_over sau một chút để board được cập nhật trước
             if winner or is_draw:
-                time.sleep(0.3)  # Đợi 300ms để board được cập nhật trên client
-                
-                for pid, sock in game['sockets'].items():
-                    response = {
-                        'action': 'game_over',
-                        'board': game['board'],
-                        'winner': 'X' if winner == 1 else ('O' if winner == 2 else 'draw'),
-                        'winning_positions': winning_positions if winner else []
-                    }
-                    
-                    if winner:
-                        response['winner_id'] = game['player1'] if winner == 1 else game['player2']
-                        winner_name = game['player1_name'] if winner == 1 else game['player2_name']
-                        print(f"🏆 Game {game_id} kết thúc! {winner_name} thắng với {response['winner']}")
-                    else:
-                        print(f"🤝 Game {game_id} kết thúc - Hòa!")
-                    
-                    sock.send(json.dumps(response).encode('utf-8'))
-            
-            # Cập nhật lượt chơi
-            if not winner and not is_draw:
-                game['current_turn'] = 3 - game['current_turn']
-    
-    def check_winner(self, board: List[str]) -> Tuple[int, List[int]]:
-        """Kiểm tra người thắng (1 cho X, 2 cho O, 0 nếu chưa) và trả về danh sách vị trí thắng"""
-        board_size = 10
-        win_length = 5
-        
-        # Kiểm tra hàng ngang
-        for row in range(board_size):
-            for col in range(board_size - win_length + 1):
-                start = row * board_size + col
-                if all(board[start + i] == board[start] and board[start] != '' for i in range(win_length)):
-                    winning_positions = [start + i for i in range(win_length)]
-                    return (1 if board[start] == 'X' else 2, winning_positions)
-        
-        # Kiểm tra cột dọc
-        for col in range(board_size):
-            for row in range(board_size - win_length + 1):
-                start = row * board_size + col
-                if all(board[start + i * board_size] == board[start] and board[start] != '' for i in range(win_length)):
-                    winning_positions = [start + i * board_size for i in range(win_length)]
-                    return (1 if board[start] == 'X' else 2, winning_positions)
-        
-        # Kiểm tra đường chéo (từ trái sang phải)
-        for row in range(board_size - win_length + 1):
-            for col in range(board_size - win_length + 1):
-                start = row * board_size + col
-                if all(board[start + i * (board_size + 1)] == board[start] and board[start] != '' for i in range(win_length)):
-                    winning_positions = [start + i * (board_size + 1) for i in range(win_length)]
-                    return (1 if board[start] == 'X' else 2, winning_positions)
-        
-        # Kiểm tra đường chéo (từ phải sang trái)
-        for row in range(board_size - win_length + 1):
-            for col in range(win_length - 1, board_size):
-                start = row * board_size + col
-                if all(board[start + i * (board_size - 1)] == board[start] and board[start] != '' for i in range(win_length)):
-                    winning_positions = [start + i * (board_size - 1) for i in range(win_length)]
-                    return (1 if board[start] == 'X' else 2, winning_positions)
-        
-        return (0, [])
-    
-    def send_game_list(self, client_id: int, client_socket: socket.socket):
-        """Gửi danh sách game đang chờ"""
+                self.end_game(game_id, game, 'finished', winner)
+            else:
+                # Cập nhật lượt chơi
+                game.current_turn = 3 - game.current_turn
+                if game.clock is not None:
+                    self.schedule_clock(game_id, game)
+                if game.bot_level is not None and game.current_turn == 2:
+                    self.request_bot_move(game_id, game)
+        
+        # Nếu có người thắng, gửi thông báo game_over sau một chút để board được cập nhật trước
+        if winner or is_draw:
+            self.schedule_game_over(game_id, winner, winning_positions)
+    
+    def end_game(self, game_id: int, game: Game, status: str, winner: int = 0):
+        """Đánh dấu game kết thúc (gọi khi đang giữ game.lock), tính rating, ghi vào kho lưu
+        và hẹn thu hồi sau game_ttl.
+        
+        Ván bị bỏ dở: winner là người còn lại (người rời đi bị tính thua).
+        """
+        game.status = status
+        game.ended_at = time.monotonic()
+        if game.clock is not None:
+            game.clock.stop(game.ended_at)
+        if self.wal is not None:
+            self.wal.append(encode_end(game_id, status))
+        self.rate_game(game, winner)
+        if self.archive is not None:
+            now = time.time()
+            self.archive.append(encode_game(game_id, game, RESULT_ABANDONED if status == 'abandoned' else winner, now),
+                                now)
+        self.call_later(self.game_ttl, self.evict_game, game_id)
+    
+    def rate_game(self, game: Game, winner: int):
+        """Cập nhật rating sau ván giữa hai người (bỏ qua ván với máy, tự đấu và ván bỏ trước nước đầu)"""
+        if game.bot_level is not None or game.moves == 0:
+            return
+        score1 = 1.0 if winner == 1 else (0.0 if winner == 2 else 0.5)
+        if self.router is not None and self.shard_index != RATINGS_SHARD:
+            # Chỉ chủ bảng rating tính Elo; bản sao ở đây được cập nhật khi chủ phát lại
+            self.router.send_game_result(RATINGS_SHARD, game.player1_name, game.player2_name, score1)
+        else:
+            self.record_result(game.player1_name, game.player2_name, score1)
+    
+    def record_result(self, name1: str, name2: str, score1: float):
+        """Tính Elo cho một ván (shard này là chủ bảng rating) và phát kết quả cho các shard khác"""
+        self.ratings.record_game(name1, name2, score1)
+        if self.router is not None:
+            self.router.publish_ratings(self.ratings.entries((name1, name2)))
+    
+    def schedule_clock(self, game_id: int, game: Game):
+        """Đưa mốc hết giờ của người tới lượt vào hàng đợi đồng hồ chung (gọi khi đang giữ game.lock)"""
+        wake = self.clocks.schedule(game_id, game.clock)
+        if wake is not None:
+            self.call_later(max(0.0, wake - time.monotonic()), self.check_clocks, wake)
+    
+    def check_clocks(self, wake: float):
+        """Hẹn giờ đánh thức của hàng đợi đồng hồ: xử thua những người đã hết giờ, đẩy lại các
+        đồng hồ đã được bấm kể từ lúc vào hàng"""
+        now = time.monotonic()
+        due, wake = self.clocks.pop_due(now, wake)
+        if wake is not None:
+            self.call_later(max(0.0, wake - now), self.check_clocks, wake)
+        for game_id, clock, deadline in due:
+            game = self.get_game(game_id)
+            if game is None or game.clock is not clock:
+                continue
+            with game.lock:
+                if clock.queued != deadline:
+                    continue  # Mục cũ: đồng hồ đã có mốc sớm hơn trong hàng
+                clock.queued = None
+                if game.status != 'playing':
+                    continue
+                if clock.deadline() <= time.monotonic():
+                    self.flag_fall(game_id, game)
+                else:
+                    self.schedule_clock(game_id, game)
+    
+    def flag_fall(self, game_id: int, game: Game):
+        """Người tới lượt hết giờ: thua ngay, game_over gửi cho mọi người (gọi khi đang giữ game.lock)"""
+        winner = 3 - game.current_turn
+        self.flags_fallen += 1
+        self.end_game(game_id, game, 'finished', winner)
+        self.broadcast(game, {
+            'action': 'game_over',
+            'seq': game.seq,
+            'winner': 'X' if winner == 1 else 'O',
+            'winning_positions': [],
+            'winner_id': game.player1 if winner == 1 else game.player2,
+            'reason': 'timeout',
+            'clock': game.clock.millis()
+        })
+        loser_name = game.player2_name if winner == 1 else game.player1_name
+        print(f"⏰ Game {game_id}: {loser_name} hết giờ")
+    
+    def evict_game(self, game_id: int):
+        """Thu hồi game đã kết thúc: xóa khỏi registry và chỉ mục ngược của người chơi"""
         with self.lock:
-            waiting_games = [
-                {'game_id': gid, 'player1': g['player1'], 'player1_name': g['player1_name']}
-                for gid, g in self.games.items()
-                if g['status'] == 'waiting'
-            ]
+            game = self.games.get(game_id)
+            if game is None:
+                return
+            with game.lock:
+                if game.ended_at is None:
+                    return
+                del self.games[game_id]
+                self.games_evicted += 1
+                self.forget_spectators(game_id, game)
+                for pid in (game.player1, game.player2):
+                    game_ids = self.client_games.get(pid)
+                    if game_ids is not None:
+                        game_ids.discard(game_id)
+    
+    def open_wal(self):
+        """Dựng lại các game còn sống từ ảnh chụp + nhật ký rồi bắt đầu ghi nhật ký (nếu có wal_dir).
         
-        response = {
-            'action': 'game_list',
-            'games': waiting_games
+        Gọi lúc khởi động, khi call_later đã dùng được (engine async: sau khi có event loop).
+        """
+        if self.wal_dir is None:
+            return
+        directory = self.wal_dir
+        if self.shard_count > 1:
+            directory = os.path.join(directory, f'shard-{self.shard_index}')
+        self.wal = WriteAheadLog(directory, self.durability, self.fsync_interval, self.wal_fsync)
+        t0 = time.perf_counter()
+        recovered = recover(directory, self.shard_count)
+        restored = self.restore_games(recovered)
+        # Ghi tiếp vào segment mới rồi chụp ảnh ngay: phần ghi dở của lần chạy trước bị bỏ cùng segment cũ
+        self.wal.open(max(list_segments(directory), default=0) + 1)
+        self.write_snapshot(self.wal.segment)
+        print(f"💾 Nhật ký {directory} ({self.durability}): khôi phục {restored} game từ "
+              f"{recovered.records} bản ghi trong {time.perf_counter() - t0:.2f}s")
+        self.call_later(self.snapshot_interval, self.snapshot_games)
+    
+    def restore_games(self, recovered) -> int:
+        """Đưa các game khôi phục vào registry; người chơi quay lại ván đang diễn ra bằng resume.
+        
+        Game còn chờ người thứ hai bị bỏ: người tạo đã mất kết nối và game không vào lại sảnh
+        chờ, nên không ai vào được nữa. Chúng cũng không nằm trong ảnh chụp ghi ngay sau đó.
+        """
+        games = recovered.live_games()
+        waiting = [game_id for game_id, state in games.items() if state['status'] == 'waiting']
+        for game_id in waiting:
+            del games[game_id]
+        if waiting:
+            print(f"🗑️ Bỏ {len(waiting)} game đang chờ người chơi trong nhật ký")
+        with self.lock:
+            self.next_game_id = max(self.next_game_id, recovered.next_game_id)
+            self.client_counter = max(self.client_counter, recovered.client_counter)
+            for game_id, state in games.items():
+                game = Game(state['player1'], state['player1_name'], {}, state['board_size'], state['win_length'])
+                game.lock = TimedLock(self.lock_wait, self.lock_hold)
+                game.player2 = state['player2']
+                game.player2_name = state['player2_name']
+                game.bot_level = state['bot_level']
+                game.tokens = state.get('tokens') or [None, None]
+                control, _ = parse_time_control(state.get('time_control'))
+                if control is not None:
+                    remaining = [control.initial() if ms is None else ms / 1000
+                                 for ms in state.get('clock') or [None, None]]
+                    game.clock = GameClock(control, remaining)
+                for row, col, symbol in state['stones']:
+                    game.play(game.position_of(row, col), symbol)
+                game.status = state['status']
+                game.first_player = state['first_player']
+                if game.first_player is not None:
+                    game.current_turn = game.first_player if game.moves % 2 == 0 else 3 - game.first_player
+                self.games[game_id] = game
+        
+        for game_id in games:
+            self.call_later(self.game_ttl, self.expire_recovered, game_id)
+            game = self.games[game_id]
+            if game.status != 'playing':
+                continue
+            with game.lock:
+                # Người chơi có game_ttl giây để quay lại bằng resume với mã phiên cũ
+                for player in (1, 2):
+                    if game.tokens[player - 1] is not None:
+                        self.hold_seat(game_id, game, player, self.game_ttl)
+                if game.clock is not None:
+                    # Lượt đang dở lúc server dừng được tính lại từ đầu
+                    game.clock.start(game.current_turn, time.monotonic())
+                    self.schedule_clock(game_id, game)
+                if game.bot_level is not None and game.current_turn == 2:
+                    self.request_bot_move(game_id, game)
+        return len(games)
+    
+    def expire_recovered(self, game_id: int):
+        """Xóa game khôi phục từ nhật ký nếu sau game_ttl vẫn không có người chơi nào kết nối"""
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None:
+                return
+            with game.lock:
+                if game.sockets or game.ended_at is not None:
+                    return
+                del self.games[game_id]
+                self.wal.append(encode_drop(game_id))
+    
+    def snapshot_games(self):
+        """Hẹn giờ: chuyển sang segment mới, chụp ảnh các game còn sống rồi xóa segment cũ"""
+        try:
+            self.write_snapshot(self.wal.rotate())
+        except OSError as e:
+            print(f"❌ Lỗi chụp ảnh nhật ký: {e}")
+        self.call_later(self.snapshot_interval, self.snapshot_games)
+    
+    def write_snapshot(self, segment: int):
+        """Chép trạng thái các game còn sống (mỗi game dưới game.lock của nó) vào ảnh chụp.
+        
+        Mọi bản ghi trước segment đã có hiệu lực trong trạng thái chép được; bản ghi ở
+        segment mới có thể đã nằm trong ảnh và được phát lại idempotent khi khôi phục.
+        """
+        with self.lock:
+            games = list(self.games.items())
+            next_game_id, client_counter = self.next_game_id, self.client_counter
+        states = {}
+        for game_id, game in games:
+            with game.lock:
+                if game.status in LIVE_STATUSES:
+                    states[game_id] = game_state(game)
+        self.wal.write_snapshot(segment, states, next_game_id, client_counter)
+    
+    def call_later(self, delay: float, callback, *args):
+        """Hẹn gọi callback(*args) sau delay giây mà không chặn thread hiện tại"""
+        return self.scheduler.call_later(delay, callback, *args)
+    
+    def call_soon_threadsafe(self, callback, *args):
+        """Gọi callback(*args) sớm nhất có thể, từ một thread bất kỳ (ví dụ callback của pool)"""
+        return self.scheduler.call_later(0, callback, *args)
+    
+    def schedule_game_over(self, game_id: int, winner: int, winning_positions: List[int]):
+        """Hẹn gửi game_over sau board_updated.
+        
+        board_updated của nước cuối đã nằm trong hàng đợi gửi của từng người chơi trước
+        khi hẹn, và hàng đợi giữ thứ tự, nên game_over luôn đến sau.
+        """
+        self.call_later(self.game_over_delay, self.send_game_over, game_id, winner, winning_positions)
+    
+    def send_game_over(self, game_id: int, winner: int, winning_positions: List[int]):
+        """Gửi thông báo kết thúc game cho cả 2 người chơi"""
+        game = self.get_game(game_id)
+        if game is None:
+            return
+        
+        with game.lock:
+            response = {
+                'action': 'game_over',
+                'seq': game.seq,
+                'winner': 'X' if winner == 1 else ('O' if winner == 2 else 'draw'),
+                'winning_positions': winning_positions if winner else []
+            }
+            if winner:
+                response['winner_id'] = game.player1 if winner == 1 else game.player2
+            self.broadcast(game, response)
+        
+        if winner:
+            winner_name = game.player1_name if winner == 1 else game.player2_name
+            print(f"🏆 Game {game_id} kết thúc! {winner_name} thắng với {'X' if winner == 1 else 'O'}")
+        else:
+            print(f"🤝 Game {game_id} kết thúc - Hòa!")
+    
+    def send_snapshot(self, client_id: int, game_id: int, client_socket: ClientConnection):
+        """Gửi toàn bộ bàn cờ khi client phát hiện hụt số thứ tự (resync)"""
+        game = self.get_game(game_id) if isinstance(game_id, int) else None
+        if game is not None:
+            with game.lock:
+                # Kiểm tra thành viên dưới game.lock để không chạy đua với người đang rời game
+                if client_id in game.sockets or client_id in (game.spectators or ()):
+                    self.send_message(client_socket, self.snapshot_message(client_id, game_id, game))
+                    return
+        self.send_message(client_socket, {'action': 'error', 'message': 'Game không tồn tại'})
+    
+    def snapshot_message(self, client_id: int, game_id: int, game: Game) -> Dict:
+        """Ảnh chụp toàn bộ bàn cờ cho một người chơi (gọi khi đang giữ game.lock)"""
+        if client_id in self.delta_clients:
+            message = {
+                'action': 'board_snapshot',
+                'game_id': game_id,
+                **game.board_fields(),
+                'seq': game.seq,
+                'current_turn': game.current_turn
+            }
+        else:
+            # Client cũ không biết board_snapshot: gửi board_updated kèm cả bàn cờ
+            # (chưa có nước nào, kể cả game đang chờ: không có last_move / last_symbol)
+            message = {
+                'action': 'board_updated',
+                'seq': game.seq,
+                'current_turn': game.current_turn,
+                **game.board_fields()
+            }
+            if game.last_move is not None:
+                message['last_move'] = game.last_move
+                message['last_symbol'] = game.symbol_at(game.last_move)
+        if game.clock is not None:
+            message['clock'] = game.clock.millis(time.monotonic())
+        return message
+    
+    def snapshot_frame(self, client_id: int, client_socket: ClientConnection, game_id: int) -> Optional[bytes]:
+        """Khung ảnh chụp dùng khi hàng đợi gửi gộp các cập nhật bàn cờ của một game"""
+        game = self.get_game(game_id)
+        if game is None:
+            return None
+        
+        with game.lock:
+            if (client_id not in game.sockets and client_id not in (game.spectators or ())) \
+                    or game.last_move is None:
+                return None
+            message = self.snapshot_message(client_id, game_id, game)
+        return encode_message(message, client_socket.codec)
+    
+    def outbound_stats(self) -> Dict[str, int]:
+        """Độ sâu hàng đợi gửi hiện tại và số lần gộp / loại client chậm"""
+        with self.lock:
+            outboxes = [conn.outbox for conn in self.clients.values()]
+        depths = [len(outbox) for outbox in outboxes]
+        return {
+            'queued_messages': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'peak_queue_depth': max((outbox.max_depth for outbox in outboxes), default=0),
+            'collapsed_updates': self.collapsed_updates + sum(outbox.collapsed for outbox in outboxes),
+            'slow_consumers_evicted': self.slow_consumers_evicted
         }
-        client_socket.send(json.dumps(response).encode('utf-8'))
     
-    def disconnect_client(self, client_id: int, client_socket: socket.socket):
+    def traffic_stats(self) -> Dict[str, int]:
+        """Tổng tin nhắn / byte nhận và gửi, kể cả các kết nối đã đóng"""
+        with self.lock:
+            totals = dict(self.traffic)
+            connections = list(self.clients.values())
+        for conn in connections:
+            totals['received_frames'] += conn.received_frames
+            totals['received_bytes'] += conn.received_bytes
+            totals['sent_frames'] += conn.outbox.queued_frames
+            totals['sent_bytes'] += conn.outbox.queued_bytes
+        return totals
+    
+    def query_archive(self, client_socket: ClientConnection, action: str, message: Dict):
+        """game_history (các ván gần nhất), player_stats (thắng / thua) và replay từ kho lưu"""
+        self.send_message(client_socket, self.archive_response(action, message))
+    
+    def archive_response(self, action: str, message: Dict) -> Dict:
+        """Trả lời một truy vấn kho lưu (đọc chỉ mục mmap / tệp của ngày đang ghi, không giữ lock server)"""
+        if self.archive is None:
+            return {'action': 'error', 'message': 'Server không lưu lịch sử ván'}
+        
+        if action == 'replay':
+            game_id = message.get('game_id')
+            game = self.archive.game(game_id) if isinstance(game_id, int) else None
+            if game is None:
+                return {'action': 'error', 'message': 'Không tìm thấy ván trong lịch sử'}
+            return {'action': 'replay', **game}
+        
+        player_name = message.get('player_name')
+        limit = message.get('limit', DEFAULT_HISTORY_LIMIT)
+        if not isinstance(player_name, str) or not isinstance(limit, int) or not 1 <= limit <= MAX_HISTORY_LIMIT:
+            return {'action': 'error', 'message': 'player_name/limit không hợp lệ'}
+        if action == 'player_stats':
+            return {'action': 'player_stats', 'player_name': player_name, **self.archive.player_totals(player_name)}
+        return {'action': 'game_history', 'player_name': player_name,
+                'games': self.archive.recent_games(player_name, limit)}
+    
+    def send_leaderboard(self, client_socket: ClientConnection, limit: int = DEFAULT_LEADERBOARD_SIZE):
+        """Gửi top limit người chơi theo rating (khung lấy từ cache của bảng xếp hạng)"""
+        if not isinstance(limit, int) or not 1 <= limit <= MAX_LEADERBOARD:
+            self.send_message(client_socket, {'action': 'error', 'message': 'limit không hợp lệ'})
+            return
+        client_socket.sendall(self.ratings.page_frame(limit, client_socket.codec))
+    
+    def send_rank(self, client_socket: ClientConnection, player_name: str):
+        """Gửi hạng, rating và thành tích của một người chơi"""
+        if not isinstance(player_name, str):
+            self.send_message(client_socket, {'action': 'error', 'message': 'player_name không hợp lệ'})
+            return
+        self.send_message(client_socket, {'action': 'rank', **self.ratings.rank_of(player_name)})
+    
+    def send_game_list(self, client_id: int, client_socket: ClientConnection,
+                       offset: int = 0, limit: int = DEFAULT_PAGE_SIZE):
+        """Gửi một trang danh sách game đang chờ (khung lấy từ cache của sảnh)"""
+        if not isinstance(offset, int) or not isinstance(limit, int):
+            self.send_message(client_socket, {'action': 'error', 'message': 'offset/limit không hợp lệ'})
+            return
+        client_socket.sendall(self.lobby.page_frame(offset, limit, client_socket.codec))
+    
+    def disconnect_client(self, client_id: int, client_socket: ClientConnection):
         """Ngắt kết nối client"""
+        self.forget_client(client_id)
+        
+        outbox = client_socket.outbox
+        self.retire_connection_stats(client_socket)
+        if outbox.evicted:
+            print(f"🐢 Client {client_id} bị ngắt vì nhận quá chậm (>{outbox.high_water} tin nhắn chờ gửi)")
+        
+        client_socket.close()
+        print(f"❌ Client {client_id} ngắt kết nối")
+        print(f"   Số client còn lại: {len(self.clients)}")
+    
+    def retire_connection_stats(self, client_socket: ClientConnection):
+        """Cộng số liệu của kết nối sắp đóng (hoặc chuyển shard) vào tổng của server"""
+        outbox = client_socket.outbox
+        with self.lock:
+            self.collapsed_updates += outbox.collapsed
+            if outbox.evicted:
+                self.slow_consumers_evicted += 1
+            self.traffic['received_frames'] += client_socket.received_frames
+            self.traffic['received_bytes'] += client_socket.received_bytes
+            self.traffic['sent_frames'] += outbox.queued_frames
+            self.traffic['sent_bytes'] += outbox.queued_bytes
+    
+    def forget_client(self, client_id: int):
+        """Gỡ client khỏi registry, hàng đợi ghép trận và các game của client"""
+        self.matchmaker.cancel(client_id)
         with self.lock:
             if client_id in self.clients:
                 del self.clients[client_id]
+            self.delta_clients.discard(client_id)
             
-            # Xóa game nếu client là người tạo
-            games_to_remove = []
-            for game_id, game in self.games.items():
-                if client_id in game['sockets']:
-                    del game['sockets'][client_id]
-                
-                if not game['sockets']:
-                    games_to_remove.append(game_id)
+            for game_id in self.client_spectating.pop(client_id, ()):
+                game = self.games.get(game_id)
+                if game is not None:
+                    with game.lock:
+                        game.spectators.pop(client_id, None)
             
-            for game_id in games_to_remove:
-                del self.games[game_id]
+            # Chỉ duyệt các game của client này nhờ chỉ mục ngược
+            for game_id in self.client_games.pop(client_id, ()):
+                game = self.games.get(game_id)
+                if game is None:
+                    continue
+                with game.lock:
+                    game.sockets.pop(client_id, None)
+                    
+                    if game.status == 'playing' and self.session_grace > 0:
+                        # Giữ chỗ để người chơi kết nối lại bằng resume trong session_grace giây
+                        self.hold_seat(game_id, game, 1 if client_id == game.player1 else 2)
+                    elif not game.sockets:
+                        # Không còn ai: xóa ngay (kể cả game đang chờ của người tạo)
+                        self.drop_game(game_id, game)
+                    elif game.status == 'playing':
+                        # Đối thủ còn lại không thể đi tiếp (và được tính thắng): thu hồi sau game_ttl
+                        self.forfeit(game_id, game, 2 if client_id == game.player1 else 1)
+    
+    def drop_game(self, game_id: int, game: Game):
+        """Xóa ngay game không còn người chơi nào (gọi khi đang giữ self.lock và game.lock)"""
+        del self.games[game_id]
+        self.forget_spectators(game_id, game)
+        self.remove_from_lobby(game_id)
+        if self.wal is not None:
+            self.wal.append(encode_drop(game_id))
+    
+    def forfeit(self, game_id: int, game: Game, winner: int):
+        """Kết thúc ván vì một người bỏ đi, winner (1 / 2) thắng (gọi khi đang giữ game.lock)"""
+        self.end_game(game_id, game, 'abandoned', winner)
+        self.broadcast(game, {
+            'action': 'game_over',
+            'seq': game.seq,
+            'winner': 'X' if winner == 1 else 'O',
+            'winning_positions': [],
+            'winner_id': game.player1 if winner == 1 else game.player2
+        })
+    
+    def hold_seat(self, game_id: int, game: Game, player: int, grace: Optional[float] = None):
+        """Giữ chỗ cho người chơi vừa mất kết nối (gọi khi đang giữ game.lock); hết hạn thì xử thua"""
+        grace = self.session_grace if grace is None else grace
+        deadline = time.monotonic() + grace
+        if game.away is None:
+            game.away = {}
+        game.away[player] = deadline
+        self.broadcast(game, {
+            'action': 'player_away',
+            'game_id': game_id,
+            'player_name': game.player1_name if player == 1 else game.player2_name,
+            'grace': grace
+        }, board=False)
+        self.call_later(grace, self.expire_seat, game_id, player, deadline)
+    
+    def expire_seat(self, game_id: int, player: int, deadline: float):
+        """Hết hạn giữ chỗ: người chưa quay lại bị xử thua; không còn ai thì xóa game"""
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is None:
+                return
+            with game.lock:
+                if not game.away or game.away.get(player) != deadline:
+                    return  # Đã quay lại (hoặc mất kết nối lần nữa với hạn mới)
+                del game.away[player]
+                if game.status != 'playing':
+                    return
+                if game.sockets:
+                    self.forfeit(game_id, game, 3 - player)
+                elif not game.away:
+                    self.drop_game(game_id, game)
+                # Đối thủ cũng đang vắng: chờ hạn của họ (hoặc họ quay lại và thắng)
+    
+    def resume(self, client_id: int, client_socket: ClientConnection, game_id: int, token: str, last_seq: int):
+        """Gắn kết nối mới vào chỗ của người chơi (theo mã phiên) và gửi các nước sau last_seq.
         
-        client_socket.close()
-        print(f"❌ Client {client_id} ngắt kết nối")
-        print(f"   Số client còn lại: {len(self.clients)}")
+        last_seq là seq cuối client đã áp dụng; chỉ các nước sau đó được gửi lại (trong
+        'resumed'), không gửi lại cả bàn cờ. Không có / sai last_seq thì gửi cả bàn cờ.
+        """
+        if self.router is not None and isinstance(game_id, int) and self.shard_of(game_id) != self.shard_index:
+            # Game thuộc shard khác: chuyển kết nối sang đó như join_game
+            client_socket.handoff = (self.shard_of(game_id), {'action': 'resume', 'game_id': game_id,
+                                                              'token': token, 'last_seq': last_seq})
+            return
+        
+        self.matchmaker.cancel(client_id)
+        error = 'Game không tồn tại'
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is not None:
+                with game.lock:
+                    player = None
+                    if isinstance(token, str):
+                        player = next((p for p in (1, 2) if game.tokens[p - 1] is not None
+                                       and secrets.compare_digest(game.tokens[p - 1], token)), None)
+                    if player is None:
+                        error = 'Mã phiên không hợp lệ'
+                    elif game.status != 'playing':
+                        error = 'Game đã kết thúc'
+                    else:
+                        error = None
+                        self.sessions_resumed += 1
+                        self.attach_player(client_id, client_socket, game_id, game, player)
+                        self.send_message(client_socket, self.resumed_message(game_id, game, player, last_seq))
+                        # Chỉ đối thủ và người xem; người vừa quay lại đã có 'resumed'
+                        self.broadcast(game, {
+                            'action': 'player_back',
+                            'game_id': game_id,
+                            'player_name': game.player1_name if player == 1 else game.player2_name
+                        }, board=False, exclude=client_id)
+                        opponent = 3 - player
+                        if game.bot_level is None and (game.player1 if opponent == 1 else game.player2) \
+                                not in game.sockets and opponent not in (game.away or ()):
+                            # Đối thủ đã hết hạn giữ chỗ trong lúc cả hai cùng vắng
+                            self.forfeit(game_id, game, player)
+        
+        if error:
+            self.send_message(client_socket, {'action': 'error', 'message': error})
+            return
+        print(f"🔁 Client {client_id} quay lại Game {game_id}")
+    
+    def attach_player(self, client_id: int, client_socket: ClientConnection, game_id: int, game: Game, player: int):
+        """Đổi chỗ player (1 / 2) sang kết nối mới (gọi khi đang giữ self.lock và game.lock).
+        
+        Kết nối cũ (nếu server chưa phát hiện nó đã chết) thôi nhận cập nhật của game.
+        """
+        old = game.player1 if player == 1 else game.player2
+        game.sockets.pop(old, None)
+        if old != client_id:
+            old_games = self.client_games.get(old)
+            if old_games is not None:
+                old_games.discard(game_id)
+        if player == 1:
+            game.player1 = client_id
+        else:
+            game.player2 = client_id
+        game.sockets[client_id] = client_socket
+        if game.away:
+            game.away.pop(player, None)
+        if game.spectators:
+            game.spectators.pop(client_id, None)
+        self.client_games.setdefault(client_id, set()).add(game_id)
+        self.client_spectating.get(client_id, set()).discard(game_id)
+    
+    def resumed_message(self, game_id: int, game: Game, player: int, last_seq: int) -> Dict:
+        """Tin nhắn 'resumed': thông tin ván và các nước sau last_seq (gọi khi đang giữ game.lock)"""
+        message = {
+            'action': 'resumed',
+            'game_id': game_id,
+            'player_symbol': 'X' if player == 1 else 'O',
+            'player1_name': game.player1_name,
+            'player2_name': game.player2_name,
+            **game.settings(),
+            'first_player_symbol': 'X' if game.first_player == 1 else 'O',
+            'seq': game.seq,
+            'current_turn': game.current_turn,
+            'session_token': game.tokens[player - 1]
+        }
+        if game.clock is not None:
+            message['clock'] = game.clock.millis(time.monotonic())
+        if isinstance(last_seq, int) and 0 <= last_seq <= game.seq:
+            # Nước thứ k (tính từ 1) nằm ở history[(k - 1) * width:]; quân đổi lượt từ người đi trước
+            missed = game.history[last_seq * move_width(game.board_size):]
+            message['from_seq'] = last_seq
+            message['moves'] = history_positions(missed, game.board_size)
+        else:
+            message.update(game.board_fields())
+        return message
+    
+    def forget_spectators(self, game_id: int, game: Game):
+        """Gỡ game sắp xóa khỏi chỉ mục người xem (gọi khi đang giữ self.lock và game.lock)"""
+        for pid in game.spectators or ():
+            game_ids = self.client_spectating.get(pid)
+            if game_ids is not None:
+                game_ids.discard(game_id)
+    
+    def detach_client(self, client_id: int, client_socket: ClientConnection, pending: bytes) -> Dict:
+        """Gỡ client đang được chuyển sang shard khác (không đóng socket).
+        
+        Trả về trạng thái để shard đích tiếp tục: codec, delta và các byte chưa xử lý,
+        mở đầu bằng chính tin nhắn gây ra việc chuyển (join_game, spectate, quick_match...).
+        """
+        shard, message = client_socket.handoff
+        with self.lock:
+            delta = client_id in self.delta_clients
+        self.forget_client(client_id)
+        self.retire_connection_stats(client_socket)
+        reason = f"vào Game {message['game_id']}" if 'game_id' in message else message['action']
+        print(f"🔀 Client {client_id} chuyển sang shard {shard + 1} để {reason}")
+        return {
+            'shard': shard,
+            'delta': delta,
+            'heartbeat': client_socket.heartbeat,
+            'codec': client_socket.codec.name,
+            'pending': encode_pending(encode_message(message) + pending)
+        }
+    
+    def resume_handoff(self, client_id: int, client_socket: ClientConnection, state: Dict) -> bytes:
+        """Khôi phục trạng thái kết nối do shard khác chuyển sang; trả về các byte cần xử lý trước"""
+        if state.get('delta'):
+            with self.lock:
+                self.delta_clients.add(client_id)
+        client_socket.heartbeat = bool(state.get('heartbeat'))
+        client_socket.codec = CODECS.get(state.get('codec'), JSON_CODEC)
+        return decode_pending(state['pending'])
     
     def shutdown(self):
         """Tắt server"""
-        self.server_socket.close()
+        self.scheduler.stop()
+        if self.wal is not None:
+            self.wal.close()
+        if self.archive is not None:
+            self.archive.close()
+        self.ratings.close()
+        if self.bot_pool is not None:
+            self.bot_pool.shutdown(wait=False, cancel_futures=True)
+        if self.server_socket:
+            self.server_socket.close()
+
+def stop_on_sigterm():
+    """SIGTERM (kill, hoặc tiến trình chính dừng các shard) đi cùng đường dừng với Ctrl+C:
+    start() bắt KeyboardInterrupt và gọi shutdown(), nên pool của CaroBot được tắt thay vì
+    để lại tiến trình con mồ côi"""
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+def parse_args():
+    """Đọc tham số dòng lệnh"""
+    parser = argparse.ArgumentParser(description='Server Cờ Caro')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded',
+                        help='threaded: mỗi client một thread; async: một event loop cho mọi kết nối')
+    parser.add_argument('--backlog', type=int, default=None,
+                        help='Độ dài hàng đợi accept (mặc định: 5 cho threaded, 4096 cho async)')
+    parser.add_argument('--game-over-delay', type=float, default=0.3,
+                        help='Số giây giữa board_updated cuối và game_over')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Số tiến trình server (shard); >1 thì chạy sau một tiến trình nhận kết nối')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Cổng HTTP phục vụ GET /metrics (Prometheus); shard i dùng cổng + i')
+    parser.add_argument('--game-ttl', type=float, default=300.0,
+                        help='Số giây giữ game đã kết thúc / bị bỏ dở trước khi thu hồi')
+    parser.add_argument('--bot-workers', type=int, default=1,
+                        help='Số tiến trình tìm nước cho các ván chơi với máy (mỗi shard)')
+    parser.add_argument('--wal-dir',
+                        help='Thư mục nhật ký ghi trước: khôi phục game đang diễn ra khi khởi động lại')
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, default='group',
+                        help='write: không fsync, group: fsync theo chu kỳ, sync: fsync mỗi bản ghi')
+    parser.add_argument('--fsync-interval', type=float, default=DEFAULT_FSYNC_INTERVAL,
+                        help='Chu kỳ fsync (giây) ở mức group')
+    parser.add_argument('--snapshot-interval', type=float, default=60.0,
+                        help='Số giây giữa hai lần chụp ảnh game và dọn nhật ký')
+    parser.add_argument('--ping-interval', type=float, default=DEFAULT_PING_INTERVAL,
+                        help="Số giây im lặng trước khi ping client 'heartbeat' (0: tắt heartbeat)")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Số giây im lặng (không trả lời ping) trước khi ngắt kết nối')
+    parser.add_argument('--session-grace', type=float, default=DEFAULT_SESSION_GRACE,
+                        help='Số giây giữ chỗ cho người chơi mất kết nối giữa ván (resume); 0: xử thua ngay')
+    parser.add_argument('--archive-dir',
+                        help='Thư mục lưu các ván đã kết thúc (game_history, player_stats, replay)')
+    parser.add_argument('--ratings-file',
+                        help='Tệp lưu rating Elo của người chơi (leaderboard, rank, ghép trận theo rating)')
+    parser.add_argument('--opening-book', action='append', default=[],
+                        help='Tệp sách khai cuộc do CaroBook.py tạo (lặp lại cho nhiều cỡ bàn)')
+    parser.add_argument('--send-queue-limit', type=int, default=DEFAULT_HIGH_WATER,
+                        help='Số tin nhắn chờ gửi tối đa cho một client trước khi gộp cập nhật / ngắt kết nối')
+    return parser.parse_args()
+
+def create_server(engine: str, host: str, port: int, backlog: Optional[int] = None, **options) -> 'TicTacToeServer':
+    """Tạo server theo engine được chọn"""
+    if engine == 'async':
+        from CaroAsyncServer import AsyncCaroServer
+        server_cls = AsyncCaroServer
+    else:
+        server_cls = TicTacToeServer
+    
+    if backlog is not None:
+        options['backlog'] = backlog
+    return server_cls(host, port, **options)
 
 if __name__ == '__main__':
-    server = TicTacToeServer('localhost', 8888)
-    server.start()
+    stop_on_sigterm()
+    args = parse_args()
+    options = {'game_over_delay': args.game_over_delay, 'send_queue_limit': args.send_queue_limit,
+               'game_ttl': args.game_ttl, 'metrics_port': args.metrics_port, 'bot_workers': args.bot_workers,
+               'opening_books': args.opening_book, 'wal_dir': args.wal_dir, 'durability': args.durability,
+               'fsync_interval': args.fsync_interval, 'snapshot_interval': args.snapshot_interval,
+               'archive_dir': args.archive_dir, 'ratings_file': args.ratings_file,
+               'session_grace': args.session_grace, 'ping_interval': args.ping_interval,
+               'idle_timeout': args.idle_timeout}
+    if args.workers > 1:
+        from CaroShards import run_sharded
+        run_sharded(args.engine, args.host, args.port, args.workers, args.backlog, **options)
+    else:
+        server = create_server(args.engine, args.host, args.port, args.backlog, **options)
+        server.start()
@@ -0,0 +1,215 @@
+"""Server Cờ Caro nhiều tiến trình: một tiến trình nhận kết nối và N worker (shard).
+
+GIL giới hạn một tiến trình Python ở một lõi CPU, nên mỗi worker chạy một server
+đầy đủ (engine threaded hoặc async) trong tiến trình riêng:
+
+- Tiến trình chính accept và chuyển fd socket cho worker qua socketpair Unix
+  (SCM_RIGHTS), chia đều theo vòng.
+- Mỗi game thuộc đúng một shard: game_id % số shard. join_game cho game ở shard
+  khác làm kết nối được chuyển hẳn sang shard đó, kèm codec, chế độ delta và các
+  byte đã nhận nhưng chưa xử lý; hai người chơi vì vậy luôn ở cùng tiến trình với game.
+  quick_match / cancel_match cũng chuyển kết nối sang MATCH_SHARD, nơi giữ hàng đợi chung.
+- Thay đổi sảnh chờ được phát cho mọi shard để list_games trả về danh sách gộp.
+- Rating có một chủ duy nhất (shard RATINGS_SHARD của CaroServer): các shard khác gửi kết
+  quả ván tới đó, chủ tính Elo, ghi tệp rồi phát trạng thái mới của hai người cho mọi shard.
+
+Cần Unix (socket.send_fds / recv_fds, Python 3.9+).
+"""
+import base64
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+from typing import Dict, List, Optional, Sequence
+
+# Khung điều khiển lớn nhất: trạng thái chuyển kết nối kèm byte chưa xử lý
+MAX_CONTROL_SIZE = 4 * 1024 * 1024
+
+
+def send_control(channel: socket.socket, message: Dict, fds: Sequence[int] = ()):
+    """Gửi một tin nhắn điều khiển (JSON) kèm các fd qua socketpair"""
+    socket.send_fds(channel, [json.dumps(message).encode('utf-8')], list(fds))
+
+
+def recv_control(channel: socket.socket):
+    """Nhận một tin nhắn điều khiển; trả về (None, []) khi đầu bên kia đã đóng"""
+    data, fds, _, _ = socket.recv_fds(channel, MAX_CONTROL_SIZE, 1)
+    if not data:
+        return None, fds
+    return json.loads(data), fds
+
+
+class ShardRouter:
+    """Kênh điều khiển của một worker tới tiến trình chính.
+
+    Việc gửi đi chạy trên một thread riêng nên handler (đang giữ lock game) không bao
+    giờ chờ socketpair.
+    """
+
+    def __init__(self, channel: socket.socket, shard_index: int, shard_count: int):
+        self.channel = channel
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.outgoing: queue.SimpleQueue = queue.SimpleQueue()
+        self.sender = threading.Thread(target=self.send_loop, name='caro-shard-sender', daemon=True)
+        self.sender.start()
+
+    def publish_lobby_add(self, entry: Dict):
+        self.outgoing.put(({'type': 'lobby_add', 'entry': entry}, None))
+
+    def publish_lobby_remove(self, game_id: int):
+        self.outgoing.put(({'type': 'lobby_remove', 'game_id': game_id}, None))
+
+    def send_game_result(self, shard: int, name1: str, name2: str, score1: float):
+        """Gửi kết quả một ván tới shard giữ bảng rating"""
+        self.outgoing.put(({'type': 'rate_game', 'shard': shard, 'name1': name1, 'name2': name2,
+                            'score1': score1}, None))
+
+    def publish_ratings(self, entries: List[Dict]):
+        """Chủ bảng rating: phát trạng thái mới của các người chơi cho bản sao ở các shard khác"""
+        self.outgoing.put(({'type': 'ratings', 'entries': entries}, None))
+
+    def hand_off(self, state: Dict, fd: int):
+        """Chuyển socket fd cùng trạng thái kết nối sang shard state['shard'].
+
+        fd được nhân bản ngay nên người gọi có thể đóng socket của mình sau khi gọi.
+        """
+        self.outgoing.put(({'type': 'handoff', **state}, os.dup(fd)))
+
+    def send_loop(self):
+        while True:
+            message, fd = self.outgoing.get()
+            try:
+                send_control(self.channel, message, [fd] if fd is not None else [])
+            except (BrokenPipeError, ConnectionResetError):
+                return  # Tiến trình chính đã dừng
+            except OSError as e:
+                print(f"❌ Lỗi gửi tới tiến trình chính: {e}")
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    def serve(self, server):
+        """Nhận kết nối và cập nhật sảnh từ tiến trình chính cho đến khi kênh đóng"""
+        while True:
+            message, fds = recv_control(self.channel)
+            if message is None:
+                return
+
+            kind = message['type']
+            if kind in ('connection', 'handoff'):
+                sock = socket.socket(fileno=fds[0])
+                address = tuple(message.get('address', ()))
+                server.adopt_connection(sock, address, message if kind == 'handoff' else None)
+            elif kind == 'lobby_add':
+                server.lobby.add(**message['entry'])
+            elif kind == 'lobby_remove':
+                server.lobby.remove(message['game_id'])
+            elif kind == 'rate_game':
+                server.record_result(message['name1'], message['name2'], message['score1'])
+            elif kind == 'ratings':
+                server.ratings.apply(message['entries'])
+
+
+def encode_pending(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def decode_pending(text: str) -> bytes:
+    return base64.b64decode(text)
+
+
+def worker_main(engine: str, host: str, port: int, shard_index: int, shard_count: int,
+                channel: socket.socket, inherited: List[socket.socket], options: Dict):
+    """Điểm vào của một worker"""
+    # Đóng đầu kênh của tiến trình chính (và của các worker trước) thừa hưởng khi fork,
+    # để khi tiến trình chính thoát worker nhận được EOF và tự dừng
+    for other in inherited:
+        other.close()
+
+    from CaroServer import create_server, stop_on_sigterm
+    stop_on_sigterm()  # process.terminate() của tiến trình chính gửi SIGTERM
+    server = create_server(engine, host, port, shard_index=shard_index, shard_count=shard_count, **options)
+    server.router = ShardRouter(channel, shard_index, shard_count)
+    server.start()
+
+
+def relay(index: int, channel: socket.socket, channels: List[socket.socket], locks: List[threading.Lock]):
+    """Chuyển tiếp tin nhắn điều khiển của worker index tới (các) shard đích"""
+    def send(target: int, message: Dict, fds: Sequence[int] = ()):
+        with locks[target]:
+            send_control(channels[target], message, fds)
+
+    while True:
+        message, fds = recv_control(channel)
+        if message is None:
+            return
+        try:
+            if 'shard' in message:
+                # Gửi cho một shard (chuyển kết nối, kết quả ván cho chủ bảng rating)
+                send(message['shard'], message, fds)
+            else:
+                for target in range(len(channels)):
+                    if target != index:
+                        send(target, message)
+        except OSError as e:
+            print(f"❌ Lỗi chuyển tiếp tới shard: {e}")
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+
+def run_sharded(engine: str, host: str, port: int, workers: int, backlog: Optional[int] = None, **options):
+    """Chạy workers tiến trình server sau một tiến trình nhận kết nối"""
+    channels: List[socket.socket] = []
+    processes = []
+    for index in range(workers):
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(engine, host, port, index, workers, child, channels + [parent], options),
+            name=f'caro-shard-{index}',
+            daemon=True
+        )
+        process.start()
+        child.close()
+        channels.append(parent)
+        processes.append(process)
+
+    locks = [threading.Lock() for _ in channels]
+    for index, channel in enumerate(channels):
+        threading.Thread(target=relay, args=(index, channel, channels, locks), daemon=True).start()
+
+    try:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(backlog or 4096)
+    except OSError as e:
+        print(f"❌ Lỗi khởi động server: {e}")
+        for process in processes:
+            process.terminate()
+        return
+
+    print(f"🎮 Server {workers} shard ({engine}) nhận kết nối tại {host}:{port}")
+    target = 0
+    try:
+        while True:
+            sock, address = listener.accept()
+            try:
+                with locks[target]:
+                    send_control(channels[target], {'type': 'connection', 'address': list(address)},
+                                 [sock.fileno()])
+            except OSError as e:
+                print(f"❌ Không chuyển được kết nối cho shard {target}: {e}")
+            finally:
+                sock.close()
+            target = (target + 1) % workers
+    except KeyboardInterrupt:
+        print("\n🛑 Server dừng")
+    finally:
+        listener.close()
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,88 @@
+"""Bánh xe hẹn giờ (hashed timing wheel) cho các hẹn giờ theo từng kết nối.
+
+Mỗi kết nối cần một hẹn giờ ping / kiểm tra nhàn rỗi; với hàng chục nghìn kết nối, một
+heap (CaroScheduler) tốn O(log n) cho mỗi lần hẹn và một mục heap cho mỗi lần hẹn lại.
+Bánh xe chia thời gian thành các nhịp tick giây và băm mỗi hẹn giờ vào ô
+(nhịp hết hạn % số ô): thêm là O(1), mỗi nhịp chỉ duyệt đúng một ô. Hẹn giờ xa hơn
+một vòng bánh xe nằm lại ô của nó cho tới vòng có nhịp hết hạn.
+
+Bánh xe không tự chạy: server gọi advance() theo nhịp bằng một hẹn giờ duy nhất (thread
+scheduler hoặc event loop), rồi gọi các callback đến hạn ngoài lock. Độ chính xác là
+một nhịp, đủ cho ping và thu hồi kết nối chết.
+"""
+import math
+import threading
+import time
+from typing import Callable, List, Optional
+
+DEFAULT_TICK = 0.5  # Giây mỗi nhịp
+DEFAULT_SLOTS = 256  # Số ô: một vòng bánh xe = 128 giây
+
+
+class WheelTimer:
+    """Một lần hẹn giờ trên bánh xe; cancel() để bỏ (ô bỏ qua khi tới lượt)"""
+
+    __slots__ = ('expires', 'callback', 'args', 'cancelled')
+
+    def __init__(self, expires: int, callback: Callable, args: tuple):
+        self.expires = expires  # Số nhịp (tính từ lúc tạo bánh xe) mà hẹn giờ đến hạn
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimingWheel:
+    """Các ô hẹn giờ theo nhịp; an toàn giữa các thread (lock lá)"""
+
+    def __init__(self, tick: float = DEFAULT_TICK, slots: int = DEFAULT_SLOTS):
+        self.tick = tick
+        self.slots: List[List[WheelTimer]] = [[] for _ in range(slots)]
+        self.origin = time.monotonic()
+        self.current = 0  # Nhịp cuối cùng đã xử lý
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def call_later(self, delay: float, callback: Callable, *args) -> WheelTimer:
+        """Gọi callback(*args) ở nhịp đầu tiên sau delay giây (làm tròn lên tới nhịp)"""
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, deadline: float, callback: Callable, *args) -> WheelTimer:
+        """Gọi callback(*args) ở nhịp đầu tiên khi time.monotonic() đạt deadline"""
+        with self.lock:
+            expires = max(self.current + 1, math.ceil((deadline - self.origin) / self.tick))
+            timer = WheelTimer(expires, callback, args)
+            self.slots[expires % len(self.slots)].append(timer)
+            self.size += 1
+            return timer
+
+    def advance(self, now: Optional[float] = None) -> List[WheelTimer]:
+        """Quay bánh xe tới thời điểm now; trả về các hẹn giờ đến hạn (chưa bị hủy)"""
+        now = time.monotonic() if now is None else now
+        target = int((now - self.origin) / self.tick)
+        due = []
+        with self.lock:
+            # Tụt lại hơn một vòng (máy bị treo lâu): mỗi ô chỉ cần duyệt một lần
+            start = max(self.current + 1, target - len(self.slots) + 1)
+            for tick in range(start, target + 1):
+                index = tick % len(self.slots)
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                remaining = []
+                for timer in slot:
+                    if timer.cancelled:
+                        self.size -= 1
+                    elif timer.expires <= target:
+                        due.append(timer)
+                        self.size -= 1
+                    else:
+                        remaining.append(timer)  # Còn một hay nhiều vòng nữa
+                self.slots[index] = remaining
+            self.current = max(self.current, target)
+        return due
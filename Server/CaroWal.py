@@ -0,0 +1,397 @@
+"""Nhật ký ghi trước (write-ahead log) để các game đang diễn ra sống sót khi server khởi động lại.
+
+Mỗi sự kiện thay đổi trạng thái game (tạo, bắt đầu, nước đi, kết thúc, xóa) được ghi
+thành một bản ghi nhị phân ngay dưới game.lock, cùng lúc với thay đổi trong bộ nhớ:
+
+    [độ dài payload u32][crc32 u32][loại u8][payload]
+
+Nhật ký chia thành các segment wal-<số>.log. Định kỳ server chụp ảnh (snapshot.json)
+các game còn sống: chuyển sang segment mới, chép trạng thái từng game rồi xóa các
+segment cũ. Khi khởi động, trạng thái = ảnh chụp + phát lại các segment từ số ghi trong
+ảnh. Phát lại là idempotent (nước đi mang seq, tạo / bắt đầu / kết thúc chỉ áp dụng
+một lần) nên sự kiện vừa nằm trong ảnh vừa nằm trong segment mới không bị áp dụng hai
+lần. Bản ghi cuối bị ghi dở (crc sai hoặc thiếu byte) đánh dấu chỗ dừng phát lại.
+
+Mức bền vững (đường đi nước chỉ nối bản ghi vào buffer trong bộ nhớ, ở mọi mức):
+    write  mỗi fsync_interval giây một thread ghi buffer ra tệp, không fsync: tiến trình chết
+           mất tối đa fsync_interval giây nước đi, mất điện có thể mất nhiều hơn
+    group  như write và fsync ngay sau mỗi lần ghi (group commit): mọi nước đi trong một chu kỳ
+           dùng chung một lần fsync, mất điện cũng chỉ mất tối đa fsync_interval giây
+    sync   thread ghi được đánh thức ngay khi có bản ghi và ghi + fsync cả buffer (các bản ghi
+           tới trong lúc fsync đi chung lần sau); writer của kết nối chờ wait_committed() trước
+           khi gửi, nên không client nào thấy nước chưa nằm trên đĩa: không mất nước đã xác
+           nhận, chậm nhất. Không fsync nào chạy khi đang giữ lock registry / game.lock.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from CaroGame import history_positions
+
+DURABILITY_LEVELS = ('write', 'group', 'sync')
+DEFAULT_FSYNC_INTERVAL = 0.01
+SNAPSHOT_NAME = 'snapshot.json'
+
+RECORD_HEADER = struct.Struct('<IIB')
+CREATE, START, MOVE, END, DROP = 1, 2, 3, 4, 5
+CREATE_BODY = struct.Struct('<qqiH')  # game_id, player1, board_size, win_length
+START_BODY = struct.Struct('<qqB')  # game_id, player2, first_player
+MOVE_BODY = struct.Struct('<qqiiB')  # game_id, seq, row, col, quân (1 X, 2 O)
+END_BODY = struct.Struct('<qB')  # game_id, trạng thái
+DROP_BODY = struct.Struct('<q')  # game_id
+TIME_CONTROL_BODY = struct.Struct('<III')  # base, increment, per_move (mili giây), sau mã phiên của CREATE
+CLOCK_BODY = struct.Struct('<I')  # thời gian còn lại của người vừa đi (mili giây), sau MOVE_BODY
+END_STATUSES = ('finished', 'abandoned')
+LIVE_STATUSES = ('waiting', 'playing')
+
+
+def pack_text(text: Optional[str]) -> bytes:
+    data = (text or '').encode('utf-8')
+    return struct.pack('<H', len(data)) + data
+
+
+def unpack_text(payload: bytes, offset: int) -> Tuple[str, int]:
+    (size,) = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    return payload[offset:offset + size].decode('utf-8'), offset + size
+
+
+def encode_record(kind: int, payload: bytes) -> bytes:
+    body = bytes((kind,)) + payload
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(body), kind) + payload
+
+
+def unpack_token(payload: bytes, offset: int) -> Tuple[Optional[str], int]:
+    """Mã phiên sau phần cố định của bản ghi CREATE / START (nhật ký cũ không có)"""
+    if offset >= len(payload):
+        return None, offset
+    token, offset = unpack_text(payload, offset)
+    return token or None, offset
+
+
+def unpack_time_control(payload: bytes, offset: int) -> Optional[Dict[str, float]]:
+    """Time control ở cuối bản ghi CREATE (ván không tính giờ và nhật ký cũ không có)"""
+    if offset + TIME_CONTROL_BODY.size > len(payload):
+        return None
+    base, increment, per_move = TIME_CONTROL_BODY.unpack_from(payload, offset)
+    if per_move:
+        return {'per_move': per_move / 1000}
+    return {'base': base / 1000, 'increment': increment / 1000}
+
+
+def encode_create(game_id: int, player1: int, player1_name: str, board_size: int, win_length: int,
+                  bot_level: Optional[str], token: Optional[str] = None,
+                  time_control: Optional[Dict[str, float]] = None) -> bytes:
+    payload = CREATE_BODY.pack(game_id, player1, board_size, win_length) + pack_text(player1_name) \
+        + pack_text(bot_level) + pack_text(token)
+    if time_control is not None:
+        payload += TIME_CONTROL_BODY.pack(*(round(time_control.get(key, 0) * 1000)
+                                            for key in ('base', 'increment', 'per_move')))
+    return encode_record(CREATE, payload)
+
+
+def encode_start(game_id: int, player2: int, player2_name: str, first_player: int,
+                 token: Optional[str] = None) -> bytes:
+    return encode_record(START, START_BODY.pack(game_id, player2, first_player) + pack_text(player2_name)
+                         + pack_text(token))
+
+
+def encode_move(game_id: int, seq: int, row: int, col: int, symbol: str, clock: Optional[int] = None) -> bytes:
+    """clock: thời gian còn lại (mili giây) của người vừa đi, với ván có time control"""
+    payload = MOVE_BODY.pack(game_id, seq, row, col, 1 if symbol == 'X' else 2)
+    if clock is not None:
+        payload += CLOCK_BODY.pack(clock)
+    return encode_record(MOVE, payload)
+
+
+def encode_end(game_id: int, status: str) -> bytes:
+    return encode_record(END, END_BODY.pack(game_id, END_STATUSES.index(status)))
+
+
+def encode_drop(game_id: int) -> bytes:
+    return encode_record(DROP, DROP_BODY.pack(game_id))
+
+
+def segment_name(number: int) -> str:
+    return f'wal-{number:08d}.log'
+
+
+def list_segments(directory: str) -> List[int]:
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith('wal-') and name.endswith('.log'):
+            try:
+                numbers.append(int(name[4:-4]))
+            except ValueError:
+                continue
+    return sorted(numbers)
+
+
+def read_records(path: str):
+    """Các bản ghi (loại, payload) hợp lệ của một segment; dừng ở bản ghi ghi dở đầu tiên"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        size, crc, kind = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + size]
+        if len(payload) != size or zlib.crc32(bytes((kind,)) + payload) != crc:
+            return
+        yield kind, payload
+        offset = start + size
+
+
+def fsync_directory(directory: str):
+    """fsync thư mục để thao tác đổi tên / tạo tệp cũng bền vững (không có trên Windows)"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def game_state(game) -> Dict:
+    """Trạng thái một game (CaroGame.Game) để ghi ảnh chụp; stones theo đúng thứ tự đã đánh"""
+    stones = []
+    symbol = 'X' if game.first_player == 1 else 'O'
+    for position in history_positions(game.history, game.board_size):
+        stones.append([*game.coordinates(position), symbol])
+        symbol = 'O' if symbol == 'X' else 'X'
+    return {
+        'player1': game.player1, 'player1_name': game.player1_name,
+        'player2': game.player2, 'player2_name': game.player2_name,
+        'board_size': game.board_size, 'win_length': game.win_length, 'bot_level': game.bot_level,
+        'status': game.status, 'first_player': game.first_player, 'seq': game.seq, 'stones': stones,
+        'tokens': game.tokens,
+        # Đồng hồ tính tới đầu lượt hiện tại: khôi phục xong, người tới lượt được tính lại cả lượt
+        'time_control': game.clock.control.to_dict() if game.clock is not None else None,
+        'clock': game.clock.millis() if game.clock is not None else None
+    }
+
+
+class RecoveredState:
+    """Trạng thái dựng lại từ ảnh chụp + nhật ký: các game còn sống và bộ đếm id"""
+
+    def __init__(self):
+        self.games: Dict[int, Dict] = {}
+        self.next_game_id = 1
+        self.client_counter = 0
+        self.segment = 1  # Segment đầu tiên cần phát lại
+        self.records = 0
+
+    def apply(self, kind: int, payload: bytes, shard_count: int):
+        """Áp dụng một bản ghi (idempotent)"""
+        self.records += 1
+        if kind == CREATE:
+            game_id, player1, board_size, win_length = CREATE_BODY.unpack_from(payload)
+            name, offset = unpack_text(payload, CREATE_BODY.size)
+            bot_level, offset = unpack_text(payload, offset)
+            token, offset = unpack_token(payload, offset)
+            time_control = unpack_time_control(payload, offset)
+            self.see_ids(game_id, player1, shard_count)
+            self.games.setdefault(game_id, {
+                'player1': player1, 'player1_name': name, 'player2': None, 'player2_name': None,
+                'board_size': board_size, 'win_length': win_length, 'bot_level': bot_level or None,
+                'status': 'waiting', 'first_player': None, 'seq': 0, 'stones': [],
+                'tokens': [token, None], 'time_control': time_control, 'clock': None
+            })
+            return
+
+        (game_id,) = DROP_BODY.unpack_from(payload)
+        state = self.games.get(game_id)
+        if state is None:
+            return
+        if kind == START and state['status'] == 'waiting':
+            _, player2, first_player = START_BODY.unpack_from(payload)
+            state['player2_name'], offset = unpack_text(payload, START_BODY.size)
+            state['tokens'] = [(state.get('tokens') or [None])[0], unpack_token(payload, offset)[0]]
+            state['player2'] = player2
+            state['first_player'] = first_player
+            state['status'] = 'playing'
+            self.see_ids(game_id, player2, shard_count)
+        elif kind == MOVE:
+            _, seq, row, col, color = MOVE_BODY.unpack_from(payload)
+            if seq == state['seq'] + 1:
+                state['stones'].append([row, col, 'X' if color == 1 else 'O'])
+                state['seq'] = seq
+                if len(payload) >= MOVE_BODY.size + CLOCK_BODY.size and state.get('time_control'):
+                    clock = state.get('clock') or [None, None]
+                    (clock[color - 1],) = CLOCK_BODY.unpack_from(payload, MOVE_BODY.size)
+                    state['clock'] = clock
+        elif kind == END:
+            _, status = END_BODY.unpack_from(payload)
+            state['status'] = END_STATUSES[status]
+        elif kind == DROP:
+            del self.games[game_id]
+
+    def see_ids(self, game_id: int, player: int, shard_count: int):
+        """Giữ bộ đếm id vượt mọi id đã dùng để id game / client không bị tái sử dụng"""
+        self.next_game_id = max(self.next_game_id, game_id // shard_count + 1)
+        self.client_counter = max(self.client_counter, player // shard_count)
+
+    def live_games(self) -> Dict[int, Dict]:
+        return {game_id: state for game_id, state in self.games.items() if state['status'] in LIVE_STATUSES}
+
+
+def recover(directory: str, shard_count: int = 1) -> RecoveredState:
+    """Đọc ảnh chụp mới nhất rồi phát lại các segment sau nó"""
+    recovered = RecoveredState()
+    path = os.path.join(directory, SNAPSHOT_NAME)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        recovered.segment = snapshot['segment']
+        recovered.next_game_id = snapshot['next_game_id']
+        recovered.client_counter = snapshot['client_counter']
+        recovered.games = {int(game_id): state for game_id, state in snapshot['games'].items()}
+    for number in list_segments(directory):
+        if number >= recovered.segment:
+            for kind, payload in read_records(os.path.join(directory, segment_name(number))):
+                recovered.apply(kind, payload, shard_count)
+    return recovered
+
+
+class WriteAheadLog:
+    """Segment đang ghi; bản ghi gom trong bộ nhớ và được một thread ghi ra theo chu kỳ"""
+
+    def __init__(self, directory: str, durability: str = 'group', fsync_interval: float = DEFAULT_FSYNC_INTERVAL,
+                 fsync_histogram=None):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"durability phải là một trong {', '.join(DURABILITY_LEVELS)}")
+        self.directory = directory
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.fsync_histogram = fsync_histogram
+        self.lock = threading.Lock()  # Lock lá: append() được gọi khi đang giữ game.lock / lock registry
+        # Ghi ra đĩa và đổi segment không chạy song song; append() không phải chờ chúng
+        self.sync_lock = threading.Lock()
+        self.buffer = bytearray()
+        self.fd: Optional[int] = None
+        self.segment = 0
+        self.records = 0
+        self.bytes = 0
+        self.fsyncs = 0
+        self.durable = 0  # Số bản ghi đầu tiên (theo self.records) đã ghi xong (và fsync nếu có)
+        self.committed = threading.Condition()  # Lock lá, báo cho wait_committed()
+        self.pending = threading.Event()  # Mức sync: đánh thức thread ghi khi có bản ghi mới
+        self.stop_event = threading.Event()
+        self.flusher: Optional[threading.Thread] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, segment: int):
+        """Bắt đầu ghi vào segment (mới) và chạy thread ghi theo chu kỳ nếu cần"""
+        self.segment = segment
+        self.fd = os.open(os.path.join(self.directory, segment_name(segment)),
+                          os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+        fsync_directory(self.directory)
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.flush_loop, name='caro-wal-flush', daemon=True)
+            self.flusher.start()
+
+    def append(self, record: bytes):
+        """Thêm một bản ghi: chỉ nối vào buffer (không syscall, không nhả GIL trên đường đi nước);
+        mức 'sync' đánh thức thread ghi ngay"""
+        with self.lock:
+            self.records += 1
+            self.bytes += len(record)
+            self.buffer += record
+        if self.durability == 'sync':
+            self.pending.set()
+
+    def wait_committed(self):
+        """Chờ mọi bản ghi đã append tới lúc gọi nằm trên đĩa (gọi ngoài mọi lock của server)"""
+        target = self.records
+        with self.committed:
+            while self.durable < target and not self.stop_event.is_set():
+                self.committed.wait()
+
+    def mark_durable(self, records: int):
+        with self.committed:
+            self.durable = max(self.durable, records)
+            self.committed.notify_all()
+
+    def sync(self, fd: int):
+        t0 = time.perf_counter()
+        os.fsync(fd)
+        self.fsyncs += 1
+        if self.fsync_histogram is not None:
+            self.fsync_histogram.observe(time.perf_counter() - t0)
+
+    def flush_loop(self):
+        """Group commit: mỗi chu kỳ (mức sync: ngay khi có bản ghi) ghi mọi bản ghi đang gom bằng
+        một lần write (+ một lần fsync)"""
+        if self.durability == 'sync':
+            while True:
+                self.pending.wait()
+                if self.stop_event.is_set():
+                    return
+                self.pending.clear()
+                self.flush()
+        while not self.stop_event.wait(self.fsync_interval):
+            self.flush()
+
+    def flush(self):
+        with self.sync_lock:
+            with self.lock:
+                if not self.buffer or self.fd is None:
+                    return
+                data, self.buffer = self.buffer, bytearray()
+                fd = self.fd
+                records = self.records
+            self.write_out(fd, data)
+            self.mark_durable(records)
+
+    def write_out(self, fd: int, data: bytes):
+        os.write(fd, data)
+        if self.durability != 'write':
+            self.sync(fd)
+
+    def rotate(self) -> int:
+        """Chuyển sang segment mới; trả về số của segment mới (các bản ghi sau đó nằm ở đây)"""
+        with self.sync_lock:
+            with self.lock:
+                old = self.fd
+                data, self.buffer = self.buffer, bytearray()
+                records = self.records
+                self.open(self.segment + 1)
+            if data:
+                self.write_out(old, data)
+                self.mark_durable(records)
+            os.close(old)
+        return self.segment
+
+    def write_snapshot(self, segment: int, games: Dict[int, Dict], next_game_id: int, client_counter: int):
+        """Ghi ảnh chụp (tệp tạm + fsync + đổi tên) rồi xóa các segment đã nằm trong ảnh"""
+        path = os.path.join(self.directory, SNAPSHOT_NAME)
+        temp = path + '.tmp'
+        snapshot = {'segment': segment, 'next_game_id': next_game_id, 'client_counter': client_counter,
+                    'games': {str(game_id): state for game_id, state in games.items()}}
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+        fsync_directory(self.directory)
+        for number in list_segments(self.directory):
+            if number < segment:
+                os.remove(os.path.join(self.directory, segment_name(number)))
+
+    def close(self):
+        self.stop_event.set()
+        self.pending.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        with self.committed:
+            self.committed.notify_all()  # Không để writer nào chờ mãi
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
@@ -0,0 +1,1681 @@
+"""Kiểm thử hồi quy cho TicTacToeServer, chạy trong tiến trình với kết nối giả (không mở socket).
+
+    cd Server && python -m unittest test_CaroServer
+"""
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from CaroArchive import ArchiveReader, GameArchive, encode_game, seal
+from CaroAsyncServer import AsyncCaroServer
+from CaroBook import OpeningBook, canonical_key, load_books, symmetries, write_book
+from CaroBot import choose_move
+from CaroClock import ClockQueue, GameClock, TimeControl, parse_time_control
+from CaroGame import Game
+from CaroLoad import LoadStats, compare, summarize
+from CaroMatchmaker import Matchmaker, Ticket
+from CaroOutbox import Outbox
+from CaroScheduler import Scheduler
+from CaroProtocol import (BINARY_CODEC, HEADER, JSON_CODEC, MAX_FRAME_SIZE, FrameDecoder, ProtocolError, decode_message,
+                          encode_frame, encode_message)
+from CaroRatings import RatingBook
+from CaroServer import ClientConnection, TicTacToeServer, create_server, enable_keepalive, stop_on_sigterm
+from CaroWal import WriteAheadLog, encode_drop, list_segments, segment_name
+from CaroShards import decode_pending, encode_pending
+from CaroTimingWheel import TimingWheel
+
+
+def decode_stream(data: bytes) -> List[Dict]:
+    """Tách các khung nối liền nhau thành tin nhắn"""
+    decoder = FrameDecoder()
+    messages = [decode_message(frame) for frame in decoder.feed(data)]
+    assert not decoder.pending(), 'khung ghi dở'
+    return messages
+
+
+class RecordingConnection:
+    """Kết nối giả: giữ lại các tin nhắn server gửi"""
+
+    def __init__(self):
+        self.codec = JSON_CODEC
+        self.outbox = Outbox()  # Chỉ để server gán snapshot_provider và đọc thống kê
+        self.handoff = None
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.last_seen = time.monotonic()
+        self.heartbeat = False
+        self.aborted = False
+        self.frames: List[bytes] = []
+        self.messages: List[Dict] = []
+
+    def sendall(self, data: bytes, collapse_key: Optional[int] = None):
+        self.frames.append(data)
+        self.messages.extend(decode_stream(data))
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        pass
+
+    def last(self, action: str) -> Optional[Dict]:
+        for message in reversed(self.messages):
+            if message['action'] == action:
+                return message
+        return None
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.quiet = contextlib.redirect_stdout(io.StringIO())
+        self.quiet.__enter__()
+        self.server = self.create_server()
+
+    def create_server(self) -> TicTacToeServer:
+        return TicTacToeServer(game_over_delay=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.quiet.__exit__(None, None, None)
+
+    def connect(self, client_id: int, features=()) -> RecordingConnection:
+        conn = RecordingConnection()
+        self.server.register_client(client_id, conn)
+        if features:
+            self.server.process_message(client_id, {'action': 'hello', 'features': list(features)}, conn)
+        return conn
+
+    def start_game(self, first: RecordingConnection, second: RecordingConnection, ids=(1, 2)) -> int:
+        """Client ids[0] tạo game, client ids[1] vào; trả về game_id"""
+        self.server.process_message(ids[0], {'action': 'create_game', 'player_name': 'A'}, first)
+        game_id = first.last('game_created')['game_id']
+        self.server.process_message(ids[1], {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}, second)
+        return game_id
+
+    def wait_for(self, conn: RecordingConnection, action: str) -> Dict:
+        """Chờ tin nhắn do thread scheduler gửi (vd. game_over)"""
+        deadline = time.monotonic() + 2
+        while conn.last(action) is None and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return conn.last(action)
+
+    def play(self, game_id: int, positions: List[int]):
+        """Hai người lần lượt đi các ô positions, bắt đầu từ người đi trước"""
+        for position in positions:
+            game = self.server.games[game_id]
+            player = game.player1 if game.current_turn == 1 else game.player2
+            self.server.process_message(player, {'action': 'move', 'game_id': game_id, 'position': position}, None)
+
+
+# Người đi trước thắng hàng ngang 0..4, người kia đi hàng thứ hai
+WINNING_MOVES = [0, 10, 1, 11, 2, 12, 3, 13, 4]
+
+
+class ThreadedEngineTest(ServerTestCase):
+    def test_game_to_win(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.play(game_id, WINNING_MOVES)
+        for conn in (first, second):
+            self.assertEqual(conn.last('board_updated')['last_move'], 4)
+            self.assertEqual(self.wait_for(conn, 'game_over')['winning_positions'], [0, 1, 2, 3, 4])
+            self.assertEqual(conn.messages[-1]['action'], 'game_over')
+
+    def test_move_rejected_outside_play(self):
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A'}, first)
+        game_id = first.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'move', 'game_id': game_id, 'position': 0}, None)
+        self.assertEqual(self.server.games[game_id].moves, 0)
+        self.server.process_message(2, {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}, second)
+        self.play(game_id, WINNING_MOVES + [50])
+        self.assertEqual(self.server.games[game_id].moves, len(WINNING_MOVES))
+
+    def test_create_server_backlog(self):
+        self.assertEqual(create_server('threaded', 'localhost', 0).backlog, 5)
+        self.assertEqual(create_server('threaded', 'localhost', 0, 64).backlog, 64)
+        server = create_server('async', 'localhost', 0)
+        self.assertIsInstance(server, AsyncCaroServer)
+        self.assertEqual(server.backlog, 4096)
+
+
+class WinCheckTest(ServerTestCase):
+    def play_stones(self, symbol: str, positions: List[int], last: int) -> Tuple[int, List[int]]:
+        """Đặt các quân trong positions, ô last đặt sau cùng; trả về kết quả kiểm tra thắng"""
+        game = Game(1, 'A', {})
+        for position in positions:
+            if position != last:
+                game.play(position, symbol)
+        return game.play(last, symbol)
+
+    def test_win_through_last_move(self):
+        # Nước đi cuối nằm giữa dãy: vị trí thắng vẫn bắt đầu từ ô nhỏ nhất
+        cases = [([40, 41, 42, 43, 44], 42), ([3, 13, 23, 33, 43], 3),
+                 ([11, 22, 33, 44, 55], 33), ([9, 18, 27, 36, 45], 27)]
+        for positions, last in cases:
+            self.assertEqual(self.play_stones('O', positions, last), (2, positions))
+
+    def test_no_wrap_across_rows(self):
+        # Cột đệm chặn dãy tràn từ cuối hàng này sang đầu hàng kế
+        self.assertEqual(self.play_stones('X', [7, 8, 9, 10, 11], 9), (0, []))
+        self.assertEqual(self.play_stones('X', [6, 15, 24, 33, 42, 51], 6)[1], [6, 15, 24, 33, 42])
+
+    def test_to_board(self):
+        game = Game(1, 'A', {})
+        game.play(9, 'X')
+        game.play(90, 'O')
+        board = game.to_board()
+        self.assertEqual((board[9], board[90], board.count('')), ('X', 'O', 98))
+        self.assertFalse(game.is_empty(9))
+        self.assertFalse(game.is_empty(100))
+
+    def test_draw_on_full_board(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        # Điền kín bàn cờ theo từng cặp cột đổi màu mỗi hàng: không có 5 quân liền
+        cells = [[p for p in range(100) if (p % 10 // 2 + p // 10) % 2 == k] for k in (0, 1)]
+        moves = [cell for pair in zip(*cells) for cell in pair]
+        self.play(game_id, moves)
+        self.assertEqual(self.wait_for(first, 'game_over')['winner'], 'draw')
+        self.assertTrue(self.server.games[game_id].is_full())
+
+
+class BoardSizeTest(ServerTestCase):
+    def start_sized_game(self, board_size: int, win_length: int) -> Tuple[int, RecordingConnection]:
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A', 'board_size': board_size,
+                                        'win_length': win_length}, first)
+        created = first.last('game_created')
+        self.assertEqual((created['board_size'], created['win_length']), (board_size, win_length))
+        self.server.process_message(2, {'action': 'join_game', 'game_id': created['game_id'],
+                                        'player_name': 'B'}, second)
+        return created['game_id'], first
+
+    def test_small_bitboard(self):
+        game_id, first = self.start_sized_game(7, 4)
+        self.assertIsNotNone(self.server.games[game_id].geometry)
+        self.play(game_id, [6, 0, 12, 1, 18, 2, 24])  # Chéo phải-trái từ góc trên phải
+        self.assertEqual(self.wait_for(first, 'game_over')['winning_positions'], [6, 12, 18, 24])
+        self.assertEqual(len(first.last('board_updated')['board']), 49)
+
+    def test_large_board_is_sparse(self):
+        game_id, first = self.start_sized_game(19, 5)
+        game = self.server.games[game_id]
+        self.assertIsNone(game.geometry)
+        # Dãy dọc sát mép dưới, nước cuối ở giữa dãy
+        self.play(game_id, [304, 0, 323, 1, 342, 2, 266, 3, 285])
+        self.assertEqual(self.wait_for(first, 'game_over')['winning_positions'], [266, 285, 304, 323, 342])
+        update = first.last('board_updated')
+        self.assertNotIn('board', update)
+        self.assertEqual(update['stones']['X' if game.first_player == 1 else 'O'], [266, 285, 304, 323, 342])
+        self.assertFalse(game.is_empty(361))
+
+    def test_unbounded_board(self):
+        game_id, first = self.start_sized_game(0, 5)
+        game = self.server.games[game_id]
+        self.play(game_id, [[-1, -1], [0, 0], [-2, -2], [0, 1], [-3, -3], [0, 2], [1000, 1000], [5, 5], [-4, -4]])
+        self.play(game_id, [[0, 0], [7, 7]])  # Ô [0, 0] đã có quân: nước đó bị bỏ qua
+        self.assertEqual((game.moves, game.status), (10, 'playing'))
+        self.play(game_id, [[-5, -5]])
+        self.assertEqual(self.wait_for(first, 'game_over')['winning_positions'],
+                         [[-5, -5], [-4, -4], [-3, -3], [-2, -2], [-1, -1]])
+        self.assertFalse(game.is_full())
+        stones = first.last('board_updated')['stones']
+        self.assertEqual(len(stones['X']) + len(stones['O']), 11)
+
+    def test_invalid_settings(self):
+        conn = self.connect(1)
+        for board_size, win_length in ((10, 2), (4, 5), (101, 5), ('10', 5)):
+            self.server.process_message(1, {'action': 'create_game', 'player_name': 'A', 'board_size': board_size,
+                                            'win_length': win_length}, conn)
+        self.assertEqual([m['action'] for m in conn.messages], ['error'] * 4)
+        self.assertEqual(self.server.games, {})
+
+
+class DeltaTest(ServerTestCase):
+    def test_delta_and_legacy_updates(self):
+        legacy, delta = self.connect(1), self.connect(2, ['delta', 'unknown'])
+        self.assertEqual(delta.last('welcome')['features'], ['delta'])
+        game_id = self.start_game(legacy, delta)
+        self.play(game_id, WINNING_MOVES)
+        updates = [m for m in delta.messages if m['action'] == 'board_updated']
+        self.assertEqual([m['seq'] for m in updates], list(range(1, len(WINNING_MOVES) + 1)))
+        self.assertNotIn('board', updates[-1])
+        self.assertEqual(updates[-1]['last_move'], 4)
+        self.assertEqual(legacy.last('board_updated')['board'][4], updates[-1]['last_symbol'])
+        self.assertNotIn('board', self.wait_for(delta, 'game_over'))
+        self.assertIn('board', self.wait_for(legacy, 'game_over'))
+        self.assertEqual(delta.last('game_over')['seq'], len(WINNING_MOVES))
+
+
+class ResyncTest(ServerTestCase):
+    def test_resync_snapshot(self):
+        first, second = self.connect(1, ['delta']), self.connect(2, ['delta'])
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0, 10])
+        self.server.process_message(1, {'action': 'resync', 'game_id': game_id}, first)
+        snapshot = first.last('board_snapshot')
+        self.assertEqual(snapshot['seq'], 2)
+        self.assertEqual(snapshot['current_turn'], self.server.games[game_id].current_turn)
+        self.assertEqual(sorted(i for i, cell in enumerate(snapshot['board']) if cell), [0, 10])
+
+    def test_resync_waiting_game_and_non_member(self):
+        first, other = self.connect(1, ['delta']), self.connect(2, ['delta'])
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A'}, first)
+        game_id = first.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'resync', 'game_id': game_id}, first)
+        self.assertEqual(first.last('board_snapshot')['seq'], 0)
+        # Không phải người chơi của game: không nhận ảnh chụp
+        self.server.process_message(2, {'action': 'resync', 'game_id': game_id}, other)
+        self.assertEqual(other.last('error')['message'], 'Game không tồn tại')
+        self.assertIsNone(other.last('board_snapshot'))
+
+    def test_resync_unknown_game(self):
+        conn = self.connect(1)
+        for game_id in (12345, [1], None):
+            self.server.process_message(1, {'action': 'resync', 'game_id': game_id}, conn)
+        self.assertEqual([m['action'] for m in conn.messages], ['error'] * 3)
+
+
+class BlockingSocket:
+    """Socket giả của một client mạng chậm: sendall chờ đến khi test mở cổng"""
+
+    def __init__(self):
+        self.sending = threading.Event()
+        self.gate = threading.Event()
+        self.data = bytearray()
+
+    def sendall(self, data: bytes):
+        self.sending.set()
+        self.gate.wait(5)
+        self.data += data
+
+    def shutdown(self, how: int):
+        self.gate.set()
+
+    def close(self):
+        self.gate.set()
+
+    def messages(self) -> List[Dict]:
+        return decode_stream(bytes(self.data))
+
+
+class FailingSocket(BlockingSocket):
+    def sendall(self, data: bytes):
+        raise ConnectionResetError
+
+
+class GameLockTest(ServerTestCase):
+    def test_slow_send_does_not_block_other_games(self):
+        first, slow_sock = self.connect(1), BlockingSocket()
+        slow = ClientConnection(slow_sock)
+        self.server.register_client(2, slow)
+        slow_game = self.start_game(first, slow)
+        self.assertTrue(slow_sock.sending.wait(5))
+        # Writer của slow đang kẹt trong sock.sendall: handler không phải chờ
+        other_game = self.start_game(self.connect(3), self.connect(4), ids=(3, 4))
+        self.play(other_game, [0, 10])
+        self.play(slow_game, [0, 10])
+        self.assertEqual((self.server.games[slow_game].seq, self.server.games[other_game].seq), (2, 2))
+        slow_sock.gate.set()
+        deadline = time.monotonic() + 2
+        while len(slow.outbox) and time.monotonic() < deadline:
+            time.sleep(0.005)
+        slow.close()
+        slow.writer.join(5)
+        self.assertEqual(slow_sock.messages()[-1]['seq'], 2)
+
+    def test_failed_send_does_not_raise(self):
+        first, broken = self.connect(1), ClientConnection(FailingSocket())
+        self.server.register_client(2, broken)
+        game_id = self.start_game(first, broken)
+        broken.writer.join(5)
+        self.play(game_id, [0, 10])
+        self.assertEqual(first.last('board_updated')['seq'], 2)
+
+
+class OutboxTest(ServerTestCase):
+    def test_collapse_keeps_order_and_latest_state(self):
+        outbox = Outbox(high_water=4)
+        outbox.snapshot_provider = lambda key: b'snapshot %d' % key
+        for data, key in ((b'a', None), (b'1', 7), (b'b', None), (b'2', 7), (b'3', 8)):
+            self.assertTrue(outbox.put(data, key))
+        self.assertEqual(len(outbox), 4)
+        self.assertEqual(outbox.collapsed, 1)
+        self.assertEqual(outbox.take(), ([b'a', b'b', b'snapshot 7', b'snapshot 8'], True))
+
+    def test_evict_when_nothing_to_collapse(self):
+        outbox = Outbox(high_water=2)
+        self.assertTrue(outbox.put(b'a') and outbox.put(b'b'))
+        self.assertFalse(outbox.put(b'c'))
+        self.assertTrue(outbox.evicted)
+        self.assertEqual(outbox.take(), ([], False))
+        self.assertFalse(outbox.put(b'd'))
+
+    def slow_client(self, client_id: int, limit: int) -> Tuple[BlockingSocket, ClientConnection]:
+        sock = BlockingSocket()
+        conn = ClientConnection(sock, limit)
+        self.server.register_client(client_id, conn)
+        return sock, conn
+
+    def test_slow_player_gets_snapshot(self):
+        first = self.connect(1)
+        sock, slow = self.slow_client(2, 4)
+        game_id = self.start_game(first, slow)
+        self.assertTrue(sock.sending.wait(5))  # Writer kẹt ở game_started
+        self.play(game_id, [0, 10, 1, 11, 2, 12])
+        self.assertLessEqual(len(slow.outbox), 4)
+        self.assertGreater(slow.outbox.collapsed, 0)
+        sock.gate.set()
+        deadline = time.monotonic() + 2
+        while len(slow.outbox) and time.monotonic() < deadline:
+            time.sleep(0.005)
+        slow.close()
+        slow.writer.join(5)
+        last = sock.messages()[-1]
+        self.assertEqual((last['action'], last['seq']), ('board_updated', 6))
+        self.assertEqual(last['board'], self.server.games[game_id].to_board())
+        self.assertEqual(self.server.outbound_stats()['collapsed_updates'], slow.outbox.collapsed)
+
+    def test_slow_consumer_evicted(self):
+        sock, slow = self.slow_client(1, 2)
+        self.server.process_message(1, {'action': 'list_games'}, slow)
+        self.assertTrue(sock.sending.wait(5))
+        for _ in range(3):
+            self.server.process_message(1, {'action': 'list_games'}, slow)
+        self.assertTrue(slow.outbox.evicted)
+        self.server.disconnect_client(1, slow)
+        self.assertEqual(self.server.outbound_stats()['slow_consumers_evicted'], 1)
+        self.assertEqual(self.server.clients, {})
+
+    def test_legacy_resync_before_first_move(self):
+        legacy = self.connect(1)
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A'}, legacy)
+        game_id = legacy.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'resync', 'game_id': game_id}, legacy)
+        snapshot = legacy.last('board_updated')
+        self.assertEqual(snapshot['seq'], 0)
+        self.assertNotIn('last_move', snapshot)
+        self.assertEqual(snapshot['board'], [''] * 100)
+        self.assertIn(game_id, self.server.games)
+
+
+class LobbyTest(ServerTestCase):
+    def create_games(self, count: int) -> List[int]:
+        game_ids = []
+        for client_id in range(1, count + 1):
+            conn = self.connect(client_id)
+            self.server.process_message(client_id, {'action': 'create_game', 'player_name': f'P{client_id}'}, conn)
+            game_ids.append(conn.last('game_created')['game_id'])
+        return game_ids
+
+    def test_pages(self):
+        game_ids = self.create_games(5)
+        conn = self.connect(100)
+        self.server.process_message(100, {'action': 'list_games', 'offset': 2, 'limit': 2}, conn)
+        page = conn.last('game_list')
+        self.assertEqual([g['game_id'] for g in page['games']], game_ids[2:4])
+        self.assertEqual((page['offset'], page['total']), (2, 5))
+        self.assertEqual(page['games'][0]['player1_name'], 'P3')
+        self.server.process_message(100, {'action': 'list_games'}, conn)
+        self.assertEqual(len(conn.last('game_list')['games']), 5)
+        self.server.process_message(100, {'action': 'list_games', 'offset': 10, 'limit': 2}, conn)
+        self.assertEqual(conn.last('game_list')['games'], [])
+        self.server.process_message(100, {'action': 'list_games', 'offset': '0'}, conn)
+        self.assertEqual(conn.last('error')['message'], 'offset/limit không hợp lệ')
+
+    def test_cache_dropped_when_lobby_changes(self):
+        game_ids = self.create_games(3)
+        lobby = self.server.lobby
+        frame = lobby.page_frame(0, 20, JSON_CODEC)
+        self.assertIs(lobby.page_frame(0, 20, JSON_CODEC), frame)
+        self.assertIsNot(lobby.page_frame(0, 20, BINARY_CODEC), frame)
+        self.assertIs(lobby.page_frame(0, 1000, JSON_CODEC), lobby.page_frame(0, 100, JSON_CODEC))
+
+        # Có người vào game 1: game rời sảnh, trang cũ không còn được dùng
+        self.server.process_message(3, {'action': 'join_game', 'game_id': game_ids[0], 'player_name': 'C'},
+                                    self.server.clients[3])
+        page = decode_message(lobby.page_frame(0, 20, JSON_CODEC)[HEADER.size:])
+        self.assertEqual([g['game_id'] for g in page['games']], game_ids[1:])
+        # Người tạo ngắt kết nối: game bị xóa khỏi sảnh
+        self.server.disconnect_client(2, self.server.clients[2])
+        self.assertEqual(lobby.page(0, 20)['games'], [lobby.entries[game_ids[2]]])
+        self.assertEqual(len(lobby), 1)
+
+
+class EvictionTest(ServerTestCase):
+    def create_server(self) -> TicTacToeServer:
+        # session_grace=0: mất kết nối là bỏ ván ngay, không giữ chỗ
+        return TicTacToeServer(game_over_delay=0, game_ttl=0.05, session_grace=0)
+
+    def wait_evicted(self, game_id: int):
+        deadline = time.monotonic() + 2
+        while game_id in self.server.games and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertNotIn(game_id, self.server.games)
+
+    def test_ids_not_reused(self):
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A'}, first)
+        self.server.process_message(2, {'action': 'create_game', 'player_name': 'B'}, second)
+        self.server.disconnect_client(1, first)
+        third = self.connect(3)
+        self.server.process_message(3, {'action': 'create_game', 'player_name': 'C'}, third)
+        self.assertEqual(third.last('game_created')['game_id'], 3)
+        self.assertEqual(self.server.games[2].player1_name, 'B')
+
+    def test_finished_game_evicted_after_ttl(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.assertEqual(self.server.client_games, {1: {game_id}, 2: {game_id}})
+        self.play(game_id, WINNING_MOVES)
+        self.assertEqual(self.server.games[game_id].status, 'finished')
+        self.wait_evicted(game_id)
+        self.assertIsNotNone(first.last('game_over'))
+        self.assertEqual(self.server.client_games, {1: set(), 2: set()})
+        self.assertEqual(self.server.games_evicted, 1)
+
+    def test_abandoned_game_evicted(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0])
+        self.server.disconnect_client(1, first)
+        self.assertEqual(self.server.games[game_id].status, 'abandoned')
+        self.assertNotIn(1, self.server.client_games)
+        self.wait_evicted(game_id)
+        self.assertEqual(self.server.client_games, {2: set()})
+
+
+class FakeRouter:
+    """ShardRouter giả: phát thay đổi sảnh thẳng cho các shard khác và ghi lại các lần chuyển kết nối"""
+
+    def __init__(self, servers: List[TicTacToeServer], shard_index: int):
+        self.servers = servers
+        self.shard_index = shard_index
+        self.handoffs: List[Tuple[Dict, int]] = []
+
+    def others(self) -> List[TicTacToeServer]:
+        return [server for index, server in enumerate(self.servers) if index != self.shard_index]
+
+    def publish_lobby_add(self, entry: Dict):
+        for server in self.others():
+            server.lobby.add(entry['game_id'], entry['player1'], entry['player1_name'])
+
+    def publish_lobby_remove(self, game_id: int):
+        for server in self.others():
+            server.lobby.remove(game_id)
+
+    def send_game_result(self, shard: int, name1: str, name2: str, score1: float):
+        self.servers[shard].record_result(name1, name2, score1)
+
+    def publish_ratings(self, entries: List[Dict]):
+        for server in self.others():
+            server.ratings.apply(entries)
+
+    def hand_off(self, state: Dict, fd: int):
+        self.handoffs.append((state, fd))
+
+
+class ScriptedSocket(BlockingSocket):
+    """Socket giả cho handle_client: recv trả lần lượt các đoạn byte cho trước"""
+
+    def __init__(self, chunks: List[bytes]):
+        super().__init__()
+        self.gate.set()
+        self.chunks = list(chunks)
+
+    def recv(self, size: int) -> bytes:
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def fileno(self) -> int:
+        return 42
+
+
+class HandoffTest(unittest.TestCase):
+    def setUp(self):
+        self.quiet = contextlib.redirect_stdout(io.StringIO())
+        self.quiet.__enter__()
+        self.shards = [self.create_shard(index) for index in range(2)]
+        for index, shard in enumerate(self.shards):
+            shard.router = FakeRouter(self.shards, index)
+
+    def create_shard(self, index: int) -> TicTacToeServer:
+        return TicTacToeServer(game_over_delay=0, shard_index=index, shard_count=2)
+
+    def tearDown(self):
+        for shard in self.shards:
+            shard.shutdown()
+        self.quiet.__exit__(None, None, None)
+
+    def create_on_shard1(self) -> Tuple[int, RecordingConnection]:
+        owner = RecordingConnection()
+        client_id = self.shards[1].next_client_id()
+        self.shards[1].register_client(client_id, owner)
+        self.shards[1].process_message(client_id, {'action': 'create_game', 'player_name': 'A'}, owner)
+        return owner.last('game_created')['game_id'], owner
+
+    def resume_on_shard1(self, state: Dict) -> RecordingConnection:
+        return self.resume_on(1, state)
+
+    def resume_on(self, index: int, state: Dict) -> RecordingConnection:
+        """Shard đích: nhận kết nối và xử lý các byte shard nguồn chuyển kèm"""
+        conn = RecordingConnection()
+        shard = self.shards[index]
+        client_id = shard.next_client_id()
+        shard.register_client(client_id, conn)
+        for frame in FrameDecoder().feed(shard.resume_handoff(client_id, conn, state)):
+            shard.process_message(client_id, decode_message(frame), conn)
+        return conn
+
+    def test_ids_carry_shard_index(self):
+        game_id, _ = self.create_on_shard1()
+        self.assertEqual(game_id % 2, 1)
+        self.assertEqual([self.shards[0].next_client_id() % 2 for _ in range(3)], [0, 0, 0])
+        # Sảnh của shard 0 cũng thấy game của shard 1
+        self.assertEqual([g['game_id'] for g in self.shards[0].lobby.page(0, 20)['games']], [game_id])
+
+    def quick_match_from_shard1(self, name: str) -> RecordingConnection:
+        """quick_match gửi tới shard 1 được chuyển sang MATCH_SHARD (shard 0) và xử lý ở đó"""
+        conn = RecordingConnection()
+        shard = self.shards[1]
+        client_id = shard.next_client_id()
+        shard.register_client(client_id, conn)
+        message = {'action': 'quick_match', 'player_name': name}
+        shard.process_message(client_id, message, conn)
+        self.assertEqual(conn.handoff, (0, message))
+        self.assertEqual((conn.messages, len(shard.matchmaker)), ([], 0))
+        return self.resume_on(0, shard.detach_client(client_id, conn, b''))
+
+    def test_quick_match_uses_one_queue_for_all_shards(self):
+        first = self.quick_match_from_shard1('A')
+        self.assertIsNotNone(first.last('match_queued'))
+        # Người chơi đang ở shard 0 ghép ngay với người đến từ shard 1
+        local = RecordingConnection()
+        client_id = self.shards[0].next_client_id()
+        self.shards[0].register_client(client_id, local)
+        self.shards[0].process_message(client_id, {'action': 'quick_match', 'player_name': 'B'}, local)
+        self.assertIsNone(local.handoff)
+        game_id = local.last('game_started')['game_id']
+        self.assertEqual(first.last('game_started')['game_id'], game_id)
+        self.assertEqual(game_id % 2, 0)
+        self.assertIn(game_id, self.shards[0].games)
+
+    def test_cancel_match_goes_to_match_shard(self):
+        conn = self.quick_match_from_shard1('A')
+        client_id = next(iter(self.shards[0].clients))
+        self.shards[0].process_message(client_id, {'action': 'cancel_match'}, conn)
+        self.assertIsNotNone(conn.last('match_cancelled'))
+        stray = RecordingConnection()
+        self.shards[1].register_client(3, stray)
+        self.shards[1].process_message(3, {'action': 'cancel_match'}, stray)
+        self.assertEqual(stray.handoff, (0, {'action': 'cancel_match'}))
+
+    def test_one_rating_book_for_all_shards(self):
+        game_id, owner = self.create_on_shard1()
+        shard = self.shards[1]
+        second = RecordingConnection()
+        client_id = shard.next_client_id()
+        shard.register_client(client_id, second)
+        shard.process_message(client_id, {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}, second)
+        game = shard.games[game_id]
+        for position in WINNING_MOVES:
+            player = game.player1 if game.current_turn == 1 else game.player2
+            shard.process_message(player, {'action': 'move', 'game_id': game_id, 'position': position}, None)
+        # Shard 0 (chủ) tính Elo, shard 1 nhận lại cùng kết quả
+        owner_book, replica = self.shards[0].ratings, shard.ratings
+        self.assertTrue(owner_book.writable)
+        self.assertFalse(replica.writable)
+        self.assertEqual(owner_book.games_rated, 1)
+        self.assertEqual(replica.top(10), owner_book.top(10))
+        self.assertEqual(len(owner_book.top(10)), 2)
+
+    def test_threaded_join_hands_off_connection(self):
+        game_id, owner = self.create_on_shard1()
+        hello = {'action': 'hello', 'features': ['delta'], 'codecs': ['binary']}
+        join = {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}
+        move = {'action': 'move', 'game_id': game_id, 'position': 5}
+        # join_game và nước đi kế tiếp (ghi dở) đến trong cùng một lần recv
+        tail = encode_message(move)
+        sock = ScriptedSocket([encode_message(hello), encode_message(join) + tail[:3]])
+        conn = ClientConnection(sock)
+        shard = self.shards[0]
+        client_id = shard.next_client_id()
+        shard.register_client(client_id, conn)
+        shard.handle_client(client_id, conn)
+
+        (state, fd), = shard.router.handoffs
+        self.assertEqual((state['shard'], state['delta'], state['codec'], fd), (1, True, 'binary', 42))
+        self.assertEqual(shard.clients, {})
+        self.assertEqual(sock.messages()[-1]['action'], 'welcome')  # Đã gửi hết trước khi chuyển
+        self.assertTrue(decode_pending(state['pending']).endswith(tail[:3]))
+
+        state['pending'] = encode_pending(decode_pending(state['pending']) + tail[3:])
+        with mock.patch('CaroServer.random.choice', return_value=2):  # Người vào game đi trước
+            player = self.resume_on_shard1(state)
+        self.assertEqual(player.codec, BINARY_CODEC)
+        self.assertIsNotNone(player.last('game_started'))
+        self.assertEqual(self.shards[1].games[game_id].status, 'playing')
+        self.assertEqual(self.shards[0].lobby.page(0, 20)['games'], [])
+        self.assertEqual(player.frames[0][HEADER.size], 0x82)  # Tiếp tục bằng codec nhị phân
+        self.assertEqual(owner.last('board_updated')['last_move'], 5)
+
+    def test_async_hand_off_keeps_buffered_bytes(self):
+        shard = AsyncCaroServer(game_over_delay=0, shard_index=0, shard_count=2)
+        shard.router = FakeRouter([shard, self.shards[1]], 0)
+        self.shards[0].shutdown()
+        self.shards[0] = shard
+        game_id, _ = self.create_on_shard1()
+        join = encode_message({'action': 'join_game', 'game_id': game_id, 'player_name': 'B'})
+        later = encode_message({'action': 'list_games'})
+
+        async def scenario():
+            shard.loop = asyncio.get_running_loop()
+            reader, writer = asyncio.StreamReader(), FakeWriter()
+
+            def arrive():
+                # Dữ liệu đến trong lúc chờ ghi hết hàng đợi gửi vẫn đi cùng kết nối
+                writer.on_drain = None
+                reader.feed_data(later)
+
+            writer.on_drain = arrive
+            reader.feed_data(join)
+            await shard.handle_connection(reader, writer)
+            return writer
+
+        writer = asyncio.run(scenario())
+        (state, fd), = shard.router.handoffs
+        self.assertEqual(fd, 42)
+        self.assertEqual(writer.transport.calls, ['pause_reading', 'abort'])
+        self.assertFalse(writer.closed)
+        self.assertEqual(shard.clients, {})
+        player = self.resume_on_shard1(state)
+        self.assertEqual([m['action'] for m in player.messages], ['game_started', 'game_list'])
+
+
+class LoadReportTest(unittest.TestCase):
+    def report(self, move_ms: List[float], moves_per_s: float) -> Dict:
+        stats = LoadStats()
+        for ms in move_ms:
+            stats.record('move', ms / 1000)
+        other = LoadStats()
+        other.counters['moves'] = int(moves_per_s * 10)
+        stats.merge(other.to_dict())
+        return summarize(stats, 10.0)
+
+    def test_percentiles(self):
+        report = self.report([float(ms) for ms in range(1, 1001)], 50)
+        move = report['latency']['move']
+        self.assertEqual((move['count'], move['p50_ms'], move['p99_ms'], move['p999_ms'], move['max_ms']),
+                         (1000, 501.0, 990.0, 999.0, 1000.0))
+        self.assertEqual(report['latency']['join']['count'], 0)
+        self.assertEqual(report['moves_per_s'], 50)
+
+    def test_compare_with_baseline(self):
+        baseline = self.report([10.0] * 100, 100)
+        self.assertEqual(compare(self.report([10.5] * 100, 95), baseline, 0.1), [])
+        regressions = compare(self.report([10.0] * 99 + [50.0], 80), baseline, 0.1)
+        self.assertEqual(regressions, ['move p999_ms: 10.00 -> 50.00', 'moves_per_s: 100 -> 80'])
+
+
+class MetricsTest(ServerTestCase):
+    def sample(self, text: str, name: str) -> float:
+        for line in text.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split()[-1])
+        self.fail(f'Không có {name}')
+
+    def test_stats_action(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0, 10, 1])
+        self.server.process_message(1, {'action': 'dance'}, first)
+        self.server.process_message(1, {'action': 'stats'}, first)
+        stats = first.last('stats')
+        self.assertEqual(stats['format'], 'prometheus')
+        text = stats['text']
+        self.assertEqual(self.sample(text, 'caro_requests_total{action="move"}'), 3)
+        self.assertEqual(self.sample(text, 'caro_requests_total{action="unknown"}'), 1)
+        self.assertEqual(self.sample(text, 'caro_request_duration_seconds_count{action="create_game"}'), 1)
+        self.assertEqual(self.sample(text, 'caro_games{status="playing"}'), 1)
+        self.assertEqual(self.sample(text, 'caro_connections'), 2)
+        self.assertGreaterEqual(self.sample(text, 'caro_game_lock_hold_seconds_count'), 4)
+
+    def test_traffic_counted_per_connection(self):
+        frames = [encode_message({'action': 'create_game', 'player_name': 'A'}), encode_message({'action': 'list_games'})]
+        sock = ScriptedSocket([b''.join(frames)])
+        conn = ClientConnection(sock)
+        self.server.register_client(1, conn)
+        self.server.handle_client(1, conn)
+        traffic = self.server.traffic_stats()
+        self.assertEqual((traffic['received_frames'], traffic['received_bytes']), (2, sum(map(len, frames))))
+        self.assertEqual(traffic['sent_frames'], 2)
+        self.assertGreater(traffic['sent_bytes'], 0)
+        self.assertEqual(self.server.clients, {})  # Kết nối đã đóng: số liệu được cộng vào tổng server
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.calls: List[str] = []
+        self.done = threading.Event()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_deadline_order_and_cancel(self):
+        now = time.monotonic()
+        self.scheduler.call_at(now + 0.03, self.calls.append, 'c')
+        self.scheduler.call_at(now + 0.01, self.calls.append, 'a')
+        self.scheduler.call_at(now + 0.01, self.calls.append, 'b')  # Cùng mốc: giữ thứ tự hẹn
+        self.scheduler.call_at(now + 0.02, self.calls.append, 'x').cancel()
+        self.scheduler.call_at(now + 0.04, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+
+    def test_earlier_timer_wakes_thread(self):
+        self.scheduler.call_later(10, self.calls.append, 'late')
+        started = time.monotonic()
+        self.scheduler.call_later(0.01, self.done.set)
+        self.assertTrue(self.done.wait(2))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.scheduler.pending(), 1)
+
+    def test_failing_callback_and_stop(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.scheduler.call_later(0, lambda: 1 / 0)
+            self.scheduler.call_later(0.01, self.done.set)
+            self.assertTrue(self.done.wait(2))
+        self.scheduler.call_later(0.01, self.calls.append, 'dropped')
+        self.scheduler.stop()
+        time.sleep(0.05)
+        self.assertEqual((self.calls, self.scheduler.pending()), ([], 0))
+
+
+class FakeTransport:
+    def __init__(self):
+        self.calls: List[str] = []
+
+    def pause_reading(self):
+        self.calls.append('pause_reading')
+
+    def set_write_buffer_limits(self, high: int):
+        pass
+
+    def abort(self):
+        self.calls.append('abort')
+
+
+class FakeSocketHandle:
+    def __init__(self):
+        self.options: Dict[Tuple[int, int], int] = {}
+
+    def fileno(self) -> int:
+        return 42
+
+    def setsockopt(self, level: int, option: int, value: int):
+        self.options[(level, option)] = value
+
+
+class FakeWriter:
+    """StreamWriter giả: giữ lại các byte server ghi ra"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+        self.transport = FakeTransport()
+        self.on_drain = None
+
+    def write(self, data: bytes):
+        self.data += data
+
+    def get_extra_info(self, name: str):
+        return {'peername': ('test', 0), 'socket': FakeSocketHandle()}.get(name)
+
+    async def drain(self):
+        if self.on_drain is not None:
+            self.on_drain()
+
+    def close(self):
+        self.closed = True
+
+    def messages(self) -> List[Dict]:
+        return decode_stream(bytes(self.data))
+
+
+class AsyncEngineTest(ServerTestCase):
+    def create_server(self) -> TicTacToeServer:
+        return AsyncCaroServer()
+
+    def test_game_over_does_not_block_loop(self):
+        async def scenario():
+            self.server.loop = asyncio.get_running_loop()
+            readers, writers, tasks = [], [], []
+            for _ in range(2):
+                reader, writer = asyncio.StreamReader(), FakeWriter()
+                readers.append(reader)
+                writers.append(writer)
+                tasks.append(asyncio.create_task(self.server.handle_connection(reader, writer)))
+
+            async def send(index: int, message: Dict):
+                readers[index].feed_data(encode_message(message))
+                await asyncio.sleep(0.01)
+
+            await send(0, {'action': 'create_game', 'player_name': 'A'})
+            game_id = writers[0].messages()[-1]['game_id']
+            await send(1, {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'})
+            for position in WINNING_MOVES:
+                turn = self.server.games[game_id].current_turn
+                await send(turn - 1, {'action': 'move', 'game_id': game_id, 'position': position})
+            # game_over đến sau board_updated cuối mà event loop vẫn chạy trong lúc chờ
+            self.assertEqual(writers[0].messages()[-1]['action'], 'board_updated')
+            await asyncio.sleep(0.4)
+            for reader in readers:
+                reader.feed_eof()
+            await asyncio.gather(*tasks)
+            return writers
+
+        writers = asyncio.run(scenario())
+        for writer in writers:
+            self.assertEqual(writer.messages()[-1]['action'], 'game_over')
+            self.assertTrue(writer.closed)
+        self.assertEqual(self.server.clients, {})
+
+
+class FramingTest(unittest.TestCase):
+    def test_split_and_coalesced_frames(self):
+        frames = [encode_message({'action': 'move', 'position': i}) for i in range(3)]
+        data = b''.join(frames)
+        decoder = FrameDecoder()
+        received = []
+        for i in range(len(data)):  # Từng byte một
+            received.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual([decode_message(f)['position'] for f in received], [0, 1, 2])
+        self.assertEqual(decoder.pending(), 0)
+        self.assertEqual(len(decoder.feed(data + frames[0][:3])), 3)  # Nhiều khung trong một lần recv
+        self.assertEqual(decoder.pending(), 3)
+
+    def test_oversized_frame(self):
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(HEADER.pack(MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ProtocolError):
+            encode_frame(b'x' * (MAX_FRAME_SIZE + 1))
+
+    def test_coalesced_messages_from_one_read(self):
+        server = AsyncCaroServer()
+        writer = FakeWriter()
+
+        async def scenario():
+            server.loop = asyncio.get_running_loop()
+            reader = asyncio.StreamReader()
+            reader.feed_data(encode_message({'action': 'create_game', 'player_name': 'A'})
+                             + encode_message({'action': 'list_games'}))
+            with contextlib.redirect_stdout(io.StringIO()):
+                task = asyncio.create_task(server.handle_connection(reader, writer))
+                await asyncio.sleep(0.01)
+                reader.feed_eof()
+                await task
+
+        asyncio.run(scenario())
+        self.assertEqual([m['action'] for m in writer.messages()], ['game_created', 'game_list'])
+
+
+
+class CodecTest(ServerTestCase):
+    MESSAGES = [
+        {'action': 'move', 'game_id': 7, 'position': 99},
+        {'action': 'board_updated', 'seq': 3, 'current_turn': 2, 'last_move': 5, 'last_symbol': 'X'},
+        {'action': 'board_updated', 'seq': 3, 'current_turn': 2, 'last_move': 5, 'last_symbol': 'O',
+         'board': ['X', 'O', ''] * 33 + ['X']},
+        {'action': 'game_over', 'seq': 9, 'winner': 'X', 'winning_positions': [0, 1, 2, 3, 4], 'winner_id': 1},
+        {'action': 'game_over', 'seq': 100, 'winner': 'draw', 'winning_positions': [], 'board': ['O'] * 100},
+        {'action': 'create_game', 'player_name': 'Người chơi'},
+        {'action': 'join_game', 'game_id': 2, 'player_name': 'B'},
+        {'action': 'list_games'},
+        {'action': 'resync', 'game_id': 4},
+        {'action': 'game_created', 'game_id': 1, 'player_symbol': 'X'},
+        {'action': 'board_snapshot', 'game_id': 1, 'board': [''] * 100, 'seq': 0, 'current_turn': 1},
+        {'action': 'list_games', 'offset': 40, 'limit': 20},
+        {'action': 'game_list', 'games': [{'game_id': 1, 'player1': 3, 'player1_name': 'A'}], 'offset': 0, 'total': 1},
+        {'action': 'error', 'message': 'Game không tồn tại'},
+    ]
+
+    def test_round_trip(self):
+        for message in self.MESSAGES:
+            frame = encode_message(message, BINARY_CODEC)
+            self.assertNotEqual(frame[HEADER.size], ord('{'), message['action'])
+            self.assertEqual(decode_message(frame[HEADER.size:]), message)
+
+    def test_fallback_to_json(self):
+        # Trường lạ hoặc giá trị không vừa định dạng nhị phân: vẫn gửi JSON
+        for message in ({'action': 'move', 'game_id': 1, 'position': 3, 'extra': 1},
+                        {'action': 'move', 'game_id': -1, 'position': 3},
+                        {'action': 'welcome', 'features': []}):
+            frame = encode_message(message, BINARY_CODEC)
+            self.assertEqual(frame[HEADER.size], ord('{'))
+            self.assertEqual(decode_message(frame[HEADER.size:]), message)
+        with self.assertRaises(ProtocolError):
+            decode_message(bytes([0x03, 0, 0]))
+
+    def test_hello_negotiates_codec(self):
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(1, {'action': 'hello', 'codecs': ['cbor', 'binary', 'json']}, first)
+        self.server.process_message(2, {'action': 'hello', 'codecs': ['cbor']}, second)
+        self.assertEqual((first.codec, second.codec), (BINARY_CODEC, JSON_CODEC))
+        # welcome luôn là JSON, sau đó mới đổi codec
+        self.assertEqual(first.frames[0][HEADER.size], ord('{'))
+        self.assertEqual(first.last('welcome')['codec'], 'binary')
+        self.assertEqual(second.last('welcome')['codec'], 'json')
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0])
+        self.assertEqual([frame[HEADER.size] for frame in first.frames[1:]], [0x81, 0x82, 0x84])
+        self.assertEqual(second.frames[-1][HEADER.size], ord('{'))
+        self.assertEqual(first.last('board_updated'), second.last('board_updated'))
+
+
+class BotSearchTest(unittest.TestCase):
+    def choose(self, stones, symbol='O', level='hard'):
+        result = choose_move(stones, symbol, 15, 5, time.monotonic() + 5, level)
+        return result['row'], result['col']
+
+    def test_takes_win(self):
+        stones = [(7, col, 'O') for col in range(3, 7)] + [(0, col, 'X') for col in range(4)] + [(5, 5, 'X')]
+        self.assertIn(self.choose(stones), [(7, 2), (7, 7)])
+
+    def test_blocks_open_four(self):
+        stones = [(col, 7, 'X') for col in range(4, 8)] + [(0, 0, 'O'), (14, 14, 'O'), (0, 14, 'O')]
+        self.assertIn(self.choose(stones), [(3, 7), (8, 7)])
+
+    def test_empty_board_plays_center(self):
+        self.assertEqual(self.choose([], 'X', 'easy'), (7, 7))
+
+
+class StalledExecutor:
+    """Pool giả: việc tìm nước không bao giờ xong (test tự gọi bot_move_ready)"""
+
+    def submit(self, *args):
+        return Future()
+
+
+class BotFailureTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        executor = StalledExecutor()
+        self.server.bot_executor = lambda: executor
+        self.conn = self.connect(1)
+        with mock.patch('CaroServer.random.choice', return_value=1):  # Người chơi đi trước
+            self.server.process_message(1, {'action': 'create_game', 'player_name': 'A', 'opponent': 'bot'},
+                                        self.conn)
+        self.game_id = self.conn.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'move', 'game_id': self.game_id, 'position': 44}, self.conn)
+
+    def assert_bot_moved(self):
+        game = self.server.games[self.game_id]
+        self.assertEqual(game.status, 'playing')
+        self.assertEqual(game.current_turn, 1)
+        self.assertEqual(game.moves, 2)
+        self.assertEqual(self.conn.last('board_updated')['seq'], 2)
+
+    def test_failed_search_plays_fallback_move(self):
+        failed = Future()
+        failed.set_exception(RuntimeError('worker died'))
+        self.server.bot_move_ready(self.game_id, 'easy', failed)
+        self.assert_bot_moved()
+
+    def test_empty_result_plays_fallback_move(self):
+        empty = Future()
+        empty.set_result({'row': None, 'col': None, 'nodes': 0, 'depth': 0, 'elapsed': 0.0})
+        self.server.bot_move_ready(self.game_id, 'easy', empty)
+        self.assert_bot_moved()
+
+    def test_rejected_move_plays_fallback_move(self):
+        self.server.play_bot_move(self.game_id, 4, 4)  # Ô người chơi vừa đánh
+        self.assert_bot_moved()
+
+
+class ShutdownTest(ServerTestCase):
+    def test_sigterm_stops_like_ctrl_c(self):
+        previous = signal.getsignal(signal.SIGTERM)
+        self.addCleanup(signal.signal, signal.SIGTERM, previous)
+        stop_on_sigterm()
+        with self.assertRaises(KeyboardInterrupt):
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(1)
+
+    def test_shutdown_stops_bot_pool(self):
+        pool = mock.Mock()
+        self.server.bot_pool = pool
+        self.server.shutdown()
+        pool.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+
+
+class OpeningBookTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'book10.bin')
+        # Thế cờ một quân X ở (2, 6) (không nằm trên trục đối xứng nào), O trả lời (2, 5)
+        key, transform = canonical_key([(2, 6, 'X')], 'O', 10)
+        perms, _ = symmetries(10)
+        write_book(self.path, {key: (perms[transform][2 * 10 + 5], 4)}, 10, 5, 1)
+
+    def test_lookup_folds_symmetry_and_colour(self):
+        book = OpeningBook(self.path)
+        self.addCleanup(book.close)
+        self.assertEqual(len(book), 1)
+        self.assertEqual(book.lookup([(2, 6, 'X')], 'O'), (2, 5))
+        self.assertEqual(book.lookup([(6, 2, 'X')], 'O'), (5, 2))  # Lật qua đường chéo
+        self.assertEqual(book.lookup([(6, 7, 'X')], 'O'), (5, 7))  # Xoay 90 độ
+        self.assertEqual(book.lookup([(2, 6, 'O')], 'X'), (2, 5))  # Đổi màu quân
+        self.assertIsNone(book.lookup([(2, 6, 'X'), (0, 0, 'O')], 'X'))  # Quá max_stones
+        self.assertIsNone(book.lookup([(1, 1, 'X')], 'O'))
+
+    def test_rejects_other_files(self):
+        path = os.path.join(self.directory, 'broken.bin')
+        with open(self.path, 'rb') as f, open(path, 'wb') as out:
+            out.write(f.read()[:-1])
+        with self.assertRaises(ValueError):
+            OpeningBook(path)
+
+    def test_bot_answers_from_book_without_search(self):
+        self.server.books = load_books([self.path])
+        executor = mock.Mock()
+        self.server.bot_executor = lambda: executor
+        conn = self.connect(1)
+        with mock.patch('CaroServer.random.choice', return_value=1):
+            self.server.process_message(1, {'action': 'create_game', 'player_name': 'A', 'opponent': 'bot'}, conn)
+        game_id = conn.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'move', 'game_id': game_id, 'position': 26}, conn)
+        self.assertEqual(self.wait_for_seq(conn, 2)['last_move'], 25)
+        executor.submit.assert_not_called()
+
+    def test_rejected_book_move_searches_again(self):
+        self.server.books = load_books([self.path])
+        executor = StalledExecutor()
+        self.server.bot_executor = lambda: executor
+        conn = self.connect(1)
+        with mock.patch('CaroServer.random.choice', return_value=1):
+            self.server.process_message(1, {'action': 'create_game', 'player_name': 'A', 'opponent': 'bot'}, conn)
+        game_id = conn.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'move', 'game_id': game_id, 'position': 44}, conn)
+        with mock.patch.object(self.server, 'request_bot_move') as request:
+            self.server.play_bot_move(game_id, 4, 4, True)  # Ô người chơi vừa đánh
+        request.assert_called_once_with(game_id, self.server.games[game_id], use_book=False)
+
+    def wait_for_seq(self, conn: RecordingConnection, seq: int) -> Optional[Dict]:
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            update = conn.last('board_updated')
+            if update is not None and update['seq'] == seq:
+                return update
+            time.sleep(0.005)
+        return None
+
+
+class WalTest(ServerTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='caro-wal-')
+        self.addCleanup(shutil.rmtree, self.directory)
+        super().setUp()
+        self.server.open_wal()
+
+    def create_server(self) -> TicTacToeServer:
+        return TicTacToeServer(game_over_delay=0, wal_dir=self.directory, durability='write')
+
+    def restart(self) -> TicTacToeServer:
+        """Tắt server hiện tại (ghi nốt nhật ký) và dựng server mới từ cùng thư mục"""
+        self.server.shutdown()
+        self.server = self.create_server()
+        self.server.open_wal()
+        return self.server
+
+    def test_restores_games_in_progress(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0, 10, 1])
+        before = self.server.games[game_id]
+        server = self.restart()
+        game = server.games[game_id]
+        self.assertEqual((game.status, game.moves, game.seq), ('playing', 3, 3))
+        self.assertEqual(game.current_turn, before.current_turn)
+        self.assertEqual([game.symbol_at(p) for p in (0, 10, 1)], [before.symbol_at(p) for p in (0, 10, 1)])
+        self.assertEqual(game.sockets, {})
+        # Id mới không trùng game / client đã có trong nhật ký
+        self.assertGreater(server.next_game_id, game_id)
+        self.assertGreaterEqual(server.client_counter, 2)
+
+    def test_drops_waiting_and_finished_games(self):
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(3, {'action': 'create_game', 'player_name': 'C'}, self.connect(3))
+        game_id = self.start_game(first, second)
+        self.play(game_id, WINNING_MOVES)
+        server = self.restart()
+        self.assertEqual(server.games, {})
+        self.assertEqual(len(server.lobby), 0)
+        # Ảnh chụp lúc khởi động không còn các game đó
+        self.assertEqual(self.restart().games, {})
+
+    def test_ignores_torn_tail(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0, 10])
+        self.server.wal.flush()
+        path = os.path.join(self.directory, segment_name(self.server.wal.segment))
+        self.play(game_id, [1])
+        self.server.wal.flush()
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 1)  # Bản ghi cuối ghi dở
+        server = self.restart()
+        self.assertEqual(server.games[game_id].moves, 2)
+        self.assertEqual(len(list_segments(self.directory)), 1)
+
+
+class SyncWalTest(unittest.TestCase):
+    def test_append_defers_fsync_to_flusher(self):
+        directory = tempfile.mkdtemp(prefix='caro-wal-')
+        self.addCleanup(shutil.rmtree, directory)
+        wal = WriteAheadLog(directory, 'sync')
+        wal.open(1)
+        self.addCleanup(wal.close)
+        path = os.path.join(directory, segment_name(1))
+        record = encode_drop(7)
+        with wal.sync_lock:  # Thread ghi đang bận: append vẫn trả về ngay, chưa ghi gì
+            wal.append(record)
+            self.assertEqual(os.path.getsize(path), 0)
+            self.assertEqual(wal.durable, 0)
+        wal.wait_committed()
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), record)
+        self.assertGreaterEqual(wal.fsyncs, 1)
+
+
+class ArchiveTest(unittest.TestCase):
+    # Giữa một ngày UTC (2023-11-14 12:00) để mọi ván nằm chung một thư mục ngày
+    NOON = 1699963200.0
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='caro-archive-')
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def archive_games(self, ended_at: Dict[int, float]) -> ArchiveReader:
+        """Ván game_id ở shard game_id % 2, A cầm X thắng B"""
+        shards = [GameArchive(self.root, shard_index) for shard_index in range(2)]
+        for game_id, timestamp in ended_at.items():
+            game = Game(0, 'A', {})
+            game.player2_name = 'B'
+            shards[game_id % 2].append(encode_game(game_id, game, 1, timestamp), timestamp)
+        for archive in shards:
+            archive.close()
+        return ArchiveReader(self.root)
+
+    def recent_ids(self, reader: ArchiveReader, limit: int) -> List[int]:
+        return [game['game_id'] for game in reader.recent_games('B', limit)]
+
+    def test_recent_games_merges_shards_of_a_day(self):
+        reader = self.archive_games({game_id: self.NOON + game_id for game_id in range(1, 7)})
+        self.assertEqual(self.recent_ids(reader, 4), [6, 5, 4, 3])
+        self.assertEqual(reader.player_totals('A'), {'wins': 6, 'losses': 0, 'draws': 0, 'abandoned': 0, 'games': 6})
+        self.assertEqual(reader.player_totals('B')['losses'], 6)
+
+    def test_same_second_orders_by_millisecond_then_game_id(self):
+        # Ván 1 kết thúc sau ván 2 trong cùng một giây; 3..6 cùng một mili giây
+        ended_at = {1: self.NOON + 0.9, 2: self.NOON + 0.1, **{game_id: self.NOON + 0.5 for game_id in range(3, 7)}}
+        reader = self.archive_games(ended_at)
+        expected = [1, 6, 5, 4, 3, 2]
+        self.assertEqual(self.recent_ids(reader, 6), expected)
+        self.assertEqual(reader.recent_games('B', 1)[0]['ended_at'], int((self.NOON + 0.9) * 1000))
+        # Đã niêm phong (chỉ mục mmap): cùng thứ tự
+        day = os.path.join(self.root, '2023-11-14')
+        for name in os.listdir(day):
+            seal(os.path.join(day, name))
+        self.assertEqual(self.recent_ids(ArchiveReader(self.root), 6), expected)
+
+    def test_replay_returns_moves_in_order(self):
+        game = Game(0, 'A', {})
+        game.player2_name = 'B'
+        for position, symbol in zip([44, 45, 54], 'XOX'):
+            game.play(position, symbol)
+        archive = GameArchive(self.root)
+        archive.append(encode_game(9, game, 0, self.NOON), self.NOON)
+        archive.close()
+        replay = ArchiveReader(self.root).game(9)
+        self.assertEqual((replay['moves'], replay['result'], replay['move_count']), ([44, 45, 54], 'draw', 3))
+        self.assertIsNone(ArchiveReader(self.root).game(10))
+
+
+class ArchiveQueryTest(ServerTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='caro-archive-')
+        self.addCleanup(shutil.rmtree, self.root)
+        super().setUp()
+
+    def create_server(self) -> TicTacToeServer:
+        return TicTacToeServer(game_over_delay=0, archive_dir=self.root)
+
+    def finish_game(self) -> int:
+        game_id = self.start_game(self.connect(1), self.connect(2))
+        self.play(game_id, WINNING_MOVES)
+        self.server.archive.flush()
+        return game_id
+
+    def test_history_stats_and_replay(self):
+        game_id = self.finish_game()
+        conn = self.connect(3)
+        self.server.process_message(3, {'action': 'game_history', 'player_name': 'A', 'limit': 5}, conn)
+        self.server.process_message(3, {'action': 'player_stats', 'player_name': 'B'}, conn)
+        self.server.process_message(3, {'action': 'replay', 'game_id': game_id}, conn)
+        self.server.process_message(3, {'action': 'game_history', 'player_name': 'A', 'limit': 0}, conn)
+        [game] = conn.last('game_history')['games']
+        self.assertEqual(game['game_id'], game_id)
+        self.assertEqual(game['move_count'], len(WINNING_MOVES))
+        self.assertEqual(conn.last('player_stats')['games'], 1)
+        self.assertEqual(conn.last('replay')['moves'], WINNING_MOVES)
+        self.assertEqual(conn.last('error')['message'], 'player_name/limit không hợp lệ')
+
+    def test_bot_without_free_cell_archived_as_loss(self):
+        conn = self.connect(1)
+        executor = StalledExecutor()
+        self.server.bot_executor = lambda: executor
+        with mock.patch('CaroServer.random.choice', return_value=1):
+            self.server.process_message(1, {'action': 'create_game', 'player_name': 'A', 'opponent': 'bot'}, conn)
+        game_id = conn.last('game_created')['game_id']
+        self.server.process_message(1, {'action': 'move', 'game_id': game_id, 'position': 44}, conn)
+        with mock.patch.object(Game, 'free_position', return_value=None):
+            self.server.play_fallback_move(game_id)
+        self.assertEqual(self.wait_for(conn, 'game_over')['winner'], 'X')
+        self.server.archive.flush()
+        self.server.process_message(1, {'action': 'player_stats', 'player_name': 'A'}, conn)
+        self.assertEqual(conn.last('player_stats')['wins'], 1)
+
+    def test_async_engine_queries_in_executor(self):
+        self.server.shutdown()
+        self.server = AsyncCaroServer(game_over_delay=0, archive_dir=self.root)
+        conn = self.connect(3)
+        threads = []
+        archive_response = self.server.archive_response
+
+        def record_thread(action, message):
+            threads.append(threading.current_thread())
+            return archive_response(action, message)
+
+        async def scenario():
+            self.server.loop = asyncio.get_running_loop()
+            game_id = self.finish_game()
+            with mock.patch.object(self.server, 'archive_response', side_effect=record_thread):
+                self.server.process_message(3, {'action': 'replay', 'game_id': game_id}, conn)
+                self.assertIsNone(conn.last('replay'))  # Chưa trả lời trên đường xử lý tin nhắn
+                for _ in range(100):
+                    if conn.last('replay') is not None:
+                        break
+                    await asyncio.sleep(0.01)
+
+        asyncio.run(scenario())
+        self.assertEqual(conn.last('replay')['moves'], WINNING_MOVES)
+        self.assertNotEqual(threads, [threading.main_thread()])
+        self.assertEqual(len(threads), 1)
+
+
+class SpectatorTest(ServerTestCase):
+    def test_spectator_follows_game(self):
+        first, second, watcher = self.connect(1), self.connect(2), self.connect(3, ['delta'])
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A'}, first)
+        game_id = first.last('game_created')['game_id']
+        self.server.process_message(3, {'action': 'spectate', 'game_id': game_id}, watcher)
+        self.assertEqual(watcher.last('spectating')['status'], 'waiting')
+        self.server.process_message(2, {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}, second)
+        started = watcher.last('game_started')
+        self.assertNotIn('player_symbol', started)
+        self.assertEqual((started['player1_name'], started['player2_name']), ('A', 'B'))
+        self.play(game_id, WINNING_MOVES)
+        self.assertEqual(watcher.last('board_updated')['seq'], len(WINNING_MOVES))
+        # Người đi trước thắng
+        self.assertEqual(self.wait_for(watcher, 'game_over')['winner'], started['first_player_symbol'])
+
+    def test_same_variant_shares_one_frame(self):
+        first, second = self.connect(1, ['delta']), self.connect(2, ['delta'])
+        watchers = [self.connect(client_id, ['delta']) for client_id in (3, 4)]
+        game_id = self.start_game(first, second)
+        for client_id, watcher in zip((3, 4), watchers):
+            self.server.process_message(client_id, {'action': 'spectate', 'game_id': game_id}, watcher)
+        sent = []
+        for conn in [first, second] + watchers:
+            conn.sendall = lambda data, collapse_key=None: sent.append(data)
+        self.play(game_id, [0])
+        self.assertEqual(len(sent), 4)
+        self.assertTrue(all(frame is sent[0] for frame in sent))
+
+    def test_spectator_resync_and_cleanup(self):
+        first, second, watcher = self.connect(1), self.connect(2), self.connect(3)
+        game_id = self.start_game(first, second)
+        self.play(game_id, [0])
+        self.server.process_message(3, {'action': 'spectate', 'game_id': game_id}, watcher)
+        self.server.process_message(3, {'action': 'resync', 'game_id': game_id}, watcher)
+        self.assertEqual(watcher.last('board_updated')['seq'], 1)
+        self.server.process_message(1, {'action': 'spectate', 'game_id': game_id}, first)
+        self.assertEqual(first.last('error')['message'], 'Bạn đang chơi game này')
+        self.server.process_message(3, {'action': 'spectate', 'game_id': 999}, watcher)
+        self.assertEqual(watcher.last('error')['message'], 'Game không tồn tại')
+        self.server.disconnect_client(3, watcher)
+        self.assertEqual(self.server.client_spectating, {})
+        self.assertEqual(self.server.games[game_id].spectators, {})
+
+
+class MatchmakerTest(ServerTestCase):
+    def ticket(self, client_id: int, rating: float, now: float = 0.0) -> Ticket:
+        return Ticket(client_id, f'P{client_id}', rating, (10, 5), None, now)
+
+    def test_pairs_within_window_and_widens_over_time(self):
+        matchmaker = Matchmaker()
+        self.assertIsNone(matchmaker.enqueue(self.ticket(1, 1200), 0.0))
+        self.assertIsNone(matchmaker.enqueue(self.ticket(2, 1600), 0.0))  # Quá xa
+        first, second = matchmaker.enqueue(self.ticket(3, 1250), 0.0)
+        self.assertEqual({first.client_id, second.client_id}, {1, 3})
+        self.assertEqual(len(matchmaker), 1)
+        self.assertEqual(matchmaker.sweep(1.0), [])
+        self.assertIsNone(matchmaker.enqueue(self.ticket(4, 1300, 1.0), 1.0))
+        # Sau vài giây cửa sổ đã nới đủ rộng cho 1300 - 1600
+        [(first, second)] = matchmaker.sweep(6.0)
+        self.assertEqual({first.client_id, second.client_id}, {2, 4})
+        self.assertEqual(len(matchmaker), 0)
+
+    def test_different_settings_never_pair(self):
+        matchmaker = Matchmaker()
+        matchmaker.enqueue(self.ticket(1, 1200), 0.0)
+        other = Ticket(2, 'P2', 1200, (15, 5), None, 0.0)
+        self.assertIsNone(matchmaker.enqueue(other, 0.0))
+        self.assertEqual(matchmaker.cancel(2), other)
+        self.assertIsNone(matchmaker.cancel(2))
+
+    def test_quick_match_starts_game_for_both(self):
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(1, {'action': 'quick_match', 'player_name': 'A'}, first)
+        self.server.process_message(1, {'action': 'quick_match', 'player_name': 'A'}, first)
+        self.assertEqual(first.last('error')['message'], 'Bạn đang chờ ghép trận')
+        self.server.process_message(2, {'action': 'quick_match', 'player_name': 'B'}, second)
+        game_id = first.last('game_started')['game_id']
+        self.assertEqual(second.last('game_started')['game_id'], game_id)
+        self.assertEqual(self.server.games[game_id].status, 'playing')
+        self.assertEqual(len(self.server.lobby), 0)
+        self.server.process_message(2, {'action': 'cancel_match'}, second)
+        self.assertEqual(second.last('error')['message'], 'Bạn không ở trong hàng đợi ghép trận')
+
+    def test_disconnect_leaves_queue(self):
+        conn = self.connect(1)
+        self.server.process_message(1, {'action': 'quick_match', 'player_name': 'A'}, conn)
+        self.server.disconnect_client(1, conn)
+        self.assertEqual(len(self.server.matchmaker), 0)
+
+
+class RatingTest(ServerTestCase):
+    def test_finished_game_updates_rank_and_leaderboard(self):
+        first, second = self.connect(1), self.connect(2)
+        game_id = self.start_game(first, second)
+        self.play(game_id, WINNING_MOVES)
+        game = self.server.games[game_id]
+        winner = game.player1_name if game.first_player == 1 else game.player2_name
+        conn = self.connect(3)
+        self.server.process_message(3, {'action': 'rank', 'player_name': winner}, conn)
+        self.server.process_message(3, {'action': 'leaderboard', 'limit': 5}, conn)
+        rank = conn.last('rank')
+        self.assertEqual((rank['rank'], rank['wins']), (1, 1))
+        self.assertGreater(rank['rating'], 1200)
+        self.assertEqual(conn.last('leaderboard')['players'][0]['player_name'], winner)
+        self.assertAlmostEqual(self.server.rating_of(winner), rank['rating'], delta=0.1)
+
+
+class RatingReplicaTest(unittest.TestCase):
+    def test_replica_matches_owner(self):
+        owner, replica = RatingBook(), RatingBook(writable=False)
+        for name1, name2, score1 in (('A', 'B', 1.0), ('B', 'C', 0.5), ('A', 'C', 0.0)):
+            owner.record_game(name1, name2, score1)
+            replica.apply(owner.entries((name1, name2)))
+        self.assertEqual(replica.top(10), owner.top(10))
+        self.assertEqual(replica.rank_of('C'), owner.rank_of('C'))
+        self.assertEqual(replica.dirty, {})
+
+    def test_replica_ignores_stale_entries(self):
+        owner, replica = RatingBook(), RatingBook(writable=False)
+        owner.record_game('A', 'B', 1.0)
+        stale = owner.entries(('A', 'B'))
+        owner.record_game('A', 'B', 1.0)
+        replica.apply(owner.entries(('A', 'B')))
+        replica.apply(stale)  # Lần phát cũ đến sau
+        self.assertEqual(replica.top(10), owner.top(10))
+
+
+class BinaryCodecTest(ServerTestCase):
+    def test_game_messages_use_binary_opcodes(self):
+        first, second = self.connect(1), self.connect(2)
+        frames = []
+        for client_id, conn in ((1, first), (2, second)):
+            self.server.process_message(client_id, {'action': 'hello', 'codecs': ['binary', 'json']}, conn)
+            sendall = conn.sendall
+            conn.sendall = lambda data, collapse_key=None, sendall=sendall: (frames.append(data), sendall(data))
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A'}, first)
+        game_id = first.last('game_created')['game_id']
+        self.server.process_message(2, {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}, second)
+        # Không rơi về JSON vì session_token
+        self.assertEqual([frame[HEADER.size] for frame in frames], [0x81, 0x82, 0x82])
+        tokens = self.server.games[game_id].tokens
+        self.assertEqual(first.last('game_created')['session_token'], tokens[0])
+        self.assertEqual(first.last('game_started')['session_token'], tokens[0])
+        self.assertEqual(second.last('game_started')['session_token'], tokens[1])
+
+
+class SessionTest(ServerTestCase):
+    def create_server(self) -> TicTacToeServer:
+        return TicTacToeServer(game_over_delay=0, session_grace=0.05)
+
+    def start(self):
+        first, second, watcher = self.connect(1), self.connect(2), self.connect(3)
+        game_id = self.start_game(first, second)
+        self.server.process_message(3, {'action': 'spectate', 'game_id': game_id}, watcher)
+        self.play(game_id, [0, 10, 1])
+        return game_id, first, second, watcher
+
+    def test_resume_sends_missed_moves_and_tells_others(self):
+        game_id, first, second, watcher = self.start()
+        token = first.last('game_started')['session_token']
+        self.server.disconnect_client(1, first)
+        self.assertEqual(second.last('player_away')['player_name'], 'A')
+        self.assertEqual(watcher.last('player_away')['player_name'], 'A')
+        again = self.connect(4)
+        self.server.process_message(4, {'action': 'resume', 'game_id': game_id, 'token': token, 'last_seq': 1}, again)
+        resumed = again.last('resumed')
+        self.assertEqual((resumed['seq'], resumed['from_seq']), (3, 1))
+        self.assertEqual(resumed['moves'], [10, 1])
+        self.assertEqual(second.last('player_back')['player_name'], 'A')
+        self.assertEqual(watcher.last('player_back')['player_name'], 'A')
+        # Người vừa quay lại chỉ nhận 'resumed'
+        self.assertEqual([m['action'] for m in again.messages], ['resumed'])
+        game = self.server.games[game_id]
+        self.assertIn(4, game.sockets)
+        self.assertEqual(game.away, {})
+
+    def test_bad_token_is_rejected(self):
+        game_id, *_ = self.start()
+        conn = self.connect(4)
+        self.server.process_message(4, {'action': 'resume', 'game_id': game_id, 'token': 'x' * 22}, conn)
+        self.assertEqual(conn.last('error')['message'], 'Mã phiên không hợp lệ')
+
+    def test_grace_expiry_forfeits(self):
+        game_id, first, second, watcher = self.start()
+        self.server.disconnect_client(1, first)
+        game_over = self.wait_for(second, 'game_over')
+        self.assertEqual(game_over['winner_id'], 2)
+        self.assertIsNone(watcher.last('player_back'))
+        self.assertEqual(self.server.games[game_id].status, 'abandoned')
+
+
+class TimingWheelTest(unittest.TestCase):
+    def test_timers_fire_on_their_tick(self):
+        wheel = TimingWheel(tick=1.0, slots=8)
+        fired = []
+        wheel.call_at(wheel.origin + 2.5, fired.append, 'a')
+        wheel.call_at(wheel.origin + 1.0, fired.append, 'b')
+        self.assertEqual(len(wheel), 2)
+        self.assertEqual(wheel.advance(wheel.origin + 1.5)[0].args, ('b',))
+        self.assertEqual(wheel.advance(wheel.origin + 2.9), [])
+        self.assertEqual([timer.args for timer in wheel.advance(wheel.origin + 3.0)], [('a',)])
+        self.assertEqual(len(wheel), 0)
+
+    def test_timer_beyond_one_revolution_waits_for_its_round(self):
+        wheel = TimingWheel(tick=1.0, slots=4)
+        wheel.call_at(wheel.origin + 6.0, print)
+        self.assertEqual(wheel.advance(wheel.origin + 2.0), [])
+        self.assertEqual(wheel.advance(wheel.origin + 5.0), [])
+        self.assertEqual(len(wheel.advance(wheel.origin + 6.0)), 1)
+
+    def test_cancelled_timer_is_skipped(self):
+        wheel = TimingWheel(tick=1.0, slots=4)
+        wheel.call_at(wheel.origin + 1.0, print).cancel()
+        self.assertEqual(wheel.advance(wheel.origin + 10.0), [])
+        self.assertEqual(len(wheel), 0)
+
+
+class HeartbeatTest(ServerTestCase):
+    def create_server(self) -> TicTacToeServer:
+        return TicTacToeServer(game_over_delay=0, ping_interval=15.0, idle_timeout=45.0)
+
+    def test_hello_enables_heartbeat(self):
+        conn = self.connect(1, ['heartbeat'])
+        self.assertTrue(conn.heartbeat)
+        self.assertEqual(conn.last('welcome')['ping_interval'], 15.0)
+        self.server.process_message(1, {'action': 'ping'}, conn)
+        self.assertIsNotNone(conn.last('pong'))
+
+    def test_each_connection_has_one_wheel_timer(self):
+        self.connect(1, ['heartbeat'])
+        self.connect(2)
+        self.assertEqual(len(self.server.wheel), 2)
+
+    def test_idle_client_is_pinged_then_reaped(self):
+        conn = self.connect(1, ['heartbeat'])
+        conn.last_seen -= 20
+        self.server.check_connection(1, conn)
+        self.assertIsNotNone(conn.last('ping'))
+        self.assertFalse(conn.aborted)
+        conn.last_seen -= 30
+        self.server.check_connection(1, conn)
+        self.assertTrue(conn.aborted)
+        self.assertEqual(self.server.idle_reaped, 1)
+
+    def test_legacy_client_is_left_to_keepalive(self):
+        conn = self.connect(1)
+        conn.last_seen -= 100
+        self.server.check_connection(1, conn)
+        self.assertFalse(conn.aborted)
+        self.assertIsNone(conn.last('ping'))
+
+    def test_keepalive_for_legacy_clients(self):
+        sock = FakeSocketHandle()
+        enable_keepalive(sock, 45.0)
+        self.assertEqual(sock.options[(socket.SOL_SOCKET, socket.SO_KEEPALIVE)], 1)
+
+    def test_disconnected_client_drops_its_timer(self):
+        conn = self.connect(1, ['heartbeat'])
+        self.server.disconnect_client(1, conn)
+        conn.last_seen -= 100
+        self.server.check_connection(1, conn)
+        self.assertFalse(conn.aborted)
+        self.assertEqual(len(self.server.wheel), 1)  # Chỉ còn mục cũ, không hẹn lại
+
+
+class ClockTest(unittest.TestCase):
+    def test_parse_time_control(self):
+        control, error = parse_time_control({'base': 300, 'increment': 2})
+        self.assertEqual((control.to_dict(), error), ({'base': 300, 'increment': 2}, None))
+        self.assertEqual(parse_time_control({'per_move': 30})[0].to_dict(), {'per_move': 30})
+        self.assertEqual(parse_time_control(None), (None, None))
+        for value in ({'per_move': 30, 'base': 60}, {'increment': 2}, {'base': 0}, {'base': True}, [300]):
+            self.assertIsNotNone(parse_time_control(value)[1])
+
+    def test_press_adds_increment_and_switches(self):
+        clock = GameClock(TimeControl(base=60, increment=2))
+        clock.start(1, 100.0)
+        self.assertEqual(clock.deadline(), 160.0)
+        self.assertTrue(clock.press(110.0))
+        self.assertEqual(clock.remaining, [52.0, 60.0])
+        self.assertEqual((clock.running, clock.deadline()), (2, 170.0))
+        self.assertEqual(clock.millis(115.0), [52000, 55000])
+        self.assertFalse(clock.press(171.0))
+
+    def test_per_move_resets(self):
+        clock = GameClock(TimeControl(per_move=30))
+        clock.start(1, 0.0)
+        clock.press(25.0)
+        self.assertEqual(clock.remaining, [30, 30])
+
+    def test_queue_keeps_one_live_entry_per_clock(self):
+        queue = ClockQueue()
+        clock = GameClock(TimeControl(base=60))
+        clock.start(1, 0.0)
+        self.assertEqual(queue.schedule(7, clock), 60.0)
+        clock.press(10.0)  # Mốc mới (70) muộn hơn mốc trong heap: không đụng tới heap
+        self.assertIsNone(queue.schedule(7, clock))
+        self.assertEqual(len(queue), 1)
+        due, wake = queue.pop_due(60.0, 60.0)
+        self.assertEqual(due, [(7, clock, 60.0)])
+        self.assertIsNone(wake)
+        clock.queued = None
+        self.assertEqual(queue.schedule(7, clock), 70.0)
+
+
+class TimedGameTest(ServerTestCase):
+    def start_timed(self, time_control: Dict):
+        first, second = self.connect(1), self.connect(2)
+        self.server.process_message(1, {'action': 'create_game', 'player_name': 'A',
+                                        'time_control': time_control}, first)
+        game_id = first.last('game_created')['game_id']
+        self.server.process_message(2, {'action': 'join_game', 'game_id': game_id, 'player_name': 'B'}, second)
+        return game_id, first, second
+
+    def test_moves_carry_clock(self):
+        game_id, first, second = self.start_timed({'base': 60, 'increment': 5})
+        self.assertEqual(first.last('game_started')['clock'], [60000, 60000])
+        game = self.server.games[game_id]
+        mover = game.current_turn
+        self.play(game_id, [0])
+        clock = second.last('board_updated')['clock']
+        self.assertGreater(clock[mover - 1], 64000)
+        self.assertEqual(clock[2 - mover], 60000)
+        self.assertEqual(len(self.server.clocks), 1)
+
+    def test_invalid_time_control_rejected(self):
+        conn = self.connect(1)
+        self.server.process_message(1, {'action': 'create_game', 'time_control': {'base': -1}}, conn)
+        self.assertIsNotNone(conn.last('error'))
+        self.assertEqual(self.server.games, {})
+
+    def test_late_move_loses_on_time(self):
+        game_id, first, second = self.start_timed({'per_move': 10})
+        game = self.server.games[game_id]
+        game.clock.started -= 11  # Hẹn giờ chưa kịp chạy
+        self.play(game_id, [0])
+        game_over = first.last('game_over')
+        self.assertEqual(game_over['reason'], 'timeout')
+        self.assertEqual(game_over['winner'], 'X' if game.current_turn == 2 else 'O')
+        self.assertIsNone(first.last('board_updated'))
+        self.assertEqual(game.status, 'finished')
+
+    def test_flag_falls_without_a_move(self):
+        game_id, first, second = self.start_timed({'per_move': 1})
+        game_over = self.wait_for(second, 'game_over')
+        self.assertEqual(game_over['reason'], 'timeout')
+        self.assertEqual(self.server.flags_fallen, 1)
+        self.assertEqual(len(self.server.clocks), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()